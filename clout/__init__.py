@@ -8,4 +8,5 @@ __version__ = "0.9-dev"
 __maintainer__ = "Jai Ram Rideout"
 __email__ = "jai.rideout@gmail.com"
 
-__all__ = ['format', 'parse', 'run', 'util']
+__all__ = ['backend', 'format', 'history', 'jobqueue', 'journal', 'logdiff',
+           'parse', 'run', 'schedule', 'supervisor', 'util']
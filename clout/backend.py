@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012-2013, The Clout Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPLv2"
+__version__ = "0.9-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+"""Module defining where and how test suites are run.
+
+An execution backend builds the shell commands that Clout runs in each phase:
+setup commands that prepare somewhere to run the test suites (e.g. start a
+cluster), a command for each test suite, and teardown commands that clean up
+afterwards. Clout runs these commands (with the same timeouts, logging, and
+email) no matter which backend built them. Backends also build the commands
+that copy the files that the test suites wrote (their artifacts) back to the
+local machine before teardown.
+"""
+
+from os.path import join
+from pipes import quote
+
+def get_artifact_patterns(options):
+    """Returns the patterns of the files to copy back for a test suite.
+
+    These are the patterns given by the test suite's artifacts option,
+    followed by those given by its junit option (JUnit XML reports are
+    copied back like any other artifact).
+
+    Arguments:
+        options - the test suite's options (see
+            clout.parse.parse_config_file())
+    """
+    return options.get('artifacts', []) + options.get('junit', [])
+
+def get_starcluster_node_aliases(cluster_size):
+    """Returns the starcluster aliases of the nodes in a cluster.
+
+    StarCluster names the first node 'master' and the remaining nodes
+    'node001', 'node002', etc.
+
+    Arguments:
+        cluster_size - the number of nodes in the cluster (including the
+            master node)
+    """
+    return ['master'] + ['node%03d' % node_num
+                         for node_num in range(1, cluster_size)]
+
+class ExecutionBackend(object):
+    """Base class for execution backends.
+
+    Subclasses must set self.node_aliases to the names of the nodes that
+    test suites can be assigned to (test suites assigned to different nodes
+    are run at the same time), and self.instance_type to a description of
+    the hardware the test suites run on (recorded in the history database),
+    and must implement build_setup_cmds(), build_test_suite_cmd(),
+    build_teardown_cmds(), and build_node_cmd(). Subclasses that run test
+    suites on instances that are billed by the hour should set
+    self.billed_instances to the number of instances, so that the email can
+    report the instance time used.
+    """
+
+    billed_instances = 0
+
+    def build_commands(self, test_suites, node_assignments=None):
+        """Builds the commands that need to be executed to run test suites.
+
+        Returns a 3-element tuple containing the list of setup command
+        strings, the list of test suite command strings (one for each test
+        suite), and the list of teardown command strings.
+
+        Arguments:
+            test_suites - the output of clout.run._expand_shards()
+            node_assignments - the node alias that each test suite will run
+                on. If None, all test suites will be run on the first node
+        """
+        if node_assignments is None:
+            node_assignments = [self.node_aliases[0]] * len(test_suites)
+
+        test_suite_cmds = [self.build_test_suite_cmd(test_suite[0],
+                                                     test_suite[1], node_alias)
+                           for test_suite, node_alias in
+                           zip(test_suites, node_assignments)]
+        return (self.build_setup_cmds(), test_suite_cmds,
+                self.build_teardown_cmds())
+
+    def build_artifacts_cmds(self, test_suites, node_assignments,
+                             artifacts_dir):
+        """Builds the commands that copy the test suites' artifacts back.
+
+        All of the artifacts on a node are copied in a single transfer: a tar
+        archive of each test suite's artifacts is written to the node's
+        standard output, the archives are gzip-compressed together as one
+        stream, and the stream is unpacked on the local machine as it
+        arrives. Each test suite's artifacts end up in a directory named
+        after its label in artifacts_dir, under the paths that they had on
+        the node (without any leading '/'). Patterns that don't match
+        anything are skipped, with a warning in the log.
+
+        Returns a list of command strings, one for each node that ran test
+        suites with artifacts, in the order that the nodes were first
+        assigned one of those test suites.
+
+        Arguments:
+            test_suites - the output of clout.run._expand_shards()
+            node_assignments - same as for build_commands()
+            artifacts_dir - the local directory to copy the artifacts to.
+                Must already exist
+        """
+        if node_assignments is None:
+            node_assignments = [self.node_aliases[0]] * len(test_suites)
+
+        node_aliases, archive_cmds = [], {}
+        for test_suite, node_alias in zip(test_suites, node_assignments):
+            patterns = get_artifact_patterns(test_suite[2])
+            if not patterns:
+                continue
+            if node_alias not in archive_cmds:
+                node_aliases.append(node_alias)
+                archive_cmds[node_alias] = []
+            archive_cmds[node_alias].append('(%s)' %
+                    self.build_artifacts_archive_cmd(test_suite[0], patterns))
+
+        artifacts_cmds = []
+        for node_alias in node_aliases:
+            node_cmd = self.build_node_cmd(node_alias, '(%s) | gzip -c' %
+                                           '; '.join(archive_cmds[node_alias]))
+            artifacts_cmds.append('%s | gzip -dc | tar xf - -i -C %s' %
+                                  (node_cmd, quote(artifacts_dir)))
+        return artifacts_cmds
+
+    def build_artifacts_archive_cmd(self, label, patterns):
+        """Returns the command that archives a test suite's artifacts.
+
+        The command is run on the test suite's node and writes an
+        uncompressed tar archive to standard output, with each file's path
+        prefixed by the test suite's label.
+
+        Arguments:
+            label - the test suite's label
+            patterns - the test suite's list of artifact glob patterns
+        """
+        # The label is used as a sed replacement inside double quotes.
+        prefix = label
+        for char in '\\&|':
+            prefix = prefix.replace(char, '\\' + char)
+        for char in '\\"$`':
+            prefix = prefix.replace(char, '\\' + char)
+
+        return ('tar cf - --ignore-failed-read --transform "s|^|%s/|" %s' %
+                (prefix, ' '.join(patterns)))
+
+    def build_node_cmd(self, node_alias, cmd):
+        """Returns a command that runs cmd on a node.
+
+        cmd must not contain single quotes.
+
+        Arguments:
+            node_alias - the node to run the command on
+            cmd - the shell command to run
+        """
+        raise NotImplementedError("Execution backends must implement "
+                                  "build_node_cmd().")
+
+    def build_setup_cmds(self):
+        """Returns the list of commands to run before any test suites."""
+        raise NotImplementedError("Execution backends must implement "
+                                  "build_setup_cmds().")
+
+    def build_test_suite_cmd(self, label, test_suite_cmd, node_alias):
+        """Returns the command that runs a test suite on a node.
+
+        Arguments:
+            label - the test suite's label
+            test_suite_cmd - the test suite's command (from the test suite
+                config file)
+            node_alias - the node to run the test suite on
+        """
+        raise NotImplementedError("Execution backends must implement "
+                                  "build_test_suite_cmd().")
+
+    def build_teardown_cmds(self):
+        """Returns the list of commands to run after the test suites."""
+        raise NotImplementedError("Execution backends must implement "
+                                  "build_teardown_cmds().")
+
+
+class StarClusterBackend(ExecutionBackend):
+    """Runs test suites on a cluster on Amazon EC2 started by StarCluster."""
+
+    def __init__(self, sc_exe_fp, sc_config_fp, cluster_tag,
+                 cluster_template=None, user='root', spot_bid=None,
+                 cluster_size=1, instance_type=None, key_location=None,
+                 ssh_config_fp=None):
+        """Initializes a new backend for a StarCluster cluster.
+
+        Arguments:
+            sc_exe_fp - same as for clout.run.run_test_suites()
+            sc_config_fp - same as for clout.run.run_test_suites()
+            cluster_tag - same as for clout.run.run_test_suites()
+            cluster_template - same as for clout.run.run_test_suites()
+            user - same as for clout.run.run_test_suites()
+            spot_bid - same as for clout.run.run_test_suites()
+            cluster_size - the number of nodes in the cluster (including the
+                master node)
+            instance_type - the EC2 instance type of the cluster's nodes, if
+                known
+            key_location - the path to the private key to log into the
+                cluster with, if known
+            ssh_config_fp - path to an SSH config file written by
+                clout.run._set_up_ssh_multiplexing(). If provided, the test
+                suites will be run using ssh directly instead of through
+                starcluster
+        """
+        self.sc_exe_fp = sc_exe_fp
+        self.sc_config_fp = sc_config_fp
+        self.cluster_tag = cluster_tag
+        self.cluster_template = cluster_template
+        self.user = user
+        self.spot_bid = spot_bid
+        self.cluster_size = cluster_size
+        self.instance_type = instance_type
+        self.key_location = key_location
+        self.ssh_config_fp = ssh_config_fp
+
+        self.node_aliases = get_starcluster_node_aliases(cluster_size)
+        self.billed_instances = cluster_size
+
+    def build_setup_cmds(self):
+        """Returns the command to start the cluster."""
+        sc_start_cmd = '%s -c %s start ' % (self.sc_exe_fp, self.sc_config_fp)
+
+        if self.cluster_template is not None:
+            sc_start_cmd += '-c %s ' % self.cluster_template
+
+        if self.spot_bid is not None:
+            sc_start_cmd += '-b %.2f --force-spot-master ' % self.spot_bid
+
+        sc_start_cmd += self.cluster_tag
+        return [sc_start_cmd]
+
+    def build_test_suite_cmd(self, label, test_suite_cmd, node_alias):
+        """Returns the command that runs a test suite on a node over ssh."""
+        return self.build_node_cmd(node_alias, test_suite_cmd)
+
+    def build_node_cmd(self, node_alias, cmd):
+        """Returns the command that runs cmd on a node over ssh."""
+        # To have the next command work without getting prompted to accept the
+        # new host, the user must have 'StrictHostKeyChecking no' in their SSH
+        # config (on the local machine). TODO: try to get starcluster devs to
+        # add this feature to sshmaster.
+        if self.ssh_config_fp is not None:
+            return 'ssh -F %s %s \'%s\'' % (self.ssh_config_fp, node_alias,
+                                            cmd)
+        elif node_alias == 'master':
+            return '%s -c %s sshmaster -u %s %s \'%s\'' % (self.sc_exe_fp,
+                    self.sc_config_fp, self.user, self.cluster_tag, cmd)
+        else:
+            return '%s -c %s sshnode -u %s %s %s \'%s\'' % (self.sc_exe_fp,
+                    self.sc_config_fp, self.user, self.cluster_tag,
+                    node_alias, cmd)
+
+    def build_teardown_cmds(self):
+        """Returns the command to terminate the cluster."""
+        # The second -c tells starcluster not to prompt us for termination
+        # confirmation.
+        return ["%s -c %s terminate -c %s" % (self.sc_exe_fp,
+                                              self.sc_config_fp,
+                                              self.cluster_tag)]
+
+
+class LocalBackend(ExecutionBackend):
+    """Runs test suites on the local machine, without starting a cluster.
+
+    Each test suite is run in its own working directory (named after the
+    test suite's label) inside work_dir, which is created during setup and
+    removed during teardown. A test suite's working directory is recreated
+    each time the test suite is run, so that a retry starts from the same
+    empty directory as the first attempt. The test suites are run by a
+    single pool of workers, so the number of test suites that run at the
+    same time is set by the max_parallel option of
+    clout.run.run_test_suites().
+    """
+
+    def __init__(self, work_dir):
+        """Initializes a new backend that runs test suites locally.
+
+        Arguments:
+            work_dir - the directory to run the test suites in. Anything
+                already in this directory will be removed
+        """
+        self.work_dir = work_dir
+        self.node_aliases = ['localhost']
+        self.instance_type = 'local'
+
+    def build_setup_cmds(self):
+        """Returns the command to create a fresh working directory."""
+        return ['rm -rf %s && mkdir -p %s' % (quote(self.work_dir),
+                                              quote(self.work_dir))]
+
+    def build_test_suite_cmd(self, label, test_suite_cmd, node_alias):
+        """Returns the command that runs a test suite in its own directory."""
+        test_suite_dir = quote(join(self.work_dir, label))
+
+        # Exiting if the directory can't be used keeps the test suite from
+        # running somewhere else, even if its command contains ';'. Removing
+        # the directory first lets the same command be rerun (e.g. when the
+        # test suite is retried).
+        return 'rm -rf %s && mkdir %s && cd %s || exit 1; %s' % (
+                test_suite_dir, test_suite_dir, test_suite_dir,
+                test_suite_cmd)
+
+    def build_artifacts_archive_cmd(self, label, patterns):
+        """Returns the command that archives a test suite's artifacts.
+
+        Relative patterns are matched in the test suite's working directory.
+        """
+        archive_cmd = super(LocalBackend, self).build_artifacts_archive_cmd(
+                label, patterns)
+        return 'cd %s && %s' % (quote(join(self.work_dir, label)),
+                                archive_cmd)
+
+    def build_node_cmd(self, node_alias, cmd):
+        """Returns cmd, since the test suites run on the local machine."""
+        return cmd
+
+    def build_teardown_cmds(self):
+        """Returns the command to remove the working directory."""
+        return ['rm -rf %s' % quote(self.work_dir)]
@@ -11,6 +11,11 @@ __email__ = "jai.rideout@gmail.com"
 
 """Module to format data structures for human consumption."""
 
+from math import ceil
+from time import localtime, strftime
+
+from clout.static import MAX_JUNIT_SLOWEST_TESTS
+
 def format_email_summary(test_suites_status):
     """Formats a string suitable for the body of an email message.
 
@@ -24,12 +29,551 @@ def format_email_summary(test_suites_status):
             element is the test suite label and the second element is the
             return value of the command that was run for the test suite. A
             non-zero return value indicates that something went wrong or the
-            test suite didn't pass
+            test suite didn't pass. An optional third element is a note that
+            will be shown in parentheses after the test suite's status
     """
     summary = ''
-    for test_suite_label, ret_val in test_suites_status:
+    for test_suite_status in test_suites_status:
+        test_suite_label, ret_val = test_suite_status[:2]
         summary += test_suite_label + ': '
-        summary += 'Pass\n' if ret_val == 0 else 'Fail\n'
+        summary += 'Pass' if ret_val == 0 else 'Fail'
+        if len(test_suite_status) > 2 and test_suite_status[2]:
+            summary += ' (%s)' % test_suite_status[2]
+        summary += '\n'
     if summary != '':
         summary += '\n'
     return summary
+
+def format_ssh_config(node_hosts, user, key_location, control_dir):
+    """Formats an SSH config file for connecting to the nodes of a cluster.
+
+    Returns a string containing a Host entry for each node, named after the
+    node's alias, so that 'ssh -F <config> master <cmd>' will work. All
+    connections to a node are multiplexed over a single master connection,
+    which avoids the cost of a full SSH handshake for every command. The
+    master connection closes itself after it has been idle for a few minutes.
+
+    Host keys are not checked or recorded because EC2 instances (and their
+    host keys) are new each time a cluster is started.
+
+    Arguments:
+        node_hosts - a list of 2-element tuples containing each node's alias
+            and public DNS name
+        user - the user to log in as
+        key_location - the path to the private key to log in with
+        control_dir - the directory to create the control sockets in. This
+            should be a short path, as unix sockets have a short path limit
+    """
+    ssh_config = ''
+    for alias, host in node_hosts:
+        ssh_config += 'Host %s\n' % alias
+        ssh_config += '    HostName %s\n' % host
+        ssh_config += '    User %s\n' % user
+        ssh_config += '    IdentityFile %s\n' % key_location
+        ssh_config += '    ControlMaster auto\n'
+        ssh_config += '    ControlPath %s/%%r@%%n\n' % control_dir
+        ssh_config += '    ControlPersist 5m\n'
+        ssh_config += '    StrictHostKeyChecking no\n'
+        ssh_config += '    UserKnownHostsFile /dev/null\n'
+        ssh_config += '    ServerAliveInterval 120\n'
+        ssh_config += '    LogLevel ERROR\n\n'
+    return ssh_config
+
+def format_warm_clusters(warm_clusters):
+    """Formats the clusters left running between runs for writing to a file.
+
+    Returns a string in the format that parse_warm_clusters() reads, with the
+    cluster tags in sorted order.
+
+    Arguments:
+        warm_clusters - a dictionary mapping cluster tags to the time (in
+            seconds since the epoch) that each cluster was last used
+    """
+    return ''.join(['%s\t%f\n' % (tag, warm_clusters[tag])
+                    for tag in sorted(warm_clusters)])
+
+def format_command_history(cmd_history):
+    """Formats recorded commands as a tab-separated table.
+
+    Returns a string containing a header line followed by one line for each
+    command.
+
+    Arguments:
+        cmd_history - the output of clout.history.get_command_history()
+    """
+    lines = ['#Start time\tPhase\tLabel\tDuration (s)\tReturn code\t'
+             'Instance type\tCluster tag']
+    for (timestamp, phase, label, duration, ret_val, instance_type,
+         cluster_tag) in cmd_history:
+        lines.append('%s\t%s\t%s\t%.2f\t%s\t%s\t%s' %
+                     (_format_timestamp(timestamp), phase, label, duration,
+                      ret_val, instance_type, cluster_tag))
+    return '\n'.join(lines) + '\n'
+
+def format_command_history_summary(cmd_history_summary):
+    """Formats a summary of recorded commands as a tab-separated table.
+
+    Returns a string containing a header line followed by one line for each
+    phase/label combination.
+
+    Arguments:
+        cmd_history_summary - the output of
+            clout.history.summarize_command_history()
+    """
+    lines = ['#Phase\tLabel\tRuns\tFailures\tMean duration (s)\t'
+             'Max duration (s)\tLast run']
+    for (phase, label, num_runs, num_failures, mean_duration, max_duration,
+         last_timestamp) in cmd_history_summary:
+        lines.append('%s\t%s\t%d\t%d\t%.2f\t%.2f\t%s' %
+                     (phase, label, num_runs, num_failures, mean_duration,
+                      max_duration, _format_timestamp(last_timestamp)))
+    return '\n'.join(lines) + '\n'
+
+def format_flaky_test_suites_summary(flaky_summary):
+    """Formats how often each test suite has been flaky as a table.
+
+    Returns a string containing a header line followed by one line for each
+    test suite that has been flaky.
+
+    Arguments:
+        flaky_summary - the output of
+            clout.history.summarize_flaky_test_suites()
+    """
+    lines = ['#Label\tFlaky runs\tRuns\tLast flaky run']
+    for label, num_flaky_runs, num_runs, last_timestamp in flaky_summary:
+        lines.append('%s\t%d\t%d\t%s' % (label, num_flaky_runs, num_runs,
+                                         _format_timestamp(last_timestamp)))
+    return '\n'.join(lines) + '\n'
+
+def format_jobs(jobs):
+    """Formats jobs in the job queue as a tab-separated table.
+
+    Returns a string containing a header line followed by one line for each
+    job. Times and values that aren't known yet are shown as '-', and each
+    message is put on a single line.
+
+    Arguments:
+        jobs - the output of clout.jobqueue.list_jobs()
+    """
+    lines = ['#Job\tProject\tStatus\tSubmitted\tStarted\tFinished\t'
+             'Cluster tag\tInstance-hours\tMessage']
+    for (job_id, project, status, submitted, started, finished, cluster_tag,
+         instance_hours, message) in jobs:
+        lines.append('%d\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s' %
+                     (job_id, project, status, _format_timestamp(submitted),
+                      '-' if started is None else _format_timestamp(started),
+                      '-' if finished is None else
+                      _format_timestamp(finished),
+                      '-' if cluster_tag is None else cluster_tag,
+                      '-' if instance_hours is None else
+                      '%.2f' % instance_hours,
+                      '-' if message is None else ' '.join(message.split())))
+    return '\n'.join(lines) + '\n'
+
+def format_schedule(ordered_test_suites, node_assignments,
+                    expected_durations, expected_makespan):
+    """Formats the planned placement of test suites on a cluster.
+
+    Returns a string suitable for the body of an email message, listing the
+    test suites that each node will run (in the order that they will be
+    started) with their expected durations, followed by the expected time it
+    will take to run all of the test suites.
+
+    Arguments:
+        ordered_test_suites - the test suites in the order that they will be
+            started (as returned by clout.schedule.schedule_test_suites())
+        node_assignments - the node alias assigned to each test suite
+        expected_durations - a dictionary mapping test suite labels to their
+            expected durations (in seconds). Test suites that aren't in the
+            dictionary are listed as having no history
+        expected_makespan - the expected number of seconds it will take to
+            run all of the test suites
+    """
+    node_plans = []
+    node_plan_lookup = {}
+    for test_suite, node_alias in zip(ordered_test_suites, node_assignments):
+        if node_alias not in node_plan_lookup:
+            node_plan_lookup[node_alias] = []
+            node_plans.append((node_alias, node_plan_lookup[node_alias]))
+
+        label = test_suite[0]
+        if label in expected_durations:
+            node_plan_lookup[node_alias].append('%s (%s)' % (label,
+                    format_duration(expected_durations[label])))
+        else:
+            node_plan_lookup[node_alias].append('%s (no history)' % label)
+
+    schedule = ('Test suite schedule (based on the durations of previous '
+                'runs):\n')
+    for node_alias, test_suite_plans in node_plans:
+        schedule += '%s: %s\n' % (node_alias, ', '.join(test_suite_plans))
+    schedule += ('Expected time to run all test suites: %s\n\n' %
+                 format_duration(expected_makespan))
+    return schedule
+
+def format_timing_table(cmd_records):
+    """Formats how long each command took to run, longest first.
+
+    Returns a string suitable for the body of an email message, listing the
+    duration of each setup, local preparation, test suite, retry, artifact
+    copying, and teardown command (commands with the same duration stay in
+    the order that they were run), followed by the time from the start of
+    the first command to the end of the last one. Returns an empty string if
+    no commands were run.
+
+    Arguments:
+        cmd_records - a list of 6-element tuples describing each command, in
+            the format expected by clout.history.record_commands()
+    """
+    if not cmd_records:
+        return ''
+
+    phase_names = {'setup': 'Cluster setup', 'teardown': 'Cluster teardown',
+                   'artifacts': 'Artifact copying',
+                   'local_prep': 'Local preparation'}
+    table = 'Time taken (longest first):\n'
+    for phase, label, cmd, start_time, end_time, ret_val in \
+            sorted(cmd_records, key=lambda record: record[3] - record[4]):
+        if phase == 'retry':
+            name = '%s (retry)' % label
+        else:
+            name = phase_names.get(phase, label)
+        table += '%s  %s\n' % (format_duration(end_time - start_time), name)
+
+    total_time = max([record[4] for record in cmd_records]) - \
+                 min([record[3] for record in cmd_records])
+    table += 'Total: %s\n\n' % format_duration(total_time)
+    return table
+
+def format_instance_time(num_instances, seconds, instance_type=None):
+    """Formats how much instance time a run used and how much is billed.
+
+    EC2 bills each instance for every hour or partial hour that it runs, so
+    the billed instance-hours are rounded up for each instance.
+
+    Arguments:
+        num_instances - the number of instances in the cluster
+        seconds - the number of seconds that the instances were used for
+        instance_type - the EC2 instance type of the instances, if known
+    """
+    instance_desc = '%d instance%s' % (num_instances,
+                                       's' if num_instances != 1 else '')
+    if instance_type is not None:
+        instance_desc += ' of type %s' % instance_type
+    billed_hours = num_instances * max(int(ceil(seconds / 3600)), 1)
+
+    return ('Instance time used by this run: %s (%s for %s), billed as %d '
+            'instance-hour%s.\n\n' % (format_duration(num_instances * seconds),
+                                      instance_desc, format_duration(seconds),
+                                      billed_hours,
+                                      's' if billed_hours != 1 else ''))
+
+def format_first_failure(label, ret_val, seconds, cancelled_labels,
+                         not_run_labels):
+    """Formats a report of the failure that stopped a fail-fast run.
+
+    Returns a string naming the test suite that failed first and when, and
+    which test suites were cancelled while running or never started as a
+    result.
+
+    Arguments:
+        label - the label of the test suite that failed first
+        ret_val - the return value of the test suite that failed first
+        seconds - the number of seconds after the first test suite started
+            that the failure happened
+        cancelled_labels - the labels of the test suites that were
+            terminated because of the failure
+        not_run_labels - the labels of the test suites that were never
+            started because of the failure
+    """
+    report = ('First failure: the %s test suite failed (return code %d) %s '
+              'after the test suites started, so the run was stopped '
+              'early.\n' % (label, ret_val, format_duration(seconds)))
+    if cancelled_labels:
+        report += 'Cancelled while running: %s\n' % ', '.join(
+                cancelled_labels)
+    if not_run_labels:
+        report += 'Not run: %s\n' % ', '.join(not_run_labels)
+    return report + '\n'
+
+def format_retry_results(flaky_test_suites, hard_failures):
+    """Formats which failed test suites passed when retried and which didn't.
+
+    Returns a string listing the test suites that failed and then passed
+    when retried (i.e. whose failures are likely flaky), followed by the
+    test suites that failed every time they were run. Returns an empty
+    string if no test suites were retried.
+
+    Arguments:
+        flaky_test_suites - a list of (test suite label, number of the retry
+            that passed) pairs
+        hard_failures - a list of (test suite label, number of times
+            retried) pairs
+    """
+    report = ''
+    if flaky_test_suites:
+        report += ('The following test suites failed and then passed when '
+                   'they were rerun on the same cluster, so their failures '
+                   'are likely flaky: %s\n\n' % ', '.join(
+                           ['%s (passed on retry %d)' % (label, retries)
+                            for label, retries in flaky_test_suites]))
+    if hard_failures:
+        report += ('The following test suites failed every time they were '
+                   'run, including when they were retried: %s\n\n' %
+                   ', '.join(['%s (retried %d time%s)' %
+                              (label, retries, 's' if retries != 1 else '')
+                              for label, retries in hard_failures]))
+    return report
+
+def format_junit_results(junit_results):
+    """Formats the test case results read from JUnit XML reports.
+
+    Returns a string listing, for each test suite, how many test cases
+    passed, failed, had errors, and were skipped, and the names of the ones
+    that failed or had errors, followed by the slowest test cases across all
+    of the test suites (the ones to speed up to shorten the run). Returns an
+    empty string if there are no results.
+
+    Arguments:
+        junit_results - the output of clout.run._summarize_junit_reports()
+    """
+    if not junit_results:
+        return ''
+
+    summary = 'Test cases (from JUnit XML reports):\n'
+    slowest_tests = []
+    for label, results in junit_results:
+        if results['num_reports']:
+            summary += ('%s: %d passed, %d failed, %d error%s, %d skipped\n'
+                        % (label, results['passed'], results['failed'],
+                           results['errors'],
+                           's' if results['errors'] != 1 else '',
+                           results['skipped']))
+        else:
+            summary += '%s: no JUnit XML reports found\n' % label
+
+        for outcome, name in results['failing_tests']:
+            summary += '    %s: %s\n' % ('Failed' if outcome == 'failed'
+                                         else 'Error', name)
+        num_unlisted = results['failed'] + results['errors'] - \
+                       len(results['failing_tests'])
+        if num_unlisted > 0:
+            summary += '    ... and %d more\n' % num_unlisted
+        for report_path in results['unreadable_reports']:
+            summary += '    Could not parse %s\n' % report_path
+
+        slowest_tests.extend([(seconds, label, name)
+                              for seconds, name in results['slowest_tests']])
+
+    # Every test suite's slowest test cases are kept, so the slowest test
+    # cases overall are among them.
+    if slowest_tests:
+        slowest_tests.sort(key=lambda test: test[0], reverse=True)
+        summary += 'Slowest test cases:\n'
+        for seconds, label, name in slowest_tests[:MAX_JUNIT_SLOWEST_TESTS]:
+            summary += '%9.2fs  %s  %s\n' % (seconds, label, name)
+    return summary + '\n'
+
+def format_new_log_lines(label, new_lines, num_new_lines):
+    """Formats the lines of a test suite's log that are new since last run.
+
+    Returns a string listing each new line with its line number, with '...'
+    between lines that weren't next to each other in the log.
+
+    Arguments:
+        label - the test suite's label
+        new_lines - the first element returned by
+            clout.logdiff.find_new_lines()
+        num_new_lines - the second element returned by
+            clout.logdiff.find_new_lines()
+    """
+    if not num_new_lines:
+        return ('The %s log has no new output since the previous run.\n\n' %
+                label)
+
+    summary = 'New output in the %s log since the previous run:\n' % label
+    prev_line_num = None
+    for line_num, line in new_lines:
+        if prev_line_num is not None and line_num != prev_line_num + 1:
+            summary += '    ...\n'
+        summary += '%6d: %s\n' % (line_num, line)
+        prev_line_num = line_num
+    if num_new_lines > len(new_lines):
+        summary += '    ... and %d more new line%s\n' % (
+                num_new_lines - len(new_lines),
+                's' if num_new_lines - len(new_lines) != 1 else '')
+    return summary + '\n'
+
+def format_artifacts_summary(labels, artifacts, artifacts_dir):
+    """Formats a summary of the artifacts copied back from the cluster.
+
+    Returns a string listing how many files (and how many bytes) were copied
+    for each test suite, and where they were saved.
+
+    Arguments:
+        labels - the labels of the test suites that have artifacts, in the
+            order that they should be listed
+        artifacts - the 'artifacts' entry returned by
+            clout.run._execute_commands_and_build_email()
+        artifacts_dir - the directory that the artifacts were saved in
+    """
+    summary = 'Artifacts (saved in %s):\n' % artifacts_dir
+    for label in labels:
+        test_suite_artifacts = artifacts.get(label, [])
+        if test_suite_artifacts:
+            summary += '%s: %d file%s (%s)\n' % (label,
+                    len(test_suite_artifacts),
+                    's' if len(test_suite_artifacts) != 1 else '',
+                    format_size(sum([size for path, size in
+                                     test_suite_artifacts])))
+        else:
+            summary += '%s: no matching files\n' % label
+    return summary + '\n'
+
+def format_prometheus_metrics(metrics):
+    """Formats a run's metrics for the Prometheus node exporter.
+
+    Returns a string in the Prometheus text exposition format, suitable for
+    a .prom file in the directory read by the node exporter's textfile
+    collector. Every sample is labelled with the run's cluster tag. Values
+    that aren't known (e.g. the duration of a phase that didn't run) are
+    left out.
+
+    Arguments:
+        metrics - a dictionary of metrics as built by
+            clout.run._build_run_metrics()
+    """
+    base_labels = [('cluster_tag', metrics['cluster_tag'])]
+    phase_samples = sorted(metrics['phases'].items())
+    test_suites = metrics['test_suites']
+
+    def test_suite_samples(key):
+        return [(base_labels + [('test_suite', test_suite['label'])],
+                 test_suite[key]) for test_suite in test_suites]
+
+    text = _format_prometheus_metric('clout_last_run_timestamp_seconds',
+            'When the last run of clout finished.',
+            [(base_labels, metrics['timestamp'])])
+    text += _format_prometheus_metric('clout_last_run_success',
+            'Whether every test suite passed without any timeouts.',
+            [(base_labels, metrics['succeeded'])])
+    text += _format_prometheus_metric('clout_phase_duration_seconds',
+            'How long each phase of the last run took.',
+            [(base_labels + [('phase', phase)], phase_metrics['duration'])
+             for phase, phase_metrics in phase_samples])
+    text += _format_prometheus_metric('clout_phase_timed_out',
+            'Whether each phase of the last run timed out.',
+            [(base_labels + [('phase', phase)], phase_metrics['timed_out'])
+             for phase, phase_metrics in phase_samples])
+    text += _format_prometheus_metric('clout_test_suite_duration_seconds',
+            'How long each test suite took to run.',
+            test_suite_samples('duration'))
+    text += _format_prometheus_metric('clout_test_suite_return_code',
+            'The return code of each test suite.',
+            test_suite_samples('return_code'))
+    text += _format_prometheus_metric('clout_test_suite_output_bytes',
+            'The size of the log of each test suite.',
+            test_suite_samples('output_bytes'))
+    text += _format_prometheus_metric('clout_test_suite_timed_out',
+            'Whether each test suite was running when the test suites timed '
+            'out.', test_suite_samples('timed_out'))
+    text += _format_prometheus_metric('clout_test_suite_cancelled',
+            'Whether each test suite was cancelled because another test '
+            'suite failed first.', test_suite_samples('cancelled'))
+    text += _format_prometheus_metric('clout_test_suite_cached',
+            'Whether each test suite was skipped because it passed before '
+            'with the same cache key.', test_suite_samples('cached'))
+    text += _format_prometheus_metric('clout_billed_instances',
+            'The number of instances billed by the hour that the test suites '
+            'ran on.',
+            [(base_labels + [('instance_type',
+                              metrics['instance_type'] or '')],
+              metrics['billed_instances'])])
+    text += _format_prometheus_metric('clout_cluster_replacements',
+            'The number of times the cluster was replaced after being lost '
+            '(e.g. to spot instance interruptions).',
+            [(base_labels, metrics['cluster_replacements'])])
+    text += _format_prometheus_metric('clout_spot_bid_dollars',
+            'The maximum spot bid per instance-hour.',
+            [(base_labels, metrics['spot_bid'])])
+    return text
+
+def format_duration(seconds):
+    """Formats a number of seconds as H:MM:SS (rounded to the second)."""
+    seconds = int(round(seconds))
+    return '%d:%02d:%02d' % (seconds // 3600, seconds % 3600 // 60,
+                             seconds % 60)
+
+def format_attachments_summary(compression_info, max_size):
+    """Formats a description of how the email's attachments were shrunk.
+
+    Returns a string reporting how much the attachments were compressed, and
+    which ones (if any) were truncated to fit within max_size.
+
+    Arguments:
+        compression_info - the second element returned by
+            clout.util.compress_attachments()
+        max_size - the maximum total size (in bytes) of the compressed
+            attachments that was passed to
+            clout.util.compress_attachments()
+    """
+    uncompressed_size = compression_info['uncompressed_size']
+    compressed_size = compression_info['compressed_size']
+    summary = ('The attached log files were compressed from %s to %s'
+               % (format_size(uncompressed_size),
+                  format_size(compressed_size)))
+    if compressed_size > 0:
+        summary += (' (%.1f times smaller)' %
+                    (uncompressed_size / compressed_size))
+    summary += '.\n\n'
+
+    if compression_info['truncated']:
+        summary += ('The following log files were too large to attach in '
+                    'full, so the middle of each one was removed to keep '
+                    'the attachments within %s: %s\n\n' %
+                    (format_size(max_size),
+                     ', '.join(compression_info['truncated'])))
+    return summary
+
+def format_size(num_bytes):
+    """Formats a number of bytes using the largest suitable unit."""
+    if num_bytes < 1024:
+        return '%d bytes' % num_bytes
+    for unit in ('KB', 'MB', 'GB'):
+        num_bytes /= 1024
+        if num_bytes < 1024 or unit == 'GB':
+            return '%.1f %s' % (num_bytes, unit)
+
+def _format_prometheus_metric(name, help_text, samples):
+    """Formats one gauge and its samples in the Prometheus text format.
+
+    Samples whose value is None are left out, as is the whole metric if none
+    of its samples have a value.
+    """
+    sample_lines = []
+    for labels, val in samples:
+        if val is None:
+            continue
+        if isinstance(val, float):
+            val_text = repr(val)
+        else:
+            val_text = '%d' % val
+        label_text = ','.join(['%s="%s"' % (label_name,
+                                            _escape_prometheus_label(
+                                                    label_val))
+                               for label_name, label_val in labels])
+        sample_lines.append('%s{%s} %s\n' % (name, label_text, val_text))
+
+    if not sample_lines:
+        return ''
+    return ('# HELP %s %s\n# TYPE %s gauge\n' % (name, help_text, name) +
+            ''.join(sample_lines))
+
+def _escape_prometheus_label(label_val):
+    """Escapes a label value for the Prometheus text format."""
+    return label_val.replace('\\', '\\\\').replace('"', '\\"').replace(
+            '\n', '\\n')
+
+def _format_timestamp(timestamp):
+    """Formats seconds since the epoch as a local date and time."""
+    return strftime('%Y-%m-%d %H:%M:%S', localtime(timestamp))
@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012-2013, The Clout Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPLv2"
+__version__ = "0.9-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+"""Module to record and query the history of commands run by Clout.
+
+Every setup, test suite, and teardown command that Clout runs is recorded in
+a SQLite database (by default, history.db in Clout's state directory) along
+with when it ran, how long it took, its return code, and the instance type
+and cluster tag that it ran with. The cache keys of test suites that passed
+are also recorded so that they can be skipped until their inputs change, as
+are the test suites that failed and then passed when they were retried
+(i.e. that are flaky).
+"""
+
+from os.path import join
+from sqlite3 import connect
+from time import time
+
+def get_history_db_fp(state_dir):
+    """Returns the filepath of the history database in the state directory."""
+    return join(state_dir, 'history.db')
+
+def open_history_db(db_fp):
+    """Opens (and creates, if necessary) a history database.
+
+    Returns a sqlite3 connection to the database.
+
+    Arguments:
+        db_fp - the path to the database file. ':memory:' may be used to
+            create a temporary in-memory database
+    """
+    conn = connect(db_fp)
+    with conn:
+        conn.execute("CREATE TABLE IF NOT EXISTS command_history ("
+                     "timestamp REAL NOT NULL, "
+                     "phase TEXT NOT NULL, "
+                     "label TEXT NOT NULL, "
+                     "command TEXT NOT NULL, "
+                     "duration REAL NOT NULL, "
+                     "ret_val INTEGER, "
+                     "instance_type TEXT, "
+                     "cluster_tag TEXT NOT NULL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS command_history_label ON "
+                     "command_history (label, timestamp)")
+        conn.execute("CREATE TABLE IF NOT EXISTS passing_cache_keys ("
+                     "label TEXT NOT NULL, "
+                     "cache_key TEXT NOT NULL, "
+                     "timestamp REAL NOT NULL, "
+                     "PRIMARY KEY (label, cache_key))")
+        conn.execute("CREATE TABLE IF NOT EXISTS flaky_test_suites ("
+                     "timestamp REAL NOT NULL, "
+                     "label TEXT NOT NULL, "
+                     "retries INTEGER NOT NULL, "
+                     "cluster_tag TEXT NOT NULL)")
+    return conn
+
+def record_commands(conn, cmd_records, cluster_tag, instance_type=None):
+    """Records commands that were run in the history database.
+
+    Arguments:
+        conn - a connection returned by open_history_db()
+        cmd_records - a list of 6-element tuples describing each command: the
+            phase ('setup', 'local_prep', 'test_suite', 'retry', 'artifacts',
+            or 'teardown'), the label (the test suite label, or the phase for
+            other commands), the command string, the start time and end time
+            (in seconds since the epoch), and the return code
+        cluster_tag - the cluster tag that the commands were run with
+        instance_type - the EC2 instance type of the cluster's nodes, if
+            known
+    """
+    with conn:
+        conn.executemany("INSERT INTO command_history (timestamp, phase, "
+                         "label, command, duration, ret_val, instance_type, "
+                         "cluster_tag) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                         [(start_time, phase, label, cmd,
+                           end_time - start_time, ret_val, instance_type,
+                           cluster_tag)
+                          for phase, label, cmd, start_time, end_time, ret_val
+                          in cmd_records])
+
+def get_command_history(conn, label=None, phase=None, cluster_tag=None,
+                        instance_type=None, limit=None):
+    """Returns recorded commands, most recent first.
+
+    Each command is returned as a 7-element tuple containing the start time
+    (in seconds since the epoch), phase, label, duration (in seconds), return
+    code, instance type, and cluster tag.
+
+    Arguments:
+        conn - a connection returned by open_history_db()
+        label - only return commands with this label
+        phase - only return commands from this phase
+        cluster_tag - only return commands run with this cluster tag
+        instance_type - only return commands run on this instance type
+        limit - the maximum number of commands to return
+    """
+    where_clause, params = _build_where_clause(label=label, phase=phase,
+            cluster_tag=cluster_tag, instance_type=instance_type)
+    query = ("SELECT timestamp, phase, label, duration, ret_val, "
+             "instance_type, cluster_tag FROM command_history%s "
+             "ORDER BY timestamp DESC" % where_clause)
+    if limit is not None:
+        query += " LIMIT ?"
+        params.append(limit)
+    return conn.execute(query, params).fetchall()
+
+def summarize_command_history(conn, phase=None, cluster_tag=None,
+                              instance_type=None):
+    """Summarizes recorded commands for each phase and label.
+
+    Returns a list of 7-element tuples containing the phase, label, number of
+    runs, number of failed runs (nonzero or missing return code), mean
+    duration, maximum duration, and the start time of the most recent run.
+    The list is sorted by mean duration, longest first.
+
+    Arguments:
+        conn - a connection returned by open_history_db()
+        phase - only summarize commands from this phase
+        cluster_tag - only summarize commands run with this cluster tag
+        instance_type - only summarize commands run on this instance type
+    """
+    where_clause, params = _build_where_clause(phase=phase,
+            cluster_tag=cluster_tag, instance_type=instance_type)
+    query = ("SELECT phase, label, COUNT(*), "
+             "SUM(CASE WHEN ret_val = 0 THEN 0 ELSE 1 END), AVG(duration), "
+             "MAX(duration), MAX(timestamp) FROM command_history%s "
+             "GROUP BY phase, label ORDER BY AVG(duration) DESC, label"
+             % where_clause)
+    return conn.execute(query, params).fetchall()
+
+def get_typical_durations(conn, labels, instance_type=None, num_runs=5):
+    """Returns how long each test suite typically takes to run.
+
+    The typical duration of a test suite is the median duration of its most
+    recent successful runs. Runs on the given instance type are preferred; if
+    a test suite has never run successfully on that instance type, its runs
+    on any instance type are used instead.
+
+    Returns a dictionary mapping test suite labels to typical durations (in
+    seconds). Test suites that have never run successfully are left out.
+
+    Arguments:
+        conn - a connection returned by open_history_db()
+        labels - the test suite labels to look up
+        instance_type - the instance type that the test suites will run on
+        num_runs - the number of most recent successful runs to consider
+    """
+    typical_durations = {}
+    for label in labels:
+        durations = []
+        for instance_type_filter in (instance_type, None):
+            where_clause, params = _build_where_clause(label=label,
+                    phase='test_suite', instance_type=instance_type_filter,
+                    ret_val=0)
+            durations = [row[0] for row in conn.execute(
+                    "SELECT duration FROM command_history%s ORDER BY "
+                    "timestamp DESC LIMIT ?" % where_clause,
+                    params + [num_runs]).fetchall()]
+            if durations:
+                break
+
+        if durations:
+            durations.sort()
+            middle = len(durations) // 2
+            if len(durations) % 2 == 1:
+                typical_durations[label] = durations[middle]
+            else:
+                typical_durations[label] = (durations[middle - 1] +
+                                            durations[middle]) / 2
+    return typical_durations
+
+def record_passing_cache_keys(conn, cache_keys):
+    """Records the cache keys of test suites that passed.
+
+    Arguments:
+        conn - a connection returned by open_history_db()
+        cache_keys - a list of (test suite label, cache key) pairs
+    """
+    now = time()
+    with conn:
+        conn.executemany("INSERT OR REPLACE INTO passing_cache_keys (label, "
+                         "cache_key, timestamp) VALUES (?, ?, ?)",
+                         [(label, cache_key, now)
+                          for label, cache_key in cache_keys])
+
+def has_passed_with_cache_key(conn, label, cache_key):
+    """Returns True if the test suite has passed with the given cache key.
+
+    Arguments:
+        conn - a connection returned by open_history_db()
+        label - the test suite label
+        cache_key - the cache key to look up
+    """
+    return conn.execute("SELECT COUNT(*) FROM passing_cache_keys WHERE "
+                        "label = ? AND cache_key = ?",
+                        (label, cache_key)).fetchone()[0] > 0
+
+def record_flaky_test_suites(conn, flaky_test_suites, cluster_tag):
+    """Records test suites that failed and then passed when retried.
+
+    Arguments:
+        conn - a connection returned by open_history_db()
+        flaky_test_suites - a list of (test suite label, number of the retry
+            that passed) pairs
+        cluster_tag - the cluster tag that the test suites were run with
+    """
+    now = time()
+    with conn:
+        conn.executemany("INSERT INTO flaky_test_suites (timestamp, label, "
+                         "retries, cluster_tag) VALUES (?, ?, ?, ?)",
+                         [(now, label, retries, cluster_tag)
+                          for label, retries in flaky_test_suites])
+
+def summarize_flaky_test_suites(conn, cluster_tag=None):
+    """Summarizes how often each test suite has been flaky.
+
+    Returns a list of 4-element tuples containing the label, the number of
+    runs in which the test suite was flaky, the total number of times that
+    the test suite has been run (not counting retries), and the time that it
+    was last flaky. The list is sorted by the number of flaky runs, most
+    first.
+
+    Arguments:
+        conn - a connection returned by open_history_db()
+        cluster_tag - only count runs with this cluster tag
+    """
+    where_clause, params = _build_where_clause(cluster_tag=cluster_tag)
+    runs_where_clause, runs_params = _build_where_clause(phase='test_suite',
+            cluster_tag=cluster_tag)
+    query = ("SELECT label, COUNT(*), (SELECT COUNT(*) FROM command_history%s "
+             "AND command_history.label = flaky_test_suites.label), "
+             "MAX(timestamp) FROM flaky_test_suites%s GROUP BY label "
+             "ORDER BY COUNT(*) DESC, label" % (runs_where_clause,
+                                                where_clause))
+    return conn.execute(query, runs_params + params).fetchall()
+
+def _build_where_clause(**filters):
+    """Returns a SQL WHERE clause and its parameters for non-None filters."""
+    conditions, params = [], []
+    for column in sorted(filters):
+        if filters[column] is not None:
+            conditions.append('%s = ?' % column)
+            params.append(filters[column])
+
+    where_clause = ''
+    if conditions:
+        where_clause = ' WHERE ' + ' AND '.join(conditions)
+    return where_clause, params
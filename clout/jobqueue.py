@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012-2013, The Clout Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPLv2"
+__version__ = "0.9-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+"""Module to queue runs of Clout for the Clout daemon.
+
+Instead of each project running Clout on its own (and starting its own
+cluster), projects can submit their test suite configuration files to a job
+queue that a single Clout daemon works through (see clout.run.serve_jobs()).
+The queue is a SQLite database (by default, queue.db in Clout's state
+directory), so jobs can be submitted from other processes while the daemon
+is running, and jobs that haven't run yet survive the daemon being
+restarted.
+
+Each job is 'queued' until a daemon claims it, 'running' while its test
+suites run, and then 'finished' once its results have been emailed, or
+'failed' if Clout couldn't run it at all (e.g. because of an error in its
+configuration file).
+"""
+
+from os.path import join
+from sqlite3 import connect
+from time import time
+
+def get_job_queue_db_fp(state_dir):
+    """Returns the filepath of the job queue database in the state dir."""
+    return join(state_dir, 'queue.db')
+
+def open_job_queue_db(db_fp):
+    """Opens (and creates, if necessary) a job queue database.
+
+    Returns a sqlite3 connection to the database. Connections can't be
+    shared between threads, so each thread must open its own.
+
+    Arguments:
+        db_fp - the path to the database file. ':memory:' may be used to
+            create a temporary in-memory database
+    """
+    conn = connect(db_fp)
+    with conn:
+        conn.execute("CREATE TABLE IF NOT EXISTS jobs ("
+                     "job_id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                     "project TEXT NOT NULL, "
+                     "config TEXT NOT NULL, "
+                     "recipients TEXT NOT NULL, "
+                     "status TEXT NOT NULL, "
+                     "submitted REAL NOT NULL, "
+                     "started REAL, "
+                     "finished REAL, "
+                     "cluster_tag TEXT, "
+                     "instance_hours REAL, "
+                     "message TEXT)")
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs "
+                     "(status, job_id)")
+    return conn
+
+def submit_job(conn, project, config, recipients):
+    """Adds a job to the end of the queue.
+
+    Returns the new job's ID.
+
+    Arguments:
+        conn - a connection returned by open_job_queue_db()
+        project - the name of the project that the job runs the test suites
+            of. Since the job's artifacts are kept in a directory named
+            after it, it must not be empty or contain '/'
+        config - the contents of the job's test suite configuration file
+            (see clout.parse.parse_config_file())
+        recipients - the contents of the job's email list file (see
+            clout.parse.parse_email_list())
+    """
+    if not project or '/' in project or project in ('.', '..'):
+        raise ValueError("Invalid project name '%s'. Project names must not "
+                         "be empty or contain '/'." % project)
+
+    with conn:
+        cursor = conn.execute("INSERT INTO jobs (project, config, "
+                              "recipients, status, submitted) VALUES "
+                              "(?, ?, ?, 'queued', ?)",
+                              (project, config, recipients, time()))
+    return cursor.lastrowid
+
+def claim_job(conn, cluster_tag):
+    """Claims the oldest queued job to run on a cluster.
+
+    The job is marked as running in a single statement, so a job is never
+    claimed twice, even by daemons in different processes.
+
+    Returns a 4-element tuple containing the job's ID, project,
+    configuration, and recipients, or None if there are no queued jobs.
+
+    Arguments:
+        conn - a connection returned by open_job_queue_db()
+        cluster_tag - the tag of the cluster that the job will run on. Only
+            one job may be running on a cluster at a time
+    """
+    with conn:
+        cursor = conn.execute("UPDATE jobs SET status = 'running', started "
+                              "= ?, cluster_tag = ? WHERE job_id = (SELECT "
+                              "job_id FROM jobs WHERE status = 'queued' "
+                              "ORDER BY job_id LIMIT 1)",
+                              (time(), cluster_tag))
+    if cursor.rowcount == 0:
+        return None
+    return conn.execute("SELECT job_id, project, config, recipients FROM "
+                        "jobs WHERE status = 'running' AND cluster_tag = ? "
+                        "ORDER BY job_id DESC LIMIT 1",
+                        (cluster_tag,)).fetchone()
+
+def finish_job(conn, job_id, succeeded, instance_hours, message=None):
+    """Records that a running job is done.
+
+    Arguments:
+        conn - a connection returned by open_job_queue_db()
+        job_id - the ID of the job
+        succeeded - True if the job's results were emailed (regardless of
+            whether its test suites passed), False if it couldn't be run
+        instance_hours - the number of instance-hours that the job used
+        message - a short description of the job's outcome (e.g. the error
+            that it failed with)
+    """
+    with conn:
+        conn.execute("UPDATE jobs SET status = ?, finished = ?, "
+                     "instance_hours = ?, message = ? WHERE job_id = ?",
+                     ('finished' if succeeded else 'failed', time(),
+                      instance_hours, message, job_id))
+
+def requeue_running_jobs(conn, cluster_tag):
+    """Puts jobs that a daemon left running back at the front of the queue.
+
+    Jobs are only left running if the daemon that was running them stopped
+    before they finished. Only the jobs claimed for the daemon's own
+    clusters (tagged cluster_tag-1, cluster_tag-2, etc.) are requeued, so
+    this can be called while other daemons (using different cluster tags)
+    are running jobs from the same queue.
+
+    Returns the number of jobs that were requeued.
+
+    Arguments:
+        conn - a connection returned by open_job_queue_db()
+        cluster_tag - the prefix of the tags of the daemon's clusters (see
+            clout.run.serve_jobs())
+    """
+    prefix = cluster_tag + '-'
+    job_ids = [job_id for job_id, job_cluster_tag in
+               conn.execute("SELECT job_id, cluster_tag FROM jobs WHERE "
+                            "status = 'running'")
+               if job_cluster_tag is not None and
+                  job_cluster_tag.startswith(prefix) and
+                  job_cluster_tag[len(prefix):].isdigit()]
+
+    num_requeued = 0
+    with conn:
+        for job_id in job_ids:
+            cursor = conn.execute("UPDATE jobs SET status = 'queued', "
+                                  "started = NULL, cluster_tag = NULL WHERE "
+                                  "job_id = ? AND status = 'running'",
+                                  (job_id,))
+            num_requeued += cursor.rowcount
+    return num_requeued
+
+def get_instance_hours_used(conn, since):
+    """Returns the instance-hours used by the jobs finished since a time.
+
+    Arguments:
+        conn - a connection returned by open_job_queue_db()
+        since - the time (in seconds since the epoch) to count from
+    """
+    return conn.execute("SELECT COALESCE(SUM(instance_hours), 0) FROM jobs "
+                        "WHERE finished >= ?", (since,)).fetchone()[0]
+
+def list_jobs(conn, status=None, limit=None):
+    """Returns the jobs in the queue, most recently submitted first.
+
+    Each job is returned as a 9-element tuple containing the job's ID,
+    project, status, submission time, start time, finish time (all in
+    seconds since the epoch, or None if the job hasn't started or finished),
+    cluster tag, instance-hours used, and message.
+
+    Arguments:
+        conn - a connection returned by open_job_queue_db()
+        status - only return jobs with this status
+        limit - the maximum number of jobs to return
+    """
+    query = ("SELECT job_id, project, status, submitted, started, finished, "
+             "cluster_tag, instance_hours, message FROM jobs")
+    params = []
+    if status is not None:
+        query += " WHERE status = ?"
+        params.append(status)
+    query += " ORDER BY job_id DESC"
+    if limit is not None:
+        query += " LIMIT ?"
+        params.append(limit)
+    return conn.execute(query, params).fetchall()
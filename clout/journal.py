@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012-2013, The Clout Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPLv2"
+__version__ = "0.9-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+"""Module to checkpoint the results of test suites in a run journal.
+
+When a run's cluster is lost partway through (e.g. because its spot
+instances were reclaimed), the test suites that had already finished don't
+need to be run again. The run journal keeps their return values and logs on
+the local machine (by default, under journals/<cluster tag> in Clout's state
+directory), so that a later run with the same cluster tag can resume from
+where the interrupted run left off.
+
+A journal is a directory containing journal.txt, which has one tab-separated
+line for each test suite that finished (the entry number, the test suite's
+label, the SHA-1 digest of its command, its return value, and when it
+started and finished), and the test suite's log, named after the entry
+number (e.g. 0.txt).
+"""
+
+from hashlib import sha1
+from os import fsync, listdir, makedirs, rename
+from os.path import exists, join
+from shutil import copyfileobj, rmtree
+from tempfile import TemporaryFile
+
+from clout.static import LOG_CHUNK_SIZE
+
+def get_journal_dir(state_dir, cluster_tag):
+    """Returns the directory of a cluster tag's journal in the state dir."""
+    return join(state_dir, 'journals', cluster_tag)
+
+def record_test_suites(journal_dir, entries):
+    """Adds test suites that finished to a journal.
+
+    Each test suite's log is copied into the journal before the test suite
+    is added to journal.txt, so a test suite is never listed without its
+    log, even if Clout is interrupted while recording it.
+
+    Arguments:
+        journal_dir - the journal's directory. Will be created if it doesn't
+            exist
+        entries - a list of 6-element tuples, one for each test suite,
+            containing the test suite's label, command, log file, return
+            value, start time, and end time (both in seconds since the
+            epoch). The log files are left positioned at their end
+    """
+    if not entries:
+        return
+    if not exists(journal_dir):
+        makedirs(journal_dir)
+
+    entry_num = len([fn for fn in listdir(journal_dir)
+                     if fn.endswith('.txt') and fn != 'journal.txt'])
+    lines = []
+    for label, cmd, log_f, ret_val, start_time, end_time in entries:
+        entry_log_fp = join(journal_dir, '%d.txt' % entry_num)
+        entry_log_f = open(entry_log_fp + '.tmp', 'wb')
+        log_f.seek(0, 0)
+        copyfileobj(log_f, entry_log_f, LOG_CHUNK_SIZE)
+        entry_log_f.close()
+        rename(entry_log_fp + '.tmp', entry_log_fp)
+
+        lines.append('%d\t%s\t%s\t%d\t%r\t%r\n' % (entry_num, label,
+                                                   sha1(cmd).hexdigest(),
+                                                   ret_val, start_time,
+                                                   end_time))
+        entry_num += 1
+
+    journal_f = open(join(journal_dir, 'journal.txt'), 'a')
+    try:
+        journal_f.write(''.join(lines))
+        journal_f.flush()
+        fsync(journal_f.fileno())
+    finally:
+        journal_f.close()
+
+def load_journal(journal_dir, test_suites):
+    """Returns the test suites in a journal that can be reused.
+
+    Only test suites whose label and command are the same as they were when
+    they were recorded are returned, so changing a test suite's command in
+    the config file causes it to be run again.
+
+    Returns a dictionary mapping the indices (into test_suites) of the test
+    suites in the journal to a 4-element tuple containing a copy of the test
+    suite's log (a TemporaryFile positioned at its beginning), its return
+    value, and when it started and finished.
+
+    Arguments:
+        journal_dir - the journal's directory
+        test_suites - the output of clout.run._expand_shards()
+    """
+    journal_fp = join(journal_dir, 'journal.txt')
+    if not exists(journal_fp):
+        return {}
+
+    cmd_indices = dict([((test_suite[0], sha1(test_suite[1]).hexdigest()),
+                         cmd_index)
+                        for cmd_index, test_suite in enumerate(test_suites)])
+    entry_nums = {}
+    journal_f = open(journal_fp, 'U')
+    try:
+        for line in journal_f:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) != 6:
+                # A line that was only partially written.
+                continue
+
+            key = (fields[1], fields[2])
+            if key in cmd_indices:
+                entry_nums[cmd_indices[key]] = (fields[0], int(fields[3]),
+                                                float(fields[4]),
+                                                float(fields[5]))
+    finally:
+        journal_f.close()
+
+    journal = {}
+    for cmd_index, (entry_num, ret_val, start_time, end_time) in \
+            entry_nums.items():
+        log_f = TemporaryFile(prefix='clout_log', suffix='.txt')
+        entry_log_f = open(join(journal_dir, '%s.txt' % entry_num), 'rb')
+        try:
+            copyfileobj(entry_log_f, log_f, LOG_CHUNK_SIZE)
+        finally:
+            entry_log_f.close()
+        log_f.seek(0, 0)
+        journal[cmd_index] = (log_f, ret_val, start_time, end_time)
+    return journal
+
+def remove_journal(journal_dir):
+    """Removes a journal, if it exists."""
+    rmtree(journal_dir, ignore_errors=True)
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012-2013, The Clout Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPLv2"
+__version__ = "0.9-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+"""Module to compare test suite logs with the logs of the previous run.
+
+Most of a test suite's log is usually the same from one run to the next, so
+instead of attaching every log to the email, Clout can report only the lines
+that are new since the previous run. The logs of the latest run are kept on
+the local machine (by default, under logs/<cluster tag> in Clout's state
+directory), one file per test suite, named after the log's attachment (e.g.
+QIIME_results.txt).
+
+Lines are compared after replacing the parts that change from run to run
+(dates and times, durations, temporary paths, and memory addresses) with
+placeholders, so that those changes alone don't make a line new.
+"""
+
+from os import makedirs, rename
+from os.path import exists, join
+from re import compile
+from shutil import copyfileobj
+
+from clout.static import LOG_CHUNK_SIZE, MAX_NEW_LOG_LINES
+
+# Applied in order, so that e.g. a timestamp isn't mistaken for a time of day.
+VOLATILE_PATTERNS = [
+    (compile(r'\d{4}-\d\d-\d\d[T ]\d\d:\d\d(:\d\d([.,]\d+)?)?'
+             r'(Z|[+-]\d\d:?\d\d)?'), '<timestamp>'),
+    (compile(r'\b\d{4}-\d\d-\d\d\b'), '<date>'),
+    (compile(r'\b\d\d?:\d\d:\d\d([.,]\d+)?\b'), '<time>'),
+    (compile(r'\b\d+(\.\d+)?\s?(ms|s|sec|secs|seconds|min|mins|minutes)\b'),
+     '<duration>'),
+    (compile(r'(/tmp|/var/tmp|/var/folders)/[^\s\'":,;)]+'), '<tmp path>'),
+    (compile(r'0x[0-9a-fA-F]+'), '<address>')
+]
+
+def get_log_archive_dir(state_dir, cluster_tag):
+    """Returns the directory of a cluster tag's logs in the state dir."""
+    return join(state_dir, 'logs', cluster_tag)
+
+def get_archived_log_fp(archive_dir, attachment_name):
+    """Returns the path that a log is archived at.
+
+    Arguments:
+        archive_dir - the directory that the logs are archived in
+        attachment_name - the name that the log is attached to the email
+            with (e.g. 'QIIME_results.txt')
+    """
+    return join(archive_dir, attachment_name.replace('/', '_'))
+
+def normalize_log_line(line):
+    """Returns a log line with its volatile parts replaced by placeholders.
+
+    Arguments:
+        line - the line to normalize (without its trailing newline)
+    """
+    for pattern, placeholder in VOLATILE_PATTERNS:
+        line = pattern.sub(placeholder, line)
+    return line
+
+def find_new_lines(previous_log_f, log_f, max_lines=MAX_NEW_LOG_LINES):
+    """Finds the lines in a log that weren't in the previous run's log.
+
+    A line is new if no line in the previous log is the same once both have
+    been normalized (see normalize_log_line()), regardless of where it was in
+    the previous log. Both logs are read a line at a time, and only a hash of
+    each of the previous log's normalized lines is kept in memory.
+
+    Returns a 2-element tuple containing a list of (line number, line)
+    pairs for the first max_lines new lines (line numbers start at 1, and
+    the lines don't have their trailing newline) and the total number of new
+    lines.
+
+    Arguments:
+        previous_log_f - the previous run's log
+        log_f - the current run's log. It is read from its current position
+        max_lines - the number of new lines to return
+    """
+    previous_lines = set(hash(normalize_log_line(line.rstrip('\r\n')))
+                         for line in previous_log_f)
+
+    new_lines, num_new_lines = [], 0
+    for line_num, line in enumerate(log_f):
+        line = line.rstrip('\r\n')
+        if hash(normalize_log_line(line)) not in previous_lines:
+            num_new_lines += 1
+            if len(new_lines) < max_lines:
+                new_lines.append((line_num + 1, line))
+    return new_lines, num_new_lines
+
+def archive_logs(archive_dir, logs):
+    """Saves logs in the archive, replacing the ones from the previous run.
+
+    Each log is written under a temporary name and then renamed, so an
+    archived log is never left half-written.
+
+    Arguments:
+        archive_dir - the directory to archive the logs in. Will be created
+            if it doesn't exist
+        logs - a list of (attachment name, log file) pairs. The log files are
+            left positioned at their beginning
+    """
+    if not exists(archive_dir):
+        makedirs(archive_dir)
+
+    for attachment_name, log_f in logs:
+        archived_log_fp = get_archived_log_fp(archive_dir, attachment_name)
+        archived_log_f = open(archived_log_fp + '.tmp', 'wb')
+        log_f.seek(0, 0)
+        copyfileobj(log_f, archived_log_f, LOG_CHUNK_SIZE)
+        archived_log_f.close()
+        log_f.seek(0, 0)
+        rename(archived_log_fp + '.tmp', archived_log_fp)
@@ -11,12 +11,47 @@ __email__ = "jai.rideout@gmail.com"
 
 """Module to parse various supported file formats."""
 
+from ConfigParser import Error as ConfigParserError, RawConfigParser
+from heapq import heappush, heappushpop
+from os.path import expanduser
+from xml.etree.cElementTree import iterparse
+
+from clout.static import MAX_JUNIT_FAILING_TESTS, MAX_JUNIT_SLOWEST_TESTS
+
 def parse_config_file(config_f):
     """Parses and validates a configuration file describing test suites.
 
     Returns a list of lists containing the test suite label as the first
-    element and the command string needed to execute the test suite as the
-    second element.
+    element, the command string needed to execute the test suite as the
+    second element, and a dictionary of test suite options as the third
+    element.
+
+    Test suite options are optional extra tab-separated fields following the
+    command, each in the form option=value. The supported options are:
+        shards - the number of pieces to split the test suite into (a
+            positive integer, default 1). See clout.run._expand_shards()
+        fingerprint - a command that is run on the local machine and whose
+            output identifies the inputs of the test suite (e.g. 'git
+            ls-remote <repository> HEAD'). If the test suite has already
+            passed with the same command and fingerprint output, it isn't run
+            again. See clout.run._get_cache_keys()
+        artifacts - one or more space-separated glob patterns (e.g.
+            'coverage.xml test-results/*.xml') matching files that the test
+            suite writes and that should be copied back from the node it ran
+            on before the cluster is terminated. Relative patterns are
+            relative to the directory that the test suite's command starts
+            in. The patterns are stored as a list. See
+            clout.backend.ExecutionBackend.build_artifacts_cmds()
+        junit - one or more space-separated glob patterns matching JUnit XML
+            reports that the test suite writes. They are copied back like
+            artifacts (and so are relative to the same directory), and the
+            number of passing, failing, erroring, and skipped test cases,
+            the names of the ones that failed, and the slowest ones are
+            reported for the test suite. See parse_junit_xml()
+        retries - the number of times to rerun the test suite on the same
+            cluster if it fails (a non-negative integer), overriding the
+            retries option of clout.run.run_test_suites(). See
+            clout.run._retry_failed_test_suites()
 
     Arguments:
         config_f - the input configuration file describing test suites
@@ -26,14 +61,15 @@ def parse_config_file(config_f):
     for line in config_f:
         if not _can_ignore(line):
             fields = line.strip().split('\t')
-            if len(fields) != 2:
+            if len(fields) < 2:
                 raise ValueError("Each line in the config file must contain "
-                                 "exactly two fields separated by tabs.")
+                                 "at least two fields separated by tabs.")
             if fields[0] in used_test_suite_names:
                 raise ValueError("The test suite label '%s' has already been "
                                  "used. Each test suite label must be unique."
                                  % fields[0])
-            results.append(fields)
+            options = _parse_test_suite_options(fields[0], fields[2:])
+            results.append([fields[0], fields[1], options])
             used_test_suite_names.append(fields[0])
     if len(results) == 0:
         raise ValueError("The config file must contain at least one test "
@@ -63,13 +99,16 @@ def parse_email_settings(email_settings_f):
     """Parses and validates a file containing email SMTP settings.
 
     Returns a dictionary with the key/value pairs 'smtp_server', 'smtp_port',
-    'sender', and 'password' defined.
+    'sender', 'password', and 'insecure_smtp' defined. insecure_smtp is True
+    only if the file sets it to 'true', which lets the email be sent to an
+    SMTP server that doesn't support STARTTLS (e.g. a local test server).
 
     Arguments:
         email_settings_f - the input file containing tab-separated email
             settings
     """
     required_fields = ['smtp_server', 'smtp_port', 'sender', 'password']
+    optional_fields = ['insecure_smtp']
     settings = {}
     for line in email_settings_f:
         if not _can_ignore(line):
@@ -79,16 +118,291 @@ def parse_email_settings(email_settings_f):
                 raise ValueError("The line '%s' in the email settings file "
                                  "must have exactly two fields separated by a "
                                  "tab." % line)
-            if setting not in required_fields:
+            if setting not in required_fields + optional_fields:
                 raise ValueError("Unrecognized setting '%s' in email settings "
                                  "file. Valid settings are %r." % (setting,
-                                 required_fields))
+                                 required_fields + optional_fields))
             settings[setting] = val
-    if len(settings) != 4:
+    if not all([field in settings for field in required_fields]):
         raise ValueError("The email settings file does not contain one or "
                 "more of the following required fields: %r" % required_fields)
+
+    insecure_smtp = settings.get('insecure_smtp', 'false')
+    if insecure_smtp not in ('true', 'false'):
+        raise ValueError("The insecure_smtp setting in the email settings "
+                         "file must be 'true' or 'false', not '%s'." %
+                         insecure_smtp)
+    settings['insecure_smtp'] = insecure_smtp == 'true'
     return settings
 
+def parse_starcluster_config(sc_config_f, cluster_template=None):
+    """Parses the settings Clout needs from a StarCluster config file.
+
+    Returns a dictionary with the following keys defined:
+        cluster_size - the number of nodes (including the master node) that
+            the cluster template will start (an int)
+        key_location - the path to the private key that is used to log into
+            the cluster's nodes, or None if the cluster template's key does
+            not define a KEY_LOCATION
+        node_instance_type - the EC2 instance type of the cluster's nodes, or
+            None if the cluster template doesn't define NODE_INSTANCE_TYPE
+
+    Arguments:
+        sc_config_f - the input StarCluster config file
+        cluster_template - the cluster template to look up. If None, the
+            DEFAULT_TEMPLATE defined in the [global] section will be used
+    """
+    config = RawConfigParser()
+    try:
+        config.readfp(sc_config_f)
+    except ConfigParserError, e:
+        raise ValueError("Could not parse the StarCluster config file: %s" % e)
+
+    if cluster_template is None:
+        if not config.has_option('global', 'default_template'):
+            raise ValueError("A cluster template was not provided and the "
+                             "StarCluster config file does not define a "
+                             "DEFAULT_TEMPLATE in its [global] section.")
+        cluster_template = config.get('global', 'default_template')
+
+    template_settings = _get_cluster_template_settings(config,
+                                                       cluster_template, [])
+
+    try:
+        cluster_size = int(template_settings.get('cluster_size', 1))
+    except ValueError:
+        raise ValueError("The CLUSTER_SIZE of cluster template '%s' must be "
+                         "an integer." % cluster_template)
+    if cluster_size < 1:
+        raise ValueError("The CLUSTER_SIZE of cluster template '%s' must be "
+                         "at least 1." % cluster_template)
+
+    key_location = None
+    if 'keyname' in template_settings:
+        key_section = 'key %s' % template_settings['keyname']
+        if config.has_option(key_section, 'key_location'):
+            key_location = expanduser(config.get(key_section,
+                                                 'key_location'))
+
+    return {'cluster_size': cluster_size, 'key_location': key_location,
+            'node_instance_type':
+                    template_settings.get('node_instance_type')}
+
+def parse_cluster_nodes(listclusters_f):
+    """Parses the output of 'starcluster listclusters <cluster_tag>'.
+
+    Returns a dictionary mapping each node's alias (e.g. 'master', 'node001')
+    to a 2-element tuple containing the node's state (e.g. 'running') and its
+    public DNS name. The DNS name will be None if the node doesn't have one
+    yet (e.g. if it is still pending).
+
+    Arguments:
+        listclusters_f - the output of the listclusters command (e.g. a file
+            or list of lines). Any lines outside of the 'Cluster nodes:'
+            section are ignored
+    """
+    nodes = {}
+    in_nodes_section = False
+    for line in listclusters_f:
+        line = line.strip()
+        if line == 'Cluster nodes:':
+            in_nodes_section = True
+        elif in_nodes_section:
+            fields = line.split()
+            if len(fields) < 3 or not fields[2].startswith('i-'):
+                in_nodes_section = False
+                continue
+            alias, state = fields[0], fields[1]
+            host = None
+            if len(fields) > 3 and not fields[3].startswith('('):
+                host = fields[3]
+            nodes[alias] = (state, host)
+    return nodes
+
+def parse_junit_xml(junit_f, max_failing_tests=MAX_JUNIT_FAILING_TESTS,
+                    max_slowest_tests=MAX_JUNIT_SLOWEST_TESTS):
+    """Parses a JUnit (or xUnit) XML test report.
+
+    The report is read as a stream, and each test case is thrown away as soon
+    as it has been counted, so memory use stays flat no matter how many test
+    cases the report contains. The root element may be a single <testsuite>
+    or a <testsuites> element containing any number of (possibly nested)
+    <testsuite> elements.
+
+    Returns a dictionary with the following keys:
+        passed, failed, errors, skipped - the number of test cases with each
+            outcome. A test case failed if it contains a <failure> element,
+            had an error if it contains an <error> element, and was skipped
+            if it contains a <skipped> element
+        failing_tests - a list of (outcome ('failed' or 'error'), test name)
+            pairs for the first max_failing_tests test cases that failed or
+            had an error, in the order that they appear in the report. A
+            test's name is its classname and name, joined by '.'
+        slowest_tests - a list of (seconds, test name) pairs for the
+            max_slowest_tests test cases that took the longest, longest first
+
+    Arguments:
+        junit_f - the JUnit XML report (a file or the path to one)
+        max_failing_tests - the number of failing test cases to list
+        max_slowest_tests - the number of slowest test cases to list
+    """
+    results = {'passed': 0, 'failed': 0, 'errors': 0, 'skipped': 0,
+               'failing_tests': [], 'slowest_tests': []}
+    slowest_tests = []
+
+    # Only the elements that are still open are kept in memory. Everything
+    # else is removed from its parent once it has ended, except for the
+    # children of a test case, which are needed to find its outcome.
+    open_elements = []
+    try:
+        for event, element in iterparse(junit_f, events=('start', 'end')):
+            if event == 'start':
+                if not open_elements and \
+                   element.tag not in ('testsuite', 'testsuites'):
+                    raise ValueError("The JUnit XML report must have a "
+                                     "<testsuite> or <testsuites> root "
+                                     "element, not <%s>." % element.tag)
+                open_elements.append(element)
+                continue
+
+            open_elements.pop()
+            if element.tag == 'testcase':
+                name = element.get('name', '')
+                if element.get('classname'):
+                    name = '%s.%s' % (element.get('classname'), name)
+
+                outcome = 'passed'
+                for child in element:
+                    if child.tag == 'failure':
+                        outcome = 'failed'
+                    elif child.tag == 'error' and outcome != 'failed':
+                        outcome = 'error'
+                    elif child.tag == 'skipped' and outcome == 'passed':
+                        outcome = 'skipped'
+
+                if outcome == 'error':
+                    results['errors'] += 1
+                else:
+                    results[outcome] += 1
+                if outcome in ('failed', 'error') and \
+                   len(results['failing_tests']) < max_failing_tests:
+                    results['failing_tests'].append((outcome, name))
+
+                try:
+                    seconds = float(element.get('time', '0').replace(',', ''))
+                except ValueError:
+                    seconds = 0.0
+                if max_slowest_tests > 0:
+                    if len(slowest_tests) < max_slowest_tests:
+                        heappush(slowest_tests, (seconds, name))
+                    else:
+                        heappushpop(slowest_tests, (seconds, name))
+
+            if open_elements and open_elements[-1].tag != 'testcase':
+                open_elements[-1].remove(element)
+    except SyntaxError, e:
+        raise ValueError("Could not parse the JUnit XML report: %s" % e)
+
+    results['slowest_tests'] = sorted(slowest_tests, reverse=True)
+    return results
+
+def parse_warm_clusters(warm_clusters_f):
+    """Parses the file that tracks clusters left running between runs.
+
+    Returns a dictionary mapping each cluster tag to the time (in seconds
+    since the epoch, as a float) that the cluster was last used.
+
+    Arguments:
+        warm_clusters_f - the input file containing a cluster tag and a
+            timestamp separated by a tab on each line
+    """
+    warm_clusters = {}
+    for line in warm_clusters_f:
+        if not _can_ignore(line):
+            fields = line.strip().split('\t')
+            if len(fields) != 2:
+                raise ValueError("Each line in the warm clusters file must "
+                                 "contain exactly two fields separated by "
+                                 "tabs.")
+            try:
+                warm_clusters[fields[0]] = float(fields[1])
+            except ValueError:
+                raise ValueError("The last used time of cluster '%s' in the "
+                                 "warm clusters file must be numeric."
+                                 % fields[0])
+    return warm_clusters
+
+def _get_cluster_template_settings(config, cluster_template, seen_templates):
+    """Returns a dict of a cluster template's settings (following EXTENDS)."""
+    section = 'cluster %s' % cluster_template
+    if not config.has_section(section):
+        raise ValueError("The cluster template '%s' is not defined in the "
+                         "StarCluster config file." % cluster_template)
+    if cluster_template in seen_templates:
+        raise ValueError("The cluster template '%s' extends itself."
+                         % cluster_template)
+
+    settings = {}
+    if config.has_option(section, 'extends'):
+        settings.update(_get_cluster_template_settings(config,
+                config.get(section, 'extends'),
+                seen_templates + [cluster_template]))
+    settings.update(config.items(section))
+    return settings
+
+def _parse_test_suite_options(label, fields):
+    """Parses the option=value fields following a test suite's command."""
+    options = {}
+    for field in fields:
+        if '=' not in field:
+            raise ValueError("The test suite option '%s' for the test suite "
+                             "'%s' must be in the form option=value." %
+                             (field, label))
+        option, val = field.split('=', 1)
+
+        if option in options:
+            raise ValueError("The test suite option '%s' was specified more "
+                             "than once for the test suite '%s'." %
+                             (option, label))
+
+        if option == 'shards':
+            try:
+                val = int(val)
+            except ValueError:
+                val = 0
+            if val < 1:
+                raise ValueError("The number of shards for the test suite "
+                                 "'%s' must be a positive integer." % label)
+        elif option == 'retries':
+            try:
+                val = int(val)
+            except ValueError:
+                val = -1
+            if val < 0:
+                raise ValueError("The number of retries for the test suite "
+                                 "'%s' must be a non-negative integer." %
+                                 label)
+        elif option == 'fingerprint':
+            if not val:
+                raise ValueError("The fingerprint command for the test suite "
+                                 "'%s' cannot be empty." % label)
+        elif option in ('artifacts', 'junit'):
+            val = val.split()
+            if not val:
+                raise ValueError("The %s option for the test suite '%s' must "
+                                 "be one or more glob patterns." %
+                                 (option, label))
+            # The patterns are run on the cluster inside single quotes.
+            if [pattern for pattern in val if "'" in pattern]:
+                raise ValueError("The %s patterns for the test suite '%s' "
+                                 "cannot contain single quotes." %
+                                 (option, label))
+        else:
+            raise ValueError("Unrecognized test suite option '%s' for the "
+                             "test suite '%s'." % (option, label))
+        options[option] = val
+    return options
+
 def _can_ignore(line):
     """Returns True if the line can be ignored (comment or blank line)."""
     return False if line.strip() != '' and not line.strip().startswith('#') \
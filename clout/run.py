@@ -11,13 +11,49 @@ __email__ = "jai.rideout@gmail.com"
 
 """Module to run test suites and publish the results."""
 
-from tempfile import TemporaryFile
+from fnmatch import fnmatch
+from functools import partial
+from hashlib import sha1
+from json import dumps
+from os import listdir, makedirs, rename, walk
+from os.path import exists, expanduser, getsize, join, relpath
+from shutil import copyfileobj, rmtree
+from sys import stdout
+from tempfile import mkdtemp, TemporaryFile
+from threading import Event, Thread
+from time import strftime, time
 
-from clout.format import format_email_summary
-from clout.parse import (parse_config_file, parse_email_list,
-                         parse_email_settings)
-from clout.static import MAX_SPOT_BID
-from clout.util import CommandExecutor, send_email
+from clout.backend import (get_artifact_patterns,
+                           get_starcluster_node_aliases, LocalBackend,
+                           StarClusterBackend)
+from clout.format import (format_artifacts_summary,
+                          format_attachments_summary, format_email_summary,
+                          format_first_failure, format_instance_time,
+                          format_junit_results, format_new_log_lines,
+                          format_prometheus_metrics, format_retry_results,
+                          format_schedule, format_ssh_config,
+                          format_timing_table, format_warm_clusters)
+from clout.history import (get_history_db_fp, get_typical_durations,
+                           has_passed_with_cache_key, open_history_db,
+                           record_commands, record_flaky_test_suites,
+                           record_passing_cache_keys)
+from clout.jobqueue import (claim_job, finish_job, get_instance_hours_used,
+                            get_job_queue_db_fp, open_job_queue_db,
+                            requeue_running_jobs)
+from clout.journal import (get_journal_dir, load_journal,
+                           record_test_suites, remove_journal)
+from clout.logdiff import (archive_logs, find_new_lines,
+                           get_archived_log_fp, get_log_archive_dir)
+from clout.parse import (parse_cluster_nodes, parse_config_file,
+                         parse_email_list, parse_email_settings,
+                         parse_junit_xml, parse_starcluster_config,
+                         parse_warm_clusters)
+from clout.schedule import schedule_test_suites
+from clout.static import (DEFAULT_MAX_ATTACHMENTS_SIZE, DEFAULT_STATE_DIR,
+                          LOG_CHUNK_SIZE, MAX_CLUSTER_REPLACEMENTS,
+                          MAX_JUNIT_FAILING_TESTS, MAX_JUNIT_SLOWEST_TESTS,
+                          MAX_SPOT_BID, SSH_ERROR_RETURN_CODE)
+from clout.util import CommandExecutor, compress_attachments, send_email
 
 def run_test_suites(config_f,
                     sc_config_fp,
@@ -31,20 +67,44 @@ def run_test_suites(config_f,
                     test_suites_timeout=240.0,
                     teardown_timeout=20.0,
                     sc_exe_fp='starcluster',
-                    suppress_spot_bid_check=False):
+                    suppress_spot_bid_check=False,
+                    max_parallel=1,
+                    ssh_multiplexing=False,
+                    keep_cluster=False,
+                    cluster_idle_ttl=60.0,
+                    state_dir=DEFAULT_STATE_DIR,
+                    schedule_by_history=False,
+                    max_attachments_size=DEFAULT_MAX_ATTACHMENTS_SIZE,
+                    backend='starcluster',
+                    metrics_dir=None,
+                    fail_fast=False,
+                    resume=False,
+                    artifacts_dir=None,
+                    diff_logs=False,
+                    retries=0,
+                    local_prep_cmds=None,
+                    manage_warm_clusters=True,
+                    project=None,
+                    per_test_suite_timeout=None):
     """Runs the test suites and emails the results to the recipients.
 
-    This function does not return anything. This function is not unit-tested
-    because there isn't a clean way to test it since it sends an email, starts
-    up a cluster on Amazon EC2, etc. Nearly every other 'private' function that
-    this function calls has been extensively unit-tested (whenever possible).
-    Thus, the amount of untested code has been minimized and contained here.
+    Returns a dict of information about the run (see
+    _execute_commands_and_build_email()), or None if none of the test suites
+    needed to be run. This function isn't unit-tested because it sends an
+    email, starts up a cluster on Amazon EC2, etc., but it is run
+    from start to finish by the end-to-end tests (tests/test_end_to_end.py)
+    against a fake StarCluster and a local SMTP server. Nearly every other
+    'private' function that this function calls has been extensively
+    unit-tested (whenever possible).
 
     Arguments:
         config_f - the input configuration file describing the test suites to
             be run
         sc_config_fp - the starcluster config filepath that will be used to
-            start/terminate the cluster that the tests will be run on
+            start/terminate the cluster that the tests will be run on. If the
+            cluster template has a CLUSTER_SIZE greater than one, the test
+            suites will be spread across all nodes in the cluster. Not used
+            (and may be None) if backend is 'local'
         recipients_f - the file containing email addresses of those who should
             receive the test suite results
         email_settings_f - the file containing email (SMTP) settings to allow
@@ -71,10 +131,157 @@ def run_test_suites(config_f,
         suppress_spot_bid_check - if True, suppress sanity checking of
             spot_bid. By default, if spot_bid is greater than
             clout.static.MAX_SPOT_BID, an error will be raised
+        max_parallel - the maximum number of test suites to run at the same
+            time on each node in the cluster (an int). Useful if the test
+            suites are single-threaded and the nodes have multiple cores
+        ssh_multiplexing - if True, the hostnames of the cluster's nodes will
+            be looked up once the cluster has been started, and the test
+            suites will be run over a single persistent SSH connection to each
+            node (instead of through starcluster sshmaster/sshnode, which
+            start a new SSH connection for every test suite). The cluster
+            template's key must define a KEY_LOCATION
+        keep_cluster - if True, the cluster will be left running after the
+            test suites have run (as long as nothing went wrong), and will be
+            reused by the next run that uses the same cluster_tag, as long as
+            it is still healthy. This avoids waiting for a new cluster to boot
+            on every run
+        cluster_idle_ttl - the number of minutes that a cluster left running
+            by keep_cluster may sit idle before it is terminated. Idle
+            clusters are terminated by the next run that uses keep_cluster,
+            regardless of which cluster tag that run uses. Must be a float, to
+            allow for fractions of a minute
+        state_dir - the directory that clout keeps information in between runs
+            (e.g. which clusters were left running, and the history database
+            that every command's duration and return code is recorded in).
+            Will be created if it doesn't exist
+        schedule_by_history - if True, the test suites will be started in
+            order of longest to shortest typical duration (according to the
+            history database) and each one will be assigned to the node that
+            is expected to become free first, instead of running the test
+            suites in the order that they appear in config_f. The planned
+            schedule is included in the email
+        max_attachments_size - the maximum total size (in megabytes) of the
+            log files attached to the email. The log files are always
+            gzip-compressed, and if they are still too large, the middle of
+            the largest ones is removed. Must be greater than zero
+        backend - where to run the test suites. 'starcluster' runs them on a
+            cluster started by StarCluster on Amazon EC2. 'local' runs them
+            on this machine (max_parallel at a time), each in its own working
+            directory under the state directory, and doesn't support
+            ssh_multiplexing or keep_cluster. See clout.backend
+        metrics_dir - if provided, the run's metrics (phase and test suite
+            durations, return codes, log sizes, timeouts, spot bid, and
+            instance type) will be written to this directory as
+            clout_<cluster_tag>.json and, in the Prometheus text format
+            (e.g. for the node exporter's textfile collector),
+            clout_<cluster_tag>.prom. The files are replaced by each run
+            with the same cluster_tag. Will be created if it doesn't exist
+        fail_fast - if True, as soon as a test suite fails, the test suites
+            that are still running are terminated, no more test suites are
+            started, and the cluster is terminated (even if keep_cluster is
+            True, since terminating the commands that started a test suite
+            doesn't necessarily stop it on the cluster). The email starts
+            with a short report of the first failure and is sent right away,
+            which gives a quick answer to pre-merge checks
+        resume - if True, the test suites that finished in the previous run
+            with the same cluster_tag are not run again, as long as that run
+            was cut short by losing its cluster and their commands haven't
+            changed. Only supported with spot_bid (see below)
+        artifacts_dir - the directory to copy the artifacts of the test
+            suites (the files matching the patterns given by their artifacts
+            and junit options in config_f) to. Each test suite's artifacts
+            are put in a directory named after its label, and the
+            directory's contents are replaced by each run. If None,
+            artifacts/<cluster_tag> in the state directory is used. Not used
+            if none of the test suites have artifacts
+        diff_logs - if True, each test suite's log is compared with its log
+            from the previous run with the same cluster_tag, and instead of
+            attaching the log, the email includes the lines of the log that
+            are new (ignoring changes in timestamps, durations, temporary
+            paths, and memory addresses) if the test suite failed. The full
+            logs are kept in logs/<cluster_tag> in the state directory. Logs
+            that have nothing to be compared with are attached as usual
+        retries - the number of times to rerun a test suite that failed, on
+            the same cluster before it is terminated, to find out whether
+            its failure is flaky. Test suites with a retries option in
+            config_f are retried that many times instead. The retries must
+            finish within what is left of test_suites_timeout. Test suites
+            that pass when retried are reported as flaky (and recorded as
+            such in the history database) instead of failed. Can't be used
+            with fail_fast, and per-test suite retries options are ignored
+            if fail_fast is True
+        local_prep_cmds - a list of commands to run on this machine while
+            the cluster is being started (e.g. to build a source
+            distribution for the test suites to install), one after another.
+            The test suites aren't started until both the cluster and the
+            commands are ready, and a failing command counts as a setup
+            failure. They share setup_timeout with the cluster setup
+        manage_warm_clusters - if False, clusters left running by
+            keep_cluster aren't recorded in the state directory, and idle
+            clusters aren't terminated. Used by serve_jobs(), which keeps
+            track of its own clusters
+        project - the name of the project that the test suites belong to.
+            If provided, it is included in the email's subject
+        per_test_suite_timeout - the number of minutes that each test suite
+            may run for before it is terminated (which counts as a failure,
+            and can be retried). Useful for stopping a hung test suite
+            without giving up on the others. If None, test suites are only
+            limited by test_suites_timeout. Must be a float, to allow for
+            fractions of a minute
+
+    The cluster is terminated in the background while the email is being
+    compressed and sent. If there are problems in terminating it, they are
+    reported in a follow-up email once the termination has finished.
+
+    If spot_bid is provided, the cluster is checked whenever test suites
+    don't finish (e.g. because SSH lost its connection to a node). If the
+    cluster has been lost (e.g. because its spot instances were reclaimed),
+    the test suites that finished are checkpointed in a run journal in the
+    state directory, and the cluster is replaced (up to
+    clout.static.MAX_CLUSTER_REPLACEMENTS times) to run the rest within what
+    is left of test_suites_timeout. If it can't be replaced, a later run with
+    resume can pick up from the journal.
     """
     if setup_timeout <= 0 or test_suites_timeout <= 0 or teardown_timeout <= 0:
         raise ValueError("The timeout (in minutes) must be greater than zero.")
 
+    if per_test_suite_timeout is not None and per_test_suite_timeout <= 0:
+        raise ValueError("The per-test suite timeout (in minutes) must be "
+                         "greater than zero.")
+
+    if cluster_idle_ttl <= 0:
+        raise ValueError("The cluster idle time (in minutes) must be greater "
+                         "than zero.")
+
+    if max_parallel < 1:
+        raise ValueError("The maximum number of test suites to run in "
+                         "parallel on each node must be at least 1.")
+
+    if backend not in ('starcluster', 'local'):
+        raise ValueError("Unrecognized backend '%s'. The backend must be "
+                         "'starcluster' or 'local'." % backend)
+
+    if backend == 'local' and (ssh_multiplexing or keep_cluster):
+        raise ValueError("SSH multiplexing and keeping the cluster are only "
+                         "supported by the starcluster backend.")
+
+    if resume and (backend != 'starcluster' or spot_bid is None):
+        raise ValueError("Resuming a run whose cluster was lost is only "
+                         "supported by the starcluster backend with a spot "
+                         "bid.")
+
+    if retries < 0:
+        raise ValueError("The number of times to retry a failed test suite "
+                         "must be at least 0.")
+
+    if retries and fail_fast:
+        raise ValueError("Retrying failed test suites can't be combined "
+                         "with failing fast.")
+
+    if max_attachments_size <= 0:
+        raise ValueError("The maximum size of the email attachments (in "
+                         "megabytes) must be greater than zero.")
+
     if spot_bid is not None:
         try:
             spot_bid = float(spot_bid)
@@ -95,115 +302,1097 @@ def run_test_suites(config_f,
     # Parse the various configuration files first so that we know if there's
     # any outstanding problems with file formats before continuing.
     test_suites = parse_config_file(config_f)
+    test_suite_labels = [test_suite[0] for test_suite in test_suites]
     recipients = parse_email_list(recipients_f)
     email_settings = parse_email_settings(email_settings_f)
+    state_dir = _create_state_dir(state_dir)
+
+    if backend == 'starcluster':
+        sc_config_f = open(sc_config_fp, 'U')
+        try:
+            sc_settings = parse_starcluster_config(sc_config_f,
+                                                   cluster_template)
+        finally:
+            sc_config_f.close()
+
+        execution_backend = StarClusterBackend(sc_exe_fp, sc_config_fp,
+                cluster_tag, cluster_template, user, spot_bid,
+                sc_settings['cluster_size'],
+                sc_settings['node_instance_type'],
+                sc_settings['key_location'])
+    else:
+        execution_backend = LocalBackend(join(state_dir, 'work',
+                                              cluster_tag))
+
+    if [test_suite for test_suite in test_suites
+        if get_artifact_patterns(test_suite[2])]:
+        if artifacts_dir is None:
+            artifacts_dir = join(state_dir, 'artifacts', cluster_tag)
+        artifacts_dir = expanduser(artifacts_dir)
+    else:
+        artifacts_dir = None
+
+    # Only runs on spot instances can be resumed after losing their cluster.
+    # Otherwise, an old journal from an interrupted run isn't needed anymore.
+    journal_dir = None
+    if backend == 'starcluster' and spot_bid is not None:
+        journal_dir = get_journal_dir(state_dir, cluster_tag)
+        if not resume:
+            remove_journal(journal_dir)
+
+    # Skip the test suites whose inputs haven't changed since they last
+    # passed.
+    cache_keys = _get_cache_keys(test_suites, setup_timeout)
+    history_conn = open_history_db(get_history_db_fp(state_dir))
+    try:
+        cached_labels = [test_suite[0] for test_suite in test_suites
+                         if test_suite[0] in cache_keys and
+                         has_passed_with_cache_key(history_conn,
+                                 test_suite[0], cache_keys[test_suite[0]])]
+    finally:
+        history_conn.close()
+    test_suites = [test_suite for test_suite in test_suites
+                   if test_suite[0] not in cached_labels]
+    test_suites, shard_parents = _expand_shards(test_suites)
 
-    # Get the commands that need to be executed (these include launching a
-    # cluster, running the test suites, and terminating the cluster).
-    setup_cmds, test_suites_cmds, teardown_cmds = \
-            _build_test_execution_commands(test_suites, sc_config_fp,
-                                           cluster_tag, cluster_template, user,
-                                           spot_bid, sc_exe_fp)
+    if test_suites:
+        email_body, attachments, run_info = _run_test_suites_with_backend(
+                test_suites, shard_parents, execution_backend, cluster_tag,
+                setup_timeout, test_suites_timeout, teardown_timeout,
+                max_parallel, ssh_multiplexing, keep_cluster, state_dir,
+                schedule_by_history, fail_fast, journal_dir, artifacts_dir,
+                retries, local_prep_cmds, per_test_suite_timeout)
+    else:
+        email_body = ("None of the test suites needed to be run, so the "
+                      "cluster was not started.\n\n")
+        attachments, run_info = [], None
+
+    email_body = format_email_summary([(label, 0, 'cached')
+                                       for label in cached_labels]) + \
+                 email_body
+
+    if diff_logs and run_info is not None:
+        email_body, attachments = _diff_test_suite_logs(
+                run_info['test_suite_results'], attachments,
+                get_log_archive_dir(state_dir, cluster_tag), email_body)
+
+    if keep_cluster and manage_warm_clusters:
+        warm_clusters = _load_warm_clusters(state_dir)
+        if run_info is None:
+            # The cluster wasn't used, so it may be idle for too long too.
+            used_cluster_tag = None
+        else:
+            used_cluster_tag = cluster_tag
+            if run_info['cluster_kept']:
+                warm_clusters[cluster_tag] = time()
+            elif cluster_tag in warm_clusters:
+                del warm_clusters[cluster_tag]
+
+        # Terminate any other clusters that have been sitting idle for too
+        # long.
+        email_body, attachments = _terminate_idle_clusters(warm_clusters,
+                used_cluster_tag, cluster_idle_ttl, sc_exe_fp, sc_config_fp,
+                teardown_timeout, email_body, attachments)
+        _save_warm_clusters(state_dir, warm_clusters)
 
-    # Execute the commands and build up the body of an email with the
-    # summarized results as well as the output in log file attachments.
-    email_body, attachments = _execute_commands_and_build_email(
-            test_suites, setup_cmds, test_suites_cmds, teardown_cmds,
-            setup_timeout, test_suites_timeout, teardown_timeout, cluster_tag)
+    # Compress the log files (and truncate them, if necessary) so that the
+    # email isn't too large to send.
+    max_size = max_attachments_size * 1024 * 1024
+    if attachments:
+        attachments, compression_info = compress_attachments(attachments,
+                                                             max_size)
+        email_body += format_attachments_summary(compression_info, max_size)
 
     # Send the email.
     # TODO: this should be configurable by the user.
-    subject = "Test suite results [Clout testing system]"
-    send_email(email_settings['smtp_server'], email_settings['smtp_port'],
-                email_settings['sender'], email_settings['password'],
-                recipients, subject, email_body, attachments)
+    if run_info is not None and run_info['first_failure'] is not None:
+        subject = "Test suite failure: %s" % run_info['first_failure']
+    else:
+        subject = "Test suite results"
+    if project is not None:
+        subject += " (%s)" % project
+    subject += " [Clout testing system]"
+    try:
+        send_email(email_settings['smtp_server'],
+                   email_settings['smtp_port'], email_settings['sender'],
+                   email_settings['password'], recipients, subject,
+                   email_body, attachments, email_settings['insecure_smtp'])
+    finally:
+        # The run's history and metrics are written even if the email
+        # couldn't be sent. The cluster was being terminated while the email
+        # was sent, so wait for it to finish first, so that the teardown is
+        # included.
+        follow_up_body = ''
+        if run_info is not None and run_info['teardown'] is not None:
+            teardown_log_f = run_info['teardown']['log_f']
+            follow_up_body = _finish_background_teardown(run_info,
+                                                         teardown_timeout,
+                                                         cluster_tag)
+            if follow_up_body:
+                teardown_log_f.seek(0, 0)
+                follow_up_attachments = compress_attachments(
+                        [('teardown_log.txt', teardown_log_f)], max_size)[0]
+            teardown_log_f.close()
+
+        if run_info is not None:
+            history_conn = open_history_db(get_history_db_fp(state_dir))
+            try:
+                record_commands(history_conn, run_info['cmd_records'],
+                                cluster_tag, execution_backend.instance_type)
+
+                # A test suite that only passed when it was retried is flaky,
+                # so it isn't skipped next time, even if its inputs haven't
+                # changed.
+                flaky_labels = set([shard_parents.get(label, label)
+                        for label in run_info['flaky_test_suites']])
+                record_passing_cache_keys(history_conn,
+                        [(label, cache_keys[label])
+                         for label, ret_val in run_info['test_suite_results']
+                         if ret_val == 0 and label in cache_keys and
+                         label not in flaky_labels])
+                record_flaky_test_suites(history_conn,
+                        sorted(run_info['flaky_test_suites'].items()),
+                        cluster_tag)
+            finally:
+                history_conn.close()
+
+        if metrics_dir is not None:
+            _write_run_metrics(metrics_dir, _build_run_metrics(
+                    test_suite_labels, cached_labels, run_info, cluster_tag,
+                    backend, execution_backend, spot_bid))
+
+    # Report any problems in terminating the cluster in a follow-up email.
+    if follow_up_body:
+        send_email(email_settings['smtp_server'],
+                   email_settings['smtp_port'], email_settings['sender'],
+                   email_settings['password'], recipients,
+                   "Cluster termination problem: %s [Clout testing system]" %
+                   cluster_tag, follow_up_body, follow_up_attachments,
+                   email_settings['insecure_smtp'])
 
-def _build_test_execution_commands(test_suites, sc_config_fp, cluster_tag,
-                                   cluster_template=None, user='root',
-                                   spot_bid=None, sc_exe_fp='starcluster'):
-    """Builds up commands that need to be executed to run the test suites.
+    return run_info
 
-    These commands are starcluster commands to start/terminate a cluster,
-    (setup/teardown commands, respectively) as well as execute commands over
-    ssh to run the test suites (test suite commands).
+def serve_jobs(sc_config_fp,
+               email_settings_f,
+               cluster_tag,
+               cluster_template=None,
+               user='root',
+               spot_bid=None,
+               setup_timeout=20.0,
+               test_suites_timeout=240.0,
+               teardown_timeout=20.0,
+               sc_exe_fp='starcluster',
+               suppress_spot_bid_check=False,
+               max_parallel=1,
+               cluster_idle_ttl=60.0,
+               state_dir=DEFAULT_STATE_DIR,
+               backend='starcluster',
+               max_clusters=1,
+               max_instance_hours=None,
+               poll_interval=30.0,
+               exit_when_idle=False,
+               per_test_suite_timeout=None):
+    """Runs the jobs submitted to the job queue until interrupted.
 
-    Returns a 3-element tuple containing the list of setup command strings,
-    the list of test suite command strings, and the list of teardown command
-    strings.
+    Up to max_clusters jobs are run at the same time, each on its own
+    cluster. The clusters are tagged cluster_tag-1, cluster_tag-2, etc., and
+    are kept running between jobs, so jobs submitted by different projects
+    share clusters instead of each starting their own. Each job is run by
+    run_test_suites() (with keep_cluster), and its results are emailed to the
+    job's recipients, with the job's project in the subject. A cluster that
+    has been idle for cluster_idle_ttl is terminated, and a new one is
+    started for the next job that needs it.
+
+    Jobs that were left running on this daemon's clusters (by a daemon with
+    the same cluster_tag that stopped) are put back in the queue when the
+    daemon starts. Several daemons may serve jobs from the same queue, but
+    each must use a different cluster_tag. Progress is printed to standard
+    output.
 
     Arguments:
-        test_suites - the output of _parse_config_file()
-        sc_config_fp - same as for run_test_suites()
+        sc_config_fp - same as for run_test_suites(). All jobs are run on
+            clusters started from the same cluster template
+        email_settings_f - same as for run_test_suites()
+        cluster_tag - the prefix of the tags of the clusters that the jobs
+            run on
+        cluster_template - same as for run_test_suites()
         user - same as for run_test_suites()
         spot_bid - same as for run_test_suites()
-        cluster_tag - same as for run_test_suites()
-        cluster_template - same as for run_test_suites()
+        setup_timeout - same as for run_test_suites()
+        test_suites_timeout - same as for run_test_suites(). Applies to each
+            job separately
+        teardown_timeout - same as for run_test_suites()
         sc_exe_fp - same as for run_test_suites()
+        suppress_spot_bid_check - same as for run_test_suites()
+        max_parallel - same as for run_test_suites()
+        cluster_idle_ttl - the number of minutes that a cluster may sit idle
+            between jobs before it is terminated. Must be a float, to allow
+            for fractions of a minute
+        state_dir - same as for run_test_suites(). The job queue database is
+            kept in this directory (see clout.jobqueue), and each job's
+            artifacts are copied to artifacts/<project>/<job ID> in it, so
+            that jobs from the same project don't overwrite each other's
+        backend - same as for run_test_suites(). With the 'local' backend,
+            no clusters are kept, and the jobs don't use any instance-hours
+        max_clusters - the maximum number of clusters to run at the same
+            time (and so the maximum number of jobs to run at the same time)
+        max_instance_hours - if provided, no more jobs are started while the
+            jobs that finished in the last 24 hours used at least this many
+            instance-hours (the number of instances in the cluster times the
+            time taken by the job's run). Time that clusters spend idle
+            between jobs isn't counted
+        poll_interval - the number of seconds to wait before checking the
+            queue again when there are no jobs to run
+        exit_when_idle - if True, the daemon exits (terminating its
+            clusters) once there are no jobs that it can start, instead of
+            waiting for more jobs to be submitted
+        per_test_suite_timeout - same as for run_test_suites()
     """
-    setup_cmds, test_suite_cmds, teardown_cmds = [], [], []
+    if cluster_idle_ttl <= 0:
+        raise ValueError("The cluster idle time (in minutes) must be greater "
+                         "than zero.")
 
-    sc_start_cmd = '%s -c %s start ' % (sc_exe_fp, sc_config_fp)
+    if max_clusters < 1:
+        raise ValueError("The maximum number of clusters must be at least 1.")
 
-    if cluster_template is not None:
-        sc_start_cmd += '-c %s ' % cluster_template
+    if max_instance_hours is not None and max_instance_hours <= 0:
+        raise ValueError("The maximum number of instance-hours must be "
+                         "greater than zero.")
 
-    if spot_bid is not None:
-        sc_start_cmd += '-b %.2f --force-spot-master ' % spot_bid
+    if poll_interval <= 0:
+        raise ValueError("The poll interval (in seconds) must be greater "
+                         "than zero.")
+
+    if backend not in ('starcluster', 'local'):
+        raise ValueError("Unrecognized backend '%s'. The backend must be "
+                         "'starcluster' or 'local'." % backend)
 
-    sc_start_cmd += cluster_tag
-    setup_cmds.append(sc_start_cmd)
+    # The email settings are read once and used by every job, so check them
+    # now instead of failing every job.
+    email_settings = list(email_settings_f)
+    parse_email_settings(email_settings)
+    state_dir = _create_state_dir(state_dir)
 
-    for test_suite_name, test_suite_exec in test_suites:
-        # To have the next command work without getting prompted to accept the
-        # new host, the user must have 'StrictHostKeyChecking no' in their SSH
-        # config (on the local machine). TODO: try to get starcluster devs to
-        # add this feature to sshmaster.
-        test_suite_cmds.append('%s -c %s sshmaster -u %s %s \'%s\'' %
-                (sc_exe_fp, sc_config_fp, user, cluster_tag, test_suite_exec))
+    if backend == 'starcluster':
+        sc_config_f = open(sc_config_fp, 'U')
+        try:
+            cluster_size = parse_starcluster_config(sc_config_f,
+                    cluster_template)['cluster_size']
+        finally:
+            sc_config_f.close()
+    else:
+        cluster_size = 0
+
+    queue_db_fp = get_job_queue_db_fp(state_dir)
+    queue_conn = open_job_queue_db(queue_db_fp)
+    try:
+        num_requeued_jobs = requeue_running_jobs(queue_conn, cluster_tag)
+    finally:
+        queue_conn.close()
+    if num_requeued_jobs:
+        _log_daemon_event("Requeued %d job%s that did not finish." %
+                          (num_requeued_jobs,
+                           's' if num_requeued_jobs != 1 else ''))
+
+    run_kwargs = {'cluster_template': cluster_template, 'user': user,
+                  'spot_bid': spot_bid, 'setup_timeout': setup_timeout,
+                  'test_suites_timeout': test_suites_timeout,
+                  'teardown_timeout': teardown_timeout,
+                  'sc_exe_fp': sc_exe_fp,
+                  'suppress_spot_bid_check': suppress_spot_bid_check,
+                  'max_parallel': max_parallel,
+                  'keep_cluster': backend == 'starcluster',
+                  'state_dir': state_dir, 'backend': backend,
+                  'manage_warm_clusters': False,
+                  'per_test_suite_timeout': per_test_suite_timeout}
+
+    stop_event = Event()
+    slots = [Thread(target=_serve_jobs_on_cluster,
+                    args=('%s-%d' % (cluster_tag, slot_num), sc_config_fp,
+                          email_settings, run_kwargs, queue_db_fp,
+                          cluster_size, cluster_idle_ttl, max_instance_hours,
+                          poll_interval, exit_when_idle, stop_event))
+             for slot_num in range(1, max_clusters + 1)]
+    for slot in slots:
+        slot.daemon = True
+        slot.start()
+    _log_daemon_event("Serving jobs from %s on up to %d cluster%s." %
+                      (queue_db_fp, max_clusters,
+                       's' if max_clusters != 1 else ''))
+
+    try:
+        # Joining with a timeout lets the main thread be interrupted.
+        while [slot for slot in slots if slot.is_alive()]:
+            for slot in slots:
+                slot.join(1.0)
+    except KeyboardInterrupt:
+        _log_daemon_event("Stopping once the running jobs have finished.")
+        stop_event.set()
+        while [slot for slot in slots if slot.is_alive()]:
+            for slot in slots:
+                slot.join(1.0)
+    _log_daemon_event("Stopped serving jobs.")
+
+def _serve_jobs_on_cluster(cluster_tag, sc_config_fp, email_settings,
+                           run_kwargs, queue_db_fp, cluster_size,
+                           cluster_idle_ttl, max_instance_hours,
+                           poll_interval, exit_when_idle, stop_event):
+    """Runs queued jobs one after another on a cluster.
+
+    This is run in its own thread by serve_jobs() for each cluster.
+
+    Arguments:
+        cluster_tag - the tag of the cluster to run the jobs on
+        sc_config_fp - same as for run_test_suites()
+        email_settings - the lines of the email settings file
+        run_kwargs - the keyword arguments to pass to run_test_suites() for
+            every job
+        queue_db_fp - the path to the job queue database
+        cluster_size - the number of instances that are billed for each job
+        cluster_idle_ttl - same as for serve_jobs()
+        max_instance_hours - same as for serve_jobs()
+        poll_interval - same as for serve_jobs()
+        exit_when_idle - same as for serve_jobs()
+        stop_event - a threading.Event that is set when no more jobs should
+            be started
+    """
+    keep_cluster = run_kwargs['keep_cluster']
+    sc_exe_fp = run_kwargs['sc_exe_fp']
+    teardown_timeout = run_kwargs['teardown_timeout']
+
+    # The time that the cluster was last used, or None if it isn't running.
+    # A cluster left running by a previous daemon is reused, and is
+    # terminated if it isn't needed.
+    last_used = None
+    if keep_cluster and _get_cluster_status(sc_exe_fp, sc_config_fp,
+                                            cluster_tag, cluster_size,
+                                            run_kwargs['setup_timeout']) \
+            != 'missing':
+        last_used = time()
+
+    queue_conn = open_job_queue_db(queue_db_fp)
+    try:
+        while not stop_event.is_set():
+            if max_instance_hours is not None and \
+               get_instance_hours_used(queue_conn, time() - 24 * 60 * 60) >= \
+               max_instance_hours:
+                job = None
+            else:
+                job = claim_job(queue_conn, cluster_tag)
+
+            if job is None:
+                if last_used is not None:
+                    last_used = _terminate_warm_cluster(cluster_tag,
+                            last_used, cluster_idle_ttl, sc_exe_fp,
+                            sc_config_fp, teardown_timeout)
+                if exit_when_idle:
+                    break
+                stop_event.wait(poll_interval)
+                continue
+
+            job_id, project, config, recipients = job
+            _log_daemon_event("Job %d (%s) started on cluster %s." %
+                              (job_id, project, cluster_tag))
+            try:
+                run_info = run_test_suites(
+                        config.encode('utf-8').splitlines(), sc_config_fp,
+                        recipients.encode('utf-8').splitlines(),
+                        email_settings, cluster_tag,
+                        cluster_idle_ttl=cluster_idle_ttl,
+                        artifacts_dir=join(run_kwargs['state_dir'],
+                                           'artifacts', project,
+                                           str(job_id)),
+                        project=project, **run_kwargs)
+            except Exception, e:
+                finish_job(queue_conn, job_id, False, 0, str(e))
+                _log_daemon_event("Job %d (%s) failed: %s" % (job_id,
+                                                              project, e))
+
+                # The job may have failed after its cluster was started and
+                # kept (e.g. while sending the email), so check whether the
+                # cluster is running. Otherwise it would never be terminated.
+                last_used = None
+                if keep_cluster and _get_cluster_status(sc_exe_fp,
+                        sc_config_fp, cluster_tag, cluster_size,
+                        run_kwargs['setup_timeout']) != 'missing':
+                    last_used = time()
+                continue
+
+            instance_hours = 0
+            if run_info is not None:
+                cmd_records = run_info['cmd_records']
+                if cmd_records:
+                    instance_hours = cluster_size * (
+                            max([record[4] for record in cmd_records]) -
+                            min([record[3] for record in cmd_records])) / 3600
+                last_used = time() if run_info['cluster_kept'] else None
+            finish_job(queue_conn, job_id, True, instance_hours)
+            _log_daemon_event("Job %d (%s) finished (%.2f instance-hours)." %
+                              (job_id, project, instance_hours))
+
+        # Clusters aren't left running once the daemon stops, since nothing
+        # would terminate them.
+        if last_used is not None:
+            _terminate_warm_cluster(cluster_tag, 0, cluster_idle_ttl,
+                                    sc_exe_fp, sc_config_fp,
+                                    teardown_timeout)
+    finally:
+        queue_conn.close()
+
+def _terminate_warm_cluster(cluster_tag, last_used, cluster_idle_ttl,
+                            sc_exe_fp, sc_config_fp, teardown_timeout):
+    """Terminates a daemon's cluster if it has been idle for too long.
 
-    # The second -c tells starcluster not to prompt us for termination
-    # confirmation.
-    teardown_cmds.append("%s -c %s terminate -c %s" % (sc_exe_fp, sc_config_fp,
-                                                       cluster_tag))
-    return setup_cmds, test_suite_cmds, teardown_cmds
+    Returns the time that the cluster was last used, or None if it was
+    terminated.
+
+    Arguments:
+        cluster_tag - the tag of the cluster
+        last_used - the time (in seconds since the epoch) that the cluster
+            was last used. 0 terminates the cluster no matter how long it
+            has been idle
+        cluster_idle_ttl - same as for serve_jobs()
+        sc_exe_fp - same as for run_test_suites()
+        sc_config_fp - same as for run_test_suites()
+        teardown_timeout - same as for run_test_suites()
+    """
+    warm_clusters = {cluster_tag: last_used}
+    message, attachments = _terminate_idle_clusters(warm_clusters, None,
+            cluster_idle_ttl, sc_exe_fp, sc_config_fp, teardown_timeout, '',
+            [])
+    for attachment_name, log_f in attachments:
+        log_f.close()
+    if message:
+        _log_daemon_event(message.strip())
+    return warm_clusters.get(cluster_tag)
+
+def _log_daemon_event(message):
+    """Prints a timestamped message about what the daemon is doing."""
+    stdout.write('%s %s\n' % (strftime('%Y-%m-%d %H:%M:%S'), message))
+    stdout.flush()
+
+def _diff_test_suite_logs(test_suite_results, attachments, archive_dir,
+                          email_body):
+    """Replaces the test suites' log attachments with what is new in them.
+
+    Each test suite log that has a log from the previous run in archive_dir
+    to compare with is left out of the attachments. If the test suite
+    failed, the lines of its log that are new since the previous run are
+    added to the email body instead. The logs are then archived, replacing
+    the previous run's logs.
+
+    Returns the updated email body and attachments.
+
+    Arguments:
+        test_suite_results - the 'test_suite_results' entry returned by
+            _execute_commands_and_build_email()
+        attachments - the attachments returned by
+            _execute_commands_and_build_email()
+        archive_dir - the directory that the logs are archived in (see
+            clout.logdiff)
+        email_body - the email body to add to
+    """
+    ret_vals = dict([('%s_results.txt' % label, (label, ret_val))
+                     for label, ret_val in test_suite_results])
+
+    kept_attachments, test_suite_logs, num_archived = [], [], 0
+    for attachment_name, log_f in attachments:
+        if attachment_name not in ret_vals:
+            kept_attachments.append((attachment_name, log_f))
+            continue
+        test_suite_logs.append((attachment_name, log_f))
+
+        previous_log_fp = get_archived_log_fp(archive_dir, attachment_name)
+        if not exists(previous_log_fp):
+            kept_attachments.append((attachment_name, log_f))
+            continue
+        num_archived += 1
+
+        label, ret_val = ret_vals[attachment_name]
+        if ret_val != 0:
+            previous_log_f = open(previous_log_fp, 'rb')
+            try:
+                new_lines, num_new_lines = find_new_lines(previous_log_f,
+                                                          log_f)
+            finally:
+                previous_log_f.close()
+            log_f.seek(0, 0)
+            email_body += format_new_log_lines(label, new_lines,
+                                               num_new_lines)
+
+    if num_archived:
+        email_body += ("The logs of %d test suite%s were compared with the "
+                       "previous run's logs instead of being attached (lines "
+                       "that only differ in timestamps, durations, temporary "
+                       "paths, or memory addresses aren't new). The full "
+                       "logs are kept in %s.\n\n" %
+                       (num_archived, 's' if num_archived != 1 else '',
+                        archive_dir))
+    archive_logs(archive_dir, test_suite_logs)
+    return email_body, kept_attachments
+
+def _run_test_suites_with_backend(test_suites, shard_parents,
+                                  execution_backend, cluster_tag,
+                                  setup_timeout, test_suites_timeout,
+                                  teardown_timeout, max_parallel,
+                                  ssh_multiplexing, keep_cluster, state_dir,
+                                  schedule_by_history, fail_fast=False,
+                                  journal_dir=None, artifacts_dir=None,
+                                  retries=0, local_prep_cmds=None,
+                                  per_test_suite_timeout=None):
+    """Sets up somewhere to run the test suites (e.g. a cluster) and runs them.
+
+    Returns the same 3-element tuple as _execute_commands_and_build_email(),
+    with how long each command took (and, if the backend's instances are
+    billed by the hour, the instance time used) added to the email body.
+
+    Arguments:
+        test_suites - the output of _expand_shards()
+        shard_parents - the output of _expand_shards()
+        execution_backend - the clout.backend.ExecutionBackend that builds
+            the commands to run. ssh_multiplexing and keep_cluster require a
+            clout.backend.StarClusterBackend
+        cluster_tag - same as for run_test_suites()
+        setup_timeout - same as for run_test_suites()
+        test_suites_timeout - same as for run_test_suites()
+        teardown_timeout - same as for run_test_suites()
+        max_parallel - same as for run_test_suites()
+        ssh_multiplexing - same as for run_test_suites()
+        keep_cluster - same as for run_test_suites()
+        state_dir - same as for run_test_suites(), but must already exist
+        schedule_by_history - same as for run_test_suites()
+        fail_fast - same as for run_test_suites()
+        journal_dir - the directory of the run journal to resume from and to
+            checkpoint finished test suites in if the cluster is lost (see
+            clout.journal). If provided, execution_backend must be a
+            clout.backend.StarClusterBackend
+        artifacts_dir - the directory to copy the test suites' artifacts to
+            (see run_test_suites()), or None if none of the test suites have
+            artifacts
+        retries - same as for run_test_suites()
+        local_prep_cmds - same as for run_test_suites()
+        per_test_suite_timeout - same as for run_test_suites()
+
+    The teardown commands are run in the background (see
+    _execute_commands_and_build_email()), so the returned run information
+    must be passed to _finish_background_teardown() once the email has been
+    sent.
+    """
+    # Decide which node of the cluster each test suite will run on (and, if
+    # scheduling by history, the order that they will run in).
+    schedule_summary = ''
+    if schedule_by_history:
+        history_conn = open_history_db(get_history_db_fp(state_dir))
+        try:
+            expected_durations = get_typical_durations(history_conn,
+                    [test_suite[0] for test_suite in test_suites],
+                    execution_backend.instance_type)
+        finally:
+            history_conn.close()
+
+        test_suites, node_assignments, expected_makespan = \
+                schedule_test_suites(test_suites, expected_durations,
+                                     execution_backend.node_aliases,
+                                     max_parallel)
+        schedule_summary = format_schedule(test_suites, node_assignments,
+                                           expected_durations,
+                                           expected_makespan)
+    else:
+        node_assignments = _assign_test_suites_to_nodes(test_suites,
+                execution_backend.node_aliases)
+
+    ssh_dir, ssh_config_fp, post_setup_fn = None, None, None
+    if ssh_multiplexing:
+        if execution_backend.key_location is None:
+            raise ValueError("SSH multiplexing requires the cluster "
+                             "template's key to have a KEY_LOCATION defined "
+                             "in the StarCluster config file.")
+
+        # The control sockets live in here, so keep the path short.
+        ssh_dir = mkdtemp(prefix='clout_ssh_', dir='/tmp')
+        ssh_config_fp = join(ssh_dir, 'ssh_config')
+        post_setup_fn = partial(_set_up_ssh_multiplexing,
+                execution_backend.sc_exe_fp, execution_backend.sc_config_fp,
+                cluster_tag, execution_backend.user,
+                execution_backend.key_location, ssh_dir,
+                sorted(set(node_assignments)))
+        execution_backend.ssh_config_fp = ssh_config_fp
+
+    cluster_lost_fn = None
+    if journal_dir is not None:
+        cluster_lost_fn = partial(_is_cluster_lost,
+                execution_backend.sc_exe_fp, execution_backend.sc_config_fp,
+                cluster_tag, execution_backend.cluster_size)
+
+    try:
+        # Get the commands that need to be executed (these include launching
+        # a cluster, running the test suites, and terminating the cluster).
+        setup_cmds, test_suites_cmds, teardown_cmds = \
+                execution_backend.build_commands(test_suites,
+                                                 node_assignments)
+        artifacts_cmds = []
+        if artifacts_dir is not None:
+            artifacts_cmds = execution_backend.build_artifacts_cmds(
+                    test_suites, node_assignments, artifacts_dir)
+
+        if keep_cluster:
+            # Reuse the cluster if it is still running. If it exists but
+            # isn't healthy (e.g. a node was lost), start over with a new one.
+            cluster_status = _get_cluster_status(execution_backend.sc_exe_fp,
+                    execution_backend.sc_config_fp, cluster_tag,
+                    execution_backend.cluster_size, setup_timeout)
+            if cluster_status == 'healthy':
+                setup_cmds = []
+            elif cluster_status == 'unhealthy':
+                setup_cmds = teardown_cmds + setup_cmds
+
+        # Execute the commands and build up the body of an email with the
+        # summarized results as well as the output in log file attachments.
+        email_body, attachments, run_info = _execute_commands_and_build_email(
+                test_suites, setup_cmds, test_suites_cmds, teardown_cmds,
+                setup_timeout, test_suites_timeout, teardown_timeout,
+                cluster_tag, node_assignments, max_parallel, post_setup_fn,
+                keep_cluster, shard_parents, fail_fast, cluster_lost_fn,
+                journal_dir, artifacts_cmds, artifacts_dir, retries,
+                local_prep_cmds, background_teardown=True,
+                per_test_suite_timeout=per_test_suite_timeout)
+    finally:
+        if ssh_dir is not None:
+            _close_ssh_multiplexing(ssh_dir, sorted(set(node_assignments)),
+                                    teardown_timeout)
+            rmtree(ssh_dir, ignore_errors=True)
+
+    # Report how long each phase and test suite took, and how much instance
+    # time the run will be billed for.
+    cmd_records = run_info['cmd_records']
+    email_body += format_timing_table(cmd_records)
+    if execution_backend.billed_instances and cmd_records:
+        email_body += format_instance_time(execution_backend.billed_instances,
+                max([record[4] for record in cmd_records]) -
+                min([record[3] for record in cmd_records]),
+                execution_backend.instance_type)
+
+    email_body += schedule_summary
+    return email_body, attachments, run_info
+
+def _build_run_metrics(test_suite_labels, cached_labels, run_info,
+                       cluster_tag, backend, execution_backend, spot_bid):
+    """Collects a run's metrics into a dictionary.
+
+    The dictionary has the following keys:
+        cluster_tag, backend, instance_type, spot_bid - the settings that
+            the run used (instance_type and spot_bid may be None)
+        billed_instances - the number of instances billed by the hour that
+            the test suites ran on (0 for the local backend)
+        timestamp - when the metrics were collected (in seconds since the
+            epoch)
+        succeeded - True if every test suite passed (or was cached) and
+            nothing timed out
+        phases - a dictionary mapping each phase ('setup', 'test_suite', and
+            'teardown') to a dictionary with the keys 'duration' (the number
+            of seconds from the start of the phase's first command to the end
+            of its last one, or None if none of its commands ran) and
+            'timed_out'
+        test_suites - a list of dictionaries, one for each cached test suite
+            followed by one for each test suite command that was run (i.e.
+            each shard, for test suites that were split into shards), with
+            the keys 'label', 'cached', 'duration', 'return_code',
+            'output_bytes', 'timed_out', and 'cancelled'. duration and
+            output_bytes are None for cached test suites. A test suite
+            command that was rerun on a replacement cluster is only reported
+            once, with the results of its last attempt
+        output_bytes - the total size of the test suites' logs
+        cluster_replacements - the number of times the cluster was replaced
+            after being lost
+
+    Arguments:
+        test_suite_labels - the labels of all of the test suites in the
+            config file
+        cached_labels - the labels of the test suites that were skipped
+            because they had already passed with the same cache key
+        run_info - the third element returned by
+            _execute_commands_and_build_email(), or None if no test suites
+            were run
+        cluster_tag - same as for run_test_suites()
+        backend - same as for run_test_suites()
+        execution_backend - the clout.backend.ExecutionBackend that built
+            the commands
+        spot_bid - same as for run_test_suites()
+    """
+    if run_info is None:
+        run_info = {'cmd_records': [], 'test_suite_results': [],
+                    'output_bytes': {}, 'timeouts': [],
+                    'timed_out_test_suites': [], 'cancelled_test_suites': [],
+                    'cluster_replacements': 0}
+
+    phases = {}
+    for phase in ('setup', 'test_suite', 'teardown'):
+        phase_records = [record for record in run_info['cmd_records']
+                         if record[0] == phase]
+        duration = None
+        if phase_records:
+            duration = max([record[4] for record in phase_records]) - \
+                       min([record[3] for record in phase_records])
+        phases[phase] = {'duration': duration,
+                         'timed_out': phase in run_info['timeouts']}
+
+    test_suites = [{'label': label, 'cached': True, 'duration': None,
+                    'return_code': 0, 'output_bytes': None,
+                    'timed_out': False, 'cancelled': False}
+                   for label in cached_labels]
+    test_suite_positions = {}
+    for phase, label, cmd, start_time, end_time, ret_val in \
+            run_info['cmd_records']:
+        if phase == 'test_suite':
+            test_suite = {'label': label, 'cached': False,
+                    'duration': end_time - start_time,
+                    'return_code': ret_val,
+                    'output_bytes': run_info['output_bytes'].get(label),
+                    'timed_out': label in run_info['timed_out_test_suites'],
+                    'cancelled': label in run_info['cancelled_test_suites']}
+
+            # Each label must only be reported once (e.g. the Prometheus
+            # textfile collector rejects a file with duplicate samples), so
+            # a later attempt replaces one that was lost with its cluster.
+            if label in test_suite_positions:
+                test_suites[test_suite_positions[label]] = test_suite
+            else:
+                test_suite_positions[label] = len(test_suites)
+                test_suites.append(test_suite)
+
+    ret_vals = dict(run_info['test_suite_results'])
+    succeeded = not run_info['timeouts'] and \
+                all([label in cached_labels or ret_vals.get(label) == 0
+                     for label in test_suite_labels])
+
+    return {'cluster_tag': cluster_tag, 'backend': backend,
+            'instance_type': execution_backend.instance_type,
+            'spot_bid': spot_bid,
+            'billed_instances': execution_backend.billed_instances,
+            'timestamp': time(), 'succeeded': succeeded, 'phases': phases,
+            'test_suites': test_suites,
+            'output_bytes': sum(run_info['output_bytes'].values()),
+            'cluster_replacements': run_info['cluster_replacements']}
+
+def _write_run_metrics(metrics_dir, metrics):
+    """Writes a run's metrics to a directory as JSON and Prometheus files.
+
+    Each file is written under a temporary name and then renamed, so that
+    anything reading the directory (e.g. the Prometheus node exporter) never
+    sees a half-written file.
+
+    Arguments:
+        metrics_dir - same as for run_test_suites()
+        metrics - the output of _build_run_metrics()
+    """
+    metrics_dir = expanduser(metrics_dir)
+    if not exists(metrics_dir):
+        makedirs(metrics_dir)
+
+    base_fp = join(metrics_dir, 'clout_%s' % metrics['cluster_tag'])
+    for metrics_fp, metrics_text in (
+            (base_fp + '.json', dumps(metrics, indent=4, sort_keys=True)),
+            (base_fp + '.prom', format_prometheus_metrics(metrics))):
+        metrics_f = open(metrics_fp + '.tmp', 'w')
+        metrics_f.write(metrics_text)
+        metrics_f.close()
+        rename(metrics_fp + '.tmp', metrics_fp)
+
+def _get_cache_keys(test_suites, timeout):
+    """Computes a cache key for each test suite that has a fingerprint.
+
+    A test suite's fingerprint command (see parse_config_file()) is run on
+    the local machine, so that the cluster doesn't need to be started to
+    decide whether the test suite needs to be run. The fingerprint commands
+    are run at the same time. The cache key is a SHA-1 digest of the test
+    suite's command and the output of its fingerprint command, so it changes
+    whenever either of them changes.
+
+    Returns a dictionary mapping test suite labels to cache keys. Test suites
+    whose fingerprint command failed or didn't finish within the timeout are
+    left out (and so are always run).
+
+    Arguments:
+        test_suites - the output of parse_config_file()
+        timeout - the number of minutes to allow all of the fingerprint
+            commands to run
+    """
+    fingerprinted_test_suites = [test_suite for test_suite in test_suites
+                                 if 'fingerprint' in test_suite[2]]
+    if not fingerprinted_test_suites:
+        return {}
+
+    log_f = TemporaryFile(prefix='clout_log', suffix='.txt')
+    fingerprint_cmds = [test_suite[2]['fingerprint']
+                        for test_suite in fingerprinted_test_suites]
+    cmd_executor = CommandExecutor(fingerprint_cmds, log_f,
+                                   log_individual_cmds=True,
+                                   queue_ids=range(len(fingerprint_cmds)))
+    fingerprint_cmds_status = cmd_executor(timeout)[1]
+    log_f.close()
+
+    cache_keys = {}
+    for test_suite, fingerprint_cmd_status in zip(fingerprinted_test_suites,
+                                                  fingerprint_cmds_status):
+        if fingerprint_cmd_status is None:
+            continue
+
+        fingerprint_log_f, ret_val = fingerprint_cmd_status
+        if ret_val == 0:
+            cache_key = sha1(test_suite[1])
+            fingerprint_log_f.seek(0, 0)
+            chunk = fingerprint_log_f.read(LOG_CHUNK_SIZE)
+            while chunk:
+                cache_key.update(chunk)
+                chunk = fingerprint_log_f.read(LOG_CHUNK_SIZE)
+            cache_keys[test_suite[0]] = cache_key.hexdigest()
+        fingerprint_log_f.close()
+    return cache_keys
+
+def _expand_shards(test_suites):
+    """Splits test suites with a shards option into one test suite per shard.
+
+    Each shard runs the test suite's command with the environment variables
+    CLOUT_SHARD_INDEX (0 to one less than the number of shards) and
+    CLOUT_SHARD_COUNT set, so that the command can decide which part of the
+    test suite to run. Shards are labelled with the test suite's label
+    followed by '.shard' and the shard index (e.g. 'QIIME.shard0'), and are
+    otherwise treated like any other test suite (e.g. they can be run on
+    different nodes at the same time).
+
+    Returns a 2-element tuple containing the expanded list of test suites and
+    a dictionary mapping each shard's label to the label of the test suite
+    that it was split from.
+
+    Arguments:
+        test_suites - the output of parse_config_file()
+    """
+    expanded_test_suites, shard_parents = [], {}
+    for label, cmd, options in test_suites:
+        shard_count = options.get('shards', 1)
+        if shard_count == 1:
+            expanded_test_suites.append([label, cmd, options])
+        else:
+            for shard_index in range(shard_count):
+                shard_label = '%s.shard%d' % (label, shard_index)
+                if shard_label in [test_suite[0]
+                                   for test_suite in test_suites]:
+                    raise ValueError("The shard label '%s' is already used "
+                                     "as a test suite label." % shard_label)
+                shard_cmd = ('export CLOUT_SHARD_INDEX=%d CLOUT_SHARD_COUNT=%d'
+                             '; %s' % (shard_index, shard_count, cmd))
+                expanded_test_suites.append([shard_label, shard_cmd, options])
+                shard_parents[shard_label] = label
+    return expanded_test_suites, shard_parents
+
+def _assign_test_suites_to_nodes(test_suites, node_aliases):
+    """Assigns each test suite to a node in the cluster.
+
+    Test suites are dealt out to the nodes in round-robin order, so each node
+    ends up with its own queue of test suites to run, and the queues on the
+    different nodes are run at the same time.
+
+    Returns a list of node aliases, one for each test suite.
+
+    Arguments:
+        test_suites - the output of _expand_shards()
+        node_aliases - the aliases of the nodes to assign test suites to
+    """
+    return [node_aliases[test_suite_num % len(node_aliases)]
+            for test_suite_num in range(len(test_suites))]
 
 def _execute_commands_and_build_email(test_suites, setup_cmds,
                                       test_suites_cmds, teardown_cmds,
                                       setup_timeout, test_suites_timeout,
-                                      teardown_timeout, cluster_tag):
+                                      teardown_timeout, cluster_tag,
+                                      node_assignments=None, max_parallel=1,
+                                      post_setup_fn=None, keep_cluster=False,
+                                      shard_parents=None, fail_fast=False,
+                                      cluster_lost_fn=None, journal_dir=None,
+                                      artifacts_cmds=None,
+                                      artifacts_dir=None, retries=0,
+                                      local_prep_cmds=None,
+                                      background_teardown=False,
+                                      per_test_suite_timeout=None):
     """Executes the test suite commands and builds the body of an email.
 
     Returns the body of an email containing the summarized results and any
     error message or issues that should be brought to the recipient's
-    attention, and a list of attachments, which are the log files from running
-    the commands.
+    attention, a list of attachments, which are the log files from running
+    the commands, and a dictionary of information about the run. The
+    dictionary has the following keys:
+        cluster_kept - True if the cluster was left running (see
+            keep_cluster)
+        cmd_records - a list of 6-element tuples, one for each setup, test
+            suite, and teardown command that was run, in the format expected
+            by clout.history.record_commands()
+        test_suite_results - a list of (test suite label, return value)
+            pairs, one for each test suite that was run (with the results of
+            a test suite's shards merged)
+        output_bytes - a dictionary mapping the label of each test suite
+            command that was run (i.e. each shard's label, for test suites
+            that were split into shards) to the size of its log in bytes
+        timeouts - the phases ('setup', 'test_suite', or 'teardown') that
+            timed out
+        timed_out_test_suites - the labels of the test suite commands that
+            were running when the test suites timed out, or that failed
+            because they ran for longer than per_test_suite_timeout
+        cancelled_test_suites - the labels of the test suite commands that
+            were terminated by fail_fast
+        first_failure - the label of the test suite command whose failure
+            stopped the run early because of fail_fast, or None
+        resumed_test_suites - the labels of the test suite commands whose
+            results were taken from the run journal
+        cluster_replacements - the number of times the cluster was replaced
+            after being lost
+        cluster_lost - True if the cluster was lost and not replaced, so
+            some test suites didn't finish
+        artifacts - a dictionary mapping the label of each test suite
+            command that artifacts were copied back for to a sorted list of
+            (path relative to the test suite's directory in artifacts_dir,
+            size in bytes) pairs
+        junit_results - the output of _summarize_junit_reports() for the
+            JUnit XML reports that were copied back (empty if the artifacts
+            weren't copied)
+        retried_test_suites - a dictionary mapping the label of each test
+            suite command that failed and was retried to the number of
+            times it was retried
+        flaky_test_suites - a dictionary mapping the label of each test
+            suite command that failed and then passed when retried to the
+            number of the retry that passed
+        teardown - the output of _start_background_teardown() if the
+            teardown commands are running in the background (see
+            background_teardown), otherwise None
 
     Arguments:
-        test_suites - the output of _parse_config_file()
-        setup_cmds - the output of _build_test_execution_commands()
-        test_suites_cmds - the output of _build_test_execution_commands()
-        teardown_cmds - the output of _build_test_execution_commands()
+        test_suites - the output of _expand_shards()
+        setup_cmds - the output of ExecutionBackend.build_commands()
+        test_suites_cmds - the output of ExecutionBackend.build_commands()
+        teardown_cmds - the output of ExecutionBackend.build_commands()
         setup_timeout - same as for run_test_suites()
         test_suites_timeout - same as for run_test_suites()
         teardown_timeout - same as for run_test_suites()
         cluster_tag - same as for run_test_suites()
+        node_assignments - the output of _assign_test_suites_to_nodes(). Test
+            suites assigned to different nodes are run at the same time. If
+            None, the test suites are run one after another
+        max_parallel - same as for run_test_suites()
+        post_setup_fn - a function to call once the setup commands have
+            succeeded, before any test suites are run. It is passed the
+            complete log file and setup_timeout, and must return True, False,
+            or None (for a timeout), just like the first element returned by
+            CommandExecutor. If it doesn't return True, setup is considered to
+            have failed
+        keep_cluster - if True, the teardown commands will not be run unless
+            something went wrong during setup or a test suite timed out or was
+            cancelled by fail_fast (in which case the cluster may not be in a
+            usable state)
+        shard_parents - the output of _expand_shards(). The results of a test
+            suite's shards are merged into a single line in the summary and a
+            single log file attachment
+        fail_fast - same as for run_test_suites()
+        cluster_lost_fn - a function to call when some test suites didn't
+            finish (i.e. they weren't run, timed out, were cancelled, or
+            exited with SSH's error code, 255). It is passed setup_timeout,
+            and must return True if the cluster has been lost, in which case
+            the teardown and setup commands (and post_setup_fn) are run again
+            to replace it, and the test suites that didn't finish are run on
+            the replacement. If None, the cluster is never replaced
+        journal_dir - the run journal's directory (see clout.journal). The
+            test suites in the journal aren't run again, the test suites that
+            finished are added to it when the cluster is lost, and it is
+            removed once every test suite has finished. If None, no journal
+            is kept
+        artifacts_cmds - the output of
+            ExecutionBackend.build_artifacts_cmds(). They are run (at the
+            same time, within teardown_timeout) after the test suites and
+            before the teardown commands, as long as the cluster was started
+            and wasn't lost
+        artifacts_dir - the directory that artifacts_cmds copy the artifacts
+            to. Anything already in it is removed first
+        retries - the number of times to retry each test suite that failed
+            (on the same cluster, within test_suites_timeout), unless the
+            test suite has its own retries option. Nothing is retried if
+            fail_fast is True, the test suites timed out, or the cluster was
+            lost. See _retry_failed_test_suites()
+        local_prep_cmds - same as for run_test_suites(). They are run at the
+            same time as the setup commands (in a separate queue), and count
+            as part of setup. If one of them fails, the setup commands that
+            are still running are cancelled (and vice versa). They are
+            recorded with the phase 'local_prep'
+        background_teardown - if True, the teardown commands are started in
+            a background thread instead of being waited for, so that the
+            email can be prepared and sent while the cluster is terminated.
+            If setup didn't succeed, they are waited for as usual, since
+            problems in terminating a cluster that didn't start are part of
+            the same story. In the background, their output is logged to a
+            separate file, since the complete log may be read while they
+            run. _finish_background_teardown() must be called to wait for
+            them
+        per_test_suite_timeout - same as for run_test_suites(). Applies to
+            retries too
     """
     email_body = ""
     attachments = []
+    run_info = {'cluster_kept': False, 'cmd_records': [],
+                'test_suite_results': [], 'output_bytes': {}, 'timeouts': [],
+                'timed_out_test_suites': [], 'cancelled_test_suites': [],
+                'first_failure': None, 'resumed_test_suites': [],
+                'cluster_replacements': 0, 'cluster_lost': False,
+                'artifacts': {}, 'junit_results': [],
+                'retried_test_suites': {}, 'flaky_test_suites': {},
+                'teardown': None}
+    test_suites_cmds_succeeded = False
+
+    # Reuse the results of the test suites that finished in an earlier run
+    # whose cluster was lost. If every test suite finished, the cluster isn't
+    # needed.
+    resumed = {}
+    if journal_dir is not None:
+        resumed = load_journal(journal_dir, test_suites)
+        if len(resumed) == len(test_suites):
+            setup_cmds, teardown_cmds, artifacts_cmds = [], [], []
+            local_prep_cmds = None
+            post_setup_fn, keep_cluster = None, False
 
     # Create a unique temporary file to hold the results of all commands.
     log_f = TemporaryFile(prefix='clout_log', suffix='.txt')
     attachments.append(('complete_log.txt', log_f))
 
     # Build up the body of the email as we execute the commands. First, execute
-    # the setup commands.
-    cmd_executor = CommandExecutor(setup_cmds, log_f,
-                                   stop_on_first_failure=True)
+    # the setup commands, along with the local preparation commands (which
+    # run on this machine while the cluster boots). If either of them fails,
+    # the other is cancelled instead of being waited for, since the test
+    # suites can't be run anyway.
+    if local_prep_cmds is None:
+        local_prep_cmds = []
+    cmd_executor = CommandExecutor(setup_cmds + local_prep_cmds, log_f,
+            stop_on_first_failure=True,
+            queue_ids=['setup'] * len(setup_cmds) +
+                      ['local_prep'] * len(local_prep_cmds),
+            cancel_on_first_failure=bool(local_prep_cmds))
     setup_cmds_succeeded = cmd_executor(setup_timeout)[0]
+    cmd_executor.queue_ids = None
+    local_prep_failed = cmd_executor.first_failed_cmd is not None and \
+                        cmd_executor.first_failed_cmd >= len(setup_cmds)
+    run_info['cmd_records'].extend(_build_cmd_records('setup',
+            ['setup'] * len(setup_cmds), cmd_executor))
+    local_prep_records = _build_cmd_records('local_prep',
+            ['local_prep'] * len(local_prep_cmds), cmd_executor,
+            len(setup_cmds))
+    run_info['cmd_records'].extend(local_prep_records)
+
+    if setup_cmds_succeeded and post_setup_fn is not None:
+        setup_cmds_succeeded = post_setup_fn(log_f, setup_timeout)
 
     if setup_cmds_succeeded is None:
+        run_info['timeouts'].append('setup')
         email_body += ("The maximum allowable cluster setup time of %s "
                        "minute(s) was exceeded.\n\n" % str(setup_timeout))
+    elif local_prep_failed:
+        email_body += ("There were problems in running the local "
+                       "preparation commands while the cluster was starting. "
+                       "Please check the attached log for more details.\n\n")
     elif not setup_cmds_succeeded:
         email_body += ("There were problems in starting the cluster while "
                        "preparing to execute the test suite(s). Please check "
@@ -215,56 +1404,362 @@ def _execute_commands_and_build_email(test_suites, setup_cmds,
         # names, we'll also specify what we want the file to be called when it
         # is attached to the email (we don't have to worry about having unique
         # filenames at that point).
-        cmd_executor.cmds = test_suites_cmds
+        #
+        # If the cluster is lost while the test suites are running (e.g.
+        # because its spot instances were reclaimed), the test suites that
+        # finished are checkpointed in the run journal and a replacement
+        # cluster is started to run the rest, as long as there is time left.
+        test_suites_cmds_status = [None] * len(test_suites)
+        for cmd_index, resumed_status in resumed.items():
+            test_suites_cmds_status[cmd_index] = resumed_status[:2]
+        pending_cmds = [cmd_index for cmd_index in range(len(test_suites))
+                        if cmd_index not in resumed]
+        timed_out_cmds, cancelled_cmds, first_failed_cmd = [], [], None
+        cmd_times = {}
+        attempt_succeeded = True
+        deadline = time() + float(test_suites_timeout) * 60.0
+
         cmd_executor.stop_on_first_failure = False
         cmd_executor.log_individual_cmds = True
-        test_suites_cmds_succeeded, test_suites_cmds_status = \
-                cmd_executor(test_suites_timeout)
+        cmd_executor.max_parallel = max_parallel
+        cmd_executor.cancel_on_first_failure = fail_fast
+        cmd_executor.cmd_timeout = per_test_suite_timeout
+        while pending_cmds:
+            attempt_cmds, pending_cmds = pending_cmds, []
+            cmd_executor.cmds = [test_suites_cmds[cmd_index]
+                                 for cmd_index in attempt_cmds]
+            if node_assignments is None:
+                cmd_executor.queue_ids = None
+            else:
+                cmd_executor.queue_ids = [node_assignments[cmd_index]
+                                          for cmd_index in attempt_cmds]
+            attempt_succeeded, attempt_status = \
+                    cmd_executor(max(deadline - time(), 0.0) / 60.0)
+            run_info['cmd_records'].extend(_build_cmd_records('test_suite',
+                    [test_suites[cmd_index][0] for cmd_index in attempt_cmds],
+                    cmd_executor))
+
+            unfinished_cmds = []
+            for pos, cmd_index in enumerate(attempt_cmds):
+                if cmd_executor.cmd_records[pos] is not None:
+                    cmd_times[cmd_index] = cmd_executor.cmd_records[pos][:2]
+                if pos < len(attempt_status) and \
+                   attempt_status[pos] is not None:
+                    if test_suites_cmds_status[cmd_index] is not None:
+                        # The log of a test suite that was cut short.
+                        test_suites_cmds_status[cmd_index][0].close()
+                    test_suites_cmds_status[cmd_index] = attempt_status[pos]
+                if pos >= len(attempt_status) or \
+                   attempt_status[pos] is None or \
+                   attempt_status[pos][1] == SSH_ERROR_RETURN_CODE or \
+                   pos in cmd_executor.timed_out_cmds or \
+                   pos in cmd_executor.cancelled_cmds:
+                    unfinished_cmds.append(cmd_index)
+            timed_out_cmds = [attempt_cmds[pos]
+                              for pos in cmd_executor.timed_out_cmds]
+            cancelled_cmds = [attempt_cmds[pos]
+                              for pos in cmd_executor.cancelled_cmds]
+            first_failed_cmd = None
+            if cmd_executor.first_failed_cmd is not None:
+                first_failed_cmd = attempt_cmds[cmd_executor.first_failed_cmd]
+
+            # A test suite that failed on its own isn't rerun (even if the
+            # cluster was lost afterwards) when failing fast.
+            if not unfinished_cmds or cluster_lost_fn is None or \
+               (fail_fast and first_failed_cmd is not None and
+                test_suites_cmds_status[first_failed_cmd][1] !=
+                SSH_ERROR_RETURN_CODE) or \
+               not cluster_lost_fn(setup_timeout):
+                break
+
+            if journal_dir is not None:
+                record_test_suites(journal_dir, [(test_suites[cmd_index][0],
+                        test_suites[cmd_index][1],
+                        test_suites_cmds_status[cmd_index][0],
+                        test_suites_cmds_status[cmd_index][1])
+                        + cmd_times[cmd_index]
+                        for cmd_index in attempt_cmds
+                        if cmd_index not in unfinished_cmds])
+
+            unfinished_labels = ', '.join([test_suites[cmd_index][0]
+                                           for cmd_index in unfinished_cmds])
+            email_body += ("The cluster was lost while the test suites were "
+                           "running (e.g. because its spot instances were "
+                           "reclaimed). ")
+            if run_info['cluster_replacements'] >= MAX_CLUSTER_REPLACEMENTS:
+                email_body += ("It has already been replaced %d time(s), so "
+                               "it wasn't replaced again. "
+                               % run_info['cluster_replacements'])
+            elif deadline - time() <= 0:
+                email_body += ("There was no time left to start a "
+                               "replacement cluster. ")
+            else:
+                run_info['cluster_replacements'] += 1
+                replacement_succeeded = _replace_cluster(setup_cmds,
+                        teardown_cmds, setup_timeout, teardown_timeout,
+                        post_setup_fn, log_f, run_info['cmd_records'])
+                if replacement_succeeded and deadline - time() <= 0:
+                    # Starting the replacement used up the rest of the time,
+                    # so the test suites that didn't finish are reported as
+                    # untested by the timeout below.
+                    email_body += ("A replacement cluster was started, but "
+                                   "there was no time left to run the test "
+                                   "suites that didn't finish on it.\n\n")
+                    attempt_succeeded, attempt_status = None, []
+                    attempt_cmds = unfinished_cmds
+                    timed_out_cmds, cancelled_cmds = [], []
+                    first_failed_cmd = None
+                    break
+                if replacement_succeeded:
+                    email_body += ("A replacement cluster was started to run "
+                                   "the test suites that didn't finish: "
+                                   "%s\n\n" % unfinished_labels)
+                    pending_cmds = unfinished_cmds
+                    continue
+                email_body += ("A replacement cluster could not be started. "
+                               "Please check the attached log for more "
+                               "details. ")
+            run_info['cluster_lost'] = True
+            email_body += ("The following test suites didn't finish: %s\n\n"
+                           % unfinished_labels)
+            if journal_dir is not None:
+                email_body += ("The results of the test suites that finished "
+                               "were saved, so running clout again with "
+                               "--resume will only run the ones that "
+                               "didn't.\n\n")
+
+        cmd_executor.queue_ids = None
+        cmd_executor.max_parallel = 1
+        cmd_executor.cancel_on_first_failure = False
+        cmd_executor.cmd_timeout = None
+        if journal_dir is not None and not run_info['cluster_lost']:
+            remove_journal(journal_dir)
+
+        # Rerun the test suites that failed on the same cluster, while there
+        # is time left, to tell flaky failures apart from hard ones.
+        num_retries, retries_timed_out = {}, False
+        if attempt_succeeded is not None and not fail_fast and \
+           not run_info['cluster_lost']:
+            max_retries = [retries] * len(test_suites)
+            for cmd_index, test_suite in enumerate(test_suites):
+                if len(test_suite) > 2:
+                    max_retries[cmd_index] = test_suite[2].get('retries',
+                                                               retries)
+            num_retries, retries_timed_out = _retry_failed_test_suites(
+                    test_suites, test_suites_cmds, test_suites_cmds_status,
+                    [cmd_index for cmd_index in range(len(test_suites))
+                     if cmd_index not in resumed and
+                     test_suites_cmds_status[cmd_index] is not None],
+                    max_retries, deadline, log_f, node_assignments,
+                    max_parallel, run_info['cmd_records'],
+                    per_test_suite_timeout)
+        for cmd_index in sorted(num_retries):
+            label = test_suites[cmd_index][0]
+            run_info['retried_test_suites'][label] = num_retries[cmd_index]
+            if test_suites_cmds_status[cmd_index][1] == 0:
+                run_info['flaky_test_suites'][label] = num_retries[cmd_index]
+
+        if attempt_succeeded is None:
+            test_suites_cmds_succeeded = None
+        else:
+            test_suites_cmds_succeeded = not [test_suite_status
+                    for test_suite_status in test_suites_cmds_status
+                    if test_suite_status is None or test_suite_status[1] != 0]
+        for test_suite, test_suite_status in zip(test_suites,
+                                                 test_suites_cmds_status):
+            if test_suite_status is not None:
+                test_suite_status[0].seek(0, 2)
+                run_info['output_bytes'][test_suite[0]] = \
+                        test_suite_status[0].tell()
+
+        # If a failure stopped the run early, start with a short report of
+        # what happened so that it is the first thing the recipients see.
+        run_info['cancelled_test_suites'] = [test_suites[cmd_index][0]
+                for cmd_index in cancelled_cmds]
+        untested_suites = [test_suite[0] for cmd_index, test_suite in
+                           enumerate(test_suites)
+                           if test_suites_cmds_status[cmd_index] is None]
+        if first_failed_cmd is not None and test_suites_cmds_succeeded is \
+           not None and (cancelled_cmds or untested_suites):
+            first_failure = test_suites[first_failed_cmd][0]
+            run_info['first_failure'] = first_failure
+            start_time = min([record[3] for record in run_info['cmd_records']
+                              if record[0] == 'test_suite'])
+            email_body += format_first_failure(first_failure,
+                    test_suites_cmds_status[first_failed_cmd][1],
+                    cmd_times[first_failed_cmd][1] - start_time,
+                    run_info['cancelled_test_suites'], untested_suites)
+
+        if resumed:
+            run_info['resumed_test_suites'] = [test_suites[cmd_index][0]
+                    for cmd_index in sorted(resumed)]
+            email_body += ("The following test suites finished in an earlier "
+                           "run whose cluster was lost, so they weren't run "
+                           "again: %s\n\n" %
+                           ', '.join(run_info['resumed_test_suites']))
 
         # It is okay if there are fewer test suites that got executed than
         # there were input test suites (which is possible if we encounter a
         # timeout). Just report the ones that finished.
+        #
+        # The cancelled, resumed, and flaky test suites are recorded by the
+        # labels of their commands, so map each shard to the test suite that
+        # it was split from. A test suite is cancelled if any of its shards
+        # were, resumed if all of them were, and flaky if any of them were
+        # (and it passed in the end).
+        if shard_parents is None:
+            shard_parents = {}
+        cancelled_labels = set([shard_parents.get(label, label)
+                for label in run_info['cancelled_test_suites']])
+        resumed_labels = set([shard_parents.get(label, label)
+                for label in run_info['resumed_test_suites']]) - \
+                set([shard_parents.get(test_suites[cmd_index][0],
+                                       test_suites[cmd_index][0])
+                     for cmd_index in range(len(test_suites))
+                     if cmd_index not in resumed])
+        flaky_retries = {}
+        for label, retry_num in run_info['flaky_test_suites'].items():
+            label = shard_parents.get(label, label)
+            flaky_retries[label] = max(flaky_retries.get(label, 0),
+                                       retry_num)
+
         label_to_ret_val = []
-        for (label, cmd), (test_suite_log_f, ret_val) in \
-                zip(test_suites, test_suites_cmds_status):
-            label_to_ret_val.append((label, ret_val))
+        for label, test_suite_status in _merge_shards(test_suites,
+                test_suites_cmds_status, shard_parents):
+            test_suite_log_f = test_suite_status[0]
+            note = None
+            if label in cancelled_labels:
+                note = 'cancelled'
+            elif label in resumed_labels:
+                note = 'from an earlier run'
+            elif label in flaky_retries and test_suite_status[1] == 0:
+                note = 'flaky, passed on retry %d' % flaky_retries[label]
+            if note is not None:
+                if len(test_suite_status) > 2:
+                    # The note describing the test suite's shards.
+                    test_suite_status = test_suite_status[:2] + \
+                            ('%s, %s' % (test_suite_status[2], note),)
+                else:
+                    test_suite_status += (note,)
+            label_to_ret_val.append((label,) + test_suite_status[1:])
+            run_info['test_suite_results'].append((label,
+                                                   test_suite_status[1]))
             attachments.append(('%s_results.txt' % label, test_suite_log_f))
 
         # Build a summary of the test suites that passed and those that didn't.
         email_body += format_email_summary(label_to_ret_val)
+        email_body += format_retry_results(
+                [(test_suites[cmd_index][0], num_retries[cmd_index])
+                 for cmd_index in sorted(num_retries)
+                 if test_suites_cmds_status[cmd_index][1] == 0],
+                [(test_suites[cmd_index][0], num_retries[cmd_index])
+                 for cmd_index in sorted(num_retries)
+                 if test_suites_cmds_status[cmd_index][1] != 0])
+        if retries_timed_out:
+            email_body += ("The maximum allowable time of %s minute(s) for "
+                           "all test suites to run was reached while "
+                           "retrying the test suites that failed, so some of "
+                           "them were retried fewer times than allowed.\n\n"
+                           % str(test_suites_timeout))
+
+        # Test suites that ran for too long on their own were terminated
+        # without stopping the others. They still count as timed out, unless
+        # they passed when retried.
+        if attempt_succeeded is not None:
+            run_info['timed_out_test_suites'] = [test_suites[cmd_index][0]
+                    for cmd_index in timed_out_cmds
+                    if test_suites_cmds_status[cmd_index][1] != 0]
+            if run_info['timed_out_test_suites']:
+                email_body += ("The following test suites were terminated "
+                               "because they ran for longer than the maximum "
+                               "allowable time of %s minute(s) for each test "
+                               "suite: %s\n\n" %
+                               (str(per_test_suite_timeout),
+                                ', '.join(run_info['timed_out_test_suites'])))
 
         if test_suites_cmds_succeeded is None:
-            timeout_test_suite = \
-                    test_suites[len(test_suites_cmds_status) - 1][0]
-            untested_suites = [label for label, cmd in
-                               test_suites[len(test_suites_cmds_status):]]
+            timeout_test_suites = [test_suites[cmd_index][0]
+                                   for cmd_index in timed_out_cmds]
+            if not timeout_test_suites and attempt_status:
+                timeout_test_suites = [test_suites[attempt_cmds[
+                        len(attempt_status) - 1]][0]]
+            run_info['timeouts'].append('test_suite')
+            run_info['timed_out_test_suites'] = timeout_test_suites
             email_body += ("The maximum allowable time of %s minute(s) for "
-                           "all test suites to run was exceeded. The timeout "
-                           "occurred while running the %s test suite." %
-                           (str(test_suites_timeout), timeout_test_suite))
+                           "all test suites to run was exceeded. " %
+                           str(test_suites_timeout))
+            if timeout_test_suites:
+                email_body += ("The timeout occurred while running the %s "
+                               "test suite%s." %
+                               (', '.join(timeout_test_suites),
+                                's' if len(timeout_test_suites) > 1 else ''))
+            else:
+                # None of the test suites in the last attempt (e.g. on a
+                # replacement cluster) had started, so none of them were
+                # tested, even if they started on the cluster that was lost.
+                email_body += ("The timeout occurred before any of the "
+                               "remaining test suites had started.")
+                untested_suites = [test_suites[cmd_index][0]
+                                   for cmd_index in sorted(attempt_cmds)]
             if untested_suites:
                 email_body += (" The following test suites were not tested: "
-                               "%s\n\n" % ', '.join(untested_suites))
+                               "%s" % ', '.join(untested_suites))
+            email_body += "\n\n"
 
-    # Lastly, execute the teardown commands.
-    cluster_termination_msg = ("IMPORTANT: You should check that the cluster "
-                               "labelled with the tag '%s' was properly "
-                               "terminated. If not, you should manually "
-                               "terminate it.\n\n" % cluster_tag)
+    # Copy the files that the test suites wrote back from the cluster before
+    # it is terminated.
+    if setup_cmds_succeeded and artifacts_cmds and \
+       not run_info['cluster_lost']:
+        artifacts_succeeded, run_info['artifacts'] = _retrieve_artifacts(
+                artifacts_cmds, artifacts_dir, teardown_timeout, log_f,
+                run_info['cmd_records'])
+        run_info['junit_results'] = _summarize_junit_reports(test_suites,
+                run_info['artifacts'], artifacts_dir, shard_parents)
+        email_body += format_junit_results(run_info['junit_results'])
+        email_body += format_artifacts_summary(
+                [test_suite[0] for test_suite in test_suites
+                 if get_artifact_patterns(test_suite[2])],
+                run_info['artifacts'], artifacts_dir)
+
+        if artifacts_succeeded is None:
+            email_body += ("The maximum allowable time of %s minute(s) for "
+                           "copying the artifacts was exceeded, so some of "
+                           "them may be missing.\n\n" % str(teardown_timeout))
+        elif not artifacts_succeeded:
+            email_body += ("There were problems in copying the artifacts. "
+                           "Please check the attached log for more "
+                           "details.\n\n")
+
+    # Lastly, execute the teardown commands, unless the cluster is being kept
+    # for the next run.
+    if keep_cluster and setup_cmds_succeeded and \
+       test_suites_cmds_succeeded is not None and \
+       not run_info['cancelled_test_suites'] and \
+       not run_info['timed_out_test_suites'] and not run_info['cluster_lost']:
+        run_info['cluster_kept'] = True
+        teardown_cmds = []
+        email_body += ("The cluster labelled with the tag '%s' was left "
+                       "running so that it can be reused.\n\n" % cluster_tag)
 
     cmd_executor.cmds = teardown_cmds
     cmd_executor.stop_on_first_failure = False
     cmd_executor.log_individual_cmds = False
-    teardown_cmds_succeeded = cmd_executor(teardown_timeout)[0]
-
-    if teardown_cmds_succeeded is None:
-        email_body += ("The maximum allowable cluster termination time of "
-                       "%s minute(s) was exceeded.\n\n%s" %
-                       (str(teardown_timeout), cluster_termination_msg))
-    elif not teardown_cmds_succeeded:
-        email_body += ("There were problems in terminating the cluster. "
-                       "Please check the attached log for more details.\n\n%s"
-                       % cluster_termination_msg)
+    if background_teardown and teardown_cmds and setup_cmds_succeeded:
+        run_info['teardown'] = _start_background_teardown(cmd_executor,
+                                                          teardown_timeout)
+        email_body += ("The cluster labelled with the tag '%s' is being "
+                       "terminated while this email is sent, so the time "
+                       "that takes isn't included below. Any problems in "
+                       "terminating it will be reported in a follow-up "
+                       "email.\n\n" % cluster_tag)
+    else:
+        teardown_cmds_succeeded = cmd_executor(teardown_timeout)[0]
+        run_info['cmd_records'].extend(_build_cmd_records('teardown',
+                ['teardown'] * len(teardown_cmds), cmd_executor))
+        if teardown_cmds_succeeded is None:
+            run_info['timeouts'].append('teardown')
+        email_body += _build_teardown_message(teardown_cmds_succeeded,
+                                              teardown_timeout, cluster_tag)
 
     # Set our file position to the beginning for all attachments since we are
     # in read/write mode and we need to read from the beginning again. Closing
@@ -272,4 +1767,657 @@ def _execute_commands_and_build_email(test_suites, setup_cmds,
     for attachment in attachments:
         attachment[1].seek(0, 0)
 
+    return email_body, attachments, run_info
+
+def _build_teardown_message(teardown_cmds_succeeded, teardown_timeout,
+                            cluster_tag):
+    """Returns the email text reporting problems in terminating the cluster.
+
+    Returns an empty string if there weren't any problems.
+
+    Arguments:
+        teardown_cmds_succeeded - the first element returned by the
+            CommandExecutor that ran the teardown commands
+        teardown_timeout - same as for run_test_suites()
+        cluster_tag - same as for run_test_suites()
+    """
+    cluster_termination_msg = ("IMPORTANT: You should check that the cluster "
+                               "labelled with the tag '%s' was properly "
+                               "terminated. If not, you should manually "
+                               "terminate it.\n\n" % cluster_tag)
+
+    if teardown_cmds_succeeded is None:
+        return ("The maximum allowable cluster termination time of %s "
+                "minute(s) was exceeded.\n\n%s" %
+                (str(teardown_timeout), cluster_termination_msg))
+    elif not teardown_cmds_succeeded:
+        return ("There were problems in terminating the cluster. Please "
+                "check the attached log for more details.\n\n%s" %
+                cluster_termination_msg)
+    return ''
+
+def _start_background_teardown(cmd_executor, teardown_timeout):
+    """Starts running the teardown commands in a background thread.
+
+    The commands' output is logged to a new temporary file instead of the
+    CommandExecutor's log file, since that is attached to the email while the
+    commands run.
+
+    Returns a dictionary with the keys 'thread' (the threading.Thread running
+    the commands) and 'log_f' (the teardown log), along with 'succeeded' (the
+    first element returned by the CommandExecutor) and 'cmd_records' (the
+    commands' history records), which are filled in when the commands have
+    finished.
+
+    Arguments:
+        cmd_executor - the CommandExecutor to run the teardown commands with
+            (its cmds must already be set to them)
+        teardown_timeout - same as for run_test_suites()
+    """
+    teardown = {'log_f': TemporaryFile(prefix='clout_log', suffix='.txt'),
+                'succeeded': False, 'cmd_records': []}
+    cmd_executor.log_f = teardown['log_f']
+
+    def run_teardown_cmds():
+        teardown['succeeded'] = cmd_executor(teardown_timeout)[0]
+        teardown['cmd_records'] = _build_cmd_records('teardown',
+                ['teardown'] * len(cmd_executor.cmds), cmd_executor)
+
+    teardown['thread'] = Thread(target=run_teardown_cmds)
+    teardown['thread'].start()
+    return teardown
+
+def _finish_background_teardown(run_info, teardown_timeout, cluster_tag):
+    """Waits for the teardown commands running in the background to finish.
+
+    The teardown commands' history records are added to run_info, as is a
+    teardown timeout.
+
+    Returns the body of a follow-up email reporting the problems in
+    terminating the cluster, or an empty string if there weren't any.
+
+    Arguments:
+        run_info - the third element returned by
+            _execute_commands_and_build_email(). Its 'teardown' entry must not
+            be None
+        teardown_timeout - same as for run_test_suites()
+        cluster_tag - same as for run_test_suites()
+    """
+    teardown = run_info['teardown']
+    teardown['thread'].join()
+    run_info['cmd_records'].extend(teardown['cmd_records'])
+    if teardown['succeeded'] is None:
+        run_info['timeouts'].append('teardown')
+
+    teardown_msg = _build_teardown_message(teardown['succeeded'],
+                                           teardown_timeout, cluster_tag)
+    if teardown_msg:
+        teardown_msg = ("The cluster labelled with the tag '%s' was being "
+                        "terminated while the test suite results were "
+                        "emailed.\n\n%s" % (cluster_tag, teardown_msg))
+    return teardown_msg
+
+def _retry_failed_test_suites(test_suites, test_suites_cmds,
+                              test_suites_cmds_status, retry_cmds,
+                              max_retries, deadline, log_f,
+                              node_assignments=None, max_parallel=1,
+                              cmd_records=None, cmd_timeout=None):
+    """Reruns the test suites that failed until they pass or run out of tries.
+
+    The test suites that failed are rerun together in rounds, on the same
+    nodes as before, until each one has passed or has been retried as many
+    times as it is allowed. The output of each retry is added to the end of
+    the test suite's log, and its status is replaced by the result of its
+    latest retry. No more rounds are started once the deadline has passed,
+    and a retry that is still running at the deadline is terminated without
+    changing the test suite's status.
+
+    Returns a 2-element tuple containing a dictionary mapping the index of
+    each test suite command that was retried to the number of times it was
+    retried, and True if the retries were cut short by the deadline (False
+    otherwise).
+
+    Arguments:
+        test_suites - the output of _expand_shards()
+        test_suites_cmds - the output of ExecutionBackend.build_commands()
+        test_suites_cmds_status - the (log file, return value) pair of each
+            test suite command. It is updated in place
+        retry_cmds - the indices of the test suite commands that may be
+            retried if they failed
+        max_retries - the maximum number of times that each test suite
+            command may be retried
+        deadline - the time (in seconds since the epoch) that the retries
+            must finish by
+        log_f - the complete log file
+        node_assignments - same as for _execute_commands_and_build_email()
+        max_parallel - same as for run_test_suites()
+        cmd_records - if provided, a history record is added to this list
+            for each retry, with the phase 'retry'
+        cmd_timeout - the number of minutes that each retry may run for
+            before it is terminated (which counts as a failure)
+    """
+    num_retries, timed_out = {}, False
+    while True:
+        round_cmds = [cmd_index for cmd_index in retry_cmds
+                      if test_suites_cmds_status[cmd_index][1] != 0 and
+                      num_retries.get(cmd_index, 0) < max_retries[cmd_index]]
+        if not round_cmds:
+            break
+        if deadline - time() <= 0:
+            timed_out = True
+            break
+
+        queue_ids = None
+        if node_assignments is not None:
+            queue_ids = [node_assignments[cmd_index]
+                         for cmd_index in round_cmds]
+        cmd_executor = CommandExecutor([test_suites_cmds[cmd_index]
+                                        for cmd_index in round_cmds], log_f,
+                                       log_individual_cmds=True,
+                                       queue_ids=queue_ids,
+                                       max_parallel=max_parallel,
+                                       cmd_timeout=cmd_timeout)
+        round_succeeded, round_status = cmd_executor(
+                max(deadline - time(), 0.0) / 60.0)
+        if cmd_records is not None:
+            cmd_records.extend(_build_cmd_records('retry',
+                    [test_suites[cmd_index][0] for cmd_index in round_cmds],
+                    cmd_executor))
+
+        for pos, cmd_index in enumerate(round_cmds):
+            if pos >= len(round_status) or round_status[pos] is None:
+                continue
+            num_retries[cmd_index] = num_retries.get(cmd_index, 0) + 1
+
+            retry_log_f, retry_ret_val = round_status[pos]
+            test_suite_log_f = test_suites_cmds_status[cmd_index][0]
+            test_suite_log_f.seek(0, 2)
+            test_suite_log_f.write('\nRetry %d:\n\n' % num_retries[cmd_index])
+            retry_log_f.seek(0, 0)
+            copyfileobj(retry_log_f, test_suite_log_f, LOG_CHUNK_SIZE)
+            retry_log_f.close()
+
+            if pos not in cmd_executor.timed_out_cmds:
+                test_suites_cmds_status[cmd_index] = (test_suite_log_f,
+                                                      retry_ret_val)
+
+        if round_succeeded is None:
+            timed_out = True
+            break
+    return num_retries, timed_out
+
+def _merge_shards(test_suites, test_suites_cmds_status, shard_parents=None):
+    """Merges the results of each test suite's shards.
+
+    Returns a list of (label, (log file, return value[, note])) pairs, one
+    for each test suite that was at least partially run, in the order that
+    they were run. Test suites that weren't split into shards are passed
+    through unchanged. For a test suite that was split into shards, the log
+    files of its shards are concatenated into a single log file, and the
+    merged return value is the first nonzero return value of its shards, 0 if
+    every shard passed, or None if any of its shards weren't run. The note
+    describes how many of the shards passed.
+
+    Arguments:
+        test_suites - the output of _expand_shards()
+        test_suites_cmds_status - the status list returned by the
+            CommandExecutor that ran the test suites
+        shard_parents - the output of _expand_shards()
+    """
+    if shard_parents is None:
+        shard_parents = {}
+
+    merged_labels, shards = [], {}
+    for cmd_index, test_suite in enumerate(test_suites):
+        label = shard_parents.get(test_suite[0], test_suite[0])
+        if label not in shards:
+            merged_labels.append(label)
+            shards[label] = []
+        test_suite_status = None
+        if cmd_index < len(test_suites_cmds_status):
+            test_suite_status = test_suites_cmds_status[cmd_index]
+        shards[label].append((test_suite[0], test_suite_status))
+
+    merged_statuses = []
+    for label in merged_labels:
+        if label not in shard_parents.values():
+            test_suite_status = shards[label][0][1]
+            if test_suite_status is not None:
+                merged_statuses.append((label, test_suite_status))
+            continue
+
+        started_shards = [(shard_label, shard_status)
+                          for shard_label, shard_status in shards[label]
+                          if shard_status is not None]
+        if not started_shards:
+            continue
+
+        merged_log_f = TemporaryFile(prefix='clout_log', suffix='.txt')
+        num_failed, merged_ret_val = 0, 0
+        for shard_label, (shard_log_f, shard_ret_val) in started_shards:
+            merged_log_f.write('Shard:\n\n%s\n\n' % shard_label)
+            shard_log_f.seek(0, 0)
+            copyfileobj(shard_log_f, merged_log_f, LOG_CHUNK_SIZE)
+            merged_log_f.write('\n')
+            shard_log_f.close()
+
+            if shard_ret_val != 0:
+                num_failed += 1
+                if merged_ret_val == 0:
+                    merged_ret_val = shard_ret_val
+
+        num_shards = len(shards[label])
+        num_not_run = num_shards - len(started_shards)
+        if num_not_run:
+            merged_ret_val = None
+
+        if num_failed == 0 and num_not_run == 0:
+            note = '%d shards' % num_shards
+        else:
+            note = '%d of %d shards failed' % (num_failed, num_shards)
+            if num_not_run:
+                note += ', %d not run' % num_not_run
+        merged_statuses.append((label, (merged_log_f, merged_ret_val, note)))
+    return merged_statuses
+
+def _replace_cluster(setup_cmds, teardown_cmds, setup_timeout,
+                     teardown_timeout, post_setup_fn, log_f, cmd_records):
+    """Terminates a cluster that was lost and starts a new one in its place.
+
+    Returns True if the new cluster was started (and post_setup_fn, if
+    provided, succeeded), False if there was a problem, and None if the
+    timeout was reached. Whether the old cluster was terminated doesn't
+    matter, since most of it is already gone.
+
+    Arguments:
+        setup_cmds - the output of ExecutionBackend.build_commands()
+        teardown_cmds - the output of ExecutionBackend.build_commands()
+        setup_timeout - same as for run_test_suites()
+        teardown_timeout - same as for run_test_suites()
+        post_setup_fn - same as for _execute_commands_and_build_email()
+        log_f - the file to log the commands' output to
+        cmd_records - the list to add the commands' history records to
+    """
+    cmd_executor = CommandExecutor(teardown_cmds, log_f)
+    cmd_executor(teardown_timeout)
+    cmd_records.extend(_build_cmd_records('teardown',
+            ['teardown'] * len(teardown_cmds), cmd_executor))
+
+    cmd_executor = CommandExecutor(setup_cmds, log_f,
+                                   stop_on_first_failure=True)
+    setup_cmds_succeeded = cmd_executor(setup_timeout)[0]
+    cmd_records.extend(_build_cmd_records('setup',
+            ['setup'] * len(setup_cmds), cmd_executor))
+
+    if setup_cmds_succeeded and post_setup_fn is not None:
+        setup_cmds_succeeded = post_setup_fn(log_f, setup_timeout)
+    return setup_cmds_succeeded
+
+def _retrieve_artifacts(artifacts_cmds, artifacts_dir, timeout, log_f,
+                        cmd_records):
+    """Copies the test suites' artifacts back from the cluster.
+
+    The commands (one for each node) are run at the same time.
+
+    Returns a 2-element tuple containing the status of the commands (True,
+    False, or None for a timeout, as with CommandExecutor) and a dictionary
+    describing the artifacts that were copied, in the format of the
+    'artifacts' entry returned by _execute_commands_and_build_email().
+
+    Arguments:
+        artifacts_cmds - the output of ExecutionBackend.build_artifacts_cmds()
+        artifacts_dir - the directory that artifacts_cmds copy the artifacts
+            to. It is emptied (or created) first
+        timeout - the number of minutes to allow the commands to run
+        log_f - the file to log the commands' output to
+        cmd_records - the list to add the commands' history records to
+    """
+    rmtree(artifacts_dir, ignore_errors=True)
+    makedirs(artifacts_dir)
+
+    cmd_executor = CommandExecutor(artifacts_cmds, log_f,
+                                   queue_ids=range(len(artifacts_cmds)))
+    artifacts_succeeded = cmd_executor(timeout)[0]
+    cmd_records.extend(_build_cmd_records('artifacts',
+            ['artifacts'] * len(artifacts_cmds), cmd_executor))
+
+    # Whatever made it across is kept, even if a transfer didn't finish.
+    artifacts = {}
+    for label in listdir(artifacts_dir):
+        test_suite_dir = join(artifacts_dir, label)
+        artifacts[label] = sorted([(relpath(join(dir_path, filename),
+                                             test_suite_dir),
+                                    getsize(join(dir_path, filename)))
+                                   for dir_path, dir_names, filenames in
+                                   walk(test_suite_dir)
+                                   for filename in filenames])
+    return artifacts_succeeded, artifacts
+
+def _summarize_junit_reports(test_suites, artifacts, artifacts_dir,
+                             shard_parents=None):
+    """Parses the JUnit XML reports that were copied back for test suites.
+
+    The reports of a test suite are the artifacts that match the patterns
+    given by its junit option (a pattern's leading '/' is ignored, since it
+    was removed from the paths of the copied files).
+
+    Returns a list of (label, results) pairs, one for each test suite with a
+    junit option (with the reports of a test suite's shards combined), in
+    the order that the test suites were run. results is a dictionary in the
+    format returned by clout.parse.parse_junit_xml(), combined across all
+    of the test suite's reports, with the extra keys 'num_reports' (the
+    number of reports that were parsed) and 'unreadable_reports' (the paths,
+    relative to artifacts_dir, of the reports that couldn't be parsed).
+
+    Arguments:
+        test_suites - the output of _expand_shards()
+        artifacts - the 'artifacts' entry returned by
+            _execute_commands_and_build_email()
+        artifacts_dir - the directory that the artifacts were copied to
+        shard_parents - the output of _expand_shards()
+    """
+    if shard_parents is None:
+        shard_parents = {}
+
+    labels, summaries = [], {}
+    for label, cmd, options in test_suites:
+        if 'junit' not in options:
+            continue
+
+        parent_label = shard_parents.get(label, label)
+        if parent_label not in summaries:
+            labels.append(parent_label)
+            summaries[parent_label] = {'passed': 0, 'failed': 0,
+                                       'errors': 0, 'skipped': 0,
+                                       'failing_tests': [],
+                                       'slowest_tests': [], 'num_reports': 0,
+                                       'unreadable_reports': []}
+        summary = summaries[parent_label]
+
+        patterns = [pattern.lstrip('/') for pattern in options['junit']]
+        for path, size in artifacts.get(label, []):
+            if not [pattern for pattern in patterns
+                    if fnmatch(path, pattern)]:
+                continue
+
+            try:
+                report_f = open(join(artifacts_dir, label, path), 'rb')
+                try:
+                    results = parse_junit_xml(report_f)
+                finally:
+                    report_f.close()
+            except (IOError, ValueError):
+                summary['unreadable_reports'].append(join(label, path))
+                continue
+
+            summary['num_reports'] += 1
+            for key in ('passed', 'failed', 'errors', 'skipped'):
+                summary[key] += results[key]
+            summary['failing_tests'] = (summary['failing_tests'] +
+                    results['failing_tests'])[:MAX_JUNIT_FAILING_TESTS]
+            summary['slowest_tests'] = sorted(summary['slowest_tests'] +
+                    results['slowest_tests'],
+                    reverse=True)[:MAX_JUNIT_SLOWEST_TESTS]
+    return [(label, summaries[label]) for label in labels]
+
+def _build_cmd_records(phase, labels, cmd_executor, first_cmd=0):
+    """Returns history records for the commands a CommandExecutor just ran.
+
+    Commands that were never started are left out.
+
+    Arguments:
+        phase - the phase that the commands belong to ('setup', 'local_prep',
+            'test_suite', 'retry', 'artifacts', or 'teardown')
+        labels - the label to record for each command
+        cmd_executor - the CommandExecutor that ran the commands
+        first_cmd - the index (into cmd_executor.cmds) of the command that
+            the first label belongs to, for when the CommandExecutor ran
+            commands from more than one phase
+    """
+    cmd_records = []
+    for label, cmd, cmd_record in zip(labels, cmd_executor.cmds[first_cmd:],
+                                      cmd_executor.cmd_records[first_cmd:]):
+        if cmd_record is not None:
+            cmd_records.append((phase, label, cmd) + cmd_record)
+    return cmd_records
+
+def _set_up_ssh_multiplexing(sc_exe_fp, sc_config_fp, cluster_tag, user,
+                             key_location, ssh_dir, node_aliases, log_f,
+                             timeout):
+    """Opens a persistent SSH connection to each node in a running cluster.
+
+    Looks up the public DNS names of the cluster's nodes (using starcluster
+    listclusters), writes an SSH config file named 'ssh_config' in ssh_dir
+    that describes how to connect to each node, and opens a master connection
+    to each node that subsequent ssh commands will share.
+
+    Returns True if the connections were opened successfully, False if there
+    was a problem, and None if the timeout was reached. All commands are
+    logged to log_f.
+
+    Arguments:
+        sc_exe_fp - same as for run_test_suites()
+        sc_config_fp - same as for run_test_suites()
+        cluster_tag - same as for run_test_suites()
+        user - same as for run_test_suites()
+        key_location - the path to the private key to log in with
+        ssh_dir - the directory to write the SSH config file and control
+            sockets to
+        node_aliases - the aliases of the nodes to connect to
+        log_f - the file to log the commands' output to
+        timeout - the number of minutes to allow for looking up the nodes and
+            for opening the connections (each)
+    """
+    listclusters_succeeded, cluster_nodes = _list_cluster_nodes(sc_exe_fp,
+            sc_config_fp, cluster_tag, log_f, timeout)
+    if not listclusters_succeeded:
+        return listclusters_succeeded
+
+    node_hosts = []
+    for node_alias in node_aliases:
+        if node_alias not in cluster_nodes or \
+           cluster_nodes[node_alias][1] is None:
+            log_f.write("Could not find the public DNS name of node '%s' "
+                        "in the output of listclusters.\n\n" % node_alias)
+            return False
+        node_hosts.append((node_alias, cluster_nodes[node_alias][1]))
+
+    ssh_config_f = open(join(ssh_dir, 'ssh_config'), 'w')
+    ssh_config_f.write(format_ssh_config(node_hosts, user, key_location,
+                                         ssh_dir))
+    ssh_config_f.close()
+
+    # -f sends the master connection to the background once it has been
+    # established, where it stays until it has been idle for a while.
+    cmd_executor = CommandExecutor(['ssh -F %s -f -N %s' %
+                                    (join(ssh_dir, 'ssh_config'), node_alias)
+                                    for node_alias in node_aliases],
+                                   log_f, stop_on_first_failure=True)
+    return cmd_executor(timeout)[0]
+
+def _close_ssh_multiplexing(ssh_dir, node_aliases, timeout):
+    """Closes the persistent SSH connections opened to a cluster's nodes.
+
+    The master connections would otherwise linger (along with their control
+    sockets) until they had been idle for a while. Problems in closing them
+    (e.g. because a node is already gone) are ignored.
+
+    Returns True if every connection was closed, False if there was a
+    problem, and None if the timeout was reached or the connections were
+    never opened (i.e. ssh_dir has no SSH config file).
+
+    Arguments:
+        ssh_dir - same as for _set_up_ssh_multiplexing()
+        node_aliases - the aliases of the nodes that connections were opened
+            to
+        timeout - the number of minutes to allow for closing the connections
+    """
+    ssh_config_fp = join(ssh_dir, 'ssh_config')
+    if not exists(ssh_config_fp):
+        return None
+
+    log_f = TemporaryFile(prefix='clout_log', suffix='.txt')
+    cmd_executor = CommandExecutor(['ssh -F %s -O exit %s' %
+                                    (ssh_config_fp, node_alias)
+                                    for node_alias in node_aliases], log_f)
+    ssh_exit_succeeded = cmd_executor(timeout)[0]
+    log_f.close()
+    return ssh_exit_succeeded
+
+def _list_cluster_nodes(sc_exe_fp, sc_config_fp, cluster_tag, log_f,
+                        timeout):
+    """Looks up the nodes of a cluster using starcluster listclusters.
+
+    Returns a 2-element tuple containing the status of the listclusters
+    command (True, False, or None for a timeout, as with CommandExecutor) and
+    the output of parse_cluster_nodes() (which will be empty if the command
+    did not succeed).
+
+    Arguments:
+        sc_exe_fp - same as for run_test_suites()
+        sc_config_fp - same as for run_test_suites()
+        cluster_tag - same as for run_test_suites()
+        log_f - the file to log the command's output to
+        timeout - the number of minutes to allow the command to run
+    """
+    cmd_executor = CommandExecutor(['%s -c %s listclusters %s' %
+                                    (sc_exe_fp, sc_config_fp, cluster_tag)],
+                                   log_f, log_individual_cmds=True)
+    listclusters_succeeded, listclusters_status = cmd_executor(timeout)
+
+    cluster_nodes = {}
+    if listclusters_succeeded:
+        listclusters_log_f = listclusters_status[0][0]
+        listclusters_log_f.seek(0, 0)
+        cluster_nodes = parse_cluster_nodes(listclusters_log_f)
+    for listclusters_log_f, ret_val in listclusters_status:
+        listclusters_log_f.close()
+    return listclusters_succeeded, cluster_nodes
+
+def _get_cluster_status(sc_exe_fp, sc_config_fp, cluster_tag, cluster_size,
+                        timeout):
+    """Checks whether a cluster is running and usable.
+
+    Returns 'healthy' if every node in the cluster is running, 'unhealthy' if
+    the cluster exists but one or more of its nodes aren't running (or are
+    missing), and 'missing' if the cluster doesn't exist (or couldn't be
+    looked up).
+
+    Arguments:
+        sc_exe_fp - same as for run_test_suites()
+        sc_config_fp - same as for run_test_suites()
+        cluster_tag - same as for run_test_suites()
+        cluster_size - the number of nodes the cluster should have
+        timeout - the number of minutes to allow the lookup to take
+    """
+    log_f = TemporaryFile(prefix='clout_log', suffix='.txt')
+    cluster_nodes = _list_cluster_nodes(sc_exe_fp, sc_config_fp, cluster_tag,
+                                        log_f, timeout)[1]
+    log_f.close()
+
+    if not cluster_nodes:
+        return 'missing'
+    for node_alias in get_starcluster_node_aliases(cluster_size):
+        if node_alias not in cluster_nodes or \
+           cluster_nodes[node_alias][0] != 'running':
+            return 'unhealthy'
+    return 'healthy'
+
+def _is_cluster_lost(sc_exe_fp, sc_config_fp, cluster_tag, cluster_size,
+                     timeout):
+    """Returns True if any of a cluster's nodes aren't running anymore.
+
+    Arguments are the same as for _get_cluster_status().
+    """
+    return _get_cluster_status(sc_exe_fp, sc_config_fp, cluster_tag,
+                               cluster_size, timeout) != 'healthy'
+
+def _terminate_idle_clusters(warm_clusters, cluster_tag, cluster_idle_ttl,
+                             sc_exe_fp, sc_config_fp, teardown_timeout,
+                             email_body, attachments):
+    """Terminates clusters that have been left running for too long.
+
+    Clusters that were successfully terminated are removed from
+    warm_clusters. The results are added to the email body, and the log of
+    the termination commands is added to the attachments (if any clusters
+    needed to be terminated).
+
+    Returns the updated email body and attachments.
+
+    Arguments:
+        warm_clusters - the output of parse_warm_clusters()
+        cluster_tag - the tag of the cluster used by the current run. This
+            cluster is never terminated
+        cluster_idle_ttl - same as for run_test_suites()
+        sc_exe_fp - same as for run_test_suites()
+        sc_config_fp - same as for run_test_suites()
+        teardown_timeout - same as for run_test_suites()
+        email_body - the email body to add to
+        attachments - the attachments to add to
+    """
+    now = time()
+    idle_cluster_tags = sorted([tag for tag, last_used in warm_clusters.items()
+                                if tag != cluster_tag and
+                                now - last_used > cluster_idle_ttl * 60.0])
+    if not idle_cluster_tags:
+        return email_body, attachments
+
+    log_f = TemporaryFile(prefix='clout_log', suffix='.txt')
+    attachments = attachments + [('idle_clusters_log.txt', log_f)]
+    cmd_executor = CommandExecutor(["%s -c %s terminate -c %s" %
+                                    (sc_exe_fp, sc_config_fp, tag)
+                                    for tag in idle_cluster_tags], log_f,
+                                   log_individual_cmds=True)
+    terminate_cmds_status = cmd_executor(teardown_timeout)[1]
+    log_f.seek(0, 0)
+
+    terminated_cluster_tags = []
+    for tag, terminate_cmd_status in zip(idle_cluster_tags,
+                                         terminate_cmds_status):
+        if terminate_cmd_status is not None:
+            terminate_log_f, ret_val = terminate_cmd_status
+            terminate_log_f.close()
+            if ret_val == 0:
+                terminated_cluster_tags.append(tag)
+                del warm_clusters[tag]
+
+    if terminated_cluster_tags:
+        email_body += ("The following idle clusters were terminated: %s\n\n"
+                       % ', '.join(terminated_cluster_tags))
+    failed_cluster_tags = [tag for tag in idle_cluster_tags
+                           if tag not in terminated_cluster_tags]
+    if failed_cluster_tags:
+        email_body += ("There were problems in terminating the following "
+                       "idle clusters, which will be retried next time: %s. "
+                       "Please check the attached log for more details.\n\n"
+                       % ', '.join(failed_cluster_tags))
     return email_body, attachments
+
+def _create_state_dir(state_dir):
+    """Creates the state directory if necessary and returns its full path."""
+    state_dir = expanduser(state_dir)
+    if not exists(state_dir):
+        makedirs(state_dir)
+    return state_dir
+
+def _load_warm_clusters(state_dir):
+    """Returns the clusters that were left running, keyed by cluster tag."""
+    warm_clusters_fp = join(state_dir, 'warm_clusters.txt')
+    if not exists(warm_clusters_fp):
+        return {}
+
+    warm_clusters_f = open(warm_clusters_fp, 'U')
+    try:
+        return parse_warm_clusters(warm_clusters_f)
+    finally:
+        warm_clusters_f.close()
+
+def _save_warm_clusters(state_dir, warm_clusters):
+    """Writes the clusters that were left running to the state directory."""
+    # Write to a temporary file first so that the state file is never left
+    # half-written.
+    warm_clusters_fp = join(state_dir, 'warm_clusters.txt')
+    warm_clusters_f = open(warm_clusters_fp + '.tmp', 'w')
+    warm_clusters_f.write(format_warm_clusters(warm_clusters))
+    warm_clusters_f.close()
+    rename(warm_clusters_fp + '.tmp', warm_clusters_fp)
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012-2013, The Clout Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPLv2"
+__version__ = "0.9-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+"""Module to decide the order and placement of test suites on a cluster."""
+
+def schedule_test_suites(test_suites, expected_durations, node_aliases,
+                         max_parallel=1):
+    """Orders test suites and assigns them to nodes to finish soonest.
+
+    Uses the longest-processing-time-first (LPT) rule: test suites are
+    considered from longest to shortest expected duration, and each one is
+    assigned to whichever slot (a node can run max_parallel test suites at
+    once, so it has max_parallel slots) will become free first. This keeps a
+    single slow test suite from being started last on a busy node. The
+    resulting makespan is guaranteed to be within 4/3 of the optimum.
+
+    Test suites with no expected duration (e.g. new test suites) are assumed
+    to take as long as the average test suite with an expected duration.
+    Test suites with equal expected durations keep their relative order.
+
+    Returns a 3-element tuple containing the reordered test suites (in the
+    order that they should be started), the node alias assigned to each of
+    the reordered test suites, and the expected number of seconds it will
+    take to run all of the test suites.
+
+    Arguments:
+        test_suites - a list of (test suite label, command) pairs
+        expected_durations - a dictionary mapping test suite labels to their
+            expected durations (in seconds)
+        node_aliases - the aliases of the nodes to assign test suites to
+        max_parallel - the number of test suites that each node can run at
+            the same time
+    """
+    durations = _fill_in_durations(test_suites, expected_durations)
+
+    # sorted() is stable, so ties keep their original order.
+    order = sorted(range(len(test_suites)), key=lambda i: -durations[i])
+
+    slot_loads = [0.0] * (len(node_aliases) * max_parallel)
+    ordered_test_suites, node_assignments = [], []
+    for test_suite_index in order:
+        # The first slot with the least load wins ties, so nodes are filled
+        # in order.
+        slot = slot_loads.index(min(slot_loads))
+        slot_loads[slot] += durations[test_suite_index]
+
+        ordered_test_suites.append(test_suites[test_suite_index])
+        node_assignments.append(node_aliases[slot // max_parallel])
+    return ordered_test_suites, node_assignments, max(slot_loads + [0.0])
+
+def _fill_in_durations(test_suites, expected_durations):
+    """Returns the expected duration of each test suite, filling in gaps."""
+    known_durations = [expected_durations[test_suite[0]]
+                       for test_suite in test_suites
+                       if test_suite[0] in expected_durations]
+    if known_durations:
+        default_duration = sum(known_durations) / len(known_durations)
+    else:
+        default_duration = 0.0
+    return [expected_durations.get(test_suite[0], default_duration)
+            for test_suite in test_suites]
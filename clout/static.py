@@ -12,3 +12,43 @@ __email__ = "jai.rideout@gmail.com"
 """Module containing static data used throughout Clout."""
 
 MAX_SPOT_BID = 10.0
+
+# The number of times that a run may replace its cluster after losing it
+# (e.g. because its spot instances were reclaimed) before giving up.
+MAX_CLUSTER_REPLACEMENTS = 2
+
+# The return code of ssh (and so of a test suite run on the cluster) when the
+# connection fails or is lost, rather than the remote command failing.
+SSH_ERROR_RETURN_CODE = 255
+
+# The number of failing test cases (by name) and of slowest test cases to
+# keep from each JUnit XML report, so that parsing a huge report (or one where
+# everything failed) doesn't use more memory than a short one.
+MAX_JUNIT_FAILING_TESTS = 20
+MAX_JUNIT_SLOWEST_TESTS = 10
+
+# The number of new lines of a failing test suite's log (compared with the
+# previous run's log) to include in the email.
+MAX_NEW_LOG_LINES = 50
+
+# The directory that Clout keeps information in between runs.
+DEFAULT_STATE_DIR = '~/.clout'
+
+# The number of bytes to copy at a time when moving command output between
+# log files, so that large amounts of output are never held in memory.
+LOG_CHUNK_SIZE = 64 * 1024
+
+# The number of bytes of an email attachment to base64-encode at a time. This
+# must be a multiple of 57, which base64 encodes as one 76-character line.
+BASE64_CHUNK_SIZE = 57 * 1024
+
+# The default maximum total size (in megabytes) of the compressed log files
+# attached to the email. Base64 encoding adds another third on top of this,
+# which keeps the message under the common 20-25 MB SMTP limits.
+DEFAULT_MAX_ATTACHMENTS_SIZE = 10.0
+
+# The message that replaces the middle of a log file that was truncated to
+# fit in the email. It is formatted with the number of bytes removed.
+ELISION_MARKER = ('\n\n[... %d bytes removed by clout to keep the email '
+                  'small ...]\n\n')
+
@@ -0,0 +1,406 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012-2013, The Clout Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPLv2"
+__version__ = "0.9-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+"""Module to supervise many shell commands from a single event loop.
+
+A CommandSupervisor starts shell commands, hands their output to the caller
+as it arrives, and enforces timeouts, all from the thread that calls run().
+Since only that thread starts, waits for, and signals the commands, a
+command's process group is only ever signalled while its process is still
+unreaped, so a timeout can never signal an unrelated process that happens to
+reuse the process ID.
+"""
+
+from errno import EAGAIN, EINTR, EWOULDBLOCK
+from fcntl import fcntl, F_GETFL, F_SETFL
+from os import close, killpg, O_NONBLOCK, pipe, read, setsid, write
+from select import error as select_error, poll, POLLIN
+from signal import SIGKILL, SIGTERM
+from subprocess import PIPE, Popen
+from threading import Lock
+from time import time
+
+from clout.static import LOG_CHUNK_SIZE
+
+# The longest (in seconds) that the event loop waits before checking whether
+# any of the commands have exited. Commands are normally noticed as soon as
+# they exit (because their output ends), but a command's output can outlive
+# it if it leaves a process running in the background.
+POLL_INTERVAL = 0.1
+
+# How long (in seconds) the event loop first waits before checking again
+# whether a command whose output has ended has exited. Commands close their
+# output when they exit, just before they can be waited for, so this starts
+# short and doubles (up to POLL_INTERVAL) in case the command keeps running.
+EXIT_POLL_INTERVAL = 0.0005
+
+# The number of seconds that a command has to exit after being asked to
+# terminate (with SIGTERM) before it is killed (with SIGKILL).
+KILL_GRACE_PERIOD = 5.0
+
+class CommandSupervisor(object):
+    """Runs shell commands concurrently from a single event loop.
+
+    Commands are organized into queues: the commands in a queue are started
+    in order, with at most max_parallel of them running at the same time,
+    while the queues themselves run at the same time as each other. Each
+    command is run in its own process group so that it can be terminated
+    along with any processes it started.
+
+    The event loop waits on the commands' stdout and stderr pipes with
+    poll(), so hundreds of commands can be supervised without a thread for
+    each one. Output is handed to output_callback as it arrives, a chunk at
+    a time, so it is never held in memory.
+
+    The callbacks are called from the thread running run(). stop() and
+    cancel() may be called from any thread (including from a callback).
+
+    This class isn't platform-independent: it relies on process groups and
+    poll(), which aren't available on Windows.
+    """
+
+    def __init__(self, cmds, queues=None, max_parallel=1, cmd_timeout=None,
+                 start_callback=None, output_callback=None,
+                 finish_callback=None):
+        """Initializes a new supervisor for a list of commands.
+
+        Arguments:
+            cmds - list of commands to run (strings)
+            queues - a list of lists of indices into cmds, one list for each
+                queue. If None, all commands are placed in a single queue
+            max_parallel - the maximum number of commands from each queue
+                that may be running at the same time
+            cmd_timeout - the number of minutes that each command may run
+                for before it is terminated. If None, commands are only
+                limited by the timeout passed to run()
+            start_callback - a function to call with a command's index just
+                before the command is started
+            output_callback - a function to call with a command's index, the
+                name of the stream ('stdout' or 'stderr'), and a string of
+                output whenever the command writes output
+            finish_callback - a function to call with a command's index and
+                return code once the command has exited and all of its output
+                has been passed to output_callback. Commands that were
+                terminated have a negative return code (the signal number)
+        """
+        self.cmds = cmds
+        self.queues = queues
+        self.max_parallel = max_parallel
+        self.cmd_timeout = cmd_timeout
+        self.start_callback = start_callback
+        self.output_callback = output_callback
+        self.finish_callback = finish_callback
+
+        # These are the only members that are shared between threads.
+        self._lock = Lock()
+        self._stop_requested = False
+        self._cancel_requested = False
+        self._wakeup_fd = None
+
+    def run(self, timeout=None):
+        """Runs the commands, returning once they have all finished.
+
+        Returns False if the timeout was reached before all of the commands
+        finished (in which case the running commands are terminated and the
+        remaining commands are not started), and True otherwise.
+
+        After this method returns, self.start_times, self.end_times, and
+        self.ret_vals contain one entry for each command (None for commands
+        that were never started), self.timed_out_cmds contains the indices of
+        the commands that were terminated because the timeout or cmd_timeout
+        was reached, and self.cancelled_cmds contains the indices of the
+        commands that were terminated by cancel().
+
+        Arguments:
+            timeout - the number of minutes to allow all of the commands to
+                run collectively. Must be a float, to allow for fractions of a
+                minute. If None, there is no time limit
+        """
+        if self.max_parallel < 1:
+            raise ValueError("The maximum number of commands to run in "
+                             "parallel must be at least 1.")
+
+        num_cmds = len(self.cmds)
+        if self.queues is None:
+            queues = [range(num_cmds)]
+        else:
+            queues = [list(queue) for queue in self.queues]
+
+        self.start_times = [None] * num_cmds
+        self.end_times = [None] * num_cmds
+        self.ret_vals = [None] * num_cmds
+        self.timed_out_cmds = []
+        self.cancelled_cmds = []
+
+        self._running = {}
+        self._fd_owners = {}
+        self._poller = poll()
+        self._num_running = [0] * len(queues)
+
+        wakeup_r, wakeup_w = pipe()
+        _set_nonblocking(wakeup_r)
+        _set_nonblocking(wakeup_w)
+        self._poller.register(wakeup_r, POLLIN)
+        with self._lock:
+            self._stop_requested = False
+            self._cancel_requested = False
+            self._wakeup_fd = wakeup_w
+
+        deadline = None
+        if timeout is not None:
+            deadline = time() + float(timeout) * 60.0
+        timed_out = False
+
+        try:
+            while True:
+                with self._lock:
+                    stop_requested = self._stop_requested
+                    cancel_requested = self._cancel_requested
+
+                now = time()
+                if cancel_requested:
+                    self._terminate(self._running.keys(),
+                                    self.cancelled_cmds, now)
+                elif deadline is not None and now >= deadline and \
+                     not timed_out and (self._running or
+                                        [queue for queue in queues if queue]):
+                    timed_out = True
+                    self._terminate(self._running.keys(),
+                                    self.timed_out_cmds, now)
+                self._terminate([cmd_index for cmd_index, running_cmd in
+                                 self._running.items()
+                                 if running_cmd.deadline is not None and
+                                 now >= running_cmd.deadline],
+                                self.timed_out_cmds, now)
+                self._kill_unresponsive(now)
+
+                if not (stop_requested or cancel_requested or timed_out):
+                    self._start_commands(queues)
+                if not self._running:
+                    break
+
+                self._wait_for_events(wakeup_r, deadline, timed_out)
+                for cmd_index, running_cmd in self._running.items():
+                    ret_val = running_cmd.proc.poll()
+                    if ret_val is not None:
+                        self._finish_command(cmd_index, ret_val)
+        finally:
+            with self._lock:
+                self._wakeup_fd = None
+            close(wakeup_r)
+            close(wakeup_w)
+
+            # Only reached with commands still running if something went
+            # wrong (e.g. a callback raised an exception), in which case
+            # don't leave them behind.
+            for cmd_index, running_cmd in self._running.items():
+                _signal_process_group(running_cmd.proc, SIGKILL)
+                running_cmd.proc.wait()
+                for fd in list(running_cmd.fds):
+                    self._close_output(fd)
+
+        self.timed_out_cmds.sort()
+        self.cancelled_cmds.sort()
+        return not timed_out
+
+    def stop(self):
+        """Stops starting new commands, letting running commands finish."""
+        with self._lock:
+            self._stop_requested = True
+            self._wake_up()
+
+    def cancel(self):
+        """Stops starting new commands and terminates the running ones."""
+        with self._lock:
+            self._stop_requested = True
+            self._cancel_requested = True
+            self._wake_up()
+
+    def _wake_up(self):
+        """Interrupts the event loop's wait. Must be called with the lock."""
+        if self._wakeup_fd is not None:
+            try:
+                write(self._wakeup_fd, 'x')
+            except OSError, e:
+                # The pipe is full, so the event loop will wake up anyway.
+                if e.errno not in (EAGAIN, EWOULDBLOCK):
+                    raise
+
+    def _start_commands(self, queues):
+        """Starts commands from each queue until the queues are full."""
+        for queue_num, queue in enumerate(queues):
+            while queue and self._num_running[queue_num] < self.max_parallel:
+                cmd_index = queue.pop(0)
+                if self.start_callback is not None:
+                    self.start_callback(cmd_index)
+
+                # setsid makes the spawned shell the process group leader, so
+                # that we can terminate it and its children together.
+                # close_fds keeps the spawned shell from inheriting (and
+                # holding open) the pipes of other commands.
+                self.start_times[cmd_index] = time()
+                proc = Popen(self.cmds[cmd_index], shell=True, stdout=PIPE,
+                             stderr=PIPE, preexec_fn=setsid, close_fds=True)
+
+                running_cmd = _RunningCommand(proc, queue_num)
+                if self.cmd_timeout is not None:
+                    running_cmd.deadline = (self.start_times[cmd_index] +
+                                            float(self.cmd_timeout) * 60.0)
+                for stream_name, stream in (('stdout', proc.stdout),
+                                            ('stderr', proc.stderr)):
+                    fd = stream.fileno()
+                    _set_nonblocking(fd)
+                    self._poller.register(fd, POLLIN)
+                    self._fd_owners[fd] = (cmd_index, stream_name)
+                    running_cmd.fds.add(fd)
+
+                self._running[cmd_index] = running_cmd
+                self._num_running[queue_num] += 1
+
+    def _wait_for_events(self, wakeup_r, deadline, timed_out):
+        """Waits for output, then hands it to the output callback."""
+        wait_time = POLL_INTERVAL
+        deadlines = [running_cmd.deadline
+                     for running_cmd in self._running.values()
+                     if running_cmd.deadline is not None and
+                     running_cmd.kill_time is None]
+        if deadline is not None and not timed_out:
+            deadlines.append(deadline)
+        if deadlines:
+            wait_time = max(min(wait_time, min(deadlines) - time()), 0.0)
+
+        for running_cmd in self._running.values():
+            if not running_cmd.fds:
+                wait_time = min(wait_time, running_cmd.exit_poll_interval)
+                running_cmd.exit_poll_interval = min(
+                        running_cmd.exit_poll_interval * 2, POLL_INTERVAL)
+
+        try:
+            events = self._poller.poll(wait_time * 1000)
+        except select_error, e:
+            if e.args[0] != EINTR:
+                raise
+            events = []
+
+        for fd, event in events:
+            if fd == wakeup_r:
+                _read_available(fd)
+            elif fd in self._fd_owners:
+                self._read_output(fd)
+
+    def _read_output(self, fd):
+        """Reads a chunk of output from a command's stdout or stderr pipe.
+
+        Returns False if there's no more output to read right now.
+        """
+        try:
+            data = read(fd, LOG_CHUNK_SIZE)
+        except OSError, e:
+            if e.errno in (EAGAIN, EWOULDBLOCK):
+                return False
+            raise
+
+        if not data:
+            self._close_output(fd)
+            return False
+
+        if self.output_callback is not None:
+            cmd_index, stream_name = self._fd_owners[fd]
+            self.output_callback(cmd_index, stream_name, data)
+        return True
+
+    def _close_output(self, fd):
+        """Stops reading from one of a command's output pipes."""
+        cmd_index, stream_name = self._fd_owners.pop(fd)
+        self._poller.unregister(fd)
+        self._running[cmd_index].fds.discard(fd)
+        getattr(self._running[cmd_index].proc, stream_name).close()
+
+    def _finish_command(self, cmd_index, ret_val):
+        """Collects the rest of an exited command's output."""
+        running_cmd = self._running[cmd_index]
+
+        # Anything still in the pipes was written before the command exited.
+        # Processes that the command left running in the background may keep
+        # writing to the pipes, but that output isn't waited for.
+        for fd in list(running_cmd.fds):
+            while fd in self._fd_owners and self._read_output(fd):
+                pass
+            if fd in self._fd_owners:
+                self._close_output(fd)
+
+        self.end_times[cmd_index] = time()
+        self.ret_vals[cmd_index] = ret_val
+        del self._running[cmd_index]
+        self._num_running[running_cmd.queue_num] -= 1
+
+        if self.finish_callback is not None:
+            self.finish_callback(cmd_index, ret_val)
+
+    def _terminate(self, cmd_indices, terminated_cmds, now):
+        """Asks running commands to terminate, recording which ones were."""
+        for cmd_index in cmd_indices:
+            running_cmd = self._running[cmd_index]
+            if running_cmd.kill_time is not None:
+                continue
+
+            # A command that has already exited finished on its own.
+            ret_val = running_cmd.proc.poll()
+            if ret_val is not None:
+                self._finish_command(cmd_index, ret_val)
+                continue
+
+            _signal_process_group(running_cmd.proc, SIGTERM)
+            running_cmd.kill_time = now
+            terminated_cmds.append(cmd_index)
+
+    def _kill_unresponsive(self, now):
+        """Kills commands that haven't exited after being terminated."""
+        for running_cmd in self._running.values():
+            if running_cmd.kill_time is not None and \
+               not running_cmd.killed and \
+               now - running_cmd.kill_time >= KILL_GRACE_PERIOD:
+                _signal_process_group(running_cmd.proc, SIGKILL)
+                running_cmd.killed = True
+
+
+class _RunningCommand(object):
+    """The state of a command that the event loop is supervising."""
+
+    def __init__(self, proc, queue_num):
+        self.proc = proc
+        self.queue_num = queue_num
+        self.fds = set()
+        self.deadline = None
+        self.kill_time = None
+        self.killed = False
+        self.exit_poll_interval = EXIT_POLL_INTERVAL
+
+
+def _signal_process_group(proc, signal_num):
+    """Signals the process group led by a process that hasn't been reaped."""
+    try:
+        killpg(proc.pid, signal_num)
+    except OSError:
+        # Every process in the group has already exited.
+        pass
+
+def _set_nonblocking(fd):
+    fcntl(fd, F_SETFL, fcntl(fd, F_GETFL) | O_NONBLOCK)
+
+def _read_available(fd):
+    """Reads and discards everything that can be read without blocking."""
+    try:
+        while read(fd, LOG_CHUNK_SIZE):
+            pass
+    except OSError, e:
+        if e.errno not in (EAGAIN, EWOULDBLOCK):
+            raise
@@ -11,29 +11,36 @@ __email__ = "jai.rideout@gmail.com"
 
 """Module to provide miscellaneous utility functionality."""
 
-from email.Encoders import encode_base64
-from email.MIMEBase import MIMEBase
-from email.MIMEMultipart import MIMEMultipart
+from base64 import encodestring
+from email.Generator import Generator
 from email.mime.text import MIMEText
 from email.Utils import formatdate
-from os import killpg, setsid
-from signal import SIGTERM
-from smtplib import SMTP
-from subprocess import PIPE, Popen
+from gzip import GzipFile
+from shutil import copyfileobj
+from smtplib import (quotedata, SMTP, SMTPDataError, SMTPException,
+                     SMTPRecipientsRefused, SMTPSenderRefused)
 from tempfile import TemporaryFile
-from threading import Lock, Thread
+from uuid import uuid4
+
+from clout.static import BASE64_CHUNK_SIZE, ELISION_MARKER, LOG_CHUNK_SIZE
+from clout.supervisor import CommandSupervisor
 
 class CommandExecutor(object):
-    """Class to run commands in a separate thread.
+    """Class to run commands and log their output.
 
     Provides support for timeouts (e.g. useful for commands that may hang
     indefinitely) and for capturing stdout, stderr, and return value of each
     command. Output is logged to a file (or optionally to separate files for
-    each command).
+    each command). Output is never held in memory: it is copied into
+    temporary files a chunk at a time as the commands write it, and from
+    there into the logs.
 
-    This class is the single place in Clout that is not platform-independent
-    (it won't be able to terminate timed-out processes on Windows). The fix is
-    to not use shell=True in our call to Popen, but this would require changing
+    The commands are run by a clout.supervisor.CommandSupervisor, which
+    supervises all of them from a single event loop in the calling thread.
+    This class is a synchronous wrapper around it that turns the commands'
+    output into logs. Like the supervisor, it is not platform-independent (it
+    won't be able to terminate timed-out processes on Windows). The fix is to
+    not use shell=True in our call to Popen, but this would require changing
     the way we support test suite config files and this (large) change will
     have to wait.
 
@@ -44,23 +51,45 @@ class CommandExecutor(object):
     """
 
     def __init__(self, cmds, log_f, stop_on_first_failure=False,
-                 log_individual_cmds=False):
+                 log_individual_cmds=False, queue_ids=None, max_parallel=1,
+                 cmd_timeout=None, cancel_on_first_failure=False):
         """Initializes a new object to execute multiple commands.
 
         Arguments:
             cmds - list of commands to run (strings)
             log_f - the file to write command output to
             stop_on_first_failure - if True, will stop running all other
-                commands once a command has a nonzero exit code
+                commands once a command has a nonzero exit code (commands
+                that are already running are allowed to finish)
             log_individual_cmds - if True, will create a TemporaryFile for each
                 command that is run and log the output separately (as well as
                 to log_f). Will also keep track of the return values for each
                 command
+            queue_ids - list of queue identifiers, one for each command in
+                cmds. Commands that share a queue identifier are run one after
+                another (in the order that they appear in cmds), while
+                commands in different queues are run at the same time. If
+                None, all commands are placed in a single queue (i.e. they are
+                run one after another)
+            max_parallel - the maximum number of commands from each queue that
+                may be running at the same time. Commands are still started in
+                the order that they appear in their queue
+            cmd_timeout - the number of minutes that each command may run
+                for before it is terminated (which counts as a failure). If
+                None, commands are only limited by the overall timeout
+            cancel_on_first_failure - if True, once a command has a nonzero
+                exit code, the commands that are still running are terminated
+                (along with any processes they started) and no other commands
+                are started
         """
         self.cmds = cmds
         self.log_f = log_f
         self.stop_on_first_failure = stop_on_first_failure
         self.log_individual_cmds = log_individual_cmds
+        self.queue_ids = queue_ids
+        self.max_parallel = max_parallel
+        self.cmd_timeout = cmd_timeout
+        self.cancel_on_first_failure = cancel_on_first_failure
 
     def __call__(self, timeout):
         """Executes the commands within the given timeout, logging output.
@@ -75,7 +104,23 @@ class CommandExecutor(object):
         The second element of the tuple will be an empty list if
         log_individual_cmds is False, otherwise will be filled with 2-element
         tuples containing the individual TemporaryFile log file for each
-        command, and the command's return code.
+        command, and the command's return code. These are in the same order as
+        self.cmds. The list stops at the last command that was started; if
+        commands are run in more than one queue, commands before that point
+        that were never started (e.g. because of a timeout) will be None.
+
+        After this method returns, self.timed_out_cmds will contain the
+        indices (into self.cmds) of the commands that were terminated because
+        the timeout (or cmd_timeout) was reached, and self.cmd_records will
+        contain one entry for each command in self.cmds: None if the command
+        was never started, otherwise a 3-element tuple containing the time
+        the command started, the time it finished (both in seconds since the
+        epoch), and its return code. These are kept regardless of
+        log_individual_cmds. self.first_failed_cmd will contain the index of
+        the first command to exit with a nonzero exit code (other than those
+        terminated because of cancel_on_first_failure), or None, and
+        self.cancelled_cmds will contain the indices of the commands that
+        were terminated because of cancel_on_first_failure.
 
         Arguments:
             timeout - the number of minutes to allow all of the commands (i.e.
@@ -83,96 +128,235 @@ class CommandExecutor(object):
                 current results. Must be a float, to allow for fractions of a
                 minute
         """
-        self._cmds_succeeded = True
-        self._individual_cmds_status = []
-
-        # We must create locks for the next two variables because they are
-        # read/written in the main thread and worker thread. They allow
-        # the threads to communicate when a timeout has occurred, and the
-        # hung process that needs to be terminated.
-        self._running_process = None
-        self._running_process_lock = Lock()
-
-        self._timeout_occurred = False
-        self._timeout_occurred_lock = Lock()
-
-        # Run the commands in a worker thread. Regain control after the
-        # specified timeout.
-        cmd_runner_thread = Thread(target=self._run_commands)
-        cmd_runner_thread.start()
-        cmd_runner_thread.join(float(timeout) * 60.0)
-
-        if cmd_runner_thread.is_alive():
-            # Timeout occurred, so terminate the current process and have the
-            # worker thread exit gracefully.
-            with self._timeout_occurred_lock:
-                self._timeout_occurred = True
-
-            with self._running_process_lock:
-                if self._running_process is not None:
-                    # We must kill the process group because the process was
-                    # launched with a shell. This code won't work on Windows.
-                    killpg(self._running_process.pid, SIGTERM)
-            cmd_runner_thread.join()
-
-        return self._cmds_succeeded, self._individual_cmds_status
-
-    def _run_commands(self):
-        """Code to be run in worker thread; actually executes the commands."""
-        for cmd in self.cmds:
-            # Check that there hasn't been a timeout before running the (next)
-            # command.
-            with self._timeout_occurred_lock:
-                if self._timeout_occurred:
-                    self._cmds_succeeded = None
-                    break
-                else:
-                    with self._running_process_lock:
-                        # setsid makes the spawned shell the process group
-                        # leader, so that we can kill it and its children from
-                        # the main thread.
-                        proc = Popen(cmd, shell=True, universal_newlines=True,
-                                     stdout=PIPE, stderr=PIPE,
-                                     preexec_fn=setsid)
-                        self._running_process = proc
-
-            # Communicate pulls all stdout/stderr from the PIPEs to avoid
-            # blocking-- don't remove this line! This call blocks until the
-            # command finishes (or is terminated by the main thread).
-            stdout, stderr = proc.communicate()
-            ret_val = proc.returncode
-
-            with self._running_process_lock:
-                self._running_process = None
-
-            cmd_str = 'Command:\n\n%s\n\n' % cmd
-            stdout_str = 'Stdout:\n\n%s\n' % stdout
-            stderr_str = 'Stderr:\n\n%s\n' % stderr
-            self.log_f.write(cmd_str + stdout_str + stderr_str)
-
-            if self.log_individual_cmds:
-                individual_cmd_log_f = TemporaryFile(
-                        prefix='clout_log', suffix='.txt')
-                individual_cmd_log_f.write(cmd_str + stdout_str + stderr_str)
-                self._individual_cmds_status.append(
-                        (individual_cmd_log_f, ret_val))
-
-            with self._timeout_occurred_lock:
-                if ret_val != 0:
-                    self._cmds_succeeded = False
-                if self._timeout_occurred:
-                    self._cmds_succeeded = None
-
-                if self._timeout_occurred or \
-                   (not self._cmds_succeeded and self.stop_on_first_failure):
-                    break
+        self._cmds_failed = False
+        self._individual_cmds_status = [None] * len(self.cmds)
+        self._started_cmds = []
+        self._cmd_logs = {}
+        self.timed_out_cmds = []
+        self.cancelled_cmds = []
+        self.first_failed_cmd = None
+        self.cmd_records = [None] * len(self.cmds)
+
+        if self.max_parallel < 1:
+            raise ValueError("The maximum number of commands to run in "
+                             "parallel must be at least 1.")
+
+        self._supervisor = CommandSupervisor(self.cmds, self._build_queues(),
+                self.max_parallel, self.cmd_timeout,
+                start_callback=self._start_command,
+                output_callback=self._log_output,
+                finish_callback=self._finish_command)
+        finished = self._supervisor.run(timeout)
+
+        self.timed_out_cmds = self._supervisor.timed_out_cmds
+        self.cancelled_cmds = self._supervisor.cancelled_cmds
+        for cmd_index, start_time in enumerate(self._supervisor.start_times):
+            if start_time is not None:
+                self.cmd_records[cmd_index] = (start_time,
+                        self._supervisor.end_times[cmd_index],
+                        self._supervisor.ret_vals[cmd_index])
+
+        if not finished:
+            cmds_succeeded = None
+        else:
+            cmds_succeeded = not self._cmds_failed
+
+        if self.log_individual_cmds and self._started_cmds:
+            individual_cmds_status = \
+                    self._individual_cmds_status[:max(self._started_cmds) + 1]
+        else:
+            individual_cmds_status = []
+        return cmds_succeeded, individual_cmds_status
+
+    def _build_queues(self):
+        """Returns a list of lists of command indices, one list per queue."""
+        if self.queue_ids is None:
+            return [range(len(self.cmds))]
+
+        if len(self.queue_ids) != len(self.cmds):
+            raise ValueError("There must be exactly one queue ID for each "
+                             "command.")
+
+        queues = []
+        queue_lookup = {}
+        for cmd_index, queue_id in enumerate(self.queue_ids):
+            if queue_id not in queue_lookup:
+                queue_lookup[queue_id] = []
+                queues.append(queue_lookup[queue_id])
+            queue_lookup[queue_id].append(cmd_index)
+        return queues
+
+    def _start_command(self, cmd_index):
+        """Creates the files that a command's output will be logged to."""
+        # The command's stdout is written straight into its log (after the
+        # header), and stderr is collected in a separate file so that it can
+        # be appended afterwards.
+        cmd_log_f = TemporaryFile(prefix='clout_log', suffix='.txt')
+        cmd_log_f.write('Command:\n\n%s\n\nStdout:\n\n' % self.cmds[cmd_index])
+        stderr_f = TemporaryFile(prefix='clout_stderr', suffix='.txt')
+        self._cmd_logs[cmd_index] = (cmd_log_f, stderr_f)
+        self._started_cmds.append(cmd_index)
+
+    def _log_output(self, cmd_index, stream_name, data):
+        """Writes a chunk of a command's output to its log."""
+        cmd_log_f, stderr_f = self._cmd_logs[cmd_index]
+        if stream_name == 'stdout':
+            cmd_log_f.write(data)
+        else:
+            stderr_f.write(data)
+
+    def _finish_command(self, cmd_index, ret_val):
+        """Finishes off a command's log and copies it into log_f."""
+        cmd_log_f, stderr_f = self._cmd_logs.pop(cmd_index)
+        cmd_log_f.write('\nStderr:\n\n')
+        stderr_f.seek(0, 0)
+        copyfileobj(stderr_f, cmd_log_f, LOG_CHUNK_SIZE)
+        stderr_f.close()
+        cmd_log_f.write('\n')
+
+        cmd_log_f.seek(0, 0)
+        copyfileobj(cmd_log_f, self.log_f, LOG_CHUNK_SIZE)
+
+        if self.log_individual_cmds:
+            self._individual_cmds_status[cmd_index] = (cmd_log_f, ret_val)
+        else:
+            cmd_log_f.close()
+
+        if ret_val != 0:
+            self._cmds_failed = True
+            if self.first_failed_cmd is None and \
+               cmd_index not in self._supervisor.cancelled_cmds:
+                self.first_failed_cmd = cmd_index
+            if self.cancel_on_first_failure:
+                self._supervisor.cancel()
+            elif self.stop_on_first_failure:
+                self._supervisor.stop()
+
+def compress_attachments(attachments, max_size=None):
+    """Gzip-compresses attachments, truncating them to fit within a budget.
+
+    Each attachment is compressed into a new TemporaryFile, and '.gz' is
+    added to its name. If the compressed attachments add up to more than
+    max_size bytes, the budget is divided among them so that small
+    attachments are kept whole, and the largest attachments are truncated:
+    their beginning and end are kept (where build setup and the final test
+    results usually are), and their middle is replaced by ELISION_MARKER.
+    Since the size of the compressed output can only be estimated ahead of
+    time, the compressed attachments may end up slightly larger than
+    max_size.
+
+    The original attachments are closed, and the compressed attachments are
+    positioned at their beginning.
+
+    Returns a 2-element tuple containing the list of compressed attachments
+    and a dictionary with the following keys:
+        uncompressed_size - the total size of the original attachments
+        compressed_size - the total size of the compressed attachments
+        truncated - the names of the original attachments that were
+            truncated
+
+    Arguments:
+        attachments - a list of 2-element tuples containing the name and file
+            of each attachment, in the format expected by send_email(). The
+            files must be seekable and positioned at their beginning
+        max_size - the maximum total size (in bytes) of the compressed
+            attachments. If None, attachments are never truncated
+    """
+    sizes, compressed_fs = [], []
+    for attachment_name, attachment_f in attachments:
+        attachment_f.seek(0, 2)
+        sizes.append(attachment_f.tell())
+        compressed_fs.append(_gzip_file(attachment_name, attachment_f,
+                                        sizes[-1]))
+    compressed_sizes = [_get_file_size(compressed_f)
+                        for compressed_f in compressed_fs]
+
+    truncated_indices = []
+    if max_size is not None and sum(compressed_sizes) > max_size:
+        # Give each attachment an equal share of the budget, starting with
+        # the smallest, so that any budget left unused by small attachments
+        # goes to the larger ones.
+        remaining_size = max_size
+        order = sorted(range(len(attachments)),
+                       key=lambda i: compressed_sizes[i])
+        for num_done, i in enumerate(order):
+            share = remaining_size / (len(order) - num_done)
+            if compressed_sizes[i] > share:
+                # Assume that the kept parts compress as well as the whole.
+                keep_size = int(max(share, 0) / compressed_sizes[i] * sizes[i])
+                compressed_fs[i].close()
+                compressed_fs[i] = _gzip_file(attachments[i][0],
+                                              attachments[i][1], keep_size)
+                compressed_sizes[i] = _get_file_size(compressed_fs[i])
+                truncated_indices.append(i)
+            remaining_size -= compressed_sizes[i]
+
+    compressed_attachments = []
+    for (attachment_name, attachment_f), compressed_f in \
+            zip(attachments, compressed_fs):
+        attachment_f.close()
+        compressed_f.seek(0, 0)
+        compressed_attachments.append(('%s.gz' % attachment_name,
+                                       compressed_f))
+    return compressed_attachments, {'uncompressed_size': sum(sizes),
+            'compressed_size': sum(compressed_sizes),
+            'truncated': [attachments[i][0]
+                          for i in sorted(truncated_indices)]}
+
+def _gzip_file(name, in_f, keep_size):
+    """Returns a TemporaryFile containing in_f gzip-compressed.
+
+    If in_f is larger than keep_size bytes, only its first and last
+    keep_size / 2 bytes are kept, separated by ELISION_MARKER.
+    """
+    in_f.seek(0, 2)
+    size = in_f.tell()
+    in_f.seek(0, 0)
+
+    out_f = TemporaryFile(prefix='clout_log', suffix='.gz')
+    # Level 6 is nearly as small as the default of 9, and much faster.
+    gzip_f = GzipFile(name, 'wb', 6, out_f)
+    if size <= keep_size:
+        copyfileobj(in_f, gzip_f, LOG_CHUNK_SIZE)
+    else:
+        head_size = keep_size // 2
+        tail_size = keep_size - head_size
+        _copy_bytes(in_f, gzip_f, head_size)
+        gzip_f.write(ELISION_MARKER % (size - head_size - tail_size))
+        in_f.seek(size - tail_size, 0)
+        copyfileobj(in_f, gzip_f, LOG_CHUNK_SIZE)
+    gzip_f.close()
+    return out_f
+
+def _copy_bytes(in_f, out_f, num_bytes):
+    """Copies num_bytes bytes from in_f to out_f in fixed-size chunks."""
+    while num_bytes > 0:
+        chunk = in_f.read(min(num_bytes, LOG_CHUNK_SIZE))
+        if not chunk:
+            break
+        out_f.write(chunk)
+        num_bytes -= len(chunk)
+
+def _get_file_size(f):
+    """Returns the size of a file, leaving it positioned at its end."""
+    f.seek(0, 2)
+    return f.tell()
 
 def send_email(host, port, sender, password, recipients, subject, body,
-               attachments=None):
+               attachments=None, insecure=False):
     """Sends an email (optionally with attachments).
 
-    This function does not return anything. It is not unit tested because it
-    sends an actual email, and thus is difficult to test.
+    This function does not return anything. It is exercised by the
+    end-to-end tests (tests/test_end_to_end.py), which send the email to a
+    local SMTP server.
+
+    The message is written to a temporary spool file by write_email() and
+    then streamed to the SMTP server a chunk at a time, so the amount of
+    memory used doesn't depend on the size of the attachments.
+
+    The connection is encrypted with STARTTLS before the sender logs in and
+    the message is sent. If the server doesn't support STARTTLS, an
+    SMTPException is raised and nothing is sent, unless insecure is True.
 
     This code is largely based on the code found here:
     http://www.blog.pythonlibrary.org/2010/05/14/how-to-send-email-with-python/
@@ -191,29 +375,136 @@ def send_email(host, port, sender, password, recipients, subject, body,
             the filename that will be used for the email attachment (as the
             recipient will see it), and the second element is the file to be
             attached
+        insecure - if True, the email is sent without encryption to a server
+            that doesn't support STARTTLS (e.g. a local test server), and the
+            sender only logs in if the server supports authentication. The
+            password is never sent over an unencrypted connection: if the
+            server asks for authentication but doesn't support STARTTLS, an
+            SMTPException is raised before logging in
+    """
+    msg_f = TemporaryFile(prefix='clout_email', suffix='.eml')
+    try:
+        write_email(msg_f, sender, recipients, subject, body, attachments)
+        msg_f.seek(0, 0)
+
+        server = SMTP(host, port)
+        server.ehlo_or_helo_if_needed()
+        if server.has_extn('starttls'):
+            server.starttls()
+            server.ehlo()
+        elif not insecure:
+            server.close()
+            raise SMTPException("The SMTP server does not support STARTTLS, "
+                                "so the email will not be sent.")
+        elif server.has_extn('auth'):
+            server.close()
+            raise SMTPException("The SMTP server requires authentication but "
+                                "does not support STARTTLS, so the password "
+                                "will not be sent.")
+
+        if not insecure or server.has_extn('auth'):
+            server.login(sender, password)
+        _send_message_file(server, sender, recipients, msg_f)
+        server.quit()
+    finally:
+        msg_f.close()
+
+def write_email(msg_f, sender, recipients, subject, body, attachments=None):
+    """Writes a MIME email message (optionally with attachments) to a file.
+
+    The body comes first, followed by each attachment. Attachments are read
+    and base64-encoded a chunk at a time, so they are never held in memory.
+
+    Arguments:
+        msg_f - the file to write the message to
+        sender - same as for send_email()
+        recipients - same as for send_email()
+        subject - same as for send_email()
+        body - same as for send_email()
+        attachments - same as for send_email()
     """
-    msg = MIMEMultipart()
-    msg['From'] = sender
-    msg['To'] = ', '.join(recipients)
-    msg['Subject'] = subject
-    msg['Date'] = formatdate(localtime=True)
- 
+    boundary = '===============clout%s==' % uuid4().hex
+
+    msg_f.write('Content-Type: multipart/mixed; boundary="%s"\n' % boundary)
+    msg_f.write('MIME-Version: 1.0\n')
+    msg_f.write('From: %s\n' % sender)
+    msg_f.write('To: %s\n' % ', '.join(recipients))
+    msg_f.write('Subject: %s\n' % subject)
+    msg_f.write('Date: %s\n\n' % formatdate(localtime=True))
+
+    # The body is small, so let the email package take care of encoding it.
+    msg_f.write('--%s\n' % boundary)
+    Generator(msg_f, mangle_from_=False).flatten(MIMEText(body, 'plain'))
+    msg_f.write('\n')
+
     if attachments is not None:
         for attachment_name, attachment_f in attachments:
-            part = MIMEBase('application', 'octet-stream')
-            part.set_payload(attachment_f.read())
-            encode_base64(part)
-            part.add_header('Content-Disposition',
-                            'attachment; filename="%s"' % attachment_name)
-            msg.attach(part)
-    part = MIMEText('text', 'plain')
-    part.set_payload(body)
-    msg.attach(part)
- 
-    server = SMTP(host, port)
-    server.ehlo()
-    server.starttls()
-    server.ehlo
-    server.login(sender, password)
-    server.sendmail(sender, recipients, msg.as_string())
-    server.quit()
+            msg_f.write('--%s\n' % boundary)
+            msg_f.write('Content-Type: application/octet-stream\n')
+            msg_f.write('MIME-Version: 1.0\n')
+            msg_f.write('Content-Transfer-Encoding: base64\n')
+            msg_f.write('Content-Disposition: attachment; filename="%s"\n\n'
+                        % attachment_name)
+
+            # Each 57 bytes of input is encoded as one 76-character line.
+            chunk = attachment_f.read(BASE64_CHUNK_SIZE)
+            while chunk:
+                msg_f.write(encodestring(chunk))
+                chunk = attachment_f.read(BASE64_CHUNK_SIZE)
+    msg_f.write('--%s--\n' % boundary)
+
+def _send_message_file(server, sender, recipients, msg_f):
+    """Sends a message from a file over an open SMTP connection.
+
+    This does the same thing as SMTP.sendmail(), except that the message is
+    read from msg_f and sent a chunk at a time instead of all at once. Raises
+    the same exceptions as SMTP.sendmail() if the server rejects the sender,
+    all of the recipients, or the message.
+
+    Returns a dictionary with an entry for each recipient that was refused,
+    mapping the recipient to the SMTP error code and message.
+
+    Arguments:
+        server - an SMTP object that is connected (and logged in, if
+            necessary)
+        sender - same as for send_email()
+        recipients - same as for send_email()
+        msg_f - the file containing the message, as written by write_email()
+    """
+    code, resp = server.mail(sender)
+    if code != 250:
+        server.rset()
+        raise SMTPSenderRefused(code, resp, sender)
+
+    refused_recipients = {}
+    for recipient in recipients:
+        code, resp = server.rcpt(recipient)
+        if code not in (250, 251):
+            refused_recipients[recipient] = (code, resp)
+    if len(refused_recipients) == len(recipients):
+        server.rset()
+        raise SMTPRecipientsRefused(refused_recipients)
+
+    code, resp = server.docmd('data')
+    if code != 354:
+        server.rset()
+        raise SMTPDataError(code, resp)
+
+    # Line endings are converted to CRLF and lines starting with a period are
+    # escaped, just like SMTP.sendmail() does.
+    buf, buf_size = [], 0
+    for line in msg_f:
+        line = quotedata(line)
+        buf.append(line)
+        buf_size += len(line)
+        if buf_size >= LOG_CHUNK_SIZE:
+            server.send(''.join(buf))
+            buf, buf_size = [], 0
+    buf.append('.\r\n')
+    server.send(''.join(buf))
+
+    code, resp = server.getreply()
+    if code != 250:
+        server.rset()
+        raise SMTPDataError(code, resp)
+    return refused_recipients
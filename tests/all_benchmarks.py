@@ -0,0 +1,353 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012-2013, The Clout Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPLv2"
+__version__ = "0.9-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+"""Run Clout's benchmarks by executing this script.
+
+The benchmarks measure how long Clout's own machinery (as opposed to the test
+suites it runs) takes: running thousands of short commands, logging commands
+that produce a lot of output, terminating many timed-out commands at once,
+compressing and MIME-encoding attachments, sending the email, and a complete
+run against the fake StarCluster in tests/fake_starcluster.py. Nothing is
+sent over the network; the email goes to the SMTP server in
+tests/smtp_sink.py.
+
+Each benchmark runs in its own process so that its peak memory use (RSS) can
+be measured separately. The results are printed and saved as JSON, and can
+be compared against the results of a previous run (e.g. of an earlier
+version of Clout) with --compare_to.
+"""
+
+from json import dump, load
+from multiprocessing import Process, Queue
+from optparse import OptionParser
+from os import devnull
+from os.path import abspath, dirname, join
+from platform import platform, python_version
+from resource import getrusage, RUSAGE_SELF
+from shutil import rmtree
+from subprocess import call
+from sys import executable, exit, path
+from tempfile import mkdtemp, TemporaryFile
+from time import time
+
+# Make the clout package importable when this file is run directly.
+path.insert(0, abspath(join(dirname(__file__), '..')))
+from clout.run import run_test_suites
+from clout.util import (CommandExecutor, compress_attachments, send_email,
+                        write_email)
+from smtp_sink import SMTPSink
+
+script_usage = """Usage: all_benchmarks.py [options]
+
+Runs Clout's benchmarks and saves the results as JSON. Use --quick for a
+fast run with small inputs (e.g. to check that the benchmarks still work)."""
+
+tests_dir = dirname(abspath(__file__))
+
+# The inputs of each benchmark, for full and quick runs.
+BENCHMARK_PARAMS = {
+    'short_commands': ({'num_cmds': 2000, 'max_parallel': 4},
+                       {'num_cmds': 100, 'max_parallel': 4}),
+    'large_output': ({'output_mb': 1024}, {'output_mb': 16}),
+    'concurrent_timeouts': ({'num_cmds': 100, 'timeout_seconds': 2.0},
+                            {'num_cmds': 10, 'timeout_seconds': 1.0}),
+    'email': ({'attachment_mb': 100, 'num_attachments': 10},
+              {'attachment_mb': 4, 'num_attachments': 4}),
+    'end_to_end': ({'num_test_suites': 200, 'cluster_size': 4},
+                   {'num_test_suites': 20, 'cluster_size': 2})
+}
+
+def benchmark_short_commands(num_cmds, max_parallel):
+    """Runs many commands that do nothing, to measure per-command overhead.
+
+    The overhead is the extra time per command that CommandExecutor takes
+    compared to starting the same commands with subprocess.call().
+    """
+    start_time = time()
+    null_f = open(devnull, 'w')
+    try:
+        for cmd_num in range(num_cmds):
+            call('true', shell=True, stdout=null_f, stderr=null_f)
+    finally:
+        null_f.close()
+    baseline_time = time() - start_time
+
+    results = {'num_cmds': num_cmds, 'baseline_seconds': baseline_time}
+    for parallel in sorted(set([1, max_parallel])):
+        log_f = TemporaryFile()
+        try:
+            executor = CommandExecutor(['true'] * num_cmds, log_f,
+                                       max_parallel=parallel)
+            start_time = time()
+            executor(60.0)
+            wall_time = time() - start_time
+        finally:
+            log_f.close()
+
+        durations = [end - start for start, end, ret_val in
+                     executor.cmd_records]
+        results['parallel_%d' % parallel] = {
+            'wall_seconds': wall_time,
+            'cmds_per_second': num_cmds / wall_time,
+            'mean_cmd_seconds': sum(durations) / len(durations)
+        }
+    results['overhead_per_cmd_ms'] = \
+            (results['parallel_1']['wall_seconds'] - baseline_time) * 1000 / \
+            num_cmds
+    return results
+
+def benchmark_large_output(output_mb):
+    """Runs a command that writes a lot of output, to measure log copying."""
+    cmd = 'head -c %d /dev/zero' % (output_mb * 1024 * 1024)
+    log_f = TemporaryFile()
+    try:
+        executor = CommandExecutor([cmd], log_f, log_individual_cmds=True)
+        start_time = time()
+        statuses = executor(60.0)[1]
+        wall_time = time() - start_time
+        for cmd_log_f, ret_val in statuses:
+            cmd_log_f.close()
+    finally:
+        log_f.close()
+
+    cmd_time = executor.cmd_records[0][1] - executor.cmd_records[0][0]
+    return {'output_mb': output_mb, 'wall_seconds': wall_time,
+            'mb_per_second': output_mb / wall_time,
+            'logging_seconds': wall_time - cmd_time}
+
+def benchmark_concurrent_timeouts(num_cmds, timeout_seconds):
+    """Runs many commands that hang, to measure how quickly they're killed.
+
+    Each command is in its own queue, so they all run (and time out) at the
+    same time.
+    """
+    log_f = TemporaryFile()
+    try:
+        executor = CommandExecutor(['sleep 600'] * num_cmds, log_f,
+                                   queue_ids=range(num_cmds))
+        start_time = time()
+        succeeded = executor(timeout_seconds / 60)[0]
+        wall_time = time() - start_time
+    finally:
+        log_f.close()
+
+    return {'num_cmds': num_cmds, 'timed_out': succeeded is None,
+            'num_timed_out_cmds': len(executor.timed_out_cmds),
+            'wall_seconds': wall_time,
+            'seconds_after_timeout': wall_time - timeout_seconds}
+
+def benchmark_email(attachment_mb, num_attachments, smtp_host, smtp_port):
+    """Compresses, MIME-encodes, and sends log files like Clout's emails."""
+    # Log-like lines that compress about as well as real test output.
+    line_template = ('test_%08d (tests.test_module.TestClass) ... ok '
+                     '[%0.6f s]\n')
+    size = attachment_mb * 1024 * 1024 // num_attachments
+    attachments = []
+    for attachment_num in range(num_attachments):
+        attachment_f = TemporaryFile()
+        line_num = 0
+        while attachment_f.tell() < size:
+            attachment_f.write(line_template % (line_num, line_num / 7919))
+            line_num += 1
+        attachment_f.seek(0, 0)
+        attachments.append(('log%d.txt' % attachment_num, attachment_f))
+
+    start_time = time()
+    attachments, compression_info = compress_attachments(attachments)
+    compress_time = time() - start_time
+
+    msg_f = TemporaryFile()
+    try:
+        start_time = time()
+        write_email(msg_f, 'clout@example.com', ['dev@example.com'],
+                    'Benchmark', 'Benchmark email body.', attachments)
+        mime_time = time() - start_time
+        msg_size = msg_f.tell()
+    finally:
+        msg_f.close()
+
+    for name, attachment_f in attachments:
+        attachment_f.seek(0, 0)
+    start_time = time()
+    send_email(smtp_host, smtp_port, 'clout@example.com', 'not-used',
+               ['dev@example.com'], 'Benchmark', 'Benchmark email body.',
+               attachments, insecure=True)
+    send_time = time() - start_time
+
+    for name, attachment_f in attachments:
+        attachment_f.close()
+    return {'attachment_mb': attachment_mb,
+            'compressed_mb': compression_info['compressed_size'] / 1024 /
+                             1024,
+            'message_mb': msg_size / 1024 / 1024,
+            'compress_seconds': compress_time,
+            'mime_encoding_seconds': mime_time,
+            'mime_encoding_mb_per_second': msg_size / 1024 / 1024 / mime_time,
+            'send_seconds': send_time}
+
+def benchmark_end_to_end(num_test_suites, cluster_size, smtp_host,
+                         smtp_port):
+    """Runs trivial test suites on a fake cluster, from start to finish.
+
+    Since the test suites and the fake cluster do nothing, the run time is
+    Clout's own overhead (plus starting the fake starcluster executable for
+    every command).
+    """
+    tmp_dir = mkdtemp(prefix='clout_benchmark')
+    try:
+        sc_config_fp = join(tmp_dir, 'starcluster.config')
+        sc_config_f = open(sc_config_fp, 'w')
+        sc_config_f.write("[global]\nDEFAULT_TEMPLATE = benchmark\n\n"
+                          "[cluster benchmark]\nCLUSTER_SIZE = %d\n\n"
+                          "[scenario]\nstate_dir = %s\n" %
+                          (cluster_size, join(tmp_dir, 'fake_state')))
+        sc_config_f.close()
+
+        config = ['Suite%d\ttrue' % suite_num
+                  for suite_num in range(num_test_suites)]
+        email_settings = ['smtp_server\t%s' % smtp_host,
+                          'smtp_port\t%d' % smtp_port,
+                          'sender\tclout@example.com', 'password\tnot-used',
+                          'insecure_smtp\ttrue']
+
+        start_time = time()
+        run_test_suites(config, sc_config_fp, ['dev@example.com'],
+                        email_settings, 'clout-benchmark',
+                        sc_exe_fp='%s %s' % (executable,
+                                             join(tests_dir,
+                                                  'fake_starcluster.py')),
+                        state_dir=join(tmp_dir, 'state'))
+        wall_time = time() - start_time
+    finally:
+        rmtree(tmp_dir)
+
+    return {'num_test_suites': num_test_suites, 'wall_seconds': wall_time,
+            'seconds_per_test_suite': wall_time / num_test_suites}
+
+BENCHMARKS = [
+    ('short_commands', benchmark_short_commands, False),
+    ('large_output', benchmark_large_output, False),
+    ('concurrent_timeouts', benchmark_concurrent_timeouts, False),
+    ('email', benchmark_email, True),
+    ('end_to_end', benchmark_end_to_end, True)
+]
+
+def run_benchmark(benchmark_fn, params):
+    """Runs a benchmark in a separate process, measuring its peak RSS."""
+    results_queue = Queue()
+
+    def run():
+        start_rss = getrusage(RUSAGE_SELF).ru_maxrss
+        results = benchmark_fn(**params)
+        # On Linux, ru_maxrss is in kilobytes.
+        results['peak_rss_mb'] = getrusage(RUSAGE_SELF).ru_maxrss / 1024
+        results['peak_rss_increase_mb'] = \
+                (getrusage(RUSAGE_SELF).ru_maxrss - start_rss) / 1024
+        results_queue.put(results)
+
+    proc = Process(target=run)
+    proc.start()
+    results = results_queue.get()
+    proc.join()
+    return results
+
+def compare_results(results, previous_results):
+    """Returns lines comparing each numeric result with a previous run's."""
+    lines = []
+    for name, benchmark_results in sorted(results['benchmarks'].items()):
+        previous = previous_results['benchmarks'].get(name, {})
+        for key, val in sorted(_flatten(benchmark_results).items()):
+            previous_val = _flatten(previous).get(key)
+            if isinstance(val, float) and isinstance(previous_val, float) \
+               and previous_val > 0:
+                lines.append('%s.%s: %.4g -> %.4g (%.2fx)' %
+                             (name, key, previous_val, val,
+                              val / previous_val))
+    return lines
+
+def _flatten(results, prefix=''):
+    """Flattens nested result dicts into dotted keys."""
+    flattened = {}
+    for key, val in results.items():
+        if isinstance(val, dict):
+            flattened.update(_flatten(val, '%s%s.' % (prefix, key)))
+        else:
+            flattened[prefix + key] = val
+    return flattened
+
+def main():
+    parser = OptionParser(usage=script_usage)
+    parser.add_option('-o', '--output_fp', default='benchmark_results.json',
+                      help='the file to save the results to as JSON '
+                      '[default: %default]')
+    parser.add_option('-c', '--compare_to', default=None,
+                      help='a results file from a previous run to compare '
+                      'against')
+    parser.add_option('-b', '--benchmarks', default=None,
+                      help='comma-separated names of the benchmarks to run '
+                      '[default: all of them]')
+    parser.add_option('-q', '--quick', action='store_true', default=False,
+                      help='use small inputs so that the benchmarks finish '
+                      'quickly [default: %default]')
+    opts, args = parser.parse_args()
+
+    names = [name for name, benchmark_fn, uses_smtp in BENCHMARKS]
+    if opts.benchmarks is not None:
+        names = opts.benchmarks.split(',')
+        for name in names:
+            if name not in BENCHMARK_PARAMS:
+                parser.error("Unrecognized benchmark '%s'." % name)
+
+    smtp_sink = SMTPSink()
+    smtp_sink.start()
+    results = {'clout_version': __version__, 'python_version':
+               python_version(), 'platform': platform(), 'timestamp': time(),
+               'quick': opts.quick, 'benchmarks': {}}
+    try:
+        for name, benchmark_fn, uses_smtp in BENCHMARKS:
+            if name not in names:
+                continue
+            params = dict(BENCHMARK_PARAMS[name][int(opts.quick)])
+            if uses_smtp:
+                params['smtp_host'] = smtp_sink.host
+                params['smtp_port'] = smtp_sink.port
+
+            print "Running the %s benchmark..." % name
+            results['benchmarks'][name] = run_benchmark(benchmark_fn, params)
+            for key, val in sorted(_flatten(
+                    results['benchmarks'][name]).items()):
+                print "    %s: %s" % (key, val)
+
+            # Don't keep the emails received so far in memory.
+            smtp_sink.messages = []
+    finally:
+        smtp_sink.stop()
+
+    output_f = open(opts.output_fp, 'w')
+    try:
+        dump(results, output_f, indent=4, sort_keys=True)
+    finally:
+        output_f.close()
+    print "\nSaved the results to %s." % opts.output_fp
+
+    if opts.compare_to is not None:
+        previous_f = open(opts.compare_to, 'U')
+        try:
+            previous_results = load(previous_f)
+        finally:
+            previous_f.close()
+        print "\nCompared with %s:\n%s" % (opts.compare_to,
+                '\n'.join(compare_results(results, previous_results)))
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
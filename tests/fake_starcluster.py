@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012-2013, The Clout Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPLv2"
+__version__ = "0.9-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+"""A stand-in for the starcluster executable that never touches EC2.
+
+Point clout at it with --starcluster_exe_fp (e.g. 'python
+tests/fake_starcluster.py'). It understands the subset of starcluster that
+clout uses (start, sshmaster, sshnode, listclusters, and terminate), keeps
+track of the clusters it has "started" in a state directory, and runs the
+commands that would have been run on the cluster on the local machine.
+
+How the fake cluster behaves is controlled by an optional [scenario] section
+in the StarCluster config file that clout passes to it with -c (the real
+starcluster ignores sections it doesn't know about). All settings are
+optional:
+    state_dir - the directory to keep track of running clusters in
+        [default: fake_starcluster_state next to the config file]
+    boot_time - seconds that 'start' takes [default: 0]
+    terminate_time - seconds that 'terminate' takes [default: 0]
+    cmd_latency - seconds added to every sshmaster/sshnode command, e.g. to
+        simulate SSH connection setup [default: 0]
+    output_bytes - bytes of filler output that every sshmaster/sshnode
+        command prints before running its command [default: 0]
+    fail_start - if true, 'start' fails [default: false]
+    fail_terminate - if true, 'terminate' fails [default: false]
+    fail_cmds - comma-separated strings; sshmaster/sshnode commands that
+        contain any of them print an error and fail instead of running
+    hang_cmds - comma-separated strings; sshmaster/sshnode commands that
+        contain any of them never finish
+    spot_interruption_after - the number of sshmaster/sshnode commands after
+        which the cluster's spot instances are reclaimed: the command fails
+        like a dropped SSH connection, as does every later command, and
+        listclusters reports the nodes as terminated
+"""
+
+from ConfigParser import RawConfigParser
+from fcntl import flock, LOCK_EX, LOCK_UN
+from os import listdir, makedirs, remove
+from os.path import abspath, dirname, exists, join
+from subprocess import call
+from sys import argv, exit, path, stderr, stdout
+from time import sleep
+
+# Make the clout package importable when this file is run directly.
+path.insert(0, abspath(join(dirname(__file__), '..')))
+from clout.backend import get_starcluster_node_aliases
+from clout.parse import parse_starcluster_config
+
+script_usage = """Usage: fake_starcluster.py -c <sc config> <command> [args]
+
+Commands:
+    start [-c <cluster template>] [-b <spot bid> --force-spot-master] <tag>
+    sshmaster -u <user> <tag> <cmd>
+    sshnode -u <user> <tag> <node alias> <cmd>
+    listclusters <tag>
+    terminate -c <tag>
+"""
+
+def main(args):
+    if len(args) < 3 or args[0] != '-c':
+        stdout.write(script_usage)
+        return 0 if '-h' in args else 1
+
+    sc_config_fp, cmd, cmd_args = args[1], args[2], args[3:]
+    scenario = _load_scenario(sc_config_fp)
+
+    if cmd == 'start':
+        return start(sc_config_fp, scenario, cmd_args)
+    elif cmd == 'sshmaster':
+        return ssh(scenario, cmd_args[2], 'master', cmd_args[3])
+    elif cmd == 'sshnode':
+        return ssh(scenario, cmd_args[2], cmd_args[3], cmd_args[4])
+    elif cmd == 'listclusters':
+        return listclusters(scenario, cmd_args[0])
+    elif cmd == 'terminate':
+        return terminate(scenario, cmd_args[-1])
+    else:
+        stderr.write("!!! ERROR - unknown command '%s'\n" % cmd)
+        return 1
+
+def start(sc_config_fp, scenario, cmd_args):
+    """Starts a fake cluster, which takes boot_time seconds."""
+    cluster_template = None
+    if cmd_args[0] == '-c':
+        cluster_template = cmd_args[1]
+    cluster_tag = cmd_args[-1]
+
+    if exists(_get_cluster_fp(scenario, cluster_tag)):
+        stderr.write("!!! ERROR - Cluster with tag name %s already exists\n"
+                     % cluster_tag)
+        return 1
+
+    sc_config_f = open(sc_config_fp, 'U')
+    try:
+        cluster_size = parse_starcluster_config(sc_config_f,
+                                                cluster_template)[
+                                                        'cluster_size']
+    finally:
+        sc_config_f.close()
+
+    stdout.write(">>> Starting fake cluster %s with %d node(s)...\n" %
+                 (cluster_tag, cluster_size))
+    stdout.flush()
+    sleep(scenario['boot_time'])
+
+    if scenario['fail_start']:
+        stderr.write("!!! ERROR - the fake cluster failed to start\n")
+        return 1
+
+    _save_cluster(scenario, cluster_tag,
+                  {'nodes': get_starcluster_node_aliases(cluster_size),
+                   'state': 'running', 'num_cmds': 0})
+    stdout.write(">>> The cluster is now ready to use.\n")
+    return 0
+
+def ssh(scenario, cluster_tag, node_alias, remote_cmd):
+    """Runs a command "on" a node of a fake cluster."""
+    # Commands may run at the same time, so count them one at a time.
+    lock_f = _lock_state_dir(scenario)
+    try:
+        cluster = _load_cluster(scenario, cluster_tag)
+        if cluster is None or node_alias not in cluster['nodes']:
+            stderr.write("!!! ERROR - node '%s' does not exist\n" %
+                         node_alias)
+            return 1
+
+        cluster['num_cmds'] += 1
+        if scenario['spot_interruption_after'] is not None and \
+           cluster['num_cmds'] > scenario['spot_interruption_after']:
+            cluster['state'] = 'terminated'
+        _save_cluster(scenario, cluster_tag, cluster)
+    finally:
+        flock(lock_f, LOCK_UN)
+        lock_f.close()
+
+    sleep(scenario['cmd_latency'])
+
+    if cluster['state'] != 'running':
+        stderr.write("Connection to %s closed by remote host.\n" % node_alias)
+        return 255
+
+    _write_filler(scenario['output_bytes'])
+
+    if _matches(remote_cmd, scenario['hang_cmds']):
+        while True:
+            sleep(60)
+
+    if _matches(remote_cmd, scenario['fail_cmds']):
+        stderr.write("fake failure of command: %s\n" % remote_cmd)
+        return 1
+
+    stdout.flush()
+    return call(remote_cmd, shell=True)
+
+def listclusters(scenario, cluster_tag):
+    """Describes a fake cluster like 'starcluster listclusters' does."""
+    cluster = _load_cluster(scenario, cluster_tag)
+    if cluster is None:
+        stderr.write("!!! ERROR - cluster %s does not exist\n" % cluster_tag)
+        return 1
+
+    stdout.write("-" * 40 + "\n%s (security group: @sc-%s)\n" %
+                 (cluster_tag, cluster_tag) + "-" * 40 + "\n")
+    stdout.write("Cluster nodes:\n")
+    for node_num, node_alias in enumerate(cluster['nodes']):
+        stdout.write("%12s %s i-%08d ec2-%d-fake.compute-1.amazonaws.com\n"
+                     % (node_alias, cluster['state'], node_num + 1,
+                        node_num + 1))
+    stdout.write("Total nodes: %d\n" % len(cluster['nodes']))
+    return 0
+
+def terminate(scenario, cluster_tag):
+    """Terminates a fake cluster, which takes terminate_time seconds."""
+    sleep(scenario['terminate_time'])
+
+    if scenario['fail_terminate']:
+        stderr.write("!!! ERROR - the fake cluster failed to terminate\n")
+        return 1
+
+    cluster_fp = _get_cluster_fp(scenario, cluster_tag)
+    if not exists(cluster_fp):
+        stderr.write("!!! ERROR - cluster %s does not exist\n" % cluster_tag)
+        return 1
+    remove(cluster_fp)
+    stdout.write(">>> Terminating fake cluster %s...\n" % cluster_tag)
+    return 0
+
+def list_running_clusters(state_dir):
+    """Returns the tags of the fake clusters that are still running."""
+    if not exists(state_dir):
+        return []
+    return sorted([fn[:-len('.cluster')] for fn in listdir(state_dir)
+                   if fn.endswith('.cluster')])
+
+def _load_scenario(sc_config_fp):
+    """Reads the [scenario] section of the StarCluster config file."""
+    config = RawConfigParser()
+    config.read(sc_config_fp)
+
+    def get(option, default, convert=str):
+        if config.has_option('scenario', option):
+            return convert(config.get('scenario', option))
+        return default
+
+    def to_bool(val):
+        return val.strip().lower() in ('true', 'yes', '1')
+
+    def to_list(val):
+        return [item.strip() for item in val.split(',') if item.strip()]
+
+    return {
+        'state_dir': get('state_dir', join(dirname(abspath(sc_config_fp)),
+                                           'fake_starcluster_state')),
+        'boot_time': get('boot_time', 0.0, float),
+        'terminate_time': get('terminate_time', 0.0, float),
+        'cmd_latency': get('cmd_latency', 0.0, float),
+        'output_bytes': get('output_bytes', 0, int),
+        'fail_start': get('fail_start', False, to_bool),
+        'fail_terminate': get('fail_terminate', False, to_bool),
+        'fail_cmds': get('fail_cmds', [], to_list),
+        'hang_cmds': get('hang_cmds', [], to_list),
+        'spot_interruption_after': get('spot_interruption_after', None, int)
+    }
+
+def _lock_state_dir(scenario):
+    if not exists(scenario['state_dir']):
+        makedirs(scenario['state_dir'])
+    lock_f = open(join(scenario['state_dir'], 'lock'), 'w')
+    flock(lock_f, LOCK_EX)
+    return lock_f
+
+def _get_cluster_fp(scenario, cluster_tag):
+    return join(scenario['state_dir'], '%s.cluster' % cluster_tag)
+
+def _load_cluster(scenario, cluster_tag):
+    cluster_fp = _get_cluster_fp(scenario, cluster_tag)
+    if not exists(cluster_fp):
+        return None
+    cluster_f = open(cluster_fp, 'U')
+    try:
+        lines = cluster_f.read().split('\n')
+    finally:
+        cluster_f.close()
+    return {'nodes': lines[0].split(), 'state': lines[1],
+            'num_cmds': int(lines[2])}
+
+def _save_cluster(scenario, cluster_tag, cluster):
+    if not exists(scenario['state_dir']):
+        makedirs(scenario['state_dir'])
+    cluster_f = open(_get_cluster_fp(scenario, cluster_tag), 'w')
+    try:
+        cluster_f.write('%s\n%s\n%d' % (' '.join(cluster['nodes']),
+                                        cluster['state'],
+                                        cluster['num_cmds']))
+    finally:
+        cluster_f.close()
+
+def _matches(remote_cmd, patterns):
+    return any([pattern in remote_cmd for pattern in patterns])
+
+def _write_filler(num_bytes):
+    line = 'fake output ' * 6 + '\n'
+    while num_bytes > 0:
+        stdout.write(line[:num_bytes])
+        num_bytes -= len(line)
+
+
+if __name__ == "__main__":
+    exit(main(argv[1:]))
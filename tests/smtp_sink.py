@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012-2013, The Clout Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPLv2"
+__version__ = "0.9-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+"""A local SMTP server that keeps the messages it receives instead of
+delivering them.
+
+Used by the end-to-end tests so that clout's emails can be inspected without
+sending anything over the network.
+"""
+
+from asyncore import close_all, loop
+from smtpd import SMTPServer
+from threading import Thread
+
+class SMTPSink(SMTPServer):
+    """SMTP server on localhost that records every message it receives.
+
+    The server listens on a free port (available as self.port) and handles
+    connections in a background thread between start() and stop(). Received
+    messages are available in self.messages as (sender, recipients, message
+    data) tuples. It doesn't support STARTTLS or authentication.
+    """
+
+    def __init__(self):
+        SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+        self.host, self.port = self.getsockname()
+        self.messages = []
+        self._thread = None
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.messages.append((mailfrom, rcpttos, data))
+
+    def start(self):
+        self._thread = Thread(target=loop, kwargs={'timeout': 0.1})
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        close_all()
+        self._thread.join()
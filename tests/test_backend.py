@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012-2013, The Clout Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPLv2"
+__version__ = "0.9-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+"""Test suite for the backend.py module."""
+
+from os import devnull, listdir, mkdir
+from os.path import exists, join
+from shutil import rmtree
+from subprocess import call
+from tempfile import mkdtemp
+from unittest import main, TestCase
+
+from clout.backend import (ExecutionBackend, get_artifact_patterns,
+                           get_starcluster_node_aliases, LocalBackend,
+                           StarClusterBackend)
+from clout.parse import parse_config_file
+
+class BackendTests(TestCase):
+    """Tests for the backend.py module."""
+
+    def setUp(self):
+        """Define some sample data that will be used by the tests."""
+        # Standard config file with two test suites.
+        self.config = ["# a comment", " ",
+                "QIIME\tsource /bin/setup.sh; cd /bin; ./tests.py",
+                "PyCogent\t/bin/cogent_tests"]
+
+    def test_get_starcluster_node_aliases(self):
+        """Test getting the aliases of the nodes in a cluster."""
+        self.assertEqual(get_starcluster_node_aliases(1), ['master'])
+        self.assertEqual(get_starcluster_node_aliases(3),
+                         ['master', 'node001', 'node002'])
+
+    def test_get_artifact_patterns(self):
+        """Test getting the patterns of a test suite's artifacts."""
+        self.assertEqual(get_artifact_patterns({}), [])
+        self.assertEqual(get_artifact_patterns({'shards': 2,
+                                                'junit': ['r/*.xml'],
+                                                'artifacts': ['cov.xml']}),
+                         ['cov.xml', 'r/*.xml'])
+
+    def test_ExecutionBackend(self):
+        """Test that the base class must be subclassed."""
+        self.assertRaises(NotImplementedError,
+                          ExecutionBackend().build_setup_cmds)
+        self.assertRaises(NotImplementedError,
+                          ExecutionBackend().build_test_suite_cmd, 'foo',
+                          'bar', 'master')
+        self.assertRaises(NotImplementedError,
+                          ExecutionBackend().build_teardown_cmds)
+        self.assertRaises(NotImplementedError,
+                          ExecutionBackend().build_node_cmd, 'master', 'foo')
+
+    def test_StarClusterBackend_standard(self):
+        """Test building commands based on standard, valid input."""
+        exp = (["starcluster -c sc_config start nightly_tests"],
+               ["starcluster -c sc_config sshmaster -u root nightly_tests "
+                "'source /bin/setup.sh; cd /bin; ./tests.py'",
+               "starcluster -c sc_config sshmaster -u root nightly_tests "
+               "'/bin/cogent_tests'"],
+               ["starcluster -c sc_config terminate -c nightly_tests"])
+
+        test_suites = parse_config_file(self.config)
+        obs = StarClusterBackend('starcluster', 'sc_config',
+                'nightly_tests').build_commands(test_suites)
+        self.assertEqual(obs, exp)
+
+    def test_StarClusterBackend_custom_cluster_template(self):
+        """Test building commands using a non-default cluster template."""
+        exp = (["starcluster -c sc_config start -c some_cluster_template "
+                "nightly_tests"],
+               ["starcluster -c sc_config sshmaster -u ubuntu nightly_tests "
+                "'source /bin/setup.sh; cd /bin; ./tests.py'",
+                "starcluster -c sc_config sshmaster -u ubuntu nightly_tests "
+                "'/bin/cogent_tests'"],
+               ["starcluster -c sc_config terminate -c nightly_tests"])
+
+        test_suites = parse_config_file(self.config)
+        obs = StarClusterBackend('starcluster', 'sc_config', 'nightly_tests',
+                'some_cluster_template', 'ubuntu').build_commands(test_suites)
+        self.assertEqual(obs, exp)
+
+    def test_StarClusterBackend_custom_starcluster_exe_fp(self):
+        """Test building commands using a non-default starcluster exec."""
+        exp = (["/usr/local/bin/starcluster -c sc_config start -c "
+                "some_cluster_template nightly_tests"],
+               ["/usr/local/bin/starcluster -c sc_config sshmaster -u ubuntu "
+                "nightly_tests 'source /bin/setup.sh; cd /bin; ./tests.py'",
+                "/usr/local/bin/starcluster -c sc_config sshmaster -u ubuntu "
+                "nightly_tests '/bin/cogent_tests'"],
+               ["/usr/local/bin/starcluster -c sc_config terminate -c "
+                "nightly_tests"])
+
+        test_suites = parse_config_file(self.config)
+        obs = StarClusterBackend('/usr/local/bin/starcluster', 'sc_config',
+                'nightly_tests', 'some_cluster_template',
+                'ubuntu').build_commands(test_suites)
+        self.assertEqual(obs, exp)
+
+    def test_StarClusterBackend_no_test_suites(self):
+        """Test building commands with no test suites."""
+        exp = (["starcluster -c sc_config start nightly_tests"], [],
+               ["starcluster -c sc_config terminate -c nightly_tests"])
+        obs = StarClusterBackend('starcluster', 'sc_config',
+                                 'nightly_tests').build_commands([])
+        self.assertEqual(obs, exp)
+
+    def test_StarClusterBackend_spot_bid(self):
+        """Test building commands using spot bids instead of flat rates."""
+        exp = (["starcluster -c sc_config start -b 0.50 --force-spot-master "
+                "nightly_tests"],
+               ["starcluster -c sc_config sshmaster -u root nightly_tests "
+                "'source /bin/setup.sh; cd /bin; ./tests.py'",
+                "starcluster -c sc_config sshmaster -u root nightly_tests "
+                "'/bin/cogent_tests'"],
+               ["starcluster -c sc_config terminate -c nightly_tests"])
+
+        test_suites = parse_config_file(self.config)
+        obs = StarClusterBackend('starcluster', 'sc_config', 'nightly_tests',
+                spot_bid=0.50).build_commands(test_suites)
+        self.assertEqual(obs, exp)
+
+        # With custom cluster template and user.
+        exp = (["starcluster -c sc_config start -c some_cluster_template -b "
+                "1.00 --force-spot-master nightly_tests"],
+               ["starcluster -c sc_config sshmaster -u ubuntu nightly_tests "
+                "'source /bin/setup.sh; cd /bin; ./tests.py'",
+                "starcluster -c sc_config sshmaster -u ubuntu nightly_tests "
+                "'/bin/cogent_tests'"],
+               ["starcluster -c sc_config terminate -c nightly_tests"])
+
+        obs = StarClusterBackend('starcluster', 'sc_config', 'nightly_tests',
+                cluster_template='some_cluster_template', user='ubuntu',
+                spot_bid=1).build_commands(test_suites)
+        self.assertEqual(obs, exp)
+
+    def test_StarClusterBackend_multiple_nodes(self):
+        """Test building commands that run test suites on worker nodes."""
+        exp = (["starcluster -c sc_config start nightly_tests"],
+               ["starcluster -c sc_config sshmaster -u root nightly_tests "
+                "'source /bin/setup.sh; cd /bin; ./tests.py'",
+                "starcluster -c sc_config sshnode -u root nightly_tests "
+                "node001 '/bin/cogent_tests'"],
+               ["starcluster -c sc_config terminate -c nightly_tests"])
+
+        test_suites = parse_config_file(self.config)
+        obs = StarClusterBackend('starcluster', 'sc_config', 'nightly_tests',
+                cluster_size=2).build_commands(test_suites,
+                                               ['master', 'node001'])
+        self.assertEqual(obs, exp)
+
+    def test_StarClusterBackend_ssh_multiplexing(self):
+        """Test building commands that run test suites over ssh directly."""
+        exp = (["starcluster -c sc_config start nightly_tests"],
+               ["ssh -F /tmp/ssh/ssh_config master "
+                "'source /bin/setup.sh; cd /bin; ./tests.py'",
+                "ssh -F /tmp/ssh/ssh_config node001 '/bin/cogent_tests'"],
+               ["starcluster -c sc_config terminate -c nightly_tests"])
+
+        test_suites = parse_config_file(self.config)
+        obs = StarClusterBackend('starcluster', 'sc_config', 'nightly_tests',
+                cluster_size=2, ssh_config_fp='/tmp/ssh/ssh_config'
+                ).build_commands(test_suites, ['master', 'node001'])
+        self.assertEqual(obs, exp)
+
+    def test_StarClusterBackend_artifacts(self):
+        """Test building commands that copy artifacts back from the nodes."""
+        test_suites = [['QIIME', 'qiime_tests', {'artifacts': ['cov.xml']}],
+                       ['PyCogent', 'cogent_tests', {}],
+                       ['biom', 'biom_tests',
+                        {'artifacts': ['/tmp/*.xml', 'a.json']}],
+                       ['R&D', 'rd_tests', {'junit': ['out/*']}]]
+        backend = StarClusterBackend('starcluster', 'sc_config',
+                                     'nightly_tests', cluster_size=2)
+
+        # The artifacts of all test suites on a node are copied together.
+        exp = ["starcluster -c sc_config sshmaster -u root nightly_tests "
+               "'((tar cf - --ignore-failed-read --transform \"s|^|QIIME/|\" "
+               "cov.xml); (tar cf - --ignore-failed-read --transform "
+               "\"s|^|biom/|\" /tmp/*.xml a.json)) | gzip -c' | gzip -dc | "
+               "tar xf - -i -C /tmp/artifacts",
+               "starcluster -c sc_config sshnode -u root nightly_tests "
+               "node001 '((tar cf - --ignore-failed-read --transform "
+               "\"s|^|R\\\\&D/|\" out/*)) | gzip -c' | gzip -dc | "
+               "tar xf - -i -C /tmp/artifacts"]
+        obs = backend.build_artifacts_cmds(test_suites,
+                ['master', 'node001', 'master', 'node001'], '/tmp/artifacts')
+        self.assertEqual(obs, exp)
+
+        backend.ssh_config_fp = '/tmp/ssh/ssh_config'
+        obs = backend.build_artifacts_cmds(test_suites[:2],
+                                           ['node001', 'master'], '/tmp/a')
+        self.assertEqual(obs, ["ssh -F /tmp/ssh/ssh_config node001 "
+                               "'((tar cf - --ignore-failed-read --transform "
+                               "\"s|^|QIIME/|\" cov.xml)) | gzip -c' | "
+                               "gzip -dc | tar xf - -i -C /tmp/a"])
+
+        # Nothing to copy.
+        self.assertEqual(backend.build_artifacts_cmds(test_suites[1:2],
+                                                      None, '/tmp/a'), [])
+
+    def test_StarClusterBackend_attributes(self):
+        """Test the nodes and instance type of a StarCluster cluster."""
+        backend = StarClusterBackend('starcluster', 'sc_config',
+                                     'nightly_tests', cluster_size=3,
+                                     instance_type='m2.xlarge')
+        self.assertEqual(backend.node_aliases,
+                         ['master', 'node001', 'node002'])
+        self.assertEqual(backend.instance_type, 'm2.xlarge')
+        self.assertEqual(backend.billed_instances, 3)
+
+    def test_LocalBackend(self):
+        """Test building commands that run test suites locally."""
+        exp = (["rm -rf /tmp/work && mkdir -p /tmp/work"],
+               ["rm -rf /tmp/work/QIIME && mkdir /tmp/work/QIIME && "
+                "cd /tmp/work/QIIME || exit 1; "
+                "source /bin/setup.sh; cd /bin; ./tests.py",
+                "rm -rf /tmp/work/PyCogent && mkdir /tmp/work/PyCogent && "
+                "cd /tmp/work/PyCogent || exit 1; /bin/cogent_tests"],
+               ["rm -rf /tmp/work"])
+
+        backend = LocalBackend('/tmp/work')
+        obs = backend.build_commands(parse_config_file(self.config))
+        self.assertEqual(obs, exp)
+        self.assertEqual(backend.node_aliases, ['localhost'])
+        self.assertEqual(backend.instance_type, 'local')
+        self.assertEqual(backend.billed_instances, 0)
+
+        # Paths that need quoting.
+        obs = LocalBackend("/tmp/my work").build_commands(
+                [["it's", 'true']])
+        self.assertEqual(obs[1], ["rm -rf '/tmp/my work/it'\"'\"'s' && "
+                                  "mkdir '/tmp/my work/it'\"'\"'s' && "
+                                  "cd '/tmp/my work/it'\"'\"'s' || exit 1; "
+                                  "true"])
+
+    def test_LocalBackend_working_dirs(self):
+        """Test that test suites run in their own working directories."""
+        tmp_dir = mkdtemp(prefix='clout_test_')
+        try:
+            work_dir = join(tmp_dir, 'work')
+            setup_cmds, test_suite_cmds, teardown_cmds = \
+                    LocalBackend(work_dir).build_commands(
+                            [['A', 'test ! -e a && touch a'],
+                             ['B', 'test -e ../A/a && test ! -e a'],
+                             ['C', 'cd /; false']])
+            self.assertEqual(call(setup_cmds[0], shell=True), 0)
+            self.assertEqual([call(cmd, shell=True)
+                              for cmd in test_suite_cmds], [0, 0, 1])
+            self.assertTrue(exists(join(work_dir, 'A', 'a')))
+
+            # Rerunning a test suite starts from an empty directory.
+            self.assertEqual(call(test_suite_cmds[0], shell=True), 0)
+
+            # A leftover working directory is replaced.
+            self.assertEqual(call(setup_cmds[0], shell=True), 0)
+            self.assertFalse(exists(join(work_dir, 'A')))
+
+            self.assertEqual(call(teardown_cmds[0], shell=True), 0)
+            self.assertFalse(exists(work_dir))
+        finally:
+            rmtree(tmp_dir)
+
+    def test_LocalBackend_artifacts(self):
+        """Test copying artifacts out of the test suites' directories."""
+        tmp_dir = mkdtemp(prefix='clout_test_')
+        try:
+            backend = LocalBackend(join(tmp_dir, 'work'))
+            artifacts_dir = join(tmp_dir, 'artifacts')
+            test_suites = [['A', 'mkdir out && echo a > out/a.xml',
+                            {'artifacts': ['out/*.xml', 'missing.xml']}],
+                           ['B', 'echo b > b.json', {}],
+                           ['R&D $1', 'echo c > c.json',
+                            {'artifacts': ['*.json']}]]
+            setup_cmds, test_suite_cmds, teardown_cmds = \
+                    backend.build_commands(test_suites)
+            artifacts_cmds = backend.build_artifacts_cmds(test_suites, None,
+                                                          artifacts_dir)
+            self.assertEqual(len(artifacts_cmds), 1)
+
+            self.assertEqual(call(setup_cmds[0], shell=True), 0)
+            for cmd in test_suite_cmds:
+                self.assertEqual(call(cmd, shell=True), 0)
+            mkdir(artifacts_dir)
+            self.assertEqual(call(artifacts_cmds[0], shell=True,
+                                  stderr=open(devnull, 'w')), 0)
+
+            self.assertEqual(open(join(artifacts_dir, 'A', 'out',
+                                       'a.xml')).read(), 'a\n')
+            self.assertEqual(open(join(artifacts_dir, 'R&D $1',
+                                       'c.json')).read(), 'c\n')
+            self.assertEqual(sorted(listdir(artifacts_dir)), ['A', 'R&D $1'])
+        finally:
+            rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,450 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012-2013, The Clout Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPLv2"
+__version__ = "0.9-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+"""End-to-end tests that run clout against a fake StarCluster.
+
+These tests call clout.run.run_test_suites() the same way the clout script
+does, but with tests/fake_starcluster.py standing in for the starcluster
+executable and tests/smtp_sink.py standing in for the SMTP server, so the
+whole run (starting the cluster, running the test suites on its nodes,
+terminating it, and emailing the results) happens on the local machine.
+"""
+
+from email import message_from_string
+from gzip import GzipFile
+from json import load
+from os import makedirs
+from os.path import abspath, dirname, exists, join
+from shutil import rmtree
+from socket import socket
+from StringIO import StringIO
+from sys import executable
+from tempfile import mkdtemp
+from unittest import main, TestCase
+
+from clout.history import (get_command_history, get_history_db_fp,
+                           open_history_db, summarize_flaky_test_suites)
+from clout.jobqueue import (get_job_queue_db_fp, list_jobs,
+                            open_job_queue_db, submit_job)
+from clout.run import run_test_suites, serve_jobs
+from fake_starcluster import list_running_clusters
+from smtp_sink import SMTPSink
+
+fake_starcluster_fp = join(dirname(abspath(__file__)), 'fake_starcluster.py')
+
+class EndToEndTests(TestCase):
+    """Tests for running clout from start to finish."""
+
+    def setUp(self):
+        """Start the SMTP sink and create a place to keep state."""
+        self.tmp_dir = mkdtemp(prefix='clout_test_end_to_end')
+        self.state_dir = join(self.tmp_dir, 'state')
+        self.fake_state_dir = join(self.tmp_dir, 'fake_starcluster_state')
+
+        self.smtp_sink = SMTPSink()
+        self.smtp_sink.start()
+
+        # The commands are wrapped in single quotes when they're run on the
+        # cluster, so they use double quotes.
+        self.config = ['PassingSuite\techo "all tests passed"',
+                       'FailingSuite\techo "one test failed"; exit 1',
+                       'ThirdSuite\techo "more tests passed"']
+
+    def tearDown(self):
+        """Stop the SMTP sink and remove the temporary files."""
+        self.smtp_sink.stop()
+        rmtree(self.tmp_dir)
+
+    def _run(self, config, scenario='', cluster_size=2, num_emails=1,
+             **kwargs):
+        """Runs clout and returns the (first) email that it sent.
+
+        Extra keyword arguments are passed to run_test_suites().
+        """
+        kwargs.setdefault('setup_timeout', 0.5)
+        kwargs.setdefault('test_suites_timeout', 0.5)
+        kwargs.setdefault('teardown_timeout', 0.5)
+
+        run_test_suites(config, self._write_sc_config(scenario, cluster_size),
+                        ["dev@example.com"], self._get_email_settings(),
+                        'clout-e2e',
+                        sc_exe_fp='%s %s' % (executable, fake_starcluster_fp),
+                        state_dir=self.state_dir, **kwargs)
+
+        self.assertEqual(len(self.smtp_sink.messages), num_emails)
+        sender, recipients, data = self.smtp_sink.messages[0]
+        self.assertEqual(sender, 'clout@example.com')
+        self.assertEqual(recipients, ['dev@example.com'])
+        return message_from_string(data)
+
+    def _write_sc_config(self, scenario, cluster_size):
+        """Writes a starcluster config file and returns its path."""
+        sc_config_fp = join(self.tmp_dir, 'starcluster.config')
+        sc_config_f = open(sc_config_fp, 'w')
+        sc_config_f.write("[global]\nDEFAULT_TEMPLATE = testcluster\n\n"
+                          "[cluster testcluster]\nCLUSTER_SIZE = %d\n\n"
+                          "[scenario]\nstate_dir = %s\n%s" %
+                          (cluster_size, self.fake_state_dir, scenario))
+        sc_config_f.close()
+        return sc_config_fp
+
+    def _get_email_settings(self):
+        """Returns the lines of an email settings file for the SMTP sink.
+
+        The SMTP sink doesn't support STARTTLS, so sending to it has to be
+        allowed explicitly.
+        """
+        return ["smtp_server\t%s" % self.smtp_sink.host,
+                "smtp_port\t%d" % self.smtp_sink.port,
+                "sender\tclout@example.com",
+                "password\tnot-used",
+                "insecure_smtp\ttrue"]
+
+    def _get_body_and_attachments(self, msg):
+        """Returns the body and a dict of attachment names to contents."""
+        body, attachments = None, {}
+        for part in msg.get_payload():
+            filename = part.get_filename()
+            if filename is None:
+                body = part.get_payload(decode=True)
+            else:
+                attachments[filename] = part.get_payload(decode=True)
+        return body, attachments
+
+    def _decompress(self, data):
+        """Returns the contents of a gzip-compressed attachment."""
+        return GzipFile(mode='rb', fileobj=StringIO(data)).read()
+
+    def test_passing_and_failing_test_suites(self):
+        """Test running test suites across the nodes of a cluster."""
+        metrics_dir = join(self.tmp_dir, 'metrics')
+        msg = self._run(self.config, metrics_dir=metrics_dir)
+        self.assertEqual(msg['Subject'],
+                         'Test suite results [Clout testing system]')
+
+        body, attachments = self._get_body_and_attachments(msg)
+        self.assertTrue('PassingSuite: Pass' in body)
+        self.assertTrue('FailingSuite: Fail' in body)
+        self.assertTrue('ThirdSuite: Pass' in body)
+        self.assertTrue('compressed from' in body)
+        self.assertTrue('Time taken (longest first):\n' in body)
+        self.assertTrue('Cluster setup\n' in body)
+        self.assertTrue('billed as 2 instance-hours' in body)
+
+        self.assertEqual(sorted(attachments),
+                         ['FailingSuite_results.txt.gz',
+                          'PassingSuite_results.txt.gz',
+                          'ThirdSuite_results.txt.gz', 'complete_log.txt.gz'])
+        self.assertTrue('one test failed' in
+                        self._decompress(attachments[
+                                'FailingSuite_results.txt.gz']))
+
+        # The cluster was terminated afterwards.
+        self.assertEqual(list_running_clusters(self.fake_state_dir), [])
+
+        metrics_f = open(join(metrics_dir, 'clout_clout-e2e.json'), 'U')
+        metrics = load(metrics_f)
+        metrics_f.close()
+        self.assertEqual(metrics['succeeded'], False)
+        self.assertEqual(metrics['billed_instances'], 2)
+        self.assertEqual([(test_suite['label'], test_suite['return_code'])
+                          for test_suite in metrics['test_suites']],
+                         [('PassingSuite', 0), ('FailingSuite', 1),
+                          ('ThirdSuite', 0)])
+        self.assertTrue(exists(join(metrics_dir, 'clout_clout-e2e.prom')))
+
+    def test_hanging_test_suite(self):
+        """Test a test suite that never finishes."""
+        msg = self._run(self.config, scenario='hang_cmds = more tests\n',
+                        test_suites_timeout=0.05)
+        body, attachments = self._get_body_and_attachments(msg)
+        self.assertTrue('The timeout occurred while running the ThirdSuite '
+                        'test suite.\n\n' in body)
+        self.assertTrue('PassingSuite: Pass' in body)
+        self.assertTrue('FailingSuite: Fail' in body)
+        self.assertTrue('ThirdSuite: Fail' in body)
+        self.assertEqual(list_running_clusters(self.fake_state_dir), [])
+
+    def test_fail_fast(self):
+        """Test stopping the run as soon as a test suite fails."""
+        msg = self._run(self.config, scenario='hang_cmds = all tests\n',
+                        test_suites_timeout=1.0, keep_cluster=True,
+                        fail_fast=True)
+        self.assertEqual(msg['Subject'],
+                         'Test suite failure: FailingSuite [Clout testing '
+                         'system]')
+
+        body, attachments = self._get_body_and_attachments(msg)
+        self.assertTrue(body.startswith('First failure: the FailingSuite '
+                                        'test suite failed (return code 1)'))
+        self.assertTrue('Cancelled while running: PassingSuite\n' in body)
+        self.assertTrue('Not run: ThirdSuite\n' in body)
+        self.assertTrue('PassingSuite: Fail (cancelled)' in body)
+        self.assertFalse('ThirdSuite_results.txt.gz' in attachments)
+
+        # The cluster was terminated, even though it would have been kept.
+        self.assertEqual(list_running_clusters(self.fake_state_dir), [])
+
+    def test_spot_interruption(self):
+        """Test replacing a cluster whose spot instances were reclaimed."""
+        metrics_dir = join(self.tmp_dir, 'metrics')
+        msg = self._run(self.config, scenario='spot_interruption_after = 2\n',
+                        spot_bid=0.5, metrics_dir=metrics_dir)
+        body, attachments = self._get_body_and_attachments(msg)
+        self.assertTrue('A replacement cluster was started to run the test '
+                        'suites that didn\'t finish: ThirdSuite\n\n' in body)
+        self.assertTrue('PassingSuite: Pass' in body)
+        self.assertTrue('FailingSuite: Fail' in body)
+        self.assertTrue('ThirdSuite: Pass' in body)
+        self.assertTrue('more tests passed' in self._decompress(
+                attachments['ThirdSuite_results.txt.gz']))
+
+        # The replacement was terminated afterwards, and nothing was left
+        # in the journal.
+        self.assertEqual(list_running_clusters(self.fake_state_dir), [])
+        self.assertFalse(exists(join(self.state_dir, 'journals',
+                                     'clout-e2e')))
+
+        metrics_f = open(join(metrics_dir, 'clout_clout-e2e.json'), 'U')
+        metrics = load(metrics_f)
+        metrics_f.close()
+        self.assertEqual(metrics['cluster_replacements'], 1)
+        self.assertEqual([(test_suite['label'], test_suite['return_code'])
+                          for test_suite in metrics['test_suites']],
+                         [('PassingSuite', 0), ('FailingSuite', 1),
+                          ('ThirdSuite', 0)])
+
+        # Every series (name and label set) appears once in the Prometheus
+        # file, even though ThirdSuite was run twice.
+        prom_f = open(join(metrics_dir, 'clout_clout-e2e.prom'), 'U')
+        series = [line.rsplit(' ', 1)[0] for line in prom_f
+                  if line.strip() and not line.startswith('#')]
+        prom_f.close()
+        self.assertEqual(len(series), len(set(series)))
+        self.assertTrue('clout_test_suite_return_code{cluster_tag='
+                        '"clout-e2e",test_suite="ThirdSuite"}' in series)
+
+    def test_artifacts(self):
+        """Test copying the test suites' artifacts back from the nodes."""
+        out_dir = join(self.tmp_dir, 'out')
+        artifacts_dir = join(self.tmp_dir, 'artifacts')
+        config = ['PassingSuite\tmkdir -p %s && echo "<testsuite/>" > '
+                  '%s/junit.xml\tjunit=%s/*.xml' % (out_dir, out_dir,
+                                                    out_dir),
+                  'FailingSuite\techo "one test failed"; exit 1\t'
+                  'artifacts=%s/missing.json' % out_dir]
+        msg = self._run(config, artifacts_dir=artifacts_dir)
+
+        body, attachments = self._get_body_and_attachments(msg)
+        self.assertTrue('Artifacts (saved in %s):\nPassingSuite: 1 file (13 '
+                        'bytes)\nFailingSuite: no matching files\n\n' %
+                        artifacts_dir in body)
+        self.assertTrue('Artifact copying\n' in body)
+        self.assertTrue('Test cases (from JUnit XML reports):\nPassingSuite: '
+                        '0 passed, 0 failed, 0 errors, 0 skipped\n\n' in body)
+        self.assertEqual(open(join(artifacts_dir, 'PassingSuite',
+                                   out_dir.lstrip('/'), 'junit.xml')).read(),
+                         '<testsuite/>\n')
+        self.assertEqual(list_running_clusters(self.fake_state_dir), [])
+
+    def test_diff_logs(self):
+        """Test emailing only the new output of the test suites' logs."""
+        msg = self._run(self.config, diff_logs=True)
+        body, attachments = self._get_body_and_attachments(msg)
+        self.assertTrue('FailingSuite_results.txt.gz' in attachments)
+
+        self.smtp_sink.messages = []
+        config = self.config[:1] + ['FailingSuite\techo "one test failed"; '
+                                    'echo "a new failure"; exit 1'] + \
+                 self.config[2:]
+        msg = self._run(config, diff_logs=True)
+        body, attachments = self._get_body_and_attachments(msg)
+        self.assertTrue('New output in the FailingSuite log since the '
+                        'previous run:\n' in body)
+        self.assertTrue(': a new failure\n' in body)
+        self.assertTrue('The logs of 3 test suites were compared' in body)
+        self.assertEqual(sorted(attachments), ['complete_log.txt.gz'])
+
+    def test_retries(self):
+        """Test retrying failed test suites before terminating the cluster."""
+        marker_fp = join(self.tmp_dir, 'marker')
+        config = self.config + ['FlakySuite\ttest -e %s || { touch %s; '
+                                'exit 1; }; echo "passed this time"\t'
+                                'fingerprint=echo v1' % (marker_fp, marker_fp)]
+        msg = self._run(config, test_suites_timeout=1.0, retries=1)
+        body, attachments = self._get_body_and_attachments(msg)
+        self.assertTrue('FailingSuite: Fail\n' in body)
+        self.assertTrue('FlakySuite: Pass (flaky, passed on retry 1)\n' in
+                        body)
+        self.assertTrue('likely flaky: FlakySuite (passed on retry 1)\n\n' in
+                        body)
+        self.assertTrue('including when they were retried: FailingSuite '
+                        '(retried 1 time)\n\n' in body)
+        self.assertTrue('FlakySuite (retry)\n' in body)
+        self.assertEqual(list_running_clusters(self.fake_state_dir), [])
+
+        history_conn = open_history_db(get_history_db_fp(self.state_dir))
+        try:
+            self.assertEqual([row[:3] for row in
+                              summarize_flaky_test_suites(history_conn)],
+                             [('FlakySuite', 1, 1)])
+        finally:
+            history_conn.close()
+
+        # Passing on a retry doesn't let the next run skip the test suite,
+        # but passing on the first try does.
+        self.smtp_sink.messages = []
+        body = self._get_body_and_attachments(self._run(config,
+                test_suites_timeout=1.0, retries=1))[0]
+        self.assertTrue('FlakySuite: Pass\n' in body)
+        self.smtp_sink.messages = []
+        body = self._get_body_and_attachments(self._run(config,
+                test_suites_timeout=1.0, retries=1))[0]
+        self.assertTrue('FlakySuite: Pass (cached)\n' in body)
+
+    def test_local_prep_and_background_teardown(self):
+        """Test overlapping local preparation with the cluster's boot."""
+        sdist_fp = join(self.tmp_dir, 'sdist.tar.gz')
+        config = ['PassingSuite\ttest -e %s' % sdist_fp]
+        msg = self._run(config, scenario='boot_time = 0.3\n'
+                                         'fail_terminate = true\n',
+                        local_prep_cmds=['sleep 0.2; touch %s' % sdist_fp],
+                        num_emails=2)
+        body, attachments = self._get_body_and_attachments(msg)
+        self.assertTrue('PassingSuite: Pass\n' in body)
+        self.assertTrue('Local preparation\n' in body)
+        self.assertTrue('is being terminated while this email is sent' in
+                        body)
+
+        # Problems in terminating the cluster are reported in a follow-up
+        # email.
+        follow_up = message_from_string(self.smtp_sink.messages[1][2])
+        self.assertEqual(follow_up['Subject'],
+                         'Cluster termination problem: clout-e2e [Clout '
+                         'testing system]')
+        body, attachments = self._get_body_and_attachments(follow_up)
+        self.assertTrue('There were problems in terminating the cluster.'
+                        in body)
+        self.assertEqual(sorted(attachments), ['teardown_log.txt.gz'])
+
+    def test_cluster_fails_to_start(self):
+        """Test a cluster that can't be started."""
+        msg = self._run(self.config, scenario='fail_start = true\n')
+        body, attachments = self._get_body_and_attachments(msg)
+        self.assertTrue('There were problems in starting the cluster' in body)
+        self.assertFalse('PassingSuite' in body)
+        self.assertTrue('complete_log.txt.gz' in attachments)
+        self.assertEqual(list_running_clusters(self.fake_state_dir), [])
+
+    def test_serve_jobs(self):
+        """Test running jobs from several projects on a shared cluster."""
+        makedirs(self.state_dir)
+        queue_conn = open_job_queue_db(get_job_queue_db_fp(self.state_dir))
+        try:
+            submit_job(queue_conn, 'QIIME', '\n'.join(self.config),
+                       'qiime@example.com\n')
+            out_dir = join(self.tmp_dir, 'out')
+            biom_job_id = submit_job(queue_conn, 'biom',
+                    'biom\tmkdir -p %s && echo "biom passed" > %s/biom.txt\t'
+                    'artifacts=%s/*.txt\n' % (out_dir, out_dir, out_dir),
+                    'biom@example.com\n')
+            submit_job(queue_conn, 'broken', 'not a valid config\n',
+                       'broken@example.com\n')
+        finally:
+            queue_conn.close()
+
+        serve_jobs(self._write_sc_config('', 2), self._get_email_settings(),
+                   'clout-e2e', setup_timeout=0.5, test_suites_timeout=0.5,
+                   teardown_timeout=0.5,
+                   sc_exe_fp='%s %s' % (executable, fake_starcluster_fp),
+                   state_dir=self.state_dir, exit_when_idle=True)
+
+        self.assertEqual([(recipients, message_from_string(data)['Subject'])
+                          for sender, recipients, data in
+                          self.smtp_sink.messages],
+                         [(['qiime@example.com'], 'Test suite results '
+                           '(QIIME) [Clout testing system]'),
+                          (['biom@example.com'], 'Test suite results (biom) '
+                           '[Clout testing system]')])
+        body = self._get_body_and_attachments(message_from_string(
+                self.smtp_sink.messages[1][2]))[0]
+        self.assertTrue('biom: Pass' in body)
+
+        queue_conn = open_job_queue_db(get_job_queue_db_fp(self.state_dir))
+        try:
+            jobs = list_jobs(queue_conn)
+        finally:
+            queue_conn.close()
+        self.assertEqual([(job[1], job[2], job[6]) for job in jobs],
+                         [('broken', 'failed', 'clout-e2e-1'),
+                          ('biom', 'finished', 'clout-e2e-1'),
+                          ('QIIME', 'finished', 'clout-e2e-1')])
+        self.assertTrue(jobs[1][7] > 0)
+
+        # Each job's artifacts are kept in their own directory.
+        self.assertTrue(exists(join(self.state_dir, 'artifacts', 'biom',
+                                    str(biom_job_id), 'biom', out_dir[1:],
+                                    'biom.txt')))
+
+        # Both projects ran on the same cluster, which was only started
+        # once, and was terminated when the daemon exited.
+        history_conn = open_history_db(get_history_db_fp(self.state_dir))
+        try:
+            self.assertEqual(len(get_command_history(history_conn,
+                                                     phase='setup')), 1)
+        finally:
+            history_conn.close()
+        self.assertEqual(list_running_clusters(self.fake_state_dir), [])
+
+    def test_serve_jobs_email_failure(self):
+        """Test terminating a kept cluster after a job fails to email."""
+        makedirs(self.state_dir)
+        queue_conn = open_job_queue_db(get_job_queue_db_fp(self.state_dir))
+        try:
+            submit_job(queue_conn, 'QIIME', '\n'.join(self.config),
+                       'qiime@example.com\n')
+        finally:
+            queue_conn.close()
+
+        # Nothing is listening on the SMTP port, so sending the email fails
+        # after the test suites have run on the cluster.
+        closed_sock = socket()
+        closed_sock.bind(('127.0.0.1', 0))
+        closed_port = closed_sock.getsockname()[1]
+        closed_sock.close()
+        email_settings = self._get_email_settings()
+        email_settings[1] = 'smtp_port\t%d' % closed_port
+
+        serve_jobs(self._write_sc_config('', 1), email_settings,
+                   'clout-e2e', setup_timeout=0.5, test_suites_timeout=0.5,
+                   teardown_timeout=0.5,
+                   sc_exe_fp='%s %s' % (executable, fake_starcluster_fp),
+                   state_dir=self.state_dir, exit_when_idle=True)
+
+        queue_conn = open_job_queue_db(get_job_queue_db_fp(self.state_dir))
+        try:
+            self.assertEqual([job[2] for job in list_jobs(queue_conn)],
+                             ['failed'])
+        finally:
+            queue_conn.close()
+        self.assertEqual(list_running_clusters(self.fake_state_dir), [])
+
+        # The run was still recorded in the history.
+        history_conn = open_history_db(get_history_db_fp(self.state_dir))
+        try:
+            self.assertEqual(len(get_command_history(history_conn,
+                                                     phase='test_suite')), 3)
+        finally:
+            history_conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -11,9 +11,20 @@ __email__ = "jai.rideout@gmail.com"
 
 """Test suite for the format.py module."""
 
+from time import localtime, strftime
 from unittest import main, TestCase
 
-from clout.format import format_email_summary
+from clout.format import (format_artifacts_summary,
+                          format_attachments_summary, format_command_history,
+                          format_command_history_summary, format_duration,
+                          format_email_summary, format_first_failure,
+                          format_flaky_test_suites_summary,
+                          format_instance_time, format_jobs,
+                          format_junit_results,
+                          format_new_log_lines, format_prometheus_metrics,
+                          format_retry_results, format_schedule, format_size,
+                          format_ssh_config, format_timing_table,
+                          format_warm_clusters)
 
 class FormatTests(TestCase):
     """Tests for the format.py module."""
@@ -36,11 +47,371 @@ class FormatTests(TestCase):
         obs = format_email_summary([('foo', 0)])
         self.assertEqual(obs, exp)
 
+    def test_format_email_summary_notes(self):
+        """Test building an email body with notes about test suites."""
+        exp = 'QIIME: Pass (4 shards)\nPyCogent: Fail\nbiom: Pass\n\n'
+        obs = format_email_summary([('QIIME', 0, '4 shards'),
+                                    ('PyCogent', 1, None), ('biom', 0)])
+        self.assertEqual(obs, exp)
+
     def test_format_email_summary_empty(self):
         """Test building an email body based on no commands being run."""
         obs = format_email_summary([])
         self.assertEqual(obs, '')
 
+    def test_format_ssh_config(self):
+        """Test building an SSH config file for multiplexed connections."""
+        exp = ('Host master\n    HostName ec2-1.amazonaws.com\n'
+               '    User root\n    IdentityFile /key.rsa\n'
+               '    ControlMaster auto\n    ControlPath /tmp/ssh/%r@%n\n'
+               '    ControlPersist 5m\n    StrictHostKeyChecking no\n'
+               '    UserKnownHostsFile /dev/null\n'
+               '    ServerAliveInterval 120\n    LogLevel ERROR\n\n'
+               'Host node001\n    HostName ec2-2.amazonaws.com\n'
+               '    User root\n    IdentityFile /key.rsa\n'
+               '    ControlMaster auto\n    ControlPath /tmp/ssh/%r@%n\n'
+               '    ControlPersist 5m\n    StrictHostKeyChecking no\n'
+               '    UserKnownHostsFile /dev/null\n'
+               '    ServerAliveInterval 120\n    LogLevel ERROR\n\n')
+        obs = format_ssh_config([('master', 'ec2-1.amazonaws.com'),
+                                 ('node001', 'ec2-2.amazonaws.com')],
+                                'root', '/key.rsa', '/tmp/ssh')
+        self.assertEqual(obs, exp)
+
+        self.assertEqual(format_ssh_config([], 'root', '/key.rsa', '/tmp'), '')
+
+    def test_format_warm_clusters(self):
+        """Test formatting the clusters left running between runs."""
+        exp = 'hourly_tests\t1358276521.000000\nnightly\t1358272921.500000\n'
+        obs = format_warm_clusters({'nightly': 1358272921.5,
+                                    'hourly_tests': 1358276521})
+        self.assertEqual(obs, exp)
+        self.assertEqual(format_warm_clusters({}), '')
+
+    def test_format_command_history(self):
+        """Test formatting recorded commands as a table."""
+        timestamp = strftime('%Y-%m-%d %H:%M:%S', localtime(1358272921.5))
+        exp = ('#Start time\tPhase\tLabel\tDuration (s)\tReturn code\t'
+               'Instance type\tCluster tag\n'
+               '%s\ttest_suite\tQIIME\t600.50\t0\tm2.xlarge\tnightly\n'
+               '%s\tsetup\tsetup\t42.00\tNone\tNone\tnightly\n'
+               % (timestamp, timestamp))
+        obs = format_command_history([
+                (1358272921.5, 'test_suite', 'QIIME', 600.5, 0, 'm2.xlarge',
+                 'nightly'),
+                (1358272921.5, 'setup', 'setup', 42, None, None, 'nightly')])
+        self.assertEqual(obs, exp)
+
+    def test_format_command_history_summary(self):
+        """Test formatting a summary of recorded commands as a table."""
+        timestamp = strftime('%Y-%m-%d %H:%M:%S', localtime(1358272921.5))
+        exp = ('#Phase\tLabel\tRuns\tFailures\tMean duration (s)\t'
+               'Max duration (s)\tLast run\n'
+               'test_suite\tQIIME\t2\t1\t500.00\t600.25\t%s\n' % timestamp)
+        obs = format_command_history_summary([
+                ('test_suite', 'QIIME', 2, 1, 500.0, 600.25, 1358272921.5)])
+        self.assertEqual(obs, exp)
+
+        self.assertEqual(format_command_history_summary([]),
+                         '#Phase\tLabel\tRuns\tFailures\tMean duration (s)\t'
+                         'Max duration (s)\tLast run\n')
+
+    def test_format_flaky_test_suites_summary(self):
+        """Test formatting how often test suites were flaky as a table."""
+        timestamp = strftime('%Y-%m-%d %H:%M:%S', localtime(1358272921.5))
+        exp = ('#Label\tFlaky runs\tRuns\tLast flaky run\n'
+               'QIIME\t3\t20\t%s\n' % timestamp)
+        obs = format_flaky_test_suites_summary([('QIIME', 3, 20,
+                                                 1358272921.5)])
+        self.assertEqual(obs, exp)
+
+        self.assertEqual(format_flaky_test_suites_summary([]),
+                         '#Label\tFlaky runs\tRuns\tLast flaky run\n')
+
+    def test_format_jobs(self):
+        """Test formatting jobs in the job queue as a table."""
+        timestamp = strftime('%Y-%m-%d %H:%M:%S', localtime(1358272921.5))
+        exp = ('#Job\tProject\tStatus\tSubmitted\tStarted\tFinished\t'
+               'Cluster tag\tInstance-hours\tMessage\n'
+               '2\tbiom\tqueued\t%s\t-\t-\t-\t-\t-\n'
+               '1\tQIIME\tfailed\t%s\t%s\t%s\tclout-1\t0.50\tbad '
+               'config\n' % (timestamp, timestamp, timestamp, timestamp))
+        obs = format_jobs([(2, 'biom', 'queued', 1358272921.5, None, None,
+                            None, None, None),
+                           (1, 'QIIME', 'failed', 1358272921.5, 1358272921.5,
+                            1358272921.5, 'clout-1', 0.5, 'bad\n\tconfig')])
+        self.assertEqual(obs, exp)
+
+    def test_format_schedule(self):
+        """Test formatting the planned placement of test suites."""
+        exp = ('Test suite schedule (based on the durations of previous '
+               'runs):\nmaster: QIIME (1:02:03), biom (no history)\n'
+               'node001: PyCogent (0:00:59)\n'
+               'Expected time to run all test suites: 1:02:03\n\n')
+        obs = format_schedule([['QIIME', 'q'], ['PyCogent', 'p'],
+                               ['biom', 'b']],
+                              ['master', 'node001', 'master'],
+                              {'QIIME': 3723, 'PyCogent': 58.6}, 3723.2)
+        self.assertEqual(obs, exp)
+
+    def test_format_timing_table(self):
+        """Test formatting how long each command took."""
+        exp = ('Time taken (longest first):\n'
+               '0:20:00  QIIME\n'
+               '0:05:00  Cluster setup\n'
+               '0:05:00  PyCogent\n'
+               '0:01:00  Cluster teardown\n'
+               '0:00:30  PyCogent (retry)\n'
+               '0:00:20  Local preparation\n'
+               '0:00:10  Artifact copying\n'
+               'Total: 0:26:00\n\n')
+        obs = format_timing_table([
+                ('setup', 'setup', 'sc start', 1000, 1300, 0),
+                ('local_prep', 'local_prep', 'make sdist', 1000, 1020, 0),
+                ('test_suite', 'QIIME', 'q', 1300, 2500, 1),
+                ('test_suite', 'PyCogent', 'p', 1300, 1600, 0),
+                ('retry', 'PyCogent', 'p', 1600, 1630, 0),
+                ('artifacts', 'artifacts', 'tar', 2490, 2500, 0),
+                ('teardown', 'teardown', 'sc terminate', 2500, 2560, 0)])
+        self.assertEqual(obs, exp)
+
+        self.assertEqual(format_timing_table([]), '')
+
+    def test_format_instance_time(self):
+        """Test formatting the instance time used and billed."""
+        exp = ('Instance time used by this run: 1:20:00 (4 instances of type '
+               'm1.large for 0:20:00), billed as 4 instance-hours.\n\n')
+        self.assertEqual(format_instance_time(4, 1200, 'm1.large'), exp)
+
+        # Partial hours are rounded up for each instance.
+        exp = ('Instance time used by this run: 1:00:01 (1 instance for '
+               '1:00:01), billed as 2 instance-hours.\n\n')
+        self.assertEqual(format_instance_time(1, 3601), exp)
+
+        exp = ('Instance time used by this run: 0:00:00 (1 instance for '
+               '0:00:00), billed as 1 instance-hour.\n\n')
+        self.assertEqual(format_instance_time(1, 0), exp)
+
+    def test_format_first_failure(self):
+        """Test formatting the failure that stopped a fail-fast run."""
+        exp = ('First failure: the QIIME test suite failed (return code 1) '
+               '0:02:05 after the test suites started, so the run was stopped '
+               'early.\nCancelled while running: PyCogent, biom\n'
+               'Not run: emperor\n\n')
+        self.assertEqual(format_first_failure('QIIME', 1, 125.2,
+                                              ['PyCogent', 'biom'],
+                                              ['emperor']), exp)
+
+        exp = ('First failure: the QIIME test suite failed (return code 1) '
+               '0:00:03 after the test suites started, so the run was stopped '
+               'early.\nNot run: emperor\n\n')
+        self.assertEqual(format_first_failure('QIIME', 1, 3, [],
+                                              ['emperor']), exp)
+
+    def test_format_retry_results(self):
+        """Test formatting which retried test suites passed."""
+        exp = ('The following test suites failed and then passed when they '
+               'were rerun on the same cluster, so their failures are likely '
+               'flaky: QIIME (passed on retry 1), biom (passed on retry 2)\n\n'
+               'The following test suites failed every time they were run, '
+               'including when they were retried: PyCogent (retried 1 time)'
+               '\n\n')
+        self.assertEqual(format_retry_results([('QIIME', 1), ('biom', 2)],
+                                              [('PyCogent', 1)]), exp)
+
+        exp = ('The following test suites failed every time they were run, '
+               'including when they were retried: PyCogent (retried 2 times)'
+               '\n\n')
+        self.assertEqual(format_retry_results([], [('PyCogent', 2)]), exp)
+        self.assertEqual(format_retry_results([], []), '')
+
+    def test_format_junit_results(self):
+        """Test formatting the test cases read from JUnit XML reports."""
+        exp = ('Test cases (from JUnit XML reports):\n'
+               'QIIME: 120 passed, 2 failed, 1 error, 3 skipped\n'
+               '    Failed: test_util.test_a\n'
+               '    Error: test_parse.test_b\n'
+               '    ... and 1 more\n'
+               'PyCogent: no JUnit XML reports found\n'
+               '    Could not parse PyCogent/results.xml\n'
+               'biom: 10 passed, 0 failed, 0 errors, 0 skipped\n'
+               'Slowest test cases:\n'
+               '   125.30s  QIIME  test_util.test_c\n'
+               '     2.00s  QIIME  test_util.test_a\n'
+               '     2.00s  biom  test_table.test_d\n\n')
+        obs = format_junit_results([
+                ('QIIME', {'passed': 120, 'failed': 2, 'errors': 1,
+                           'skipped': 3, 'num_reports': 2,
+                           'failing_tests': [('failed', 'test_util.test_a'),
+                                             ('error', 'test_parse.test_b')],
+                           'slowest_tests': [(125.3, 'test_util.test_c'),
+                                             (2.0, 'test_util.test_a')],
+                           'unreadable_reports': []}),
+                ('PyCogent', {'passed': 0, 'failed': 0, 'errors': 0,
+                              'skipped': 0, 'num_reports': 0,
+                              'failing_tests': [], 'slowest_tests': [],
+                              'unreadable_reports': ['PyCogent/results.xml']}),
+                ('biom', {'passed': 10, 'failed': 0, 'errors': 0,
+                          'skipped': 0, 'num_reports': 1,
+                          'failing_tests': [],
+                          'slowest_tests': [(2.0, 'test_table.test_d')],
+                          'unreadable_reports': []})])
+        self.assertEqual(obs, exp)
+        self.assertEqual(format_junit_results([]), '')
+
+    def test_format_new_log_lines(self):
+        """Test formatting the new lines of a test suite's log."""
+        exp = ('New output in the QIIME log since the previous run:\n'
+               '     9: test_b ... FAIL\n'
+               '    10: AssertionError\n'
+               '    ...\n'
+               '    13: FAILED (failures=1)\n'
+               '    ... and 2 more new lines\n\n')
+        obs = format_new_log_lines('QIIME', [(9, 'test_b ... FAIL'),
+                                             (10, 'AssertionError'),
+                                             (13, 'FAILED (failures=1)')], 5)
+        self.assertEqual(obs, exp)
+
+        self.assertEqual(format_new_log_lines('QIIME', [], 0),
+                         'The QIIME log has no new output since the previous '
+                         'run.\n\n')
+
+    def test_format_artifacts_summary(self):
+        """Test formatting the artifacts copied back from the cluster."""
+        exp = ('Artifacts (saved in /tmp/artifacts):\n'
+               'QIIME: 2 files (1.5 KB)\n'
+               'PyCogent: no matching files\n'
+               'biom: 1 file (10 bytes)\n\n')
+        obs = format_artifacts_summary(['QIIME', 'PyCogent', 'biom'],
+                {'QIIME': [('coverage.xml', 1024), ('tmp/junit.xml', 512)],
+                 'biom': [('bench.json', 10)]}, '/tmp/artifacts')
+        self.assertEqual(obs, exp)
+
+    def test_format_prometheus_metrics(self):
+        """Test formatting a run's metrics for Prometheus."""
+        metrics = {'cluster_tag': 'nightly', 'backend': 'starcluster',
+                   'instance_type': 'm1.large', 'spot_bid': None,
+                   'billed_instances': 2, 'timestamp': 1358272921.5,
+                   'succeeded': False,
+                   'phases': {
+                       'setup': {'duration': 60.0, 'timed_out': False},
+                       'test_suite': {'duration': 240.5, 'timed_out': True},
+                       'teardown': {'duration': None, 'timed_out': False}},
+                   'test_suites': [
+                       {'label': 'biom', 'cached': True, 'duration': None,
+                        'return_code': 0, 'output_bytes': None,
+                        'timed_out': False, 'cancelled': False},
+                       {'label': 'Q"2', 'cached': False, 'duration': 240.5,
+                        'return_code': -15, 'output_bytes': 1000L,
+                        'timed_out': True, 'cancelled': False}],
+                   'output_bytes': 1000, 'cluster_replacements': 1}
+        exp = ('# HELP clout_last_run_timestamp_seconds When the last run of '
+               'clout finished.\n'
+               '# TYPE clout_last_run_timestamp_seconds gauge\n'
+               'clout_last_run_timestamp_seconds{cluster_tag="nightly"} '
+               '1358272921.5\n'
+               '# HELP clout_last_run_success Whether every test suite passed '
+               'without any timeouts.\n'
+               '# TYPE clout_last_run_success gauge\n'
+               'clout_last_run_success{cluster_tag="nightly"} 0\n'
+               '# HELP clout_phase_duration_seconds How long each phase of '
+               'the last run took.\n'
+               '# TYPE clout_phase_duration_seconds gauge\n'
+               'clout_phase_duration_seconds{cluster_tag="nightly",'
+               'phase="setup"} 60.0\n'
+               'clout_phase_duration_seconds{cluster_tag="nightly",'
+               'phase="test_suite"} 240.5\n'
+               '# HELP clout_phase_timed_out Whether each phase of the last '
+               'run timed out.\n'
+               '# TYPE clout_phase_timed_out gauge\n'
+               'clout_phase_timed_out{cluster_tag="nightly",phase="setup"} 0\n'
+               'clout_phase_timed_out{cluster_tag="nightly",'
+               'phase="teardown"} 0\n'
+               'clout_phase_timed_out{cluster_tag="nightly",'
+               'phase="test_suite"} 1\n'
+               '# HELP clout_test_suite_duration_seconds How long each test '
+               'suite took to run.\n'
+               '# TYPE clout_test_suite_duration_seconds gauge\n'
+               'clout_test_suite_duration_seconds{cluster_tag="nightly",'
+               'test_suite="Q\\"2"} 240.5\n'
+               '# HELP clout_test_suite_return_code The return code of each '
+               'test suite.\n'
+               '# TYPE clout_test_suite_return_code gauge\n'
+               'clout_test_suite_return_code{cluster_tag="nightly",'
+               'test_suite="biom"} 0\n'
+               'clout_test_suite_return_code{cluster_tag="nightly",'
+               'test_suite="Q\\"2"} -15\n'
+               '# HELP clout_test_suite_output_bytes The size of the log of '
+               'each test suite.\n'
+               '# TYPE clout_test_suite_output_bytes gauge\n'
+               'clout_test_suite_output_bytes{cluster_tag="nightly",'
+               'test_suite="Q\\"2"} 1000\n'
+               '# HELP clout_test_suite_timed_out Whether each test suite was '
+               'running when the test suites timed out.\n'
+               '# TYPE clout_test_suite_timed_out gauge\n'
+               'clout_test_suite_timed_out{cluster_tag="nightly",'
+               'test_suite="biom"} 0\n'
+               'clout_test_suite_timed_out{cluster_tag="nightly",'
+               'test_suite="Q\\"2"} 1\n'
+               '# HELP clout_test_suite_cancelled Whether each test suite was '
+               'cancelled because another test suite failed first.\n'
+               '# TYPE clout_test_suite_cancelled gauge\n'
+               'clout_test_suite_cancelled{cluster_tag="nightly",'
+               'test_suite="biom"} 0\n'
+               'clout_test_suite_cancelled{cluster_tag="nightly",'
+               'test_suite="Q\\"2"} 0\n'
+               '# HELP clout_test_suite_cached Whether each test suite was '
+               'skipped because it passed before with the same cache key.\n'
+               '# TYPE clout_test_suite_cached gauge\n'
+               'clout_test_suite_cached{cluster_tag="nightly",'
+               'test_suite="biom"} 1\n'
+               'clout_test_suite_cached{cluster_tag="nightly",'
+               'test_suite="Q\\"2"} 0\n'
+               '# HELP clout_billed_instances The number of instances billed '
+               'by the hour that the test suites ran on.\n'
+               '# TYPE clout_billed_instances gauge\n'
+               'clout_billed_instances{cluster_tag="nightly",'
+               'instance_type="m1.large"} 2\n'
+               '# HELP clout_cluster_replacements The number of times the '
+               'cluster was replaced after being lost (e.g. to spot instance '
+               'interruptions).\n'
+               '# TYPE clout_cluster_replacements gauge\n'
+               'clout_cluster_replacements{cluster_tag="nightly"} 1\n')
+        self.assertEqual(format_prometheus_metrics(metrics), exp)
+
+    def test_format_duration(self):
+        """Test formatting durations."""
+        self.assertEqual(format_duration(0), '0:00:00')
+        self.assertEqual(format_duration(59.5), '0:01:00')
+        self.assertEqual(format_duration(3723), '1:02:03')
+        self.assertEqual(format_duration(100000), '27:46:40')
+
+    def test_format_attachments_summary(self):
+        """Test describing how the attachments were shrunk."""
+        obs = format_attachments_summary({'uncompressed_size': 4096000,
+                                          'compressed_size': 409600,
+                                          'truncated': []}, 10485760)
+        self.assertEqual(obs, 'The attached log files were compressed from '
+                              '3.9 MB to 400.0 KB (10.0 times smaller).\n\n')
+
+        obs = format_attachments_summary({'uncompressed_size': 0,
+                                          'compressed_size': 0,
+                                          'truncated': ['a.txt', 'b.txt']},
+                                         1024)
+        self.assertEqual(obs, 'The attached log files were compressed from '
+                              '0 bytes to 0 bytes.\n\nThe following log '
+                              'files were too large to attach in full, so '
+                              'the middle of each one was removed to keep the '
+                              'attachments within 1.0 KB: a.txt, b.txt\n\n')
+
+    def test_format_size(self):
+        """Test formatting numbers of bytes."""
+        self.assertEqual(format_size(0), '0 bytes')
+        self.assertEqual(format_size(1023), '1023 bytes')
+        self.assertEqual(format_size(1536), '1.5 KB')
+        self.assertEqual(format_size(10485760), '10.0 MB')
+        self.assertEqual(format_size(5 * 1024 ** 4), '5120.0 GB')
+
 
 if __name__ == "__main__":
     main()
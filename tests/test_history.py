@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012-2013, The Clout Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPLv2"
+__version__ = "0.9-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+"""Test suite for the history.py module."""
+
+from unittest import main, TestCase
+
+from clout.history import (get_command_history, get_history_db_fp,
+                           get_typical_durations, has_passed_with_cache_key,
+                           open_history_db, record_commands,
+                           record_flaky_test_suites,
+                           record_passing_cache_keys,
+                           summarize_command_history,
+                           summarize_flaky_test_suites)
+
+class HistoryTests(TestCase):
+    """Tests for the history.py module."""
+
+    def setUp(self):
+        """Define some sample data that will be used by the tests."""
+        self.conn = open_history_db(':memory:')
+
+        # Two runs of two test suites on different instance types.
+        record_commands(self.conn, [
+                ('setup', 'setup', 'starcluster start', 100.0, 400.0, 0),
+                ('test_suite', 'QIIME', 'qiime_tests', 400.0, 1000.0, 0),
+                ('test_suite', 'PyCogent', 'cogent_tests', 400.0, 500.0, 1),
+                ('teardown', 'teardown', 'starcluster terminate', 1000.0,
+                 1060.0, 0)], 'nightly_tests', 'm2.xlarge')
+        record_commands(self.conn, [
+                ('test_suite', 'QIIME', 'qiime_tests', 2000.0, 2400.0, 0),
+                ('test_suite', 'PyCogent', 'cogent_tests', 2000.0, 2050.0,
+                 None)], 'hourly_tests', 'c1.medium')
+
+    def tearDown(self):
+        """Close the database."""
+        self.conn.close()
+
+    def test_get_history_db_fp(self):
+        """Test getting the path of the history database."""
+        self.assertEqual(get_history_db_fp('/foo/.clout'),
+                         '/foo/.clout/history.db')
+
+    def test_get_command_history(self):
+        """Test querying recorded commands."""
+        obs = get_command_history(self.conn, label='QIIME')
+        self.assertEqual(obs, [
+                (2000.0, 'test_suite', 'QIIME', 400.0, 0, 'c1.medium',
+                 'hourly_tests'),
+                (400.0, 'test_suite', 'QIIME', 600.0, 0, 'm2.xlarge',
+                 'nightly_tests')])
+
+        obs = get_command_history(self.conn, phase='test_suite',
+                                  instance_type='m2.xlarge')
+        self.assertEqual([row[2] for row in obs], ['QIIME', 'PyCogent'])
+
+        obs = get_command_history(self.conn, limit=2)
+        self.assertEqual([row[0] for row in obs], [2000.0, 2000.0])
+
+        obs = get_command_history(self.conn, cluster_tag='nightly_tests')
+        self.assertEqual(len(obs), 4)
+
+        self.assertEqual(get_command_history(self.conn, label='foo'), [])
+
+    def test_summarize_command_history(self):
+        """Test summarizing recorded commands."""
+        obs = summarize_command_history(self.conn)
+        self.assertEqual(obs, [
+                ('test_suite', 'QIIME', 2, 0, 500.0, 600.0, 2000.0),
+                ('setup', 'setup', 1, 0, 300.0, 300.0, 100.0),
+                ('test_suite', 'PyCogent', 2, 2, 75.0, 100.0, 2000.0),
+                ('teardown', 'teardown', 1, 0, 60.0, 60.0, 1000.0)])
+
+        obs = summarize_command_history(self.conn, phase='test_suite',
+                                        cluster_tag='hourly_tests')
+        self.assertEqual(obs, [
+                ('test_suite', 'QIIME', 1, 0, 400.0, 400.0, 2000.0),
+                ('test_suite', 'PyCogent', 1, 1, 50.0, 50.0, 2000.0)])
+
+    def test_get_typical_durations(self):
+        """Test looking up how long test suites typically take."""
+        record_commands(self.conn, [
+                ('test_suite', 'QIIME', 'qiime_tests', 3000.0, 3500.0, 0),
+                ('test_suite', 'QIIME', 'qiime_tests', 4000.0, 4900.0, 0)],
+                'nightly_tests', 'm2.xlarge')
+
+        # Median of the successful runs on the same instance type.
+        obs = get_typical_durations(self.conn, ['QIIME', 'PyCogent', 'foo'],
+                                    'm2.xlarge')
+        self.assertEqual(obs, {'QIIME': 600.0})
+
+        obs = get_typical_durations(self.conn, ['QIIME'], 'm2.xlarge',
+                                    num_runs=2)
+        self.assertEqual(obs, {'QIIME': 700.0})
+
+        # Falls back to any instance type.
+        obs = get_typical_durations(self.conn, ['QIIME'], 't1.micro')
+        self.assertEqual(obs, {'QIIME': 550.0})
+        obs = get_typical_durations(self.conn, ['QIIME'], 'c1.medium')
+        self.assertEqual(obs, {'QIIME': 400.0})
+
+    def test_passing_cache_keys(self):
+        """Test recording and looking up the cache keys of passing runs."""
+        self.assertFalse(has_passed_with_cache_key(self.conn, 'QIIME', 'abc'))
+
+        record_passing_cache_keys(self.conn, [('QIIME', 'abc'),
+                                              ('PyCogent', 'def')])
+        record_passing_cache_keys(self.conn, [('QIIME', 'ghi'),
+                                              ('QIIME', 'abc')])
+        self.assertTrue(has_passed_with_cache_key(self.conn, 'QIIME', 'abc'))
+        self.assertTrue(has_passed_with_cache_key(self.conn, 'QIIME', 'ghi'))
+        self.assertTrue(has_passed_with_cache_key(self.conn, 'PyCogent',
+                                                  'def'))
+        self.assertFalse(has_passed_with_cache_key(self.conn, 'QIIME', 'def'))
+
+    def test_flaky_test_suites(self):
+        """Test recording and summarizing test suites that were flaky."""
+        self.assertEqual(summarize_flaky_test_suites(self.conn), [])
+
+        record_flaky_test_suites(self.conn, [('QIIME', 1), ('PyCogent', 2)],
+                                 'nightly_tests')
+        record_flaky_test_suites(self.conn, [('QIIME', 1)], 'hourly_tests')
+        obs = summarize_flaky_test_suites(self.conn)
+        self.assertEqual([row[:3] for row in obs],
+                         [('QIIME', 2, 2), ('PyCogent', 1, 2)])
+        self.assertTrue(obs[0][3] >= obs[1][3])
+
+        obs = summarize_flaky_test_suites(self.conn, 'hourly_tests')
+        self.assertEqual([row[:3] for row in obs], [('QIIME', 1, 1)])
+
+        # Retries aren't counted as runs.
+        record_commands(self.conn, [
+                ('retry', 'PyCogent', 'cogent_tests', 500.0, 550.0, 0)],
+                'nightly_tests', 'm2.xlarge')
+        obs = summarize_flaky_test_suites(self.conn, 'nightly_tests')
+        self.assertEqual([row[:3] for row in obs],
+                         [('PyCogent', 1, 1), ('QIIME', 1, 1)])
+
+
+if __name__ == "__main__":
+    main()
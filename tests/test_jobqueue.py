@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012-2013, The Clout Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPLv2"
+__version__ = "0.9-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+"""Test suite for the jobqueue.py module."""
+
+from time import time
+from unittest import main, TestCase
+
+from clout.jobqueue import (claim_job, finish_job, get_instance_hours_used,
+                            get_job_queue_db_fp, list_jobs,
+                            open_job_queue_db, requeue_running_jobs,
+                            submit_job)
+
+class JobQueueTests(TestCase):
+    """Tests for the jobqueue.py module."""
+
+    def setUp(self):
+        """Define some sample data that will be used by the tests."""
+        self.conn = open_job_queue_db(':memory:')
+        self.qiime_job_id = submit_job(self.conn, 'QIIME',
+                                       'QIIME\tqiime_tests\n',
+                                       'qiime@example.com\n')
+        self.biom_job_id = submit_job(self.conn, 'biom',
+                                      'biom\tbiom_tests\n',
+                                      'biom@example.com\n')
+
+    def tearDown(self):
+        """Close the database."""
+        self.conn.close()
+
+    def test_get_job_queue_db_fp(self):
+        """Test getting the path of the job queue database."""
+        self.assertEqual(get_job_queue_db_fp('/foo/.clout'),
+                         '/foo/.clout/queue.db')
+
+    def test_submit_job(self):
+        """Test adding jobs to the queue."""
+        self.assertEqual(self.biom_job_id, self.qiime_job_id + 1)
+        self.assertEqual([job[:3] for job in list_jobs(self.conn)],
+                         [(self.biom_job_id, 'biom', 'queued'),
+                          (self.qiime_job_id, 'QIIME', 'queued')])
+
+    def test_submit_job_invalid_project(self):
+        """Test adding jobs with project names that can't be used."""
+        for project in ('', 'foo/bar', '..'):
+            self.assertRaises(ValueError, submit_job, self.conn, project,
+                              'QIIME\tqiime_tests\n', 'qiime@example.com\n')
+
+    def test_claim_job(self):
+        """Test claiming jobs in the order that they were submitted."""
+        self.assertEqual(claim_job(self.conn, 'clout-1'),
+                         (self.qiime_job_id, 'QIIME', 'QIIME\tqiime_tests\n',
+                          'qiime@example.com\n'))
+        self.assertEqual(claim_job(self.conn, 'clout-2')[:2],
+                         (self.biom_job_id, 'biom'))
+        self.assertEqual(claim_job(self.conn, 'clout-3'), None)
+
+        jobs = list_jobs(self.conn, status='running')
+        self.assertEqual([(job[0], job[6]) for job in jobs],
+                         [(self.biom_job_id, 'clout-2'),
+                          (self.qiime_job_id, 'clout-1')])
+        self.assertTrue(jobs[0][4] is not None)
+
+    def test_finish_job(self):
+        """Test recording that jobs are done."""
+        claim_job(self.conn, 'clout-1')
+        claim_job(self.conn, 'clout-2')
+        finish_job(self.conn, self.qiime_job_id, True, 2.5)
+        finish_job(self.conn, self.biom_job_id, False, 0, 'bad config')
+
+        jobs = list_jobs(self.conn)
+        self.assertEqual([(job[2], job[7], job[8]) for job in jobs],
+                         [('failed', 0, 'bad config'),
+                          ('finished', 2.5, None)])
+        self.assertTrue(jobs[0][5] is not None)
+
+    def test_requeue_running_jobs(self):
+        """Test putting jobs that were left running back in the queue."""
+        claim_job(self.conn, 'clout-1')
+        self.assertEqual(requeue_running_jobs(self.conn, 'clout'), 1)
+        self.assertEqual(requeue_running_jobs(self.conn, 'clout'), 0)
+        self.assertEqual([(job[2], job[4], job[6])
+                          for job in list_jobs(self.conn)],
+                         [('queued', None, None), ('queued', None, None)])
+
+        # The requeued job is still first in line.
+        self.assertEqual(claim_job(self.conn, 'clout-1')[0],
+                         self.qiime_job_id)
+
+    def test_requeue_running_jobs_other_daemons(self):
+        """Test that jobs run by other daemons aren't requeued."""
+        claim_job(self.conn, 'nightly-1')
+        claim_job(self.conn, 'nightly-10-2')
+        self.assertEqual(requeue_running_jobs(self.conn, 'nightly-10'), 1)
+        self.assertEqual([(job[0], job[2], job[6])
+                          for job in list_jobs(self.conn)],
+                         [(self.biom_job_id, 'queued', None),
+                          (self.qiime_job_id, 'running', 'nightly-1')])
+
+        # A daemon only requeues the jobs on its own clusters.
+        self.assertEqual(requeue_running_jobs(self.conn, 'nightly-1'), 0)
+        self.assertEqual(requeue_running_jobs(self.conn, 'nightly'), 1)
+        self.assertEqual(list_jobs(self.conn, status='running'), [])
+
+    def test_get_instance_hours_used(self):
+        """Test adding up the instance-hours used by finished jobs."""
+        self.assertEqual(get_instance_hours_used(self.conn, 0), 0)
+
+        claim_job(self.conn, 'clout-1')
+        claim_job(self.conn, 'clout-2')
+        finish_job(self.conn, self.qiime_job_id, True, 2.5)
+        finish_job(self.conn, self.biom_job_id, True, 1.25)
+        self.assertEqual(get_instance_hours_used(self.conn, 0), 3.75)
+        self.assertEqual(get_instance_hours_used(self.conn, time() + 60), 0)
+
+    def test_list_jobs(self):
+        """Test listing jobs with and without filters."""
+        claim_job(self.conn, 'clout-1')
+        self.assertEqual([job[0] for job in list_jobs(self.conn,
+                                                      status='queued')],
+                         [self.biom_job_id])
+        self.assertEqual([job[0] for job in list_jobs(self.conn, limit=1)],
+                         [self.biom_job_id])
+        self.assertEqual(list_jobs(self.conn, status='finished'), [])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012-2013, The Clout Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPLv2"
+__version__ = "0.9-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+"""Test suite for the journal.py module."""
+
+from os.path import exists, join
+from shutil import rmtree
+from tempfile import mkdtemp, TemporaryFile
+from unittest import main, TestCase
+
+from clout.journal import (get_journal_dir, load_journal, record_test_suites,
+                           remove_journal)
+
+class JournalTests(TestCase):
+    """Tests for the journal.py module."""
+
+    def setUp(self):
+        """Define some sample data that will be used by the tests."""
+        self.state_dir = mkdtemp(prefix='clout_test_journal')
+        self.journal_dir = get_journal_dir(self.state_dir, 'nightly')
+        self.test_suites = [['QIIME', 'qiime_tests.py', {}],
+                            ['PyCogent', 'cogent_tests.py', {}],
+                            ['biom', 'biom_tests.py', {}]]
+
+    def tearDown(self):
+        """Remove the temporary state directory."""
+        rmtree(self.state_dir)
+
+    def _make_log(self, contents):
+        log_f = TemporaryFile(prefix='clout_test_journal', suffix='.txt')
+        log_f.write(contents)
+        return log_f
+
+    def test_get_journal_dir(self):
+        """Test finding a cluster tag's journal in the state directory."""
+        self.assertEqual(get_journal_dir('/foo/.clout', 'nightly'),
+                         '/foo/.clout/journals/nightly')
+
+    def test_load_journal_missing(self):
+        """Test loading a journal that doesn't exist."""
+        self.assertEqual(load_journal(self.journal_dir, self.test_suites),
+                         {})
+
+    def test_record_test_suites(self):
+        """Test checkpointing test suites and loading them back."""
+        record_test_suites(self.journal_dir,
+                [('QIIME', 'qiime_tests.py', self._make_log('qiime log\n'),
+                  0, 100.5, 200.25)])
+        record_test_suites(self.journal_dir,
+                [('biom', 'biom_tests.py', self._make_log('biom log\n'), 1,
+                  110.0, 150.0)])
+        record_test_suites(self.journal_dir, [])
+
+        obs = load_journal(self.journal_dir, self.test_suites)
+        self.assertEqual(sorted(obs), [0, 2])
+        log_f, ret_val, start_time, end_time = obs[0]
+        self.assertEqual(log_f.read(), 'qiime log\n')
+        self.assertEqual((ret_val, start_time, end_time), (0, 100.5, 200.25))
+        log_f, ret_val, start_time, end_time = obs[2]
+        self.assertEqual(log_f.read(), 'biom log\n')
+        self.assertEqual((ret_val, start_time, end_time), (1, 110.0, 150.0))
+
+    def test_load_journal_changed_cmds(self):
+        """Test that test suites whose commands changed aren't reused."""
+        record_test_suites(self.journal_dir,
+                [('QIIME', 'qiime_tests.py', self._make_log('qiime log\n'),
+                  0, 100.0, 200.0),
+                 ('PyCogent', 'old_cogent_tests.py',
+                  self._make_log('cogent log\n'), 0, 100.0, 200.0)])
+
+        obs = load_journal(self.journal_dir, self.test_suites)
+        self.assertEqual(sorted(obs), [0])
+
+        # The test suites are matched by label, not by position.
+        obs = load_journal(self.journal_dir, [['foo', 'bar', {}]] +
+                           self.test_suites)
+        self.assertEqual(sorted(obs), [1])
+
+    def test_load_journal_partial_line(self):
+        """Test that a line that was only partially written is ignored."""
+        record_test_suites(self.journal_dir,
+                [('QIIME', 'qiime_tests.py', self._make_log('qiime log\n'),
+                  0, 100.0, 200.0)])
+        journal_f = open(join(self.journal_dir, 'journal.txt'), 'a')
+        journal_f.write('1\tbiom\t0123')
+        journal_f.close()
+
+        obs = load_journal(self.journal_dir, self.test_suites)
+        self.assertEqual(sorted(obs), [0])
+
+    def test_remove_journal(self):
+        """Test removing a journal."""
+        record_test_suites(self.journal_dir,
+                [('QIIME', 'qiime_tests.py', self._make_log('qiime log\n'),
+                  0, 100.0, 200.0)])
+        self.assertTrue(exists(self.journal_dir))
+        remove_journal(self.journal_dir)
+        self.assertFalse(exists(self.journal_dir))
+
+        # Removing it again does nothing.
+        remove_journal(self.journal_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012-2013, The Clout Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPLv2"
+__version__ = "0.9-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+"""Test suite for the logdiff.py module."""
+
+from os import listdir
+from os.path import join
+from shutil import rmtree
+from StringIO import StringIO
+from tempfile import mkdtemp, TemporaryFile
+from unittest import main, TestCase
+
+from clout.logdiff import (archive_logs, find_new_lines, get_archived_log_fp,
+                           get_log_archive_dir, normalize_log_line)
+
+class LogDiffTests(TestCase):
+    """Tests for the logdiff.py module."""
+
+    def setUp(self):
+        """Define some sample data that will be used by the tests."""
+        self.previous_log = ("Command:\n\n./tests.py\n\nStdout:\n\n"
+                             "2013-01-14 02:00:05 starting tests\n"
+                             "test_a ... ok\ntest_b ... ok\n"
+                             "Ran 2 tests in 3.512s\n\nOK\n")
+        self.log = ("Command:\n\n./tests.py\n\nStdout:\n\n"
+                    "2013-01-15 02:00:07 starting tests\n"
+                    "test_a ... ok\ntest_b ... FAIL\n"
+                    "AssertionError: <Foo at 0x7f3a2c> != None\n"
+                    "Ran 2 tests in 4.1s\n\nFAILED (failures=1)\n")
+
+    def test_get_log_archive_dir(self):
+        """Test finding a cluster tag's logs in the state directory."""
+        self.assertEqual(get_log_archive_dir('/foo/.clout', 'nightly'),
+                         '/foo/.clout/logs/nightly')
+        self.assertEqual(get_archived_log_fp('/foo/logs', 'a/b_results.txt'),
+                         '/foo/logs/a_b_results.txt')
+
+    def test_normalize_log_line(self):
+        """Test replacing the parts of a line that change between runs."""
+        self.assertEqual(normalize_log_line('2013-01-15T02:00:07.123+00:00 '
+                                            'started'),
+                         '<timestamp> started')
+        self.assertEqual(normalize_log_line('Date: 2013-01-15 (12:01:02)'),
+                         'Date: <date> (<time>)')
+        self.assertEqual(normalize_log_line('Ran 12 tests in 0.345s'),
+                         'Ran 12 tests in <duration>')
+        self.assertEqual(normalize_log_line('took 12 ms, 3 minutes'),
+                         'took <duration>, <duration>')
+        self.assertEqual(normalize_log_line("IOError: '/tmp/tmpa8Xf2/x.txt'"),
+                         "IOError: '<tmp path>'")
+        self.assertEqual(normalize_log_line('<Foo object at 0x10a3bF>'),
+                         '<Foo object at <address>>')
+        self.assertEqual(normalize_log_line('test_a ... ok'), 'test_a ... ok')
+
+    def test_find_new_lines(self):
+        """Test finding the lines that are new since the previous run."""
+        obs = find_new_lines(StringIO(self.previous_log), StringIO(self.log))
+        self.assertEqual(obs, ([(9, 'test_b ... FAIL'),
+                                (10, 'AssertionError: <Foo at 0x7f3a2c> != '
+                                     'None'),
+                                (13, 'FAILED (failures=1)')], 3))
+
+        obs = find_new_lines(StringIO(self.previous_log), StringIO(self.log),
+                             max_lines=1)
+        self.assertEqual(obs, ([(9, 'test_b ... FAIL')], 3))
+
+        # Nothing is new.
+        self.assertEqual(find_new_lines(StringIO(self.log),
+                                        StringIO(self.log)), ([], 0))
+
+        # Everything is new.
+        self.assertEqual(find_new_lines(StringIO(''), StringIO('a\r\nb\n')),
+                         ([(1, 'a'), (2, 'b')], 2))
+
+    def test_archive_logs(self):
+        """Test saving logs in the archive."""
+        tmp_dir = mkdtemp(prefix='clout_test_logdiff')
+        archive_dir = join(tmp_dir, 'logs')
+        try:
+            log_f = TemporaryFile(prefix='clout_test_logdiff')
+            log_f.write(self.previous_log)
+            archive_logs(archive_dir, [('QIIME_results.txt', log_f)])
+            self.assertEqual(log_f.tell(), 0)
+
+            log_f = TemporaryFile(prefix='clout_test_logdiff')
+            log_f.write(self.log)
+            archive_logs(archive_dir, [('QIIME_results.txt', log_f)])
+
+            self.assertEqual(listdir(archive_dir), ['QIIME_results.txt'])
+            archived_log_f = open(join(archive_dir, 'QIIME_results.txt'))
+            self.assertEqual(archived_log_f.read(), self.log)
+            archived_log_f.close()
+        finally:
+            rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    main()
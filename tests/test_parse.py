@@ -11,10 +11,13 @@ __email__ = "jai.rideout@gmail.com"
 
 """Test suite for the parse.py module."""
 
+from StringIO import StringIO
 from unittest import main, TestCase
 
-from clout.parse import (parse_config_file, parse_email_list,
-                         parse_email_settings, _can_ignore)
+from clout.parse import (parse_cluster_nodes, parse_config_file,
+                         parse_email_list, parse_email_settings,
+                         parse_junit_xml, parse_starcluster_config,
+                         parse_warm_clusters, _can_ignore)
 
 class ParseTests(TestCase):
     """Tests for the parse.py module."""
@@ -40,6 +43,48 @@ class ParseTests(TestCase):
         # Empty fields.
         self.config5 = ["QIIME\t/bin/tests.py", "\t/bin/foo.sh"]
 
+        # Test suite options.
+        self.config6 = ["QIIME\t/bin/tests.py\tshards=4",
+                        "PyCogent\t/foo.py\tfingerprint=cd /x && git log -1",
+                        "biom\t/biom.py\tartifacts=cov.xml  /tmp/junit/*.xml",
+                        "emperor\t/emperor.py\tjunit=/tmp/emperor/*.xml",
+                        "PICRUSt\t/picrust.py\tretries=2"]
+
+        # Bad test suite options.
+        self.config7 = ["QIIME\t/bin/tests.py\tshards"]
+        self.config8 = ["QIIME\t/bin/tests.py\tshards=0"]
+        self.config9 = ["QIIME\t/bin/tests.py\tshards=four"]
+        self.config10 = ["QIIME\t/bin/tests.py\tshards=2\tshards=3"]
+        self.config11 = ["QIIME\t/bin/tests.py\tshard=2"]
+        self.config12 = ["QIIME\t/bin/tests.py\tfingerprint="]
+        self.config13 = ["QIIME\t/bin/tests.py\tartifacts=   \tshards=2"]
+        self.config14 = ["QIIME\t/bin/tests.py\tartifacts=it's.xml"]
+        self.config15 = ["QIIME\t/bin/tests.py\tjunit="]
+        self.config16 = ["QIIME\t/bin/tests.py\tretries=-1"]
+        self.config17 = ["QIIME\t/bin/tests.py\tretries=two"]
+
+        # A JUnit XML report with nested test suites.
+        self.junit1 = """<?xml version="1.0" encoding="UTF-8"?>
+<testsuites>
+  <testsuite name="qiime" tests="5">
+    <properties><property name="python" value="2.7"/></properties>
+    <testcase classname="test_util.UtilTests" name="test_a" time="0.5"/>
+    <testcase classname="test_util.UtilTests" name="test_b" time="2.25">
+      <failure message="1 != 2">Traceback ...</failure>
+      <system-out>some output</system-out>
+    </testcase>
+    <testsuite name="nested">
+      <testcase classname="test_parse" name="test_c" time="1,234.5">
+        <error type="IOError">Traceback ...</error>
+      </testcase>
+      <testcase name="test_d" time="abc"><skipped/></testcase>
+    </testsuite>
+    <testcase classname="test_util.UtilTests" name="test_e"/>
+    <system-err>warnings</system-err>
+  </testsuite>
+</testsuites>
+"""
+
         # Standard email list with a comment.
         self.email_list1 = ["# some comment...", "foo@bar.baz",
                             "foo2@bar2.baz2"]
@@ -80,13 +125,47 @@ class ParseTests(TestCase):
         self.email_settings5 = ["# A comment", "smtp_server\tfoo.bar.com",
                                 "smtp_port\t44"]
 
+        # Bad email settings (insecure_smtp isn't true or false).
+        self.email_settings6 = self.email_settings1 + ["insecure_smtp\tyes"]
+
+        # StarCluster config with a default template, a multi-node template
+        # that extends it, and a template with an invalid cluster size.
+        self.sc_config1 = ("[global]\nDEFAULT_TEMPLATE=clout\n\n"
+                "[cluster clout]\nKEYNAME = clout_key\nCLUSTER_SIZE = 1\n"
+                "NODE_INSTANCE_TYPE = m2.xlarge\n\n"
+                "[key clout_key]\nKEY_LOCATION = /some/key.rsa\n\n"
+                "[cluster big]\nEXTENDS = clout\nCLUSTER_SIZE = 4\n\n"
+                "[cluster bad]\nCLUSTER_SIZE = many\n")
+
+        # StarCluster config without a default template.
+        self.sc_config2 = "[cluster clout]\nNODE_INSTANCE_TYPE = m1.small\n"
+
     def test_parse_config_file_standard(self):
         """Test parsing a standard config file."""
-        exp = [['QIIME', 'source /bin/setup.sh; cd /bin; ./tests.py'],
-               ['PyCogent', '/bin/cogent_tests']]
+        exp = [['QIIME', 'source /bin/setup.sh; cd /bin; ./tests.py', {}],
+               ['PyCogent', '/bin/cogent_tests', {}]]
         obs = parse_config_file(self.config1)
         self.assertEqual(obs, exp)
 
+    def test_parse_config_file_options(self):
+        """Test parsing a config file with test suite options."""
+        exp = [['QIIME', '/bin/tests.py', {'shards': 4}],
+               ['PyCogent', '/foo.py', {'fingerprint': 'cd /x && git log -1'}],
+               ['biom', '/biom.py',
+                {'artifacts': ['cov.xml', '/tmp/junit/*.xml']}],
+               ['emperor', '/emperor.py', {'junit': ['/tmp/emperor/*.xml']}],
+               ['PICRUSt', '/picrust.py', {'retries': 2}]]
+        obs = parse_config_file(self.config6)
+        self.assertEqual(obs, exp)
+
+    def test_parse_config_file_invalid_options(self):
+        """Test parsing a config file with invalid test suite options."""
+        for config in (self.config7, self.config8, self.config9,
+                       self.config10, self.config11, self.config12,
+                       self.config13, self.config14, self.config15,
+                       self.config16, self.config17):
+            self.assertRaises(ValueError, parse_config_file, config)
+
     def test_parse_config_file_empty(self):
         """Test parsing an empty config file."""
         self.assertRaises(ValueError, parse_config_file, self.config2)
@@ -127,10 +206,17 @@ class ParseTests(TestCase):
     def test_parse_email_settings_standard(self):
         """Test parsing a standard email settings file."""
         exp = {'smtp_server': 'some.smtp.server', 'smtp_port': '42',
-                'sender': 'foo@bar.baz', 'password': '424242!'}
+                'sender': 'foo@bar.baz', 'password': '424242!',
+                'insecure_smtp': False}
         obs = parse_email_settings(self.email_settings1)
         self.assertEqual(obs, exp)
 
+        # Allowing an SMTP server without STARTTLS.
+        exp['insecure_smtp'] = True
+        obs = parse_email_settings(self.email_settings1 +
+                                   ["insecure_smtp\ttrue"])
+        self.assertEqual(obs, exp)
+
     def test_parse_email_settings_invalid(self):
         """Test parsing invalid email settings files."""
         self.assertRaises(ValueError,
@@ -141,6 +227,135 @@ class ParseTests(TestCase):
                           parse_email_settings, self.email_settings4)
         self.assertRaises(ValueError,
                           parse_email_settings, self.email_settings5)
+        self.assertRaises(ValueError,
+                          parse_email_settings, self.email_settings6)
+
+    def test_parse_starcluster_config_standard(self):
+        """Test parsing a standard StarCluster config file."""
+        obs = parse_starcluster_config(StringIO(self.sc_config1))
+        self.assertEqual(obs, {'cluster_size': 1,
+                               'key_location': '/some/key.rsa',
+                               'node_instance_type': 'm2.xlarge'})
+
+        obs = parse_starcluster_config(StringIO(self.sc_config1), 'big')
+        self.assertEqual(obs, {'cluster_size': 4,
+                               'key_location': '/some/key.rsa',
+                               'node_instance_type': 'm2.xlarge'})
+
+        # CLUSTER_SIZE defaults to a single node, and there is no key.
+        obs = parse_starcluster_config(StringIO(self.sc_config2), 'clout')
+        self.assertEqual(obs, {'cluster_size': 1, 'key_location': None,
+                               'node_instance_type': 'm1.small'})
+
+    def test_parse_starcluster_config_invalid(self):
+        """Test parsing invalid StarCluster config files."""
+        self.assertRaises(ValueError, parse_starcluster_config,
+                          StringIO(self.sc_config1), 'bad')
+        self.assertRaises(ValueError, parse_starcluster_config,
+                          StringIO(self.sc_config1), 'nonexistent')
+        self.assertRaises(ValueError, parse_starcluster_config,
+                          StringIO(self.sc_config2))
+        self.assertRaises(ValueError, parse_starcluster_config,
+                          StringIO('CLUSTER_SIZE = 1\n'))
+
+    def test_parse_cluster_nodes(self):
+        """Test parsing the output of starcluster listclusters."""
+        listclusters = ["StarCluster - (http://star.mit.edu/cluster)",
+            "-----------------------------------------------",
+            "nightly_tests (security group: @sc-nightly_tests)",
+            "-----------------------------------------------",
+            "Launch time: 2013-01-15 10:42:01", "Uptime: 0 days, 00:04:12",
+            "Keypair: clout_key", "EBS volumes: N/A", "Cluster nodes:",
+            "     master running i-1d2c3b4a "
+            "ec2-184-72-1-1.compute-1.amazonaws.com",
+            "    node001 running i-5a6b7c8d "
+            "ec2-50-17-2-2.compute-1.amazonaws.com (spot sir-1234abcd)",
+            "    node002 pending i-9e8f7a6b", "Total nodes: 3"]
+        exp = {'master': ('running',
+                          'ec2-184-72-1-1.compute-1.amazonaws.com'),
+               'node001': ('running',
+                           'ec2-50-17-2-2.compute-1.amazonaws.com'),
+               'node002': ('pending', None)}
+        self.assertEqual(parse_cluster_nodes(listclusters), exp)
+
+        # The cluster doesn't exist.
+        self.assertEqual(parse_cluster_nodes(["!!! ERROR - cluster "
+                                              "nightly_tests does not exist"]),
+                         {})
+
+    def test_parse_warm_clusters(self):
+        """Test parsing the clusters left running between runs."""
+        exp = {'nightly_tests': 1358272921.5, 'hourly_tests': 1358276521.0}
+        obs = parse_warm_clusters(["# a comment",
+                                   "nightly_tests\t1358272921.500000",
+                                   "hourly_tests\t1358276521"])
+        self.assertEqual(obs, exp)
+        self.assertEqual(parse_warm_clusters([]), {})
+
+        self.assertRaises(ValueError, parse_warm_clusters,
+                          ["nightly_tests"])
+        self.assertRaises(ValueError, parse_warm_clusters,
+                          ["nightly_tests\tyesterday"])
+
+    def test_parse_junit_xml(self):
+        """Test parsing a JUnit XML report."""
+        exp = {'passed': 2, 'failed': 1, 'errors': 1, 'skipped': 1,
+               'failing_tests': [('failed', 'test_util.UtilTests.test_b'),
+                                 ('error', 'test_parse.test_c')],
+               'slowest_tests': [(1234.5, 'test_parse.test_c'),
+                                 (2.25, 'test_util.UtilTests.test_b'),
+                                 (0.5, 'test_util.UtilTests.test_a'),
+                                 (0.0, 'test_util.UtilTests.test_e'),
+                                 (0.0, 'test_d')]}
+        obs = parse_junit_xml(StringIO(self.junit1))
+        self.assertEqual(obs, exp)
+
+        # Only the first failing tests and the slowest tests are kept.
+        obs = parse_junit_xml(StringIO(self.junit1), max_failing_tests=1,
+                              max_slowest_tests=2)
+        self.assertEqual(obs['failing_tests'],
+                         [('failed', 'test_util.UtilTests.test_b')])
+        self.assertEqual(obs['slowest_tests'],
+                         [(1234.5, 'test_parse.test_c'),
+                          (2.25, 'test_util.UtilTests.test_b')])
+        self.assertEqual((obs['failed'], obs['errors']), (1, 1))
+
+        # A single test suite as the root element.
+        obs = parse_junit_xml(StringIO('<testsuite><testcase name="a" '
+                                       'time="3"/></testsuite>'))
+        self.assertEqual(obs['passed'], 1)
+        self.assertEqual(obs['slowest_tests'], [(3.0, 'a')])
+
+    def test_parse_junit_xml_streamed(self):
+        """Test parsing a large report that is read a piece at a time."""
+        def junit_chunks():
+            yield '<testsuites><testsuite name="big">'
+            for test_num in range(50000):
+                yield ('<testcase classname="c%d" name="test" time="%d">'
+                       '<system-out>%s</system-out></testcase>' %
+                       (test_num, test_num % 1000, 'x' * 100))
+            yield '</testsuite></testsuites>'
+
+        class JUnitFile(object):
+            def __init__(self):
+                self.chunks = junit_chunks()
+
+            def read(self, size):
+                return next(self.chunks, '')
+
+        obs = parse_junit_xml(JUnitFile())
+        self.assertEqual(obs['passed'], 50000)
+        self.assertEqual(len(obs['slowest_tests']), 10)
+        self.assertEqual(obs['slowest_tests'][0], (999.0, 'c9999.test'))
+
+    def test_parse_junit_xml_invalid(self):
+        """Test parsing reports that aren't valid JUnit XML."""
+        self.assertRaises(ValueError, parse_junit_xml, StringIO(''))
+        self.assertRaises(ValueError, parse_junit_xml,
+                          StringIO('<testsuite><testcase name="a">'))
+        self.assertRaises(ValueError, parse_junit_xml,
+                          StringIO('<coverage><testcase name="a"/>'
+                                   '</coverage>'))
 
     def test_can_ignore(self):
         """Test whether comments and whitespace-only lines are ignored."""
@@ -11,12 +11,26 @@ __email__ = "jai.rideout@gmail.com"
 
 """Test suite for the run.py module."""
 
+from json import load
+from os import listdir, makedirs, remove
+from os.path import dirname, exists, join
 from re import sub
+from shutil import rmtree
+from tempfile import mkdtemp, TemporaryFile
+from time import time
 from unittest import main, TestCase
 
+from clout.backend import LocalBackend, StarClusterBackend
+from clout.format import format_prometheus_metrics, format_ssh_config
 from clout.parse import parse_config_file
-from clout.run import (_build_test_execution_commands,
-                       _execute_commands_and_build_email, run_test_suites)
+from clout.run import (_assign_test_suites_to_nodes, _build_run_metrics,
+                       _close_ssh_multiplexing, _diff_test_suite_logs,
+                       _execute_commands_and_build_email, _expand_shards,
+                       _finish_background_teardown, _get_cache_keys,
+                       _get_cluster_status,
+                       _set_up_ssh_multiplexing, _summarize_junit_reports,
+                       _terminate_idle_clusters, _write_run_metrics,
+                       run_test_suites)
 
 class RunTests(TestCase):
     """Tests for the run.py module."""
@@ -49,87 +63,258 @@ class RunTests(TestCase):
         self.assertRaises(ValueError, run_test_suites, 1, 1, 1, 1, 1, 1, 1,
                           10.42, 1, 1, 1, 1)
 
-    def test_build_test_execution_commands_standard(self):
-        """Test building commands based on standard, valid input."""
-        exp = (["starcluster -c sc_config start nightly_tests"],
-               ["starcluster -c sc_config sshmaster -u root nightly_tests "
-                "'source /bin/setup.sh; cd /bin; ./tests.py'",
-               "starcluster -c sc_config sshmaster -u root nightly_tests "
-               "'/bin/cogent_tests'"],
-               ["starcluster -c sc_config terminate -c nightly_tests"])
+        # max_parallel is < 1.
+        self.assertRaises(ValueError, run_test_suites, 1, 1, 1, 1, 1, 1, 1,
+                          None, 1, 1, 1, 1, False, 0)
 
-        test_suites = parse_config_file(self.config)
-        obs = _build_test_execution_commands(test_suites, 'sc_config',
-                                             'nightly_tests')
-        self.assertEqual(obs, exp)
-
-    def test_build_test_execution_commands_custom_cluster_template(self):
-        """Test building commands using a non-default cluster template."""
-        exp = (["starcluster -c sc_config start -c some_cluster_template "
-                "nightly_tests"],
-               ["starcluster -c sc_config sshmaster -u ubuntu nightly_tests "
-                "'source /bin/setup.sh; cd /bin; ./tests.py'",
-                "starcluster -c sc_config sshmaster -u ubuntu nightly_tests "
-                "'/bin/cogent_tests'"],
-               ["starcluster -c sc_config terminate -c nightly_tests"])
+        # Unrecognized backend.
+        self.assertRaises(ValueError, run_test_suites, 1, 1, 1, 1, 1,
+                          backend='foo')
 
-        test_suites = parse_config_file(self.config)
-        obs = _build_test_execution_commands(test_suites, 'sc_config',
-                'nightly_tests', 'some_cluster_template', 'ubuntu')
-        self.assertEqual(obs, exp)
-
-    def test_build_test_execution_commands_custom_starcluster_exe_fp(self):
-        """Test building commands using a non-default starcluster exec."""
-        exp = (["/usr/local/bin/starcluster -c sc_config start -c "
-                "some_cluster_template nightly_tests"],
-               ["/usr/local/bin/starcluster -c sc_config sshmaster -u ubuntu "
-                "nightly_tests 'source /bin/setup.sh; cd /bin; ./tests.py'",
-                "/usr/local/bin/starcluster -c sc_config sshmaster -u ubuntu "
-                "nightly_tests '/bin/cogent_tests'"],
-               ["/usr/local/bin/starcluster -c sc_config terminate -c "
-                "nightly_tests"])
+        # Options that the local backend doesn't support.
+        self.assertRaises(ValueError, run_test_suites, 1, None, 1, 1, 1,
+                          backend='local', keep_cluster=True)
+        self.assertRaises(ValueError, run_test_suites, 1, None, 1, 1, 1,
+                          backend='local', ssh_multiplexing=True)
 
-        test_suites = parse_config_file(self.config)
-        obs = _build_test_execution_commands(test_suites, 'sc_config',
-                'nightly_tests', 'some_cluster_template', 'ubuntu',
-                sc_exe_fp='/usr/local/bin/starcluster')
-        self.assertEqual(obs, exp)
-
-    def test_build_test_execution_commands_no_test_suites(self):
-        """Test building commands with no test suites."""
-        exp = (["starcluster -c sc_config start nightly_tests"], [],
-               ["starcluster -c sc_config terminate -c nightly_tests"])
-        obs = _build_test_execution_commands([], 'sc_config', 'nightly_tests')
-        self.assertEqual(obs, exp)
-
-    def test_build_test_execution_commands_spot_bid(self):
-        """Test building commands using spot bids instead of flat rates."""
-        exp = (["starcluster -c sc_config start -b 0.50 --force-spot-master "
-                "nightly_tests"],
-               ["starcluster -c sc_config sshmaster -u root nightly_tests "
-                "'source /bin/setup.sh; cd /bin; ./tests.py'",
-                "starcluster -c sc_config sshmaster -u root nightly_tests "
-                "'/bin/cogent_tests'"],
-               ["starcluster -c sc_config terminate -c nightly_tests"])
+        # Resuming requires spot instances.
+        self.assertRaises(ValueError, run_test_suites, 1, 1, 1, 1, 1,
+                          resume=True)
+
+        # Bad number of retries, and retries with fail_fast.
+        self.assertRaises(ValueError, run_test_suites, 1, 1, 1, 1, 1,
+                          retries=-1)
+        self.assertRaises(ValueError, run_test_suites, 1, 1, 1, 1, 1,
+                          retries=1, fail_fast=True)
+
+        # Bad per-test suite timeout.
+        self.assertRaises(ValueError, run_test_suites, 1, 1, 1, 1, 1,
+                          per_test_suite_timeout=0)
+
+    def test_set_up_ssh_multiplexing_missing_node(self):
+        """Test setting up SSH connections to a node that doesn't exist."""
+        ssh_dir = mkdtemp(prefix='clout_test_')
+        try:
+            # Stand in for starcluster with a command that prints some fake
+            # listclusters output.
+            sc_exe_fp = ("printf 'Cluster nodes:\\n master running i-1 "
+                         "ec2-1.amazonaws.com\\n'; true")
+            log_f = TemporaryFile(prefix='clout_test_', suffix='.txt')
+            obs = _set_up_ssh_multiplexing(sc_exe_fp, 'sc_config',
+                    'nightly_tests', 'root', '/key.rsa', ssh_dir,
+                    ['master', 'node001'], log_f, 1)
+            self.assertEqual(obs, False)
+            self.assertFalse(exists(join(ssh_dir, 'ssh_config')))
+
+            log_f.seek(0, 0)
+            self.assertTrue("Could not find the public DNS name of node "
+                            "'node001'" in log_f.read())
+        finally:
+            rmtree(ssh_dir)
+
+    def test_close_ssh_multiplexing(self):
+        """Test closing SSH connections to a cluster's nodes."""
+        ssh_dir = mkdtemp(prefix='clout_test_')
+        try:
+            # The connections were never opened.
+            self.assertEqual(_close_ssh_multiplexing(ssh_dir,
+                                                     ['master'], 1), None)
+
+            # There is no master connection to close, so ssh fails, but the
+            # failure is only reported.
+            ssh_config_f = open(join(ssh_dir, 'ssh_config'), 'w')
+            ssh_config_f.write(format_ssh_config(
+                    [('master', 'ec2-1.amazonaws.com')], 'root', '/key.rsa',
+                    ssh_dir))
+            ssh_config_f.close()
+            self.assertEqual(_close_ssh_multiplexing(ssh_dir,
+                                                     ['master'], 1), False)
+        finally:
+            rmtree(ssh_dir)
+
+    def test_get_cluster_status(self):
+        """Test checking whether a cluster is running and usable."""
+        # Stand in for starcluster with commands that print some fake
+        # listclusters output.
+        sc_exe_fp = ("printf 'Cluster nodes:\\n master running i-1 "
+                     "ec2-1.amazonaws.com\\n node001 running i-2 "
+                     "ec2-2.amazonaws.com\\n'; true")
+        self.assertEqual(_get_cluster_status(sc_exe_fp, 'sc_config',
+                                             'nightly_tests', 2, 1), 'healthy')
+        self.assertEqual(_get_cluster_status(sc_exe_fp, 'sc_config',
+                                             'nightly_tests', 3, 1),
+                         'unhealthy')
 
+        sc_exe_fp = ("printf 'Cluster nodes:\\n master stopped i-1 "
+                     "ec2-1.amazonaws.com\\n'; true")
+        self.assertEqual(_get_cluster_status(sc_exe_fp, 'sc_config',
+                                             'nightly_tests', 1, 1),
+                         'unhealthy')
+
+        self.assertEqual(_get_cluster_status('echo', 'sc_config',
+                                             'nightly_tests', 1, 1), 'missing')
+        self.assertEqual(_get_cluster_status('false', 'sc_config',
+                                             'nightly_tests', 1, 1), 'missing')
+
+    def test_terminate_idle_clusters(self):
+        """Test terminating clusters that have been idle for too long."""
+        # Nothing to terminate.
+        warm_clusters = {'nightly_tests': 0, 'hourly_tests': time()}
+        obs = _terminate_idle_clusters(warm_clusters, 'nightly_tests', 60,
+                                       'false', 'sc_config', 1, 'foo\n\n',
+                                       [])
+        self.assertEqual(obs, ('foo\n\n', []))
+
+        # Termination succeeds for one cluster but not the other.
+        warm_clusters = {'nightly_tests': 0, 'hourly_tests': time(),
+                         'old_tests': 0, 'broken_tests': 0}
+        sc_exe_fp = 'f() { test "$5" = old_tests; }; f'
+        obs = _terminate_idle_clusters(warm_clusters, 'nightly_tests', 60,
+                                       sc_exe_fp, 'sc_config', 1, '', [])
+        self.assertEqual(obs[0], 'The following idle clusters were '
+                         'terminated: old_tests\n\nThere were problems in '
+                         'terminating the following idle clusters, which '
+                         'will be retried next time: broken_tests. Please '
+                         'check the attached log for more details.\n\n')
+        self.assertEqual(len(obs[1]), 1)
+        self.assertEqual(obs[1][0][0], 'idle_clusters_log.txt')
+        self.assertEqual(sorted(warm_clusters),
+                         ['broken_tests', 'hourly_tests', 'nightly_tests'])
+
+    def test_assign_test_suites_to_nodes(self):
+        """Test dealing out test suites to the nodes in a cluster."""
+        test_suites = [['A', 'a'], ['B', 'b'], ['C', 'c']]
+        self.assertEqual(_assign_test_suites_to_nodes(test_suites,
+                                                      ['master']),
+                         ['master', 'master', 'master'])
+        self.assertEqual(_assign_test_suites_to_nodes(test_suites,
+                                                      ['master', 'node001']),
+                         ['master', 'node001', 'master'])
+        self.assertEqual(_assign_test_suites_to_nodes(test_suites,
+                ['master', 'node001', 'node002', 'node003', 'node004']),
+                ['master', 'node001', 'node002'])
+        self.assertEqual(_assign_test_suites_to_nodes([], ['master']), [])
+
+    def test_expand_shards(self):
+        """Test splitting test suites into shards."""
+        test_suites = [['QIIME', './tests.py', {'shards': 2}],
+                       ['PyCogent', '/bin/cogent_tests', {}]]
+        exp = ([['QIIME.shard0', 'export CLOUT_SHARD_INDEX=0 '
+                 'CLOUT_SHARD_COUNT=2; ./tests.py', {'shards': 2}],
+                ['QIIME.shard1', 'export CLOUT_SHARD_INDEX=1 '
+                 'CLOUT_SHARD_COUNT=2; ./tests.py', {'shards': 2}],
+                ['PyCogent', '/bin/cogent_tests', {}]],
+               {'QIIME.shard0': 'QIIME', 'QIIME.shard1': 'QIIME'})
+        self.assertEqual(_expand_shards(test_suites), exp)
+
+        # No shards.
         test_suites = parse_config_file(self.config)
-        obs = _build_test_execution_commands(test_suites, 'sc_config',
-                'nightly_tests', spot_bid=0.50)
-        self.assertEqual(obs, exp)
-
-        # With custom cluster template and user.
-        exp = (["starcluster -c sc_config start -c some_cluster_template -b "
-                "1.00 --force-spot-master nightly_tests"],
-               ["starcluster -c sc_config sshmaster -u ubuntu nightly_tests "
-                "'source /bin/setup.sh; cd /bin; ./tests.py'",
-                "starcluster -c sc_config sshmaster -u ubuntu nightly_tests "
-                "'/bin/cogent_tests'"],
-               ["starcluster -c sc_config terminate -c nightly_tests"])
-
-        obs = _build_test_execution_commands(test_suites, 'sc_config',
-                'nightly_tests', cluster_template='some_cluster_template',
-                user='ubuntu', spot_bid=1)
-        self.assertEqual(obs, exp)
+        self.assertEqual(_expand_shards(test_suites), (test_suites, {}))
+
+        # Shard labels that clash with another test suite's label.
+        self.assertRaises(ValueError, _expand_shards,
+                [['QIIME.shard1', '/foo', {}], ['QIIME', '/bar',
+                                               {'shards': 2}]])
+
+    def test_build_run_metrics(self):
+        """Test collecting a run's metrics."""
+        run_info = {'cluster_kept': False,
+                    'cmd_records': [
+                        ('setup', 'setup', 'sc start', 100.0, 160.0, 0),
+                        ('test_suite', 'QIIME', 'q', 160.0, 400.0, 1),
+                        ('test_suite', 'PyCogent', 'p', 160.0, 200.0, 0),
+                        ('teardown', 'teardown', 'sc stop', 400.0, 430.0, 0)],
+                    'test_suite_results': [('QIIME', 1), ('PyCogent', 0)],
+                    'output_bytes': {'QIIME': 1000, 'PyCogent': 24},
+                    'timeouts': [], 'timed_out_test_suites': [],
+                    'cancelled_test_suites': ['QIIME'],
+                    'first_failure': 'PyCogent', 'cluster_replacements': 1}
+        backend = StarClusterBackend('starcluster', 'sc_config', 'nightly',
+                                     cluster_size=2, instance_type='m1.large')
+        obs = _build_run_metrics(['QIIME', 'PyCogent', 'biom'], ['biom'],
+                                 run_info, 'nightly', 'starcluster', backend,
+                                 0.5)
+
+        self.assertTrue(obs['timestamp'] <= time())
+        del obs['timestamp']
+        self.assertEqual(obs, {'cluster_tag': 'nightly',
+                'backend': 'starcluster', 'instance_type': 'm1.large',
+                'spot_bid': 0.5, 'billed_instances': 2, 'succeeded': False,
+                'phases': {
+                    'setup': {'duration': 60.0, 'timed_out': False},
+                    'test_suite': {'duration': 240.0, 'timed_out': False},
+                    'teardown': {'duration': 30.0, 'timed_out': False}},
+                'test_suites': [
+                    {'label': 'biom', 'cached': True, 'duration': None,
+                     'return_code': 0, 'output_bytes': None,
+                     'timed_out': False, 'cancelled': False},
+                    {'label': 'QIIME', 'cached': False, 'duration': 240.0,
+                     'return_code': 1, 'output_bytes': 1000,
+                     'timed_out': False, 'cancelled': True},
+                    {'label': 'PyCogent', 'cached': False, 'duration': 40.0,
+                     'return_code': 0, 'output_bytes': 24,
+                     'timed_out': False, 'cancelled': False}],
+                'output_bytes': 1024, 'cluster_replacements': 1})
+
+        # Every test suite was cached, so nothing was run.
+        obs = _build_run_metrics(['biom'], ['biom'], None, 'nightly',
+                                 'local', LocalBackend('/tmp/work'), None)
+        self.assertEqual(obs['succeeded'], True)
+        self.assertEqual(obs['billed_instances'], 0)
+        self.assertEqual(obs['phases']['setup'],
+                         {'duration': None, 'timed_out': False})
+        self.assertEqual(len(obs['test_suites']), 1)
+
+        # A timeout means the run didn't succeed, even if nothing failed.
+        run_info['test_suite_results'] = [('QIIME', 0), ('PyCogent', 0)]
+        self.assertEqual(_build_run_metrics(['QIIME', 'PyCogent'], [],
+                run_info, 'nightly', 'starcluster', backend,
+                None)['succeeded'], True)
+        run_info['timeouts'] = ['teardown']
+        self.assertEqual(_build_run_metrics(['QIIME', 'PyCogent'], [],
+                run_info, 'nightly', 'starcluster', backend,
+                None)['succeeded'], False)
+
+    def test_write_run_metrics(self):
+        """Test writing a run's metrics to JSON and Prometheus files."""
+        metrics = _build_run_metrics(['biom'], ['biom'], None, 'nightly',
+                                     'local', LocalBackend('/tmp/work'), None)
+        metrics_dir = join(mkdtemp(prefix='clout_test_'), 'metrics')
+        try:
+            _write_run_metrics(metrics_dir, metrics)
+            self.assertEqual(sorted(listdir(metrics_dir)),
+                             ['clout_nightly.json', 'clout_nightly.prom'])
+
+            metrics_f = open(join(metrics_dir, 'clout_nightly.json'), 'U')
+            self.assertEqual(load(metrics_f), metrics)
+            metrics_f.close()
+
+            metrics_f = open(join(metrics_dir, 'clout_nightly.prom'), 'U')
+            self.assertEqual(metrics_f.read(),
+                             format_prometheus_metrics(metrics))
+            metrics_f.close()
+        finally:
+            rmtree(dirname(metrics_dir))
+
+    def test_get_cache_keys(self):
+        """Test computing cache keys from fingerprint commands."""
+        test_suites = [['Test1', 'echo foo', {'fingerprint': 'echo 1'}],
+                       ['Test2', 'echo bar', {}],
+                       ['Test3', 'echo baz', {'fingerprint': 'false'}],
+                       ['Test4', 'echo foo', {'fingerprint': 'echo 2'}],
+                       ['Test5', 'echo bar', {'fingerprint': 'echo 1'}]]
+        obs = _get_cache_keys(test_suites, 1)
+        self.assertEqual(sorted(obs), ['Test1', 'Test4', 'Test5'])
+
+        # Changing either the command or the fingerprint changes the key.
+        self.assertNotEqual(obs['Test1'], obs['Test4'])
+        self.assertNotEqual(obs['Test1'], obs['Test5'])
+        self.assertEqual(obs, _get_cache_keys(test_suites, 1))
+
+        # Fingerprint commands that time out are ignored.
+        self.assertEqual(_get_cache_keys(
+                [['Test1', 'echo foo', {'fingerprint': 'sleep 5'}]], 0.01), {})
+        self.assertEqual(_get_cache_keys(test_suites[1:2], 1), {})
 
     def test_execute_commands_and_build_email(self):
         """Test functions correctly using standard, valid input."""
@@ -164,6 +349,172 @@ class RunTests(TestCase):
         self.assertEqual(log_f.read(),
             "Command:\n\necho bar\n\nStdout:\n\nbar\n\nStderr:\n\n\n")
 
+        # Every command is recorded for the history database.
+        self.assertEqual([cmd_record[:3] + cmd_record[5:]
+                          for cmd_record in obs[2]['cmd_records']],
+            [('setup', 'setup', 'echo setting up', 0),
+             ('setup', 'setup', 'echo ...', 0),
+             ('test_suite', 'Test1', 'echo foo', 0),
+             ('test_suite', 'Test2', 'echo bar', 0),
+             ('teardown', 'teardown', 'echo tearing down', 0),
+             ('teardown', 'teardown', 'echo ...', 0)])
+        for cmd_record in obs[2]['cmd_records']:
+            self.assertTrue(cmd_record[3] <= cmd_record[4])
+        self.assertEqual(obs[2]['test_suite_results'],
+                         [('Test1', 0), ('Test2', 0)])
+        self.assertEqual(obs[2]['output_bytes'], {'Test1': 44, 'Test2': 44})
+        self.assertEqual(obs[2]['timeouts'], [])
+        self.assertEqual(obs[2]['timed_out_test_suites'], [])
+
+    def test_execute_commands_and_build_email_artifacts(self):
+        """Test copying the test suites' artifacts before teardown."""
+        tmp_dir = mkdtemp(prefix='clout_test_run')
+        try:
+            backend = LocalBackend(join(tmp_dir, 'work'))
+            artifacts_dir = join(tmp_dir, 'artifacts')
+            test_suites = [['Test1', 'mkdir out && echo foo > out/foo.xml',
+                            {'artifacts': ['out/*.xml']}],
+                           ['Test2', 'echo bar', {'artifacts': ['*.xml']}],
+                           ['Test3', 'echo baz > baz.xml', {}]]
+            setup_cmds, test_suites_cmds, teardown_cmds = \
+                    backend.build_commands(test_suites)
+            artifacts_cmds = backend.build_artifacts_cmds(test_suites, None,
+                                                          artifacts_dir)
+
+            obs = _execute_commands_and_build_email(test_suites, setup_cmds,
+                    test_suites_cmds, teardown_cmds, 1, 1, 1,
+                    'test-cluster-tag', artifacts_cmds=artifacts_cmds,
+                    artifacts_dir=artifacts_dir)
+            self.assertEqual(obs[0], 'Test1: Pass\nTest2: Pass\nTest3: Pass\n'
+                             '\nArtifacts (saved in %s):\nTest1: 1 file (4 '
+                             'bytes)\nTest2: no matching files\n\n' %
+                             artifacts_dir)
+            self.assertEqual(obs[2]['artifacts'],
+                             {'Test1': [('out/foo.xml', 4)]})
+            self.assertEqual(open(join(artifacts_dir, 'Test1', 'out',
+                                       'foo.xml')).read(), 'foo\n')
+
+            # The artifacts were copied before the teardown commands ran.
+            self.assertEqual([cmd_record[0]
+                              for cmd_record in obs[2]['cmd_records']],
+                             ['setup', 'test_suite', 'test_suite',
+                              'test_suite', 'artifacts', 'teardown'])
+
+            # Problems in copying the artifacts are reported.
+            obs = _execute_commands_and_build_email(test_suites, setup_cmds,
+                    test_suites_cmds, teardown_cmds, 1, 1, 1,
+                    'test-cluster-tag', artifacts_cmds=['exit 1'],
+                    artifacts_dir=artifacts_dir)
+            self.assertTrue('Test1: no matching files\n' in obs[0])
+            self.assertTrue('There were problems in copying the artifacts.'
+                            in obs[0])
+            self.assertEqual(obs[2]['artifacts'], {})
+
+            # Nothing is copied if the cluster couldn't be started.
+            obs = _execute_commands_and_build_email(test_suites, ['exit 1'],
+                    test_suites_cmds, teardown_cmds, 1, 1, 1,
+                    'test-cluster-tag', artifacts_cmds=artifacts_cmds,
+                    artifacts_dir=artifacts_dir)
+            self.assertFalse('Artifacts' in obs[0])
+            self.assertFalse('artifacts' in [cmd_record[0] for cmd_record in
+                                             obs[2]['cmd_records']])
+        finally:
+            rmtree(tmp_dir)
+
+    def test_summarize_junit_reports(self):
+        """Test combining the JUnit XML reports of each test suite."""
+        tmp_dir = mkdtemp(prefix='clout_test_run')
+        try:
+            reports = {'QIIME.shard0/tmp/qiime/a.xml':
+                           '<testsuite><testcase name="a" time="3">'
+                           '<failure/></testcase></testsuite>',
+                       'QIIME.shard1/tmp/qiime/b.xml':
+                           '<testsuite><testcase name="b" time="5"/>'
+                           '<testcase name="c"><skipped/></testcase>'
+                           '</testsuite>',
+                       'QIIME.shard1/tmp/qiime/coverage.xml':
+                           '<coverage/>',
+                       'biom/results/junit.xml': '<testsuite>'}
+            for report_path, report in reports.items():
+                report_fp = join(tmp_dir, report_path)
+                if not exists(dirname(report_fp)):
+                    makedirs(dirname(report_fp))
+                report_f = open(report_fp, 'w')
+                report_f.write(report)
+                report_f.close()
+
+            options = {'junit': ['/tmp/qiime/?.xml'], 'shards': 2}
+            test_suites = [['QIIME.shard0', 'q', options],
+                           ['QIIME.shard1', 'q', options],
+                           ['PyCogent', 'p', {}],
+                           ['biom', 'b', {'junit': ['results/*.xml']}]]
+            artifacts = {'QIIME.shard0': [('tmp/qiime/a.xml', 1)],
+                         'QIIME.shard1': [('tmp/qiime/b.xml', 1),
+                                          ('tmp/qiime/coverage.xml', 1)],
+                         'biom': [('results/junit.xml', 1)]}
+            obs = _summarize_junit_reports(test_suites, artifacts, tmp_dir,
+                    {'QIIME.shard0': 'QIIME', 'QIIME.shard1': 'QIIME'})
+            self.assertEqual(obs, [
+                    ('QIIME', {'passed': 1, 'failed': 1, 'errors': 0,
+                               'skipped': 1, 'failing_tests': [('failed',
+                                                                'a')],
+                               'slowest_tests': [(5.0, 'b'), (3.0, 'a'),
+                                                 (0.0, 'c')],
+                               'num_reports': 2, 'unreadable_reports': []}),
+                    ('biom', {'passed': 0, 'failed': 0, 'errors': 0,
+                              'skipped': 0, 'failing_tests': [],
+                              'slowest_tests': [], 'num_reports': 0,
+                              'unreadable_reports': ['biom/results/'
+                                                     'junit.xml']})])
+        finally:
+            rmtree(tmp_dir)
+
+    def test_diff_test_suite_logs(self):
+        """Test reporting what is new in the test suites' logs."""
+        archive_dir = mkdtemp(prefix='clout_test_run')
+        try:
+            def make_attachments(qiime_log, cogent_log):
+                attachments = []
+                for name, contents in (('complete_log.txt', 'everything\n'),
+                                       ('QIIME_results.txt', qiime_log),
+                                       ('PyCogent_results.txt', cogent_log)):
+                    log_f = TemporaryFile(prefix='clout_test_run')
+                    log_f.write(contents)
+                    log_f.seek(0, 0)
+                    attachments.append((name, log_f))
+                return attachments
+
+            # The first run has nothing to compare with.
+            attachments = make_attachments('ok in 2.5s\n', 'ok\nfailed\n')
+            obs = _diff_test_suite_logs([('QIIME', 0), ('PyCogent', 1)],
+                                        attachments, archive_dir, 'foo\n\n')
+            self.assertEqual(obs, ('foo\n\n', attachments))
+            self.assertEqual(sorted(listdir(archive_dir)),
+                             ['PyCogent_results.txt', 'QIIME_results.txt'])
+
+            # Only the new lines of failing test suites are reported.
+            attachments = make_attachments('ok in 3s\nnew but passing\n',
+                                           'ok\nfailed\nnew failure\n')
+            obs = _diff_test_suite_logs([('QIIME', 0), ('PyCogent', 1)],
+                                        attachments, archive_dir, '')
+            self.assertEqual(obs[0], 'New output in the PyCogent log since '
+                             'the previous run:\n     3: new failure\n\n'
+                             'The logs of 2 test suites were compared with '
+                             'the previous run\'s logs instead of being '
+                             'attached (lines that only differ in '
+                             'timestamps, durations, temporary paths, or '
+                             'memory addresses aren\'t new). The full logs '
+                             'are kept in %s.\n\n' % archive_dir)
+            self.assertEqual([name for name, log_f in obs[1]],
+                             ['complete_log.txt'])
+
+            archived_log_f = open(join(archive_dir, 'PyCogent_results.txt'))
+            self.assertEqual(archived_log_f.read(),
+                             'ok\nfailed\nnew failure\n')
+            archived_log_f.close()
+        finally:
+            rmtree(archive_dir)
+
     def test_execute_commands_and_build_email_failures(self):
         """Test functions correctly when a test suite fails."""
         obs = _execute_commands_and_build_email(
@@ -240,6 +591,134 @@ class RunTests(TestCase):
             "Command:\n\nfoobarbaz\n\nStdout:\n\n\nStderr:\n\n\n\n"
             "Command:\n\nfoobarbaz\n\nStdout:\n\n\nStderr:\n\n\n\n")
 
+    def test_execute_commands_and_build_email_local_prep(self):
+        """Test running local preparation commands while setting up."""
+        obs = _execute_commands_and_build_email(
+            [['Test1', 'echo foo']],
+            ['sleep 0.2', 'echo setting up'],
+            ['echo foo'],
+            ['echo tearing down'],
+            1, 1, 1, 'test-cluster-tag',
+            local_prep_cmds=['echo building', 'echo bundling'])
+        self.assertEqual(obs[0], 'Test1: Pass\n\n')
+        cmd_records = obs[2]['cmd_records']
+        self.assertEqual([cmd_record[:3] for cmd_record in cmd_records],
+            [('setup', 'setup', 'sleep 0.2'),
+             ('setup', 'setup', 'echo setting up'),
+             ('local_prep', 'local_prep', 'echo building'),
+             ('local_prep', 'local_prep', 'echo bundling'),
+             ('test_suite', 'Test1', 'echo foo'),
+             ('teardown', 'teardown', 'echo tearing down')])
+
+        # The local preparation commands ran while the cluster was being set
+        # up, and the test suite waited for both.
+        self.assertTrue(cmd_records[3][4] < cmd_records[0][4])
+        self.assertTrue(cmd_records[4][3] >= cmd_records[1][4])
+
+        # A failing local preparation command counts as a setup failure.
+        obs = _execute_commands_and_build_email(
+            [['Test1', 'echo foo']],
+            ['echo setting up'],
+            ['echo foo'],
+            ['echo tearing down'],
+            1, 1, 1, 'test-cluster-tag', local_prep_cmds=['exit 1'])
+        self.assertEqual(obs[0], 'There were problems in running the local '
+                         'preparation commands while the cluster was '
+                         'starting. Please check the attached log for more '
+                         'details.\n\n')
+        self.assertEqual([cmd_record[0] for cmd_record in
+                          obs[2]['cmd_records']],
+                         ['setup', 'local_prep', 'teardown'])
+
+        # A failing local preparation command cancels a slow cluster start
+        # instead of waiting for it.
+        start_time = time()
+        obs = _execute_commands_and_build_email(
+            [['Test1', 'echo foo']],
+            ['sleep 10; echo setting up'],
+            ['echo foo'],
+            ['echo tearing down'],
+            1, 1, 1, 'test-cluster-tag', local_prep_cmds=['exit 1'])
+        self.assertTrue(time() - start_time < 5)
+        self.assertTrue(obs[0].startswith('There were problems in running '
+                                          'the local preparation commands'))
+        self.assertEqual([cmd_record[0] for cmd_record in
+                          obs[2]['cmd_records']],
+                         ['setup', 'local_prep', 'teardown'])
+        self.assertNotEqual(obs[2]['cmd_records'][0][5], 0)
+
+        # A failing cluster start cancels the local preparation commands,
+        # and is reported as the problem.
+        start_time = time()
+        obs = _execute_commands_and_build_email(
+            [['Test1', 'echo foo']],
+            ['exit 1'],
+            ['echo foo'],
+            ['echo tearing down'],
+            1, 1, 1, 'test-cluster-tag', local_prep_cmds=['sleep 10'])
+        self.assertTrue(time() - start_time < 5)
+        self.assertTrue(obs[0].startswith('There were problems in starting '
+                                          'the cluster'))
+
+    def test_execute_commands_and_build_email_background_teardown(self):
+        """Test terminating the cluster while the email is sent."""
+        obs = _execute_commands_and_build_email(
+            [['Test1', 'echo foo']],
+            ['echo setting up'],
+            ['echo foo'],
+            ['sleep 0.1; echo tearing down'],
+            1, 1, 1, 'test-cluster-tag', background_teardown=True)
+        self.assertEqual(obs[0], "Test1: Pass\n\nThe cluster labelled with "
+                         "the tag 'test-cluster-tag' is being terminated "
+                         "while this email is sent, so the time that takes "
+                         "isn't included below. Any problems in terminating "
+                         "it will be reported in a follow-up email.\n\n")
+        self.assertFalse('teardown' in [cmd_record[0] for cmd_record in
+                                        obs[2]['cmd_records']])
+
+        run_info = obs[2]
+        self.assertEqual(_finish_background_teardown(run_info, 1,
+                                                     'test-cluster-tag'), '')
+        self.assertEqual(run_info['cmd_records'][-1][:3],
+                         ('teardown', 'teardown',
+                          'sleep 0.1; echo tearing down'))
+        self.assertEqual(run_info['timeouts'], [])
+
+        # The teardown output is kept out of the complete log, which may be
+        # read while the teardown commands run.
+        self.assertFalse('tearing down' in obs[1][0][1].read())
+        run_info['teardown']['log_f'].seek(0, 0)
+        self.assertTrue('tearing down' in
+                        run_info['teardown']['log_f'].read())
+
+        # Problems are reported in a follow-up email.
+        obs = _execute_commands_and_build_email(
+            [['Test1', 'echo foo']],
+            ['echo setting up'],
+            ['echo foo'],
+            ['sleep 5'],
+            1, 1, 0.01, 'test-cluster-tag', background_teardown=True)
+        self.assertEqual(_finish_background_teardown(obs[2], 0.01,
+                                                     'test-cluster-tag'),
+            "The cluster labelled with the tag 'test-cluster-tag' was being "
+            "terminated while the test suite results were emailed.\n\n"
+            "The maximum allowable cluster termination time of 0.01 "
+            "minute(s) was exceeded.\n\nIMPORTANT: You should check that "
+            "the cluster labelled with the tag 'test-cluster-tag' was "
+            "properly terminated. If not, you should manually terminate "
+            "it.\n\n")
+        self.assertEqual(obs[2]['timeouts'], ['teardown'])
+
+        # The teardown commands are waited for if setup failed.
+        obs = _execute_commands_and_build_email(
+            [['Test1', 'echo foo']],
+            ['exit 1'],
+            ['echo foo'],
+            ['echo tearing down'],
+            1, 1, 1, 'test-cluster-tag', background_teardown=True)
+        self.assertEqual(obs[2]['teardown'], None)
+        self.assertEqual(obs[2]['cmd_records'][-1][0], 'teardown')
+
     def test_execute_commands_and_build_email_test_suite_timeout(self):
         """Test functions correctly when a test suite timeout occurs."""
         # Test a timeout that occurs in the first test suite to run.
@@ -253,6 +732,8 @@ class RunTests(TestCase):
             'of 0.01 minute(s) for all test suites to run was exceeded. The '
             'timeout occurred while running the Test1 test suite. The '
             'following test suites were not tested: Test2\n\n')
+        self.assertEqual(obs[2]['timeouts'], ['test_suite'])
+        self.assertEqual(obs[2]['timed_out_test_suites'], ['Test1'])
 
         self.assertEqual(len(obs[1]), 2)
         name, log_f = obs[1][0]
@@ -281,7 +762,7 @@ class RunTests(TestCase):
         self.assertEqual(obs[0], 'Test1: Pass\nTest2: Fail\n\nThe maximum '
             'allowable time of 0.01 minute(s) for all test suites to run was '
             'exceeded. The timeout occurred while running the Test2 test '
-            'suite.')
+            'suite.\n\n')
 
         self.assertEqual(len(obs[1]), 3)
         name, log_f = obs[1][0]
@@ -314,6 +795,7 @@ class RunTests(TestCase):
             0.01, 1, 1, 'test-cluster-tag')
         self.assertEqual(obs[0], 'The maximum allowable cluster setup time of '
         '0.01 minute(s) was exceeded.\n\n')
+        self.assertEqual(obs[2]['timeouts'], ['setup'])
 
         self.assertEqual(len(obs[1]), 1)
         name, log_f = obs[1][0]
@@ -351,6 +833,491 @@ class RunTests(TestCase):
         self.assertEqual(log_f.read(),
             "Command:\n\necho foo\n\nStdout:\n\nfoo\n\nStderr:\n\n\n")
 
+    def test_execute_commands_and_build_email_multiple_nodes(self):
+        """Test functions correctly when test suites run on multiple nodes."""
+        obs = _execute_commands_and_build_email(
+            [['Test1', 'sleep 5'], ['Test2', 'echo bar'],
+             ['Test3', 'echo baz']],
+            ['echo setting up'],
+            ['sleep 5', 'echo bar', 'echo baz'],
+            ['echo tearing down'],
+            1, 0.01, 1, 'test-cluster-tag', ['master', 'node001', 'master'])
+        self.assertEqual(obs[0], 'Test1: Fail\nTest2: Pass\n\nThe maximum '
+            'allowable time of 0.01 minute(s) for all test suites to run was '
+            'exceeded. The timeout occurred while running the Test1 test '
+            'suite. The following test suites were not tested: Test3\n\n')
+
+        self.assertEqual(len(obs[1]), 3)
+        self.assertEqual(obs[1][1][0], 'Test1_results.txt')
+        self.assertEqual(obs[1][2][0], 'Test2_results.txt')
+        self.assertEqual(obs[1][2][1].read(),
+            "Command:\n\necho bar\n\nStdout:\n\nbar\n\nStderr:\n\n\n")
+
+    def test_execute_commands_and_build_email_shards(self):
+        """Test functions correctly when a test suite is split into shards."""
+        test_suites, shard_parents = _expand_shards(
+                [['Test1', 'test $CLOUT_SHARD_INDEX != 2', {'shards': 3}],
+                 ['Test2', 'echo bar', {}]])
+        test_suites_cmds = [test_suite[1] for test_suite in test_suites]
+        obs = _execute_commands_and_build_email(test_suites,
+                ['echo setting up'], test_suites_cmds, ['echo tearing down'],
+                1, 1, 1, 'test-cluster-tag', shard_parents=shard_parents)
+        self.assertEqual(obs[0], 'Test1: Fail (1 of 3 shards failed)\n'
+                                 'Test2: Pass\n\n')
+
+        # The shards' logs are merged into one attachment.
+        self.assertEqual(len(obs[1]), 3)
+        name, log_f = obs[1][1]
+        self.assertEqual(name, 'Test1_results.txt')
+        self.assertEqual(log_f.read(),
+            "Shard:\n\nTest1.shard0\n\nCommand:\n\n%s\n\nStdout:\n\n\n"
+            "Stderr:\n\n\n\n"
+            "Shard:\n\nTest1.shard1\n\nCommand:\n\n%s\n\nStdout:\n\n\n"
+            "Stderr:\n\n\n\n"
+            "Shard:\n\nTest1.shard2\n\nCommand:\n\n%s\n\nStdout:\n\n\n"
+            "Stderr:\n\n\n\n" % tuple(test_suites_cmds[:3]))
+        self.assertEqual(obs[1][2][0], 'Test2_results.txt')
+
+        # Each shard is recorded separately in the history.
+        self.assertEqual([cmd_record[1] for cmd_record in
+                          obs[2]['cmd_records']
+                          if cmd_record[0] == 'test_suite'],
+                         ['Test1.shard0', 'Test1.shard1', 'Test1.shard2',
+                          'Test2'])
+
+        # All shards pass.
+        test_suites, shard_parents = _expand_shards(
+                [['Test1', 'true', {'shards': 2}]])
+        obs = _execute_commands_and_build_email(test_suites,
+                ['echo setting up'], ['true', 'true'], ['echo tearing down'],
+                1, 1, 1, 'test-cluster-tag', shard_parents=shard_parents)
+        self.assertEqual(obs[0], 'Test1: Pass (2 shards)\n\n')
+        self.assertEqual(obs[2]['test_suite_results'], [('Test1', 0)])
+
+    def test_execute_commands_and_build_email_shards_notes(self):
+        """Test reporting cancelled and flaky shards under their test suite."""
+        # Shard 1 fails right away, so shard 0 is cancelled.
+        test_suites, shard_parents = _expand_shards(
+                [['Test1', 'test $CLOUT_SHARD_INDEX = 0 && sleep 10 || exit 1',
+                  {'shards': 2}]])
+        obs = _execute_commands_and_build_email(test_suites,
+                ['echo setting up'],
+                [test_suite[1] for test_suite in test_suites],
+                ['echo tearing down'], 1, 1, 1, 'test-cluster-tag',
+                node_assignments=['master', 'node001'],
+                shard_parents=shard_parents, fail_fast=True)
+        self.assertEqual(obs[2]['cancelled_test_suites'], ['Test1.shard0'])
+        self.assertTrue('Test1: Fail (2 of 2 shards failed, cancelled)\n' in
+                        obs[0])
+
+        # Shard 1 fails the first time it is run.
+        tmp_dir = mkdtemp(prefix='clout_test_run')
+        try:
+            marker_fp = join(tmp_dir, 'marker')
+            test_suites, shard_parents = _expand_shards(
+                    [['Test1', 'test $CLOUT_SHARD_INDEX = 0 || test -e %s || '
+                      '{ touch %s; exit 1; }' % (marker_fp, marker_fp),
+                      {'shards': 2}]])
+            obs = _execute_commands_and_build_email(test_suites,
+                    ['echo setting up'],
+                    [test_suite[1] for test_suite in test_suites],
+                    ['echo tearing down'], 1, 1, 1, 'test-cluster-tag',
+                    shard_parents=shard_parents, retries=1)
+            self.assertEqual(obs[2]['flaky_test_suites'], {'Test1.shard1': 1})
+            self.assertTrue(obs[0].startswith(
+                    'Test1: Pass (2 shards, flaky, passed on retry 1)\n\n'))
+        finally:
+            rmtree(tmp_dir)
+
+    def test_execute_commands_and_build_email_max_parallel(self):
+        """Test functions correctly when test suites run in parallel."""
+        obs = _execute_commands_and_build_email(
+            [['Test1', 'sleep 1 && echo foo'], ['Test2', 'sleep 1']],
+            ['echo setting up'],
+            ['sleep 1 && echo foo', 'sleep 1'],
+            ['echo tearing down'],
+            1, 0.03, 1, 'test-cluster-tag', max_parallel=2)
+        self.assertEqual(obs[0], 'Test1: Pass\nTest2: Pass\n\n')
+        self.assertEqual(len(obs[1]), 3)
+        self.assertEqual(obs[1][1][1].read(),
+            "Command:\n\nsleep 1 && echo foo\n\nStdout:\n\nfoo\n\n"
+            "Stderr:\n\n\n")
+
+    def test_execute_commands_and_build_email_post_setup_failure(self):
+        """Test functions correctly when post-setup work fails."""
+        post_setup_calls = []
+        def post_setup_fn(log_f, timeout):
+            post_setup_calls.append(timeout)
+            return False
+
+        obs = _execute_commands_and_build_email(
+            [['Test1', 'echo foo']],
+            ['echo setting up'],
+            ['echo foo'],
+            ['echo tearing down'],
+            0.5, 1, 1, 'test-cluster-tag', post_setup_fn=post_setup_fn)
+        self.assertEqual(obs[0], 'There were problems in starting the '
+        'cluster while preparing to execute the test suite(s). Please check '
+        'the attached log for more details.\n\n')
+        self.assertEqual(post_setup_calls, [0.5])
+        self.assertEqual(len(obs[1]), 1)
+
+        # Not called if the setup commands fail.
+        obs = _execute_commands_and_build_email(
+            [['Test1', 'echo foo']],
+            ['foobarbaz'],
+            ['echo foo'],
+            ['echo tearing down'],
+            0.5, 1, 1, 'test-cluster-tag', post_setup_fn=post_setup_fn)
+        self.assertEqual(post_setup_calls, [0.5])
+
+    def test_execute_commands_and_build_email_fail_fast(self):
+        """Test stopping the test suites as soon as one of them fails."""
+        obs = _execute_commands_and_build_email(
+            [['Test1', 'sleep 10'], ['Test2', 'sleep 0.1; exit 3'],
+             ['Test3', 'echo foo'], ['Test4', 'echo bar']],
+            ['echo setting up'],
+            ['sleep 10', 'sleep 0.1; exit 3', 'echo foo', 'echo bar'],
+            ['echo tearing down'],
+            1, 1, 1, 'test-cluster-tag',
+            node_assignments=['master', 'node001', 'node001', 'master'],
+            keep_cluster=True, fail_fast=True)
+        self.assertEqual(sub(r'\d:\d\d:\d\d', 'H:MM:SS', obs[0]),
+            'First failure: the Test2 test suite failed (return code 3) '
+            'H:MM:SS after the test suites started, so the run was stopped '
+            'early.\nCancelled while running: Test1\n'
+            'Not run: Test3, Test4\n\n'
+            'Test1: Fail (cancelled)\nTest2: Fail\n\n')
+        self.assertEqual(obs[2]['first_failure'], 'Test2')
+        self.assertEqual(obs[2]['cancelled_test_suites'], ['Test1'])
+        self.assertEqual(obs[2]['timeouts'], [])
+
+        # The cluster is terminated, since the cancelled test suite may
+        # still be running on it.
+        self.assertEqual(obs[2]['cluster_kept'], False)
+        self.assertTrue('tearing down' in obs[1][0][1].read())
+        self.assertEqual([name for name, log_f in obs[1]],
+                         ['complete_log.txt', 'Test1_results.txt',
+                          'Test2_results.txt'])
+
+        # Without fail_fast, the other test suites run to completion.
+        obs = _execute_commands_and_build_email(
+            [['Test1', 'sleep 0.2'], ['Test2', 'exit 3']],
+            ['echo setting up'],
+            ['sleep 0.2', 'exit 3'],
+            ['echo tearing down'],
+            1, 1, 1, 'test-cluster-tag',
+            node_assignments=['master', 'node001'])
+        self.assertEqual(obs[0], 'Test1: Pass\nTest2: Fail\n\n')
+        self.assertEqual(obs[2]['first_failure'], None)
+        self.assertEqual(obs[2]['cancelled_test_suites'], [])
+
+        # A failure that doesn't stop anything early isn't reported.
+        obs = _execute_commands_and_build_email(
+            [['Test1', 'echo foo'], ['Test2', 'exit 3']],
+            ['echo setting up'],
+            ['echo foo', 'exit 3'],
+            ['echo tearing down'],
+            1, 1, 1, 'test-cluster-tag', fail_fast=True)
+        self.assertEqual(obs[0], 'Test1: Pass\nTest2: Fail\n\n')
+        self.assertEqual(obs[2]['first_failure'], None)
+
+    def test_execute_commands_and_build_email_per_test_suite_timeout(self):
+        """Test terminating a test suite that runs for too long on its own."""
+        start_time = time()
+        obs = _execute_commands_and_build_email(
+                [['Test1', 'sleep 10'], ['Test2', 'echo foo']],
+                ['echo setting up'], ['sleep 10', 'echo foo'],
+                ['echo tearing down'], 1, 1, 1, 'test-cluster-tag',
+                node_assignments=['master', 'node001'], keep_cluster=True,
+                per_test_suite_timeout=0.005)
+        self.assertTrue(time() - start_time < 5)
+        self.assertTrue(obs[0].startswith('Test1: Fail\nTest2: Pass\n\n'
+                'The following test suites were terminated because they ran '
+                'for longer than the maximum allowable time of 0.005 '
+                'minute(s) for each test suite: Test1\n\n'))
+        self.assertEqual(obs[2]['timed_out_test_suites'], ['Test1'])
+        self.assertEqual(obs[2]['timeouts'], [])
+
+        # The cluster isn't kept, since the test suite may still be running
+        # on it.
+        self.assertFalse(obs[2]['cluster_kept'])
+        self.assertEqual(obs[2]['cmd_records'][-1][0], 'teardown')
+
+    def test_execute_commands_and_build_email_retries(self):
+        """Test retrying the test suites that failed."""
+        tmp_dir = mkdtemp(prefix='clout_test_run')
+        try:
+            # Test2 fails the first time it is run, and Test3 every time.
+            marker_fp = join(tmp_dir, 'marker')
+            flaky_cmd = ('test -e %s || { touch %s; echo first; exit 1; }; '
+                         'echo second' % (marker_fp, marker_fp))
+            test_suites = [['Test1', 'echo foo', {}],
+                           ['Test2', flaky_cmd, {}],
+                           ['Test3', 'exit 3', {}],
+                           ['Test4', 'exit 4', {'retries': 0}]]
+            obs = _execute_commands_and_build_email(test_suites,
+                    ['echo setting up'],
+                    [test_suite[1] for test_suite in test_suites],
+                    ['echo tearing down'], 1, 1, 1, 'test-cluster-tag',
+                    node_assignments=['master', 'node001', 'master',
+                                      'node001'], retries=2)
+            self.assertEqual(obs[0],
+                'Test1: Pass\nTest2: Pass (flaky, passed on retry 1)\n'
+                'Test3: Fail\nTest4: Fail\n\n'
+                'The following test suites failed and then passed when they '
+                'were rerun on the same cluster, so their failures are likely '
+                'flaky: Test2 (passed on retry 1)\n\n'
+                'The following test suites failed every time they were run, '
+                'including when they were retried: Test3 (retried 2 '
+                'times)\n\n')
+            self.assertEqual(obs[2]['test_suite_results'],
+                             [('Test1', 0), ('Test2', 0), ('Test3', 3),
+                              ('Test4', 4)])
+            self.assertEqual(obs[2]['retried_test_suites'],
+                             {'Test2': 1, 'Test3': 2})
+            self.assertEqual(obs[2]['flaky_test_suites'], {'Test2': 1})
+            self.assertEqual([cmd_record[:2] + cmd_record[5:]
+                              for cmd_record in obs[2]['cmd_records']
+                              if cmd_record[0] in ('test_suite', 'retry')],
+                             [('test_suite', 'Test1', 0),
+                              ('test_suite', 'Test2', 1),
+                              ('test_suite', 'Test3', 3),
+                              ('test_suite', 'Test4', 4),
+                              ('retry', 'Test2', 0), ('retry', 'Test3', 3),
+                              ('retry', 'Test3', 3)])
+
+            # The retry's output follows the first run's in the log.
+            test2_log = dict(obs[1])['Test2_results.txt'].read()
+            self.assertTrue(test2_log.index('Stdout:\n\nfirst') <
+                            test2_log.index('Retry 1:\n\n') <
+                            test2_log.index('Stdout:\n\nsecond'))
+
+            # Nothing is retried when failing fast, or without retries.
+            obs = _execute_commands_and_build_email(test_suites[2:3],
+                    ['echo setting up'], ['exit 3'], ['echo tearing down'],
+                    1, 1, 1, 'test-cluster-tag', fail_fast=True, retries=2)
+            self.assertEqual(obs[0], 'Test3: Fail\n\n')
+            self.assertEqual(obs[2]['retried_test_suites'], {})
+            obs = _execute_commands_and_build_email(test_suites[2:3],
+                    ['echo setting up'], ['exit 3'], ['echo tearing down'],
+                    1, 1, 1, 'test-cluster-tag')
+            self.assertEqual(obs[0], 'Test3: Fail\n\n')
+
+            # Retries stop when the test suites run out of time.
+            obs = _execute_commands_and_build_email(
+                    [['Test1', 'sleep 0.8; exit 1']], ['echo setting up'],
+                    ['sleep 0.8; exit 1'], ['echo tearing down'], 1, 0.02,
+                    1, 'test-cluster-tag', retries=5)
+            self.assertEqual(obs[2]['retried_test_suites'], {'Test1': 1})
+            self.assertTrue('Test1: Fail\n\n' in obs[0])
+            self.assertTrue('was reached while retrying the test suites '
+                            'that failed' in obs[0])
+            self.assertEqual(obs[2]['timeouts'], [])
+        finally:
+            rmtree(tmp_dir)
+
+    def test_execute_commands_and_build_email_retries_local(self):
+        """Test retrying a test suite that failed on the local backend."""
+        tmp_dir = mkdtemp(prefix='clout_test_run')
+        try:
+            # The test suite fails the first time it is run. Each attempt
+            # must start in an empty working directory.
+            marker_fp = join(tmp_dir, 'marker')
+            flaky_cmd = ('test ! -e out || exit 2; touch out; test -e %s || '
+                         '{ touch %s; exit 1; }' % (marker_fp, marker_fp))
+            test_suites = [['Test1', flaky_cmd, {}]]
+            backend = LocalBackend(join(tmp_dir, 'work'))
+            setup_cmds, test_suites_cmds, teardown_cmds = \
+                    backend.build_commands(test_suites)
+
+            obs = _execute_commands_and_build_email(test_suites, setup_cmds,
+                    test_suites_cmds, teardown_cmds, 1, 1, 1,
+                    'test-cluster-tag', retries=2)
+            self.assertEqual(obs[0].split('\n\n')[0],
+                             'Test1: Pass (flaky, passed on retry 1)')
+            self.assertEqual(obs[2]['test_suite_results'], [('Test1', 0)])
+            self.assertEqual(obs[2]['retried_test_suites'], {'Test1': 1})
+            self.assertEqual(obs[2]['flaky_test_suites'], {'Test1': 1})
+
+            # A sharded test suite is flaky if one of its shards only passed
+            # when it was retried.
+            remove(marker_fp)
+            test_suites, shard_parents = _expand_shards(
+                    [['Test1', 'test $CLOUT_SHARD_INDEX = 0 || (%s)' %
+                      flaky_cmd, {'shards': 2}]])
+            setup_cmds, test_suites_cmds, teardown_cmds = \
+                    backend.build_commands(test_suites)
+            obs = _execute_commands_and_build_email(test_suites, setup_cmds,
+                    test_suites_cmds, teardown_cmds, 1, 1, 1,
+                    'test-cluster-tag', shard_parents=shard_parents,
+                    retries=2)
+            self.assertEqual(obs[0].split('\n\n')[0],
+                    'Test1: Pass (2 shards, flaky, passed on retry 1)')
+            self.assertEqual(obs[2]['retried_test_suites'],
+                             {'Test1.shard1': 1})
+        finally:
+            rmtree(tmp_dir)
+
+    def test_execute_commands_and_build_email_cluster_lost(self):
+        """Test replacing a cluster that was lost during the test suites."""
+        tmp_dir = mkdtemp(prefix='clout_test_')
+        try:
+            journal_dir = join(tmp_dir, 'journal')
+            marker_fp = join(tmp_dir, 'marker')
+            # Test2 loses its connection the first time it is run.
+            flaky_cmd = ('test -e %s && echo bar || (touch %s; exit 255)' %
+                         (marker_fp, marker_fp))
+            cluster_checks = []
+
+            def cluster_lost_fn(timeout):
+                cluster_checks.append(timeout)
+                return True
+
+            obs = _execute_commands_and_build_email(
+                [['Test1', 'echo foo'], ['Test2', flaky_cmd]],
+                ['echo setting up'],
+                ['echo foo', flaky_cmd],
+                ['echo tearing down'],
+                0.5, 1, 1, 'test-cluster-tag',
+                cluster_lost_fn=cluster_lost_fn, journal_dir=journal_dir)
+            self.assertEqual(obs[0], 'The cluster was lost while the test '
+                'suites were running (e.g. because its spot instances were '
+                'reclaimed). A replacement cluster was started to run the '
+                'test suites that didn\'t finish: Test2\n\n'
+                'Test1: Pass\nTest2: Pass\n\n')
+            self.assertEqual(cluster_checks, [0.5])
+            self.assertEqual(obs[2]['cluster_replacements'], 1)
+            self.assertEqual(obs[2]['cluster_lost'], False)
+            self.assertEqual([record[:2] for record in obs[2]['cmd_records']],
+                             [('setup', 'setup'), ('test_suite', 'Test1'),
+                              ('test_suite', 'Test2'),
+                              ('teardown', 'teardown'), ('setup', 'setup'),
+                              ('test_suite', 'Test2'),
+                              ('teardown', 'teardown')])
+
+            # The journal is removed once every test suite has finished.
+            self.assertFalse(exists(journal_dir))
+
+            # The cluster is never replaced more than twice.
+            obs = _execute_commands_and_build_email(
+                [['Test1', 'echo foo'], ['Test2', 'exit 255']],
+                ['echo setting up'],
+                ['echo foo', 'exit 255'],
+                ['echo tearing down'],
+                0.5, 1, 1, 'test-cluster-tag', keep_cluster=True,
+                cluster_lost_fn=cluster_lost_fn, journal_dir=journal_dir)
+            self.assertEqual(obs[0], 'The cluster was lost while the test '
+                'suites were running (e.g. because its spot instances were '
+                'reclaimed). A replacement cluster was started to run the '
+                'test suites that didn\'t finish: Test2\n\n' * 2 +
+                'The cluster was lost while the test suites were running '
+                '(e.g. because its spot instances were reclaimed). It has '
+                'already been replaced 2 time(s), so it wasn\'t replaced '
+                'again. The following test suites didn\'t finish: Test2\n\n'
+                'The results of the test suites that finished were saved, so '
+                'running clout again with --resume will only run the ones '
+                'that didn\'t.\n\nTest1: Pass\nTest2: Fail\n\n')
+            self.assertEqual(obs[2]['cluster_replacements'], 2)
+            self.assertEqual(obs[2]['cluster_lost'], True)
+            self.assertEqual(obs[2]['cluster_kept'], False)
+            self.assertTrue(exists(journal_dir))
+
+            # The next run only runs the test suite that didn't finish.
+            obs = _execute_commands_and_build_email(
+                [['Test1', 'echo foo'], ['Test2', 'echo bar']],
+                ['echo setting up'],
+                ['echo foo', 'echo bar'],
+                ['echo tearing down'],
+                0.5, 1, 1, 'test-cluster-tag',
+                cluster_lost_fn=cluster_lost_fn, journal_dir=journal_dir)
+            self.assertEqual(obs[0], 'The following test suites finished in '
+                'an earlier run whose cluster was lost, so they weren\'t run '
+                'again: Test1\n\nTest1: Pass (from an earlier run)\n'
+                'Test2: Pass\n\n')
+            self.assertEqual([record[1] for record in obs[2]['cmd_records']
+                              if record[0] == 'test_suite'], ['Test2'])
+            self.assertEqual([name for name, log_f in obs[1]],
+                             ['complete_log.txt', 'Test1_results.txt',
+                              'Test2_results.txt'])
+            self.assertEqual(obs[1][1][1].read(),
+                "Command:\n\necho foo\n\nStdout:\n\nfoo\n\nStderr:\n\n\n")
+            self.assertFalse(exists(journal_dir))
+
+            # Test suites that fail with a healthy cluster aren't rerun.
+            obs = _execute_commands_and_build_email(
+                [['Test1', 'exit 255']],
+                ['echo setting up'],
+                ['exit 255'],
+                ['echo tearing down'],
+                0.5, 1, 1, 'test-cluster-tag',
+                cluster_lost_fn=lambda timeout: False,
+                journal_dir=journal_dir)
+            self.assertEqual(obs[0], 'Test1: Fail\n\n')
+            self.assertEqual(obs[2]['cluster_replacements'], 0)
+        finally:
+            rmtree(tmp_dir)
+
+    def test_execute_commands_and_build_email_cluster_lost_timeout(self):
+        """Test running out of time while replacing a lost cluster."""
+        # Starting the replacement cluster takes longer than the time that
+        # is left for the test suites.
+        obs = _execute_commands_and_build_email(
+            [['Test1', 'echo foo'], ['Test2', 'exit 255']],
+            ['sleep 0.8'],
+            ['echo foo', 'exit 255'],
+            ['echo tearing down'],
+            0.5, 0.01, 1, 'test-cluster-tag',
+            cluster_lost_fn=lambda timeout: True)
+        self.assertEqual(obs[0], 'The cluster was lost while the test '
+            'suites were running (e.g. because its spot instances were '
+            'reclaimed). A replacement cluster was started, but there was no '
+            'time left to run the test suites that didn\'t finish on it.\n\n'
+            'Test1: Pass\nTest2: Fail\n\n'
+            'The maximum allowable time of 0.01 minute(s) for all test '
+            'suites to run was exceeded. The timeout occurred before any of '
+            'the remaining test suites had started. The following test '
+            'suites were not tested: Test2\n\n')
+        self.assertEqual(obs[2]['cluster_replacements'], 1)
+        self.assertEqual(obs[2]['timeouts'], ['test_suite'])
+        self.assertEqual(obs[2]['timed_out_test_suites'], [])
+        self.assertEqual([record[1] for record in obs[2]['cmd_records']
+                          if record[0] == 'test_suite'], ['Test1', 'Test2'])
+
+    def test_execute_commands_and_build_email_keep_cluster(self):
+        """Test functions correctly when the cluster is kept for reuse."""
+        obs = _execute_commands_and_build_email(
+            [['Test1', 'echo foo']],
+            ['echo setting up'],
+            ['echo foo'],
+            ['echo tearing down'],
+            1, 1, 1, 'test-cluster-tag', keep_cluster=True)
+        self.assertEqual(obs[0], "Test1: Pass\n\nThe cluster labelled with "
+                         "the tag 'test-cluster-tag' was left running so that "
+                         "it can be reused.\n\n")
+        self.assertEqual(obs[2]['cluster_kept'], True)
+        self.assertFalse('tearing down' in obs[1][0][1].read())
+
+        # The cluster is terminated if a test suite times out.
+        obs = _execute_commands_and_build_email(
+            [['Test1', 'sleep 5']],
+            ['echo setting up'],
+            ['sleep 5'],
+            ['echo tearing down'],
+            1, 0.01, 1, 'test-cluster-tag', keep_cluster=True)
+        self.assertEqual(obs[2]['cluster_kept'], False)
+        self.assertTrue('tearing down' in obs[1][0][1].read())
+
+        # The cluster is terminated if setup fails.
+        obs = _execute_commands_and_build_email(
+            [['Test1', 'echo foo']],
+            ['foobarbaz'],
+            ['echo foo'],
+            ['echo tearing down'],
+            1, 1, 1, 'test-cluster-tag', keep_cluster=True)
+        self.assertEqual(obs[2]['cluster_kept'], False)
+        self.assertTrue('tearing down' in obs[1][0][1].read())
+
 
 if __name__ == "__main__":
     main()
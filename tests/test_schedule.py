@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012-2013, The Clout Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPLv2"
+__version__ = "0.9-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+"""Test suite for the schedule.py module."""
+
+from unittest import main, TestCase
+
+from clout.schedule import schedule_test_suites
+
+class ScheduleTests(TestCase):
+    """Tests for the schedule.py module."""
+
+    def setUp(self):
+        """Define some sample data that will be used by the tests."""
+        self.test_suites = [['biom', 'b'], ['QIIME', 'q'], ['PyCogent', 'p'],
+                            ['PyNAST', 'n'], ['PICRUSt', 'r']]
+        self.durations = {'biom': 60, 'QIIME': 600, 'PyCogent': 300,
+                          'PyNAST': 200, 'PICRUSt': 250}
+
+    def test_schedule_test_suites_single_node(self):
+        """Test ordering test suites to run on a single node."""
+        obs = schedule_test_suites(self.test_suites, self.durations,
+                                   ['master'])
+        self.assertEqual(obs[0], [['QIIME', 'q'], ['PyCogent', 'p'],
+                                  ['PICRUSt', 'r'], ['PyNAST', 'n'],
+                                  ['biom', 'b']])
+        self.assertEqual(obs[1], ['master'] * 5)
+        self.assertEqual(obs[2], 1410)
+
+    def test_schedule_test_suites_multiple_nodes(self):
+        """Test placing test suites on multiple nodes."""
+        obs = schedule_test_suites(self.test_suites, self.durations,
+                                   ['master', 'node001'])
+        self.assertEqual([test_suite[0] for test_suite in obs[0]],
+                         ['QIIME', 'PyCogent', 'PICRUSt', 'PyNAST', 'biom'])
+        self.assertEqual(obs[1], ['master', 'node001', 'node001', 'node001',
+                                  'master'])
+        self.assertEqual(obs[2], 750)
+
+        # Two test suites at a time on each node.
+        obs = schedule_test_suites(self.test_suites, self.durations,
+                                   ['master', 'node001'], max_parallel=2)
+        self.assertEqual(obs[1], ['master', 'master', 'node001', 'node001',
+                                  'node001'])
+        self.assertEqual(obs[2], 600)
+
+    def test_schedule_test_suites_missing_durations(self):
+        """Test scheduling test suites that have no history."""
+        # Test suites with no history are assumed to take the average time.
+        obs = schedule_test_suites(self.test_suites,
+                                   {'QIIME': 600, 'biom': 100},
+                                   ['master', 'node001'])
+        self.assertEqual([test_suite[0] for test_suite in obs[0]],
+                         ['QIIME', 'PyCogent', 'PyNAST', 'PICRUSt', 'biom'])
+        self.assertEqual(obs[1], ['master', 'node001', 'node001', 'master',
+                                  'node001'])
+        self.assertEqual(obs[2], 950)
+
+        # No history at all keeps the original order.
+        obs = schedule_test_suites(self.test_suites, {}, ['master'])
+        self.assertEqual(obs, (self.test_suites, ['master'] * 5, 0))
+
+    def test_schedule_test_suites_no_test_suites(self):
+        """Test scheduling no test suites."""
+        self.assertEqual(schedule_test_suites([], {}, ['master']),
+                         ([], [], 0))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012-2013, The Clout Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPLv2"
+__version__ = "0.9-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+"""Test suite for the supervisor.py module."""
+
+from signal import SIGKILL, SIGTERM
+from threading import Timer
+from time import time
+from unittest import main, TestCase
+
+import clout.supervisor
+from clout.supervisor import CommandSupervisor
+
+class SupervisorTests(TestCase):
+    """Tests for the supervisor.py module."""
+
+    def setUp(self):
+        """Collect what the supervisor passes to its callbacks."""
+        self.started = []
+        self.output = {}
+        self.finished = []
+
+    def _start_callback(self, cmd_index):
+        self.started.append(cmd_index)
+
+    def _output_callback(self, cmd_index, stream_name, data):
+        key = (cmd_index, stream_name)
+        self.output[key] = self.output.get(key, '') + data
+
+    def _finish_callback(self, cmd_index, ret_val):
+        self.finished.append((cmd_index, ret_val))
+
+    def _make_supervisor(self, cmds, **kwargs):
+        return CommandSupervisor(cmds, start_callback=self._start_callback,
+                                 output_callback=self._output_callback,
+                                 finish_callback=self._finish_callback,
+                                 **kwargs)
+
+    def test_run(self):
+        """Test running commands one after another."""
+        supervisor = self._make_supervisor(['echo foo', 'echo bar 1>&2',
+                                            'exit 3'])
+        self.assertEqual(supervisor.run(), True)
+
+        self.assertEqual(self.started, [0, 1, 2])
+        self.assertEqual(self.finished, [(0, 0), (1, 0), (2, 3)])
+        self.assertEqual(self.output, {(0, 'stdout'): 'foo\n',
+                                       (1, 'stderr'): 'bar\n'})
+        self.assertEqual(supervisor.ret_vals, [0, 0, 3])
+        self.assertEqual(supervisor.timed_out_cmds, [])
+        self.assertEqual(supervisor.cancelled_cmds, [])
+
+        for start_time, end_time in zip(supervisor.start_times,
+                                        supervisor.end_times):
+            self.assertTrue(start_time <= end_time)
+        self.assertTrue(supervisor.end_times[0] <=
+                        supervisor.start_times[1])
+
+    def test_run_no_cmds(self):
+        """Test running nothing."""
+        supervisor = self._make_supervisor([])
+        self.assertEqual(supervisor.run(), True)
+        self.assertEqual(supervisor.ret_vals, [])
+
+    def test_run_queues(self):
+        """Test that separate queues run at the same time."""
+        cmds = ['sleep 0.3', 'sleep 0.3', 'echo foo', 'echo bar']
+        supervisor = self._make_supervisor(cmds, queues=[[0, 2], [1, 3]])
+
+        start = time()
+        self.assertEqual(supervisor.run(), True)
+        self.assertTrue(time() - start < 0.55)
+
+        # Commands in a queue still run in order.
+        self.assertTrue(supervisor.end_times[0] <=
+                        supervisor.start_times[2])
+        self.assertTrue(supervisor.end_times[1] <=
+                        supervisor.start_times[3])
+        self.assertEqual(supervisor.ret_vals, [0, 0, 0, 0])
+
+    def test_run_max_parallel(self):
+        """Test running several commands from one queue at a time."""
+        cmds = ['sleep 0.3'] * 4
+        supervisor = self._make_supervisor(cmds, max_parallel=2)
+
+        start = time()
+        self.assertEqual(supervisor.run(), True)
+        elapsed = time() - start
+        self.assertTrue(0.55 < elapsed < 0.85)
+        self.assertEqual(self.started, [0, 1, 2, 3])
+
+    def test_run_invalid_max_parallel(self):
+        """Test running with an invalid max_parallel."""
+        supervisor = self._make_supervisor(['echo foo'], max_parallel=0)
+        self.assertRaises(ValueError, supervisor.run)
+
+    def test_run_streams_output(self):
+        """Test that output is handed over before the command exits."""
+        seen_before_exit = []
+
+        def output_callback(cmd_index, stream_name, data):
+            seen_before_exit.append(supervisor.ret_vals[cmd_index] is None)
+
+        supervisor = CommandSupervisor(['echo foo; sleep 0.2; echo bar'],
+                                       output_callback=output_callback)
+        supervisor.run()
+        self.assertEqual(seen_before_exit, [True, True])
+
+    def test_run_large_output(self):
+        """Test commands that write more output than a pipe can hold."""
+        supervisor = self._make_supervisor(
+                ["head -c 1000000 /dev/zero | tr '\\0' a",
+                 "head -c 1000000 /dev/zero | tr '\\0' b 1>&2"],
+                queues=[[0], [1]])
+        self.assertEqual(supervisor.run(), True)
+        self.assertEqual(self.output, {(0, 'stdout'): 'a' * 1000000,
+                                       (1, 'stderr'): 'b' * 1000000})
+
+    def test_run_timeout(self):
+        """Test reaching the timeout for all of the commands."""
+        supervisor = self._make_supervisor(['echo foo', 'sleep 10',
+                                            'echo bar'])
+
+        start = time()
+        self.assertEqual(supervisor.run(0.005), False)
+        self.assertTrue(time() - start < 2)
+
+        self.assertEqual(supervisor.timed_out_cmds, [1])
+        self.assertEqual(supervisor.ret_vals, [0, -SIGTERM, None])
+        self.assertEqual(self.started, [0, 1])
+        self.assertEqual(self.finished, [(0, 0), (1, -SIGTERM)])
+
+    def test_run_cmd_timeout(self):
+        """Test reaching the timeout for individual commands."""
+        supervisor = self._make_supervisor(['sleep 10', 'echo foo',
+                                            'sleep 10'], cmd_timeout=0.005)
+
+        start = time()
+        self.assertEqual(supervisor.run(), True)
+        self.assertTrue(time() - start < 2)
+
+        # The commands after a timed out command are still run.
+        self.assertEqual(supervisor.timed_out_cmds, [0, 2])
+        self.assertEqual(supervisor.ret_vals, [-SIGTERM, 0, -SIGTERM])
+
+    def test_run_kills_unresponsive_cmds(self):
+        """Test killing commands that ignore SIGTERM."""
+        old_grace_period = clout.supervisor.KILL_GRACE_PERIOD
+        clout.supervisor.KILL_GRACE_PERIOD = 0.2
+        try:
+            supervisor = self._make_supervisor(
+                    ["trap '' TERM; echo ready; while true; do sleep 0.05; "
+                     "done"], cmd_timeout=0.005)
+            start = time()
+            supervisor.run()
+            elapsed = time() - start
+        finally:
+            clout.supervisor.KILL_GRACE_PERIOD = old_grace_period
+
+        self.assertTrue(0.5 < elapsed < 2)
+        self.assertEqual(supervisor.timed_out_cmds, [0])
+        self.assertEqual(supervisor.ret_vals, [-SIGKILL])
+
+    def test_stop(self):
+        """Test stopping from a callback."""
+        def finish_callback(cmd_index, ret_val):
+            self.finished.append((cmd_index, ret_val))
+            if ret_val != 0:
+                supervisor.stop()
+
+        supervisor = CommandSupervisor(['exit 1', 'sleep 0.3', 'echo foo',
+                                        'echo bar'], queues=[[0, 3], [1, 2]],
+                                       finish_callback=finish_callback)
+        self.assertEqual(supervisor.run(), True)
+
+        # The running command finished on its own, and nothing else started.
+        self.assertEqual(self.finished, [(0, 1), (1, 0)])
+        self.assertEqual(supervisor.ret_vals, [1, 0, None, None])
+        self.assertEqual(supervisor.cancelled_cmds, [])
+
+    def test_cancel(self):
+        """Test cancelling from a callback."""
+        def finish_callback(cmd_index, ret_val):
+            self.finished.append((cmd_index, ret_val))
+            if ret_val != 0:
+                supervisor.cancel()
+
+        supervisor = CommandSupervisor(['sleep 0.1; exit 1', 'sleep 10',
+                                        'echo foo'], queues=[[0], [1, 2]],
+                                       finish_callback=finish_callback)
+        start = time()
+        self.assertEqual(supervisor.run(), True)
+        self.assertTrue(time() - start < 2)
+
+        self.assertEqual(self.finished, [(0, 1), (1, -SIGTERM)])
+        self.assertEqual(supervisor.cancelled_cmds, [1])
+        self.assertEqual(supervisor.timed_out_cmds, [])
+        self.assertEqual(supervisor.ret_vals, [1, -SIGTERM, None])
+
+    def test_cancel_from_another_thread(self):
+        """Test cancelling while the event loop is waiting."""
+        supervisor = self._make_supervisor(['sleep 10', 'sleep 10'],
+                                           queues=[[0], [1]])
+        timer = Timer(0.2, supervisor.cancel)
+        timer.start()
+        try:
+            start = time()
+            self.assertEqual(supervisor.run(), True)
+            self.assertTrue(time() - start < 2)
+        finally:
+            timer.cancel()
+
+        self.assertEqual(supervisor.cancelled_cmds, [0, 1])
+        self.assertEqual(supervisor.ret_vals, [-SIGTERM, -SIGTERM])
+
+    def test_cancel_terminates_child_processes(self):
+        """Test that cancelling terminates the commands' children too."""
+        supervisor = self._make_supervisor(['sleep 10 & sleep 10; wait'])
+        timer = Timer(0.2, supervisor.cancel)
+        timer.start()
+        try:
+            start = time()
+            supervisor.run()
+            self.assertTrue(time() - start < 2)
+        finally:
+            timer.cancel()
+        self.assertEqual(supervisor.cancelled_cmds, [0])
+
+
+if __name__ == "__main__":
+    main()
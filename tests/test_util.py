@@ -11,11 +11,19 @@ __email__ = "jai.rideout@gmail.com"
 
 """Test suite for the util.py module."""
 
+from email import message_from_file
+from gzip import GzipFile
+from random import Random
 from re import sub
+from smtplib import SMTPDataError, SMTPException, SMTPRecipientsRefused
 from tempfile import TemporaryFile
+from time import time
 from unittest import main, TestCase
 
-from clout.util import CommandExecutor
+from clout.static import ELISION_MARKER
+from clout.util import (CommandExecutor, compress_attachments, send_email,
+                        _send_message_file, write_email)
+from smtp_sink import SMTPSink
 
 class UtilTests(TestCase):
     """Tests for the util.py module."""
@@ -56,6 +64,25 @@ class UtilTests(TestCase):
         obs = sub('Stderr:\n\n.*\n\n', 'Stderr:\n\n\n\n', log_f.read())
         self.assertEqual(obs, exp)
 
+    def test_CommandExecutor_cmd_records(self):
+        """Test recording when each command ran and its return code."""
+        log_f = TemporaryFile(prefix=self.prefix, suffix='.txt')
+        cmd_exec = CommandExecutor(['sleep 0.2', 'foobarbaz', 'echo foo'],
+                                   log_f, stop_on_first_failure=True)
+        before = time()
+        cmd_exec(1)
+        after = time()
+
+        self.assertEqual(len(cmd_exec.cmd_records), 3)
+        start_time, end_time, ret_val = cmd_exec.cmd_records[0]
+        self.assertEqual(ret_val, 0)
+        self.assertTrue(before <= start_time)
+        self.assertTrue(end_time - start_time >= 0.2)
+        start_time, end_time, ret_val = cmd_exec.cmd_records[1]
+        self.assertEqual(ret_val, 127)
+        self.assertTrue(end_time <= after)
+        self.assertEqual(cmd_exec.cmd_records[2], None)
+
     def test_CommandExecutor_stop_on_first_failure(self):
         """Test executing arbitrary commands and stopping on first failure."""
         # All commands succeed.
@@ -161,6 +188,301 @@ class UtilTests(TestCase):
         log_obs = log_f.read()
         self.assertEqual(log_obs, exp)
 
+    def test_CommandExecutor_queue_ids(self):
+        """Test running queues of commands at the same time."""
+        # Each queue takes about two seconds, so running the queues one after
+        # another would exceed the timeout.
+        log_f = TemporaryFile(prefix=self.prefix, suffix='.txt')
+        cmd_exec = CommandExecutor(['sleep 1 && echo foo', 'echo bar',
+                                    'sleep 1 && echo baz', 'sleep 2'],
+                                   log_f, log_individual_cmds=True,
+                                   queue_ids=['a', 'b', 'a', 'c'])
+        obs = cmd_exec(0.05)
+        self.assertEqual(obs[0], True)
+        self.assertEqual([ret_val for log_f, ret_val in obs[1]], [0, 0, 0, 0])
+        self.assertEqual(cmd_exec.timed_out_cmds, [])
+
+        # Individual logs are in the same order as the commands.
+        log_f = obs[1][2][0]
+        log_f.seek(0, 0)
+        self.assertEqual(log_f.read(), "Command:\n\nsleep 1 && echo baz\n\n"
+                         "Stdout:\n\nbaz\n\nStderr:\n\n\n")
+
+        # A timeout terminates the running commands in every queue.
+        log_f = TemporaryFile(prefix=self.prefix, suffix='.txt')
+        cmd_exec = CommandExecutor(['sleep 5', 'echo foo', 'sleep 5',
+                                    'echo bar'], log_f,
+                                   log_individual_cmds=True,
+                                   queue_ids=['a', 'b', 'b', 'a'])
+        obs = cmd_exec(0.01)
+        self.assertEqual(obs[0], None)
+        self.assertEqual(len(obs[1]), 3)
+        self.assertNotEqual(obs[1][0][1], 0)
+        self.assertEqual(obs[1][1][1], 0)
+        self.assertNotEqual(obs[1][2][1], 0)
+        self.assertEqual(cmd_exec.timed_out_cmds, [0, 2])
+
+    def test_CommandExecutor_max_parallel(self):
+        """Test running several commands from the same queue at once."""
+        # Running these commands one after another would exceed the timeout.
+        log_f = TemporaryFile(prefix=self.prefix, suffix='.txt')
+        cmd_exec = CommandExecutor(['sleep 1 && echo foo', 'sleep 1',
+                                    'sleep 1 && echo bar'], log_f,
+                                   log_individual_cmds=True, max_parallel=3)
+        obs = cmd_exec(0.04)
+        self.assertEqual(obs[0], True)
+        self.assertEqual([ret_val for log_f, ret_val in obs[1]], [0, 0, 0])
+
+        log_f = obs[1][2][0]
+        log_f.seek(0, 0)
+        self.assertEqual(log_f.read(), "Command:\n\nsleep 1 && echo bar\n\n"
+                         "Stdout:\n\nbar\n\nStderr:\n\n\n")
+
+        # Commands that are already running are allowed to finish after a
+        # failure, but no new commands are started.
+        log_f = TemporaryFile(prefix=self.prefix, suffix='.txt')
+        cmd_exec = CommandExecutor(['foobarbaz', 'sleep 1', 'echo foo'],
+                                   log_f, stop_on_first_failure=True,
+                                   log_individual_cmds=True, max_parallel=2)
+        obs = cmd_exec(1)
+        self.assertEqual(obs[0], False)
+        self.assertEqual([ret_val for log_f, ret_val in obs[1]], [127, 0])
+
+        # A timeout terminates all running commands.
+        log_f = TemporaryFile(prefix=self.prefix, suffix='.txt')
+        cmd_exec = CommandExecutor(['sleep 5', 'sleep 5', 'echo foo'], log_f,
+                                   log_individual_cmds=True, max_parallel=2)
+        obs = cmd_exec(0.01)
+        self.assertEqual(obs[0], None)
+        self.assertEqual(len(obs[1]), 2)
+        self.assertEqual(cmd_exec.timed_out_cmds, [0, 1])
+
+        # Invalid number of commands to run in parallel.
+        cmd_exec = CommandExecutor(['echo foo'], log_f, max_parallel=0)
+        self.assertRaises(ValueError, cmd_exec, 1)
+
+    def test_CommandExecutor_large_output(self):
+        """Test logging commands that write a lot of output."""
+        cmd = ("head -c 3000000 /dev/zero | tr '\\0' a && "
+               "head -c 1000000 /dev/zero | tr '\\0' b 1>&2")
+        log_f = TemporaryFile(prefix=self.prefix, suffix='.txt')
+        cmd_exec = CommandExecutor([cmd], log_f, log_individual_cmds=True)
+        obs = cmd_exec(1)
+        self.assertEqual(obs[0], True)
+
+        exp = ("Command:\n\n%s\n\nStdout:\n\n%s\nStderr:\n\n%s\n" %
+               (cmd, 'a' * 3000000, 'b' * 1000000))
+        log_f.seek(0, 0)
+        self.assertEqual(log_f.read(), exp)
+        individual_log_f = obs[1][0][0]
+        individual_log_f.seek(0, 0)
+        self.assertEqual(individual_log_f.read(), exp)
+
+    def test_CommandExecutor_cmd_timeout(self):
+        """Test terminating commands that run for too long."""
+        log_f = TemporaryFile(prefix=self.prefix, suffix='.txt')
+        cmd_exec = CommandExecutor(['sleep 10', 'echo foo'], log_f,
+                                   cmd_timeout=0.005)
+        start = time()
+        obs = cmd_exec(1)
+        self.assertTrue(time() - start < 2)
+
+        # The timed out command fails, but the next command still runs.
+        self.assertEqual(obs, (False, []))
+        self.assertEqual(cmd_exec.timed_out_cmds, [0])
+        self.assertEqual(cmd_exec.cmd_records[0][2], -15)
+        self.assertEqual(cmd_exec.cmd_records[1][2], 0)
+
+    def test_CommandExecutor_cancel_on_first_failure(self):
+        """Test terminating the running commands on the first failure."""
+        log_f = TemporaryFile(prefix=self.prefix, suffix='.txt')
+        cmd_exec = CommandExecutor(['sleep 10', 'sleep 0.1; exit 2',
+                                    'echo foo', 'echo bar'], log_f,
+                                   log_individual_cmds=True,
+                                   queue_ids=['a', 'b', 'b', 'a'],
+                                   cancel_on_first_failure=True)
+        start = time()
+        obs = cmd_exec(1)
+        self.assertTrue(time() - start < 2)
+
+        self.assertEqual(obs[0], False)
+        self.assertEqual([cmd_status[1] for cmd_status in obs[1]], [-15, 2])
+        self.assertEqual(cmd_exec.first_failed_cmd, 1)
+        self.assertEqual(cmd_exec.cancelled_cmds, [0])
+        self.assertEqual(cmd_exec.timed_out_cmds, [])
+        self.assertEqual(cmd_exec.cmd_records[2:], [None, None])
+
+        # Nothing is cancelled if every command succeeds.
+        cmd_exec.cmds = ['echo foo', 'echo bar']
+        cmd_exec.queue_ids = None
+        self.assertEqual(cmd_exec(1)[0], True)
+        self.assertEqual(cmd_exec.first_failed_cmd, None)
+        self.assertEqual(cmd_exec.cancelled_cmds, [])
+
+    def test_CommandExecutor_invalid_queue_ids(self):
+        """Test passing a mismatched number of queue IDs."""
+        log_f = TemporaryFile(prefix=self.prefix, suffix='.txt')
+        cmd_exec = CommandExecutor(['echo foo', 'echo bar'], log_f,
+                                   queue_ids=['a'])
+        self.assertRaises(ValueError, cmd_exec, 1)
+
+    def test_compress_attachments(self):
+        """Test compressing attachments without a size limit."""
+        attachments = [('foo.txt', self._make_file('foo\n' * 1000)),
+                       ('bar.txt', self._make_file(''))]
+        obs = compress_attachments(attachments)
+        self.assertEqual([name for name, f in obs[0]],
+                         ['foo.txt.gz', 'bar.txt.gz'])
+        self.assertEqual(GzipFile(mode='rb', fileobj=obs[0][0][1]).read(),
+                         'foo\n' * 1000)
+        self.assertEqual(GzipFile(mode='rb', fileobj=obs[0][1][1]).read(), '')
+        self.assertEqual(obs[1]['uncompressed_size'], 4000)
+        self.assertTrue(obs[1]['compressed_size'] < 200)
+        self.assertEqual(obs[1]['truncated'], [])
+
+        # The original files are closed.
+        self.assertTrue(attachments[0][1].closed)
+
+    def test_compress_attachments_max_size(self):
+        """Test truncating attachments to fit within a size limit."""
+        # Random data doesn't compress, which makes the sizes predictable.
+        rand = Random(42)
+        big_data = ''.join([chr(rand.randint(0, 255))
+                            for i in range(100000)])
+        attachments = [('small.txt', self._make_file('small\n')),
+                       ('big1.txt', self._make_file(big_data)),
+                       ('big2.txt', self._make_file(big_data[:50000]))]
+        obs = compress_attachments(attachments, 40000)
+        self.assertEqual(obs[1]['uncompressed_size'], 150006)
+        self.assertEqual(obs[1]['truncated'], ['big1.txt', 'big2.txt'])
+        self.assertTrue(obs[1]['compressed_size'] < 40000 * 1.05)
+
+        self.assertEqual(GzipFile(mode='rb', fileobj=obs[0][0][1]).read(),
+                         'small\n')
+
+        # The beginning and end of the log are kept.
+        obs_data = GzipFile(mode='rb', fileobj=obs[0][1][1]).read()
+        self.assertTrue(10000 < len(obs_data) < 30000)
+        head, tail = obs_data.split('\n\n[... ', 1)
+        tail = tail.split(' ...]\n\n', 1)[1]
+        self.assertEqual(head, big_data[:len(head)])
+        self.assertEqual(tail, big_data[-len(tail):])
+        self.assertEqual(len(obs_data),
+                len(head) + len(tail) +
+                len(ELISION_MARKER % (100000 - len(head) - len(tail))))
+
+    def test_write_email(self):
+        """Test writing an email message with attachments to a file."""
+        rand = Random(42)
+        data = ''.join([chr(rand.randint(0, 255)) for i in range(200000)])
+        msg_f = TemporaryFile(prefix='clout_test_', suffix='.eml')
+        write_email(msg_f, 'foo@bar.baz', ['a@b.c', 'd@e.f'], 'Results',
+                    'QIIME: Pass\n.\n', [('data.gz', self._make_file(data)),
+                                          ('empty.txt', self._make_file(''))])
+        msg_f.seek(0, 0)
+
+        msg = message_from_file(msg_f)
+        self.assertEqual(msg['From'], 'foo@bar.baz')
+        self.assertEqual(msg['To'], 'a@b.c, d@e.f')
+        self.assertEqual(msg['Subject'], 'Results')
+        self.assertTrue(msg['Date'] is not None)
+
+        parts = msg.get_payload()
+        self.assertEqual(len(parts), 3)
+        self.assertEqual(parts[0].get_content_type(), 'text/plain')
+        self.assertEqual(parts[0].get_payload(decode=True),
+                         'QIIME: Pass\n.\n')
+        self.assertEqual(parts[1].get_filename(), 'data.gz')
+        self.assertEqual(parts[1].get_payload(decode=True), data)
+        self.assertEqual(parts[2].get_filename(), 'empty.txt')
+        self.assertEqual(parts[2].get_payload(decode=True), '')
+
+        # Base64-encoded lines are the standard length.
+        self.assertEqual(max([len(line) for line in
+                              parts[1].get_payload().split('\n')]), 76)
+
+    def test_send_message_file(self):
+        """Test streaming a message to an SMTP server."""
+        msg_f = self._make_file('Subject: foo\n\nbar\n.baz\n')
+        server = FakeSMTP()
+        obs = _send_message_file(server, 'foo@bar.baz', ['a@b.c', 'bad'],
+                                 msg_f)
+        self.assertEqual(obs, {'bad': (550, 'No such user')})
+        self.assertEqual(server.cmds, ['mail foo@bar.baz', 'rcpt a@b.c',
+                                       'rcpt bad', 'data'])
+        self.assertEqual(''.join(server.sent),
+                         'Subject: foo\r\n\r\nbar\r\n..baz\r\n.\r\n')
+
+        # All recipients refused.
+        server = FakeSMTP()
+        msg_f.seek(0, 0)
+        self.assertRaises(SMTPRecipientsRefused, _send_message_file, server,
+                          'foo@bar.baz', ['bad'], msg_f)
+        self.assertEqual(server.cmds[-1], 'rset')
+
+        # Message rejected.
+        server = FakeSMTP(data_code=554)
+        msg_f.seek(0, 0)
+        self.assertRaises(SMTPDataError, _send_message_file, server,
+                          'foo@bar.baz', ['a@b.c'], msg_f)
+
+    def test_send_email_starttls(self):
+        """Test that the email isn't sent without STARTTLS by default."""
+        smtp_sink = SMTPSink()
+        smtp_sink.start()
+        try:
+            self.assertRaises(SMTPException, send_email, smtp_sink.host,
+                              smtp_sink.port, 'foo@bar.baz', 'secret',
+                              ['a@b.c'], 'Subject', 'Body')
+            self.assertEqual(smtp_sink.messages, [])
+
+            # Sending without encryption has to be allowed explicitly.
+            send_email(smtp_sink.host, smtp_sink.port, 'foo@bar.baz',
+                       'secret', ['a@b.c'], 'Subject', 'Body', insecure=True)
+            self.assertEqual([message[:2] for message in smtp_sink.messages],
+                             [('foo@bar.baz', ['a@b.c'])])
+        finally:
+            smtp_sink.stop()
+
+    def _make_file(self, data):
+        """Returns a TemporaryFile containing data."""
+        f = TemporaryFile(prefix='clout_test_', suffix='.txt')
+        f.write(data)
+        f.seek(0, 0)
+        return f
+
+
+class FakeSMTP(object):
+    """Stands in for an SMTP connection, recording what is sent to it."""
+
+    def __init__(self, data_code=250):
+        self.cmds = []
+        self.sent = []
+        self.data_code = data_code
+
+    def mail(self, sender):
+        self.cmds.append('mail %s' % sender)
+        return 250, 'OK'
+
+    def rcpt(self, recipient):
+        self.cmds.append('rcpt %s' % recipient)
+        if recipient == 'bad':
+            return 550, 'No such user'
+        return 250, 'OK'
+
+    def docmd(self, cmd):
+        self.cmds.append(cmd)
+        return 354, 'Go ahead'
+
+    def send(self, data):
+        self.sent.append(data)
+
+    def getreply(self):
+        return self.data_code, 'Done'
+
+    def rset(self):
+        self.cmds.append('rset')
+
 
 if __name__ == "__main__":
     main()